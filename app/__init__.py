@@ -23,9 +23,13 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     app.config['JSON_AS_ASCII'] = False
+    # pool / connect_args ตาม dialect (ค่าที่ตั้งเองใน config มาก่อน)
+    from app.db_profile import configure_database, engine_options
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
 
     # 2. ผูก Extensions กับ app ที่สร้างขึ้น
     db.init_app(app)
+    configure_database(app, db) # PRAGMA ของ SQLite (WAL, synchronous, busy_timeout, ...) ทุก connection
     migrate.init_app(app, db)
     login.init_app(app)
     csrf.init_app(app)
@@ -118,6 +122,12 @@ def create_app(config_class=Config):
         # (แม้ว่า blueprints ต่างๆ จะ import ไปแล้วก็ตาม นี่คือการการันตี)
         from app import models 
         db.create_all()
+        # ตาราง FTS5 / pg_trgm index ของการค้นหาตัวชี้วัด (create_all ไม่รู้จัก)
+        from app.indicator_search import ensure_indicator_search_index
+        ensure_indicator_search_index()
+        # ดัชนีค้นหารวม (นักเรียน/บุคลากร/วิชา/ห้อง/แผนการสอน)
+        from app.global_search import ensure_global_search_index
+        ensure_global_search_index()
     # --- [END FIX] ---
 
     return app
\ No newline at end of file
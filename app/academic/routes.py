@@ -1,7 +1,6 @@
 # FILE: app/academic/routes.py
 from collections import defaultdict
 from datetime import datetime
-import random, json
 from sqlite3 import IntegrityError
 from statistics import StatisticsError, mode
 from flask import current_app, jsonify, redirect, render_template, abort, flash, request, url_for
@@ -9,13 +8,19 @@ from flask_login import login_required, current_user
 from flask_wtf import FlaskForm
 from flask_wtf.csrf import generate_csrf, validate_csrf, CSRFError
 from sqlalchemy.orm import joinedload, selectinload
-from sqlalchemy import and_, func, inspect, or_
+from sqlalchemy import and_, func, inspect, or_, update
 from app.academic import bp
 from app import db
 from app.models import (AcademicYear, AdvisorAssessmentRecord, AdvisorAssessmentScore, AssessmentItem, AssessmentTemplate, AssessmentTopic, Classroom, Course, CourseGrade, Curriculum, Enrollment, GradeLevel, GradedItem, Indicator, Notification, RepeatCandidate, Role,
                         LessonPlan, LearningUnit, Room, Semester, Student, TimeSlot, Standard, 
-                        Subject, TimetableEntry, User, SubjectGroup, WeeklyScheduleSlot, QualitativeScore)
-from app.services import calculate_final_grades_for_course, calculate_grade_statistics, check_graduation_readiness, log_action
+                        Subject, TimetableEntry, User, SubjectGroup, WeeklyScheduleSlot, QualitativeScore,
+                        bump_timetable_version)
+from app.services import calculate_final_grades_for_course, calculate_grade_statistics, check_graduation_readiness_batch, log_action
+from app.jobs import start_job
+from app.materialized_timetables import OWNER_TEACHER, get_weekly_timetable
+from app.timetable_index import advance_conflict_index, get_conflict_index, get_timetable_payload
+from app.timetable_solver import (DEFAULT_STARTS, DEFAULT_TIME_BUDGET, TimetableSolver, build_timetable_snapshot,
+                                  find_target_course_ids, run_timetable_search, save_timetable_solution)
 from . import bp
 
 @bp.route('/dashboard')
@@ -489,84 +494,35 @@ def approve_final(plan_id):
 @bp.route('/timetable/manage/<int:semester_id>')
 @login_required
 def manage_timetable(semester_id):
+    """[REVISED] หน้าเปล่า: ข้อมูลตารางโหลดจาก academic.timetable_data (cache ตาม timetable_version)"""
     semester = Semester.query.get_or_404(semester_id)
-    
-    all_classrooms = Classroom.query.filter_by(academic_year_id=semester.academic_year_id).order_by(Classroom.name).all()
-    all_teachers = User.query.filter(User.roles.any(Role.name == 'Teacher')).order_by(User.first_name).all()
-    all_rooms = Room.query.order_by(Room.name).all()
-
-    # --- START: ส่วนที่แก้ไข ---
-    all_courses = Course.query.filter_by(semester_id=semester_id).options(
-        joinedload(Course.subject), 
-        joinedload(Course.classroom),
-        joinedload(Course.teachers), 
-        joinedload(Course.room),
-        joinedload(Course.lesson_plan).selectinload(LessonPlan.constraints) # ดึง Constraints มาด้วย
-    ).all()
-    
-    courses_data = []
-    for c in all_courses:
-        constraints = {}
-        manual_notes = None
-        if c.lesson_plan:
-            constraints = {const.constraint_type: const.value for const in c.lesson_plan.constraints}
-            manual_notes = c.lesson_plan.manual_scheduling_notes
-        
-        courses_data.append({
-            'id': c.id, 
-            'subject_name': f"{c.subject.subject_code} - {c.subject.name}",
-            'classroom_id': c.classroom_id, 
-            'classroom_name': c.classroom.name,
-            'teacher_ids': [t.id for t in c.teachers],
-            'teachers_name': [t.full_name for t in c.teachers],
-            'room_id': c.room_id, 
-            'room_name': c.room.name if c.room else 'N/A',
-            'periods_needed': int((c.subject.credit or 0) * 2),
-            'constraints': constraints, # เพิ่มข้อมูลเงื่อนไข
-            'manual_notes': manual_notes # <--- เพิ่มข้อมูลบันทึกส่วนตัว
-        })
-    # --- END: ส่วนที่แก้ไข ---
-
-    all_entries = TimetableEntry.query.join(WeeklyScheduleSlot).filter(
-        WeeklyScheduleSlot.semester_id == semester_id
-    ).options(
-        joinedload(TimetableEntry.course).selectinload(Course.subject),
-        joinedload(TimetableEntry.course).selectinload(Course.classroom),
-        joinedload(TimetableEntry.course).selectinload(Course.teachers),
-        joinedload(TimetableEntry.course).selectinload(Course.room),
-        joinedload(TimetableEntry.slot)
-    ).all()
-
-    all_slots = WeeklyScheduleSlot.query.filter_by(semester_id=semester_id).all()
-    
-    entries_data = [{
-        'id': e.id,
-        'day': e.slot.day_of_week, 
-        'period': e.slot.period_number,
-        'course': next((c for c in courses_data if c['id'] == e.course_id), None)
-    } for e in all_entries]
-
-    slots_data = [
-        {'id': s.id, 'day': s.day_of_week, 'period': s.period_number, 'is_teaching': s.is_teaching_period, 
-         'activity': s.activity_name, 'grade_level_id': s.grade_level_id} 
-        for s in all_slots
-    ]
-
     form = FlaskForm()
 
     return render_template(
         'academic/manage_timetable.html',
         title='จัดตารางสอน',
         semester=semester,
-        all_classrooms_json=json.dumps([{'id': c.id, 'name': c.name, 'grade_level_id': c.grade_level_id} for c in all_classrooms]),
-        all_teachers_json=json.dumps([{'id': t.id, 'name': t.full_name} for t in all_teachers]),
-        all_rooms_json=json.dumps([{'id': r.id, 'name': r.name} for r in all_rooms]),
-        all_courses_json=json.dumps(courses_data),
-        all_entries_json=json.dumps(entries_data),
-        all_slots_json=json.dumps(slots_data),
         form=form
     )
 
+@bp.route('/api/timetable/<int:semester_id>/data')
+@login_required
+def timetable_data(semester_id):
+    """
+    [NEW] Courses (keyed by id), entries (course ids only), slots and filter
+    lists for manage_timetable. The serialized body is cached per
+    Semester.timetable_version and revalidated with an ETag, so reopening the
+    page or another tab only costs one version lookup.
+    """
+    cached = get_timetable_payload(semester_id)
+    if cached is None:
+        abort(404)
+    version, body = cached
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(f"timetable-{semester_id}-v{version}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 @bp.route('/timetable/my-schedule')
 @login_required
 def teacher_timetable():
@@ -575,30 +531,18 @@ def teacher_timetable():
 
     semester = Semester.query.filter_by(is_current=True).first_or_404()
 
-    # 1. Fetch all timetable entries for the current semester with necessary details
-    all_entries = TimetableEntry.query.join(WeeklyScheduleSlot).filter(
-        WeeklyScheduleSlot.semester_id == semester.id
-    ).options(
-        joinedload(TimetableEntry.slot),
-        joinedload(TimetableEntry.course).selectinload(Course.subject),
-        joinedload(TimetableEntry.course).selectinload(Course.classroom),
-        joinedload(TimetableEntry.course).selectinload(Course.teachers),
-        joinedload(TimetableEntry.course).selectinload(Course.room)
-    ).all()
+    # 1. [REVISED] ตารางสอนของครูที่คำนวณไว้แล้ว (query เดียว แทนการโหลดทุกคาบของภาคเรียนแล้วกรองใน Python)
+    timetable = get_weekly_timetable(semester.id, OWNER_TEACHER, current_user.id)
 
-    # 2. Filter entries for the current user
-    my_entries = [entry for entry in all_entries if current_user in entry.course.teachers]
-
-    # 3. Structure data for the grid
+    # 2. Structure data for the grid
     schedule_grid = defaultdict(lambda: None)
-    for entry in my_entries:
-        key = f"{entry.slot.day_of_week}-{entry.slot.period_number}"
-        # --- MODIFIED SECTION ---
+    for cell in timetable['cells']:
+        key = f"{cell['day']}-{cell['period']}"
         schedule_grid[key] = {
-            'entry_id': entry.id, # ADD THIS LINE
-            'subject_name': entry.course.subject.subject_code,
-            'classroom_name': entry.course.classroom.name,
-            'room_name': entry.course.room.name if entry.course.room else 'N/A'
+            'entry_id': cell['entry_id'],
+            'subject_name': cell['subject_code'],
+            'classroom_name': cell['classroom_name'],
+            'room_name': cell['room_name'] or 'N/A'
         }
 
     # 4. Get all possible time slots for rendering the table structure
@@ -615,182 +559,72 @@ def teacher_timetable():
 @bp.route('/api/timetable/auto-schedule', methods=['POST'])
 @login_required
 def auto_schedule_timetable():
-    data = request.get_json()
+    """
+    [REVISED v2] จัดตารางอัตโนมัติด้วย constraint solver (app/timetable_solver.py)
+    แทนการสุ่มแบบ greedy เดิม: ผลลัพธ์ทำซ้ำได้ด้วย seed และคืน metrics ของการจัด
+    mode='multistart' จะรันหลาย seed ขนานกันเป็น background job และตอบกลับ 202 พร้อม job_id
+    """
+    data = request.get_json() or {}
     semester_id = data.get('semester_id')
     if not semester_id:
         return jsonify({'status': 'error', 'message': 'Semester ID is required'}), 400
 
-    # --- PHASE 1: ระบุกลุ่มเป้าหมายทั้งหมด และแยกกลุ่มที่จัดแล้วกับยังไม่จัด ---
-    target_courses_query = Course.query.filter_by(semester_id=semester_id)
     classroom_id = data.get('classroom_id')
     teacher_id = data.get('teacher_id')
     room_id = data.get('room_id')
-
-    if classroom_id:
-        target_courses_query = target_courses_query.filter_by(classroom_id=classroom_id)
-    elif teacher_id:
-        target_courses_query = target_courses_query.filter(Course.teachers.any(User.id == teacher_id))
-    elif room_id:
-        target_courses_query = target_courses_query.filter_by(room_id=room_id)
-    else:
+    if not (classroom_id or teacher_id or room_id):
         return jsonify({'status': 'error', 'message': 'A target is required.'}), 400
 
-    all_target_courses = target_courses_query.options(
-        joinedload(Course.subject),
-        joinedload(Course.classroom).joinedload(Classroom.grade_level),
-        joinedload(Course.teachers),
-        joinedload(Course.room),
-        joinedload(Course.lesson_plan).selectinload(LessonPlan.constraints)
-    ).all()
+    try:
+        seed = int(data['seed']) if data.get('seed') is not None else 0
+        time_budget = min(max(float(data.get('time_budget', DEFAULT_TIME_BUDGET)), 1.0), 60.0)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid seed or time budget.'}), 400
 
-    if not all_target_courses:
+    target_ids = find_target_course_ids(semester_id, classroom_id=classroom_id, teacher_id=teacher_id, room_id=room_id)
+    if not target_ids:
         return jsonify({'status': 'success', 'message': 'No courses found.', 'unscheduled_courses': []})
 
-    # --- PHASE 2: สร้าง Conflict Map จากทุกวิชาที่ถูกจัดไปแล้ว (ทั้งในและนอกกลุ่มเป้าหมาย) ---
-    all_entries_in_semester = TimetableEntry.query.join(WeeklyScheduleSlot).filter(
-        WeeklyScheduleSlot.semester_id == semester_id
-    ).options(
-        joinedload(TimetableEntry.course).selectinload(Course.teachers),
-        joinedload(TimetableEntry.course).selectinload(Course.room),
-        joinedload(TimetableEntry.course).selectinload(Course.classroom),
-        joinedload(TimetableEntry.slot)
-    ).all()
-
-    already_scheduled_periods = defaultdict(int)
-    for entry in all_entries_in_semester:
-        already_scheduled_periods[entry.course_id] += 1
-        
-    courses_to_process = [
-        c for c in all_target_courses 
-        if already_scheduled_periods.get(c.id, 0) < int((c.subject.credit or 0) * 2)
-    ]
-    
-    if not courses_to_process:
-        return jsonify({'status': 'success', 'message': 'All target courses are already fully scheduled.', 'unscheduled_courses': []})
-
-    teacher_schedule, classroom_schedule, room_schedule = defaultdict(set), defaultdict(set), defaultdict(set)
-    occupied_slot_ids = {entry.weekly_schedule_slot_id for entry in all_entries_in_semester}
-    for entry in all_entries_in_semester:
-        day, period, course = entry.slot.day_of_week, entry.slot.period_number, entry.course
-        if course:
-            classroom_schedule[course.classroom_id].add((day, period))
-            for teacher in course.teachers:
-                teacher_schedule[teacher.id].add((day, period))
-            if course.room_id:
-                room_schedule[course.room_id].add((day, period))
-
-    # --- PHASE 3: CLEAR OLD SCHEDULE FOR TARGETS ---
-
-    # --- PHASE 4: REVISED SCHEDULING ALGORITHM ---
-    all_slots = WeeklyScheduleSlot.query.filter_by(semester_id=semester_id).all()
-    
-    # สร้าง "พจนานุกรม" ของ Slot แยกตามระดับชั้น เพื่อให้ดึงใช้ได้ง่าย
-    slots_by_grade = defaultdict(list)
-    for s in all_slots:
-        slots_by_grade[s.grade_level_id].append(s)
-
-    # จัดลำดับความสำคัญใหม่: 1. วิชาที่ต้องการคาบคู่มาก่อน, 2. วิชาที่มีหน่วยกิตเยอะ (คาบเยอะ) มาก่อน
-    courses_to_process.sort(key=lambda c: (
-        -1 if c.lesson_plan and any(
-            const.constraint_type == 'period_arrangement' and const.value == 'consecutive'
-            for const in c.lesson_plan.constraints
-        ) else 0,
-        -int(c.subject.credit or 0)
-    ))
+    if data.get('mode') == 'multistart':
+        # ค้นหาหลายรอบแบบขนานใน background job แล้ว poll ผลจาก /api/jobs/<job_id>
+        try:
+            starts = min(max(int(data.get('starts', DEFAULT_STARTS)), 1), 32)
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Invalid number of starts.'}), 400
+        job_id = start_job('timetable_schedule', run_timetable_search, int(semester_id), target_ids,
+                           starts, seed, time_budget, user_id=current_user.id)
+        return jsonify({
+            'status': 'queued',
+            'job_id': job_id,
+            'status_url': url_for('main.job_status', job_id=job_id),
+        }), 202
+
+    snapshot = build_timetable_snapshot(semester_id, target_ids)
+    result = TimetableSolver(snapshot, seed=seed, time_budget=time_budget).solve()
+    metrics = result['metrics']
+    if not metrics['required_periods']:
+        return jsonify({'status': 'success', 'message': 'All target courses are already fully scheduled.',
+                        'unscheduled_courses': [], 'metrics': metrics})
 
-    max_passes, pass_count, progress_made = 10, 0, True
-    while progress_made and pass_count < max_passes and courses_to_process:
-        pass_count, progress_made, remaining_courses_this_pass = pass_count + 1, False, []
-        for course in courses_to_process:
-            remaining_periods = int((course.subject.credit or 0) * 2) - already_scheduled_periods.get(course.id, 0)
-            if remaining_periods <= 0: continue
-            course_grade_level_id = course.classroom.grade_level_id
-            relevant_slots = slots_by_grade.get(course_grade_level_id, [])
-            teacher_ids, constraints = {t.id for t in course.teachers}, {c.constraint_type: c.value for c in course.lesson_plan.constraints} if course.lesson_plan else {}
-            arrangement, time_preference = constraints.get('period_arrangement', 'separate'), constraints.get('time_preference', 'any')
-            possible_slots = []
-            for slot in relevant_slots:
-                if slot.id in occupied_slot_ids or not slot.is_teaching_period: continue
-                day, period = slot.day_of_week, slot.period_number
-                if any((day, period) in teacher_schedule[tid] for tid in teacher_ids): continue
-                if (day, period) in classroom_schedule[course.classroom_id] and course.classroom_id is not None: continue
-                if course.room_id and (day, period) in room_schedule[course.room_id]: continue
-                if pass_count <= 2 and ((time_preference == 'morning' and slot.period_number > 5) or (time_preference == 'afternoon' and slot.period_number < 6)): continue
-                possible_slots.append(slot)
-            
-            placements_to_make = []
-            if arrangement == 'consecutive' and remaining_periods > 1:
-                num_pairs_needed = remaining_periods // 2
-                found_pairs, used_in_this_search = [], set()
-                slots_by_day = defaultdict(list)
-                for s in possible_slots: slots_by_day[s.day_of_week].append(s)
-                day_keys = list(slots_by_day.keys())
-                random.shuffle(day_keys)
-                for day in day_keys:
-                    if len(found_pairs) >= num_pairs_needed: break
-                    s_slots = sorted(slots_by_day[day], key=lambda x: x.period_number)
-                    i = 0
-                    while i < len(s_slots) - 1:
-                        if len(found_pairs) >= num_pairs_needed: break
-                        slot1, slot2 = s_slots[i], s_slots[i+1]
-                        if slot1.id not in used_in_this_search and slot2.id not in used_in_this_search and slot2.period_number == slot1.period_number + 1:
-                            found_pairs.append([slot1, slot2]); used_in_this_search.add(slot1.id); used_in_this_search.add(slot2.id); i += 2
-                        else: i += 1
-                if len(found_pairs) >= num_pairs_needed:
-                    placements_to_make.extend(slot for pair in found_pairs for slot in pair)
-            else:
-                if len(possible_slots) >= remaining_periods:
-                    placements_to_make.extend(random.sample(possible_slots, remaining_periods))
-
-            if len(placements_to_make) >= remaining_periods:
-                progress_made = True
-                for slot in placements_to_make:
-                    day, period = slot.day_of_week, slot.period_number
-                    occupied_slot_ids.add(slot.id)
-                    classroom_schedule[course.classroom_id].add((day, period))
-                    for t in course.teachers: teacher_schedule[t.id].add((day, period))
-                    if course.room_id: room_schedule[course.room_id].add((day, period))
-                    db.session.add(TimetableEntry(course_id=course.id, weekly_schedule_slot_id=slot.id))
-                already_scheduled_periods[course.id] += len(placements_to_make)
-            else:
-                remaining_courses_this_pass.append(course)
-        courses_to_process = remaining_courses_this_pass
-
-    # --- PHASE 5: ANALYZE UNSCHEDULED COURSES & FINALIZE (REVISED LOGIC) ---
-    unscheduled_courses_report = []
-    if courses_to_process:
-        for course in courses_to_process:
-            required = int((course.subject.credit or 0) * 2) - already_scheduled_periods.get(course.id, 0)
-            course_grade_level_id = course.classroom.grade_level_id
-            
-            relevant_slots_for_analysis = slots_by_grade.get(course_grade_level_id, [])
-            truly_available_for_grade = [s for s in relevant_slots_for_analysis if s.is_teaching_period and s.id not in occupied_slot_ids]
-            available_slot_count = len(truly_available_for_grade)
-            
-            reasons = defaultdict(int)
-            teacher_ids = {t.id for t in course.teachers}
-            constraints = {c.constraint_type: c.value for c in course.lesson_plan.constraints} if course.lesson_plan else {}
-            time_preference = constraints.get('time_preference', 'any')
-
-            for slot in truly_available_for_grade:
-                day, period = slot.day_of_week, slot.period_number
-                if time_preference == 'morning' and slot.period_number > 5: reasons['ติดเงื่อนไข "ต้องสอนช่วงเช้า"'] += 1; continue
-                if time_preference == 'afternoon' and slot.period_number < 6: reasons['ติดเงื่อนไข "ต้องสอนช่วงบ่าย"'] += 1; continue
-                if any((day, period) in teacher_schedule[tid] for tid in teacher_ids): reasons['ครูผู้สอนไม่ว่าง'] += 1; continue
-                if (day, period) in classroom_schedule[course.classroom_id]: reasons['ห้องเรียนไม่ว่าง'] += 1; continue
-                if course.room_id and (day, period) in room_schedule[course.room_id]: reasons[f'ห้อง {course.room.name} ไม่ว่าง'] += 1; continue
-                    
-        summary = f"มีคาบว่างสำหรับระดับชั้นนี้ {available_slot_count} คาบ (ต้องการ {required} คาบ)"
-        if reasons:
-            top_reason_text = max(reasons, key=reasons.get)
-            summary += f"สาเหตุหลัก: {top_reason_text} ({reasons[top_reason_text]} คาบ)"
-        elif available_slot_count < required: summary += "สาเหตุ: มีคาบว่างไม่พอ"
-        else: summary += "สาเหตุ: ไม่สามารถหาคาบคู่ได้"
-        
-        unscheduled_courses_report.append({'subject_name': f"{course.subject.subject_code} ({course.classroom.name})", 'reason': summary})
+    try:
+        save_timetable_solution(semester_id, result['assignments'])
+        db.session.commit()
+    except Exception as e:
+        # ตารางถูกแก้ไขพร้อมกันระหว่างที่กำลังคำนวณ (slot ถูกใช้ไปแล้ว)
+        db.session.rollback()
+        current_app.logger.error(f"Auto-schedule save failed for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': 'ตารางสอนถูกแก้ไขระหว่างการจัดอัตโนมัติ กรุณาลองใหม่อีกครั้ง'}), 409
 
-    db.session.commit()
-    return jsonify({'status': 'success', 'message': 'AI scheduling complete.', 'unscheduled_courses': unscheduled_courses_report})
+    current_app.logger.info(
+        f"Auto-schedule semester {semester_id}: placed {metrics['placed_periods']}/{metrics['required_periods']} periods, "
+        f"soft score {metrics['soft_score']}, {metrics['nodes']} nodes in {metrics['solve_time']}s (seed {metrics['seed']})"
+    )
+    return jsonify({
+        'status': 'success',
+        'message': 'AI scheduling complete.',
+        'unscheduled_courses': result['unscheduled_courses'],
+        'metrics': metrics,
+    })
 
 @bp.route('/api/timetable/entry', methods=['POST'])
 @login_required
@@ -810,65 +644,38 @@ def save_timetable_entry():
     period = data.get('period')
     semester_id = data.get('semester_id')
 
-    # --- VALIDATION ENGINE (ส่วนนี้ถูกต้องแล้ว) ---
+    # --- VALIDATION ENGINE: [REVISED] ตรวจผ่าน conflict index ในหน่วยความจำแทน JOIN query ทีละประเภท ---
     target_course = Course.query.get(course_id)
     if not target_course:
         return jsonify({'status': 'error', 'message': 'ไม่พบรายวิชาที่ระบุ'}), 404
 
-    slot = WeeklyScheduleSlot.query.filter_by(semester_id=semester_id, day_of_week=day, period_number=period).first()
-    if not slot:
+    index = get_conflict_index(semester_id)
+    try:
+        slot_id = index.slot_for_course(target_course.id, int(day), int(period)) if index else None
+    except (TypeError, ValueError):
+        slot_id = None
+    if not slot_id:
         return jsonify({'status': 'error', 'message': 'ไม่พบช่องตารางสอน'}), 404
-        
-    existing_entry_in_slot = TimetableEntry.query.filter_by(weekly_schedule_slot_id=slot.id).first()
-    
-    classroom_conflict = TimetableEntry.query.join(WeeklyScheduleSlot).join(Course).filter(
-        WeeklyScheduleSlot.semester_id == semester_id,
-        WeeklyScheduleSlot.day_of_week == day,
-        WeeklyScheduleSlot.period_number == period,
-        Course.classroom_id == target_course.classroom_id,
-        TimetableEntry.id != (existing_entry_in_slot.id if existing_entry_in_slot else 0)
-    ).first()
-    if classroom_conflict:
-        return jsonify({'status': 'error', 'message': f'ห้องเรียน {target_course.classroom.name} มีเรียนวิชาอื่นในเวลานี้แล้ว'}), 400
-
-    teacher_ids = {t.id for t in target_course.teachers}
-    teacher_conflict = TimetableEntry.query.join(WeeklyScheduleSlot).join(Course).join(Course.teachers).filter(
-        WeeklyScheduleSlot.semester_id == semester_id,
-        WeeklyScheduleSlot.day_of_week == day,
-        WeeklyScheduleSlot.period_number == period,
-        User.id.in_(teacher_ids),
-        TimetableEntry.id != (existing_entry_in_slot.id if existing_entry_in_slot else 0)
-    ).first()
-    if teacher_conflict:
-        conflicting_teacher = User.query.get(list(teacher_ids.intersection(t.id for t in teacher_conflict.course.teachers))[0])
-        return jsonify({'status': 'error', 'message': f'ครู {conflicting_teacher.full_name} มีสอนคาบอื่นในเวลานี้แล้ว'}), 400
-        
-    if target_course.room_id:
-        room_conflict = TimetableEntry.query.join(WeeklyScheduleSlot).join(Course).filter(
-            WeeklyScheduleSlot.semester_id == semester_id,
-            WeeklyScheduleSlot.day_of_week == day,
-            WeeklyScheduleSlot.period_number == period,
-            Course.room_id == target_course.room_id,
-            TimetableEntry.id != (existing_entry_in_slot.id if existing_entry_in_slot else 0)
-        ).first()
-        if room_conflict:
-            return jsonify({'status': 'error', 'message': f'ห้อง {target_course.room.name} ถูกใช้งานในเวลานี้แล้ว'}), 400
 
-    # --- START: ส่วนที่แก้ไข ---
-    # ใช้ตัวแปรชื่อ 'entry' เพียงตัวเดียว
-    entry = TimetableEntry.query.filter_by(weekly_schedule_slot_id=slot.id).first()
-    
+    # ช่องที่มีวิชาอื่นอยู่แล้วจะถูกแทนที่ จึงไม่นับเป็น conflict
+    existing_entry_id = index.entry_by_slot.get(slot_id)
+    conflicts = index.conflicts(target_course.id, slot_id,
+                                ignore_entry_ids=(existing_entry_id,) if existing_entry_id else ())
+    if conflicts:
+        return jsonify({'status': 'error', 'message': _timetable_conflict_message(index, *conflicts[0])}), 400
+
+    entry = db.session.get(TimetableEntry, existing_entry_id) if existing_entry_id else None
     if entry:
         # ถ้ามีรายการเก่าในช่องนี้อยู่แล้ว ให้อัปเดต course_id
-        entry.course_id = course_id
+        entry.course_id = target_course.id
     else:
         # ถ้าช่องนี้ว่าง ให้สร้างรายการใหม่และเก็บลงในตัวแปร 'entry'
-        entry = TimetableEntry(course_id=course_id, weekly_schedule_slot_id=slot.id)
+        entry = TimetableEntry(course_id=target_course.id, weekly_schedule_slot_id=slot_id)
         db.session.add(entry)
-    # --- END: ส่วนที่แก้ไข ---
     
     try:
         db.session.commit()
+        advance_conflict_index(index, placed=[(entry.id, target_course.id, slot_id)])
         # ตอนนี้ 'entry' จะมีข้อมูลเสมอ ไม่ว่าจะมาจากเงื่อนไข if หรือ else
         course = Course.query.get(course_id)
         teachers = [t.full_name for t in course.teachers]
@@ -900,10 +707,12 @@ def delete_timetable_entry(entry_id):
     Deletes a single timetable entry. Used for manual adjustments on the frontend.
     """
     entry = TimetableEntry.query.get_or_404(entry_id)
+    index = get_conflict_index(entry.slot.semester_id)
     
     try:
         db.session.delete(entry)
         db.session.commit()
+        advance_conflict_index(index, removed=[entry_id])
         return jsonify({'status': 'success', 'message': 'Entry deleted successfully.'})
     except Exception as e:
         db.session.rollback()
@@ -928,26 +737,133 @@ def move_timetable_entry(entry_id):
     if not new_slot:
         return jsonify({'status': 'error', 'message': 'New slot not found.'}), 404
 
-    # --- Server-side Validation ---
-    # 1. Check if the new slot is a teaching period
-    if not new_slot.is_teaching_period:
-        return jsonify({'status': 'error', 'message': f'Cannot move to an activity slot: {new_slot.activity_name}.'}), 400
-
-    # 2. Check if the new slot is already occupied by another course
-    existing_entry = TimetableEntry.query.filter_by(weekly_schedule_slot_id=new_slot_id).first()
-    if existing_entry:
-        return jsonify({'status': 'error', 'message': 'Target slot is already occupied.'}), 409 # 409 Conflict
-
-    # (You can add more checks here for teacher/classroom availability if needed)
+    # --- Server-side Validation: [REVISED] ใช้ conflict index (ครู/ห้องเรียน/ห้อง/ช่องซ้ำ) ---
+    index = get_conflict_index(new_slot.semester_id)
+    _, errors = index.validate_moves([(entry.id, new_slot.id)])
+    if errors:
+        kind, ref_id = errors[entry.id][0]
+        status_code = 409 if kind in ('slot', 'entry') else 400 # 409 Conflict
+        return jsonify({'status': 'error', 'message': _timetable_conflict_message(index, kind, ref_id)}), status_code
 
     try:
-        entry.weekly_schedule_slot_id = new_slot_id
+        entry.weekly_schedule_slot_id = new_slot.id
         db.session.commit()
+        advance_conflict_index(index, placed=[(entry.id, entry.course_id, new_slot.id)])
         return jsonify({'status': 'success', 'message': 'Entry moved successfully.'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': f'Failed to move entry: {str(e)}'}), 500
 
+# [NEW] ย้ายหลายคาบในคำสั่งเดียว ตรวจ conflict ของทุกคาบพร้อมกันก่อนบันทึก
+@bp.route('/api/timetable/entries/move', methods=['POST'])
+@login_required
+def move_timetable_entries():
+    """
+    Moves many timetable entries at once. Payload:
+    {"semester_id": 1, "moves": [{"entry_id": 10, "new_slot_id": 55}, ...]}
+
+    All moves are validated together (so entries may trade places within the
+    batch); if any move fails nothing is saved and the per-entry errors are
+    returned.
+    """
+    data = request.get_json() or {}
+    semester_id = data.get('semester_id')
+    try:
+        moves = [(int(m['entry_id']), int(m['new_slot_id'])) for m in data.get('moves') or []]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid moves payload.'}), 400
+    if not semester_id or not moves:
+        return jsonify({'status': 'error', 'message': 'Semester ID and moves are required.'}), 400
+    if len({entry_id for entry_id, _ in moves}) != len(moves):
+        return jsonify({'status': 'error', 'message': 'Each entry can only be moved once per request.'}), 400
+
+    index = get_conflict_index(semester_id)
+    if index is None:
+        return jsonify({'status': 'error', 'message': 'Semester not found.'}), 404
+    _, errors = index.validate_moves(moves)
+    if errors:
+        return jsonify({
+            'status': 'error',
+            'message': 'บางคาบไม่สามารถย้ายได้ ไม่มีการบันทึกการเปลี่ยนแปลง',
+            'errors': [{'entry_id': entry_id, 'message': _timetable_conflict_message(index, *found[0])}
+                       for entry_id, found in errors.items()],
+        }), 409
+
+    # slot มี unique constraint: ต้องย้ายคาบที่ออกจากช่องก่อน คาบที่จะเข้าไปแทนที่ (สลับกันได้ผ่านช่องว่างชั่วคราว)
+    steps = _order_moves_for_unique_slots(index, moves)
+    if steps is None:
+        return jsonify({'status': 'error', 'message': 'ภาคเรียนนี้ไม่มีช่องว่างสำหรับพักคาบระหว่างสลับ กรุณาย้ายทีละขั้น'}), 409
+
+    try:
+        # ทีละแถวตามลำดับ steps (executemany) เพื่อให้ unique constraint ผ่านทุกขั้น
+        db.session.execute(update(TimetableEntry), [
+            {'id': entry_id, 'weekly_schedule_slot_id': slot_id} for entry_id, slot_id in steps
+        ])
+        bump_timetable_version(db.session, [index.semester_id])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Batch timetable move failed: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'Failed to move entries: {str(e)}'}), 500
+
+    advance_conflict_index(index, placed=[(entry_id, index.entries[entry_id][0], new_slot_id)
+                                          for entry_id, new_slot_id in moves])
+    return jsonify({'status': 'success', 'message': f'ย้าย {len(moves)} คาบเรียบร้อยแล้ว', 'moved': len(moves)})
+
+def _order_moves_for_unique_slots(index, moves):
+    """
+    Orders the moves into UPDATE steps so no entry enters a slot before its
+    occupant leaves (slot has a unique constraint). A cycle (e.g. a swap) is
+    broken by parking one of its entries in a free slot of the semester first;
+    the parked entry gets its own step to its real target later.
+
+    Returns:
+        list[tuple[int, int]] | None: (entry_id, slot_id) steps in order, or None
+            if the moves form a cycle and the semester has no free slot.
+    """
+    occupant = dict(index.entry_by_slot)
+    slot_of = {eid: index.entries[eid][1] for eid, _ in moves}
+    pending = dict(moves)
+    steps = []
+
+    def place(eid, slot_id):
+        if occupant.get(slot_of[eid]) == eid:
+            del occupant[slot_of[eid]]
+        occupant[slot_id] = eid
+        slot_of[eid] = slot_id
+        steps.append((eid, slot_id))
+
+    while pending:
+        ready = [eid for eid, slot_id in pending.items() if occupant.get(slot_id) in (None, eid)]
+        if ready:
+            for eid in ready:
+                place(eid, pending.pop(eid))
+            continue
+        # เหลือแต่คาบที่สลับกันเป็นวง: พักคาบหนึ่งไว้ในช่องว่างก่อน แล้ววงจะคลายออก
+        parking_slot = next((slot_id for slot_id in index.slots if slot_id not in occupant), None)
+        if parking_slot is None:
+            return None
+        place(min(pending), parking_slot)
+    return steps
+
+def _timetable_conflict_message(index, kind, ref_id):
+    if kind == 'activity':
+        return f'Cannot move to an activity slot: {index.slots[ref_id][4]}.'
+    if kind == 'slot':
+        return 'Target slot is already occupied.'
+    if kind == 'classroom':
+        classroom = db.session.get(Classroom, ref_id)
+        return f'ห้องเรียน {classroom.name} มีเรียนวิชาอื่นในเวลานี้แล้ว'
+    if kind == 'teacher':
+        teacher = db.session.get(User, ref_id)
+        return f'ครู {teacher.full_name} มีสอนคาบอื่นในเวลานี้แล้ว'
+    if kind == 'room':
+        room = db.session.get(Room, ref_id)
+        return f'ห้อง {room.name} ถูกใช้งานในเวลานี้แล้ว'
+    if kind == 'missing_slot':
+        return 'New slot not found.'
+    return 'Entry not found in this semester.'
+
 @bp.route('/api/student/<int:student_id>/details')
 @login_required
 # @academic_required # decorator to check for 'Academic' role
@@ -1990,21 +1906,21 @@ def graduation_approval():
     current_academic_year_id = current_semester.academic_year_id
     current_academic_year = db.session.get(AcademicYear, current_academic_year_id)
 
-    graduating_grade_short_names = ['ม.3', 'ม.6']
     graduating_students_data = []
-    # ... (code to query enrollments - same as before) ...
+    # ชั้นจบหลักสูตร = ระดับชั้นที่กำหนดหน่วยกิตขั้นต่ำไว้ (ม.3/ม.6)
     enrollments = Enrollment.query.join(Classroom).join(GradeLevel).filter(
         Classroom.academic_year_id == current_academic_year_id,
-        GradeLevel.short_name.in_(graduating_grade_short_names)
+        GradeLevel.graduation_credits.isnot(None)
     ).options(
         joinedload(Enrollment.student),
         joinedload(Enrollment.classroom).joinedload(Classroom.grade_level)
     ).order_by(Classroom.name, Enrollment.roll_number).all()
 
 
+    readiness = check_graduation_readiness_batch(current_academic_year_id)
     for en in enrollments:
         student = en.student
-        is_ready, reason = check_graduation_readiness(student.id, current_academic_year_id)
+        result = readiness.get(student.id, {})
         graduating_students_data.append({
             'enrollment_id': en.id,
             'student_id': student.id,
@@ -2012,8 +1928,10 @@ def graduation_approval():
             'full_name': f"{student.name_prefix or ''}{student.first_name} {student.last_name}".strip(),
             'classroom_name': en.classroom.name,
             'current_status': student.status,
-            'is_ready': is_ready,
-            'reason': reason # Pass the potentially detailed reason
+            'is_ready': result.get('is_ready'),
+            'reason': result.get('reason'), # Pass the potentially detailed reason
+            'credits_earned': result.get('credits_earned'),
+            'required_credits': result.get('required_credits'),
         })
 
     return render_template('academic/graduation_approval.html',
@@ -2043,21 +1961,12 @@ def submit_graduation_approval():
     submitted_count = 0
     errors = []
 
-    # --- Find Graduating Students Again for Validation ---
-    graduating_grade_short_names = ['ม.3', 'ม.6']
-    valid_student_ids_in_year = { en.student_id for en in Enrollment.query.join(Classroom).join(GradeLevel).filter(
-        Classroom.academic_year_id == current_academic_year_id,
-        GradeLevel.short_name.in_(graduating_grade_short_names)).options(db.load_only(Enrollment.student_id)).all()
-    }
-
+    # --- Check Graduating Students Again for Validation ---
     students_to_verify = Student.query.filter(Student.id.in_(verified_student_ids)).all()
+    readiness = check_graduation_readiness_batch(current_academic_year_id, [s.id for s in students_to_verify])
 
     for student in students_to_verify:
-         if student.id not in valid_student_ids_in_year:
-              errors.append(f"นักเรียน {student.full_name} ไม่ได้อยู่ในระดับชั้น ม.3/ม.6 ในปีการศึกษานี้")
-              continue
-
-         is_ready, reason = check_graduation_readiness(student.id, current_academic_year_id)
+         is_ready, reason = readiness[student.id]['is_ready'], readiness[student.id]['reason']
          if is_ready is True:
               # ... (Logic for handling status update/flagging for director) ...
               if student.status == 'กำลังศึกษา': # Only count those who are not already graduated
@@ -2069,7 +1978,7 @@ def submit_graduation_approval():
 
          elif is_ready is False:
               errors.append(f"นักเรียน {student.full_name} ยังไม่พร้อมจบ ({reason}) - ไม่สามารถเสนอชื่อได้")
-         else:
+         else: # ไม่ได้อยู่ในชั้นจบหลักสูตรของปีนี้ / ไม่พบข้อมูล
               errors.append(f"ไม่สามารถตรวจสอบสถานะความพร้อมของ {student.full_name} ได้ ({reason})")
 
     if errors:
@@ -75,6 +75,8 @@ class EditUserForm(FlaskForm):
 class GradeLevelForm(FlaskForm):
     name = StringField('ชื่อระดับชั้น (เช่น มัธยมศึกษาปีที่ 1)', validators=[DataRequired(), Length(min=2, max=50)])
     short_name = StringField('ชื่อย่อ (เช่น ม.1)', validators=[DataRequired(), Length(min=1, max=10)])
+    graduation_credits = FloatField('หน่วยกิตขั้นต่ำเพื่อจบหลักสูตร (เว้นว่างถ้าไม่ใช่ชั้นจบ)', validators=[Optional()],
+                                    render_kw={'type': 'number', 'step': '0.5', 'min': '0'})
     submit = SubmitField('บันทึกข้อมูล')
 
 class SubjectGroupForm(FlaskForm):
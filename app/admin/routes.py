@@ -2,34 +2,41 @@
 
 from collections import defaultdict
 from datetime import datetime, time
-import shutil
 from urllib.parse import parse_qs, urlparse
 import zipfile
 from flask_wtf.file import FileAllowed
 import io
-import math
 from PIL import Image
 from sqlalchemy.exc import IntegrityError # สำหรับดักจับ Error ข้อมูลซ้ำ
 from flask_wtf import FlaskForm
 from wtforms import FileField, HiddenField, StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired
 from app.admin import bp
-from flask import abort, json, jsonify, render_template, redirect, send_file, url_for, flash, request, current_app, send_from_directory, session
+from flask import Response, abort, json, jsonify, render_template, redirect, send_file, stream_with_context, url_for, flash, request, current_app, send_from_directory, session
 from app import db
-from sqlalchemy import func, or_
+from sqlalchemy import and_, func, or_
 import json, os, uuid
 import pandas as pd
 from sqlalchemy.orm import joinedload, selectinload
-from app.models import AcademicYear, AdministrativeDepartment, AssessmentDimension, AssessmentTemplate, AssessmentTopic, AttendanceRecord, AttendanceWarning, AuditLog, Classroom, Course, Curriculum, Enrollment, GradeLevel, GradedItem, Indicator, LearningStrand, LearningUnit, LessonPlan, Notification, Program, Role, Room, RubricLevel, Score, Semester, Setting, Standard, Student, Subject, SubjectGroup, SubjectType, TimeSlot, User, WeeklyScheduleSlot
+from app.models import AcademicYear, AdministrativeDepartment, AssessmentDimension, AssessmentTemplate, AssessmentTopic, AttendanceRecord, AttendanceWarning, AuditLog, Classroom, Course, Curriculum, Enrollment, GradeLevel, GradedItem, Indicator, LearningStrand, LearningUnit, LessonPlan, Notification, Program, Role, Room, RubricLevel, Score, Semester, Setting, Standard, Student, Subject, SubjectGroup, SubjectType, TimeSlot, User, WeeklyScheduleSlot, name_search_key
 from app.admin.forms import AcademicYearForm, AddUserForm, AssessmentDimensionForm, AssessmentTemplateForm, AssessmentTopicForm, AssessmentTopicForm, AssignAdvisorsForm, AssignHeadsForm, ClassroomForm, CurriculumForm, EditUserForm, EnrollmentForm, GradeLevelForm, ProgramForm, RoleForm, RubricLevelForm, SemesterForm, StudentForm, SubjectForm, SubjectForm, SubjectGroupForm, SubjectTypeForm, get_all_academic_years, get_all_semesters, get_all_grade_levels
 from flask_login import current_user, login_required
 from werkzeug.utils import secure_filename
 
-from app.services import log_action, promote_students_to_next_year, copy_schedule_structure
+from app.services import (SEMESTER_CLONE_SCOPES, clone_semester_setup, log_action, promote_students_to_next_year,
+                          run_lesson_plan_rollover_job, run_promotion_job, copy_schedule_structure)
+from app.importers import (PreviewSpool, UploadFormatError, build_preview, build_standards_preview,
+                           build_student_preview, build_subject_preview, build_teacher_preview, run_spooled_import,
+                           run_standards_import, run_student_import, run_subject_import, run_teacher_import)
+from app.archive import archive_academic_year, run_archive_job
+from app.backups import ArchiveRestore, BackupArchive
+from app.global_search import ensure_global_search_index
+from app.indicator_search import ensure_indicator_search_index
+from app.jobs import get_job, start_job
+from app.pagination import approximate_count, keyset_paginate, prefix_match
+from app.typeahead import SOURCE_USERS, get_index, parse_limit, search_source, typeahead_response
 # from flask_login import login_required # This will be enabled later
 
-BATCH_SIZE = 20 # กำหนดขนาดของแต่ละ Batch (ปรับค่าได้ตามความเหมาะสม)
-
 def _cleanup_file(filepath):
     """ Safely delete a file if it exists. """
     try:
@@ -249,10 +256,29 @@ def delete_role(role_id):
     flash('ลบบทบาทเรียบร้อยแล้ว', 'info')
     return redirect(url_for('admin.list_roles'))
 
+def _name_search_filter(query_str, first_key, last_key, *code_columns):
+    """
+    [NEW] Indexed name search: every column is matched by prefix on its
+    normalized value ("สม" finds สมชาย, "ใจ" finds นามสกุล ใจดี). Two or more
+    words mean first name + last name.
+    """
+    words = (name_search_key(query_str) or '').split()
+    if not words:
+        return None
+    if len(words) > 1:
+        return and_(prefix_match(first_key, words[0]), prefix_match(last_key, ' '.join(words[1:])))
+    return or_(prefix_match(first_key, words[0]), prefix_match(last_key, words[0]),
+               *[prefix_match(column, words[0]) for column in code_columns])
+
 # เส้นทางสำหรับแสดงรายการผู้ใช้ (READ)
 @bp.route('/users')
 @login_required # Add @admin_required if you have one
 def list_users():
+    """
+    [REVISED] Keyset pagination (?after= / ?before= cursors on User.id) and
+    indexed prefix search on the normalized name columns; the total is an
+    approximate, briefly cached count instead of COUNT(*) on every page.
+    """
     # --- Filter Logic Start ---
     search_name = request.args.get('name', '', type=str).strip()
     selected_role_id = request.args.get('role_id', '', type=str).strip() # Get as string first
@@ -260,21 +286,18 @@ def list_users():
     query = User.query # Start with the base query
 
     # Apply name filter if provided
-    if search_name:
-        search_pattern = f"%{search_name}%"
-        query = query.filter(or_(
-            User.first_name.ilike(search_pattern),
-            User.last_name.ilike(search_pattern),
-            User.username.ilike(search_pattern) # Optional: search username too
-        ))
+    # คำค้นถูกแปลงเป็นตัวพิมพ์เล็ก จึงเทียบกับ lower(username) (มี index ix_user_username_lower)
+    name_filter = _name_search_filter(search_name, User.first_name_key, User.last_name_key, func.lower(User.username))
+    if name_filter is not None:
+        query = query.filter(name_filter)
 
     # Apply role filter if provided and valid
     role_id_int = None # Variable to hold integer role ID for template
     if selected_role_id:
         try:
             role_id_int = int(selected_role_id)
-            # Join with the roles relationship and filter by Role.id
-            query = query.join(User.roles).filter(Role.id == role_id_int)
+            # EXISTS บน user_roles (index role_id) แทน join เพื่อไม่ให้แถวซ้ำ
+            query = query.filter(User.roles.any(Role.id == role_id_int))
         except ValueError:
             flash('Role ID ที่ระบุไม่ถูกต้อง', 'warning')
             selected_role_id = '' # Clear invalid ID
@@ -283,12 +306,12 @@ def list_users():
     all_roles = Role.query.order_by(Role.name).all()
     # --- Filter Logic End ---
 
-    # Pagination using the potentially filtered query
-    page = request.args.get('page', 1, type=int)
-    # Use the filtered query here, and adjust per_page if needed (e.g., from config)
-    pagination = query.order_by(User.id.asc()).paginate(
-        page=page, per_page=current_app.config.get('USERS_PER_PAGE', 20), error_out=False # Use config or default to 20
+    pagination = keyset_paginate(
+        query.options(selectinload(User.roles)), [User.id],
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=current_app.config.get('USERS_PER_PAGE', 20) # Use config or default to 20
     )
+    pagination.total = approximate_count(query, ('users', name_search_key(search_name), role_id_int))
     users = pagination.items
 
     # ตรวจสอบ Header ว่าถูกเรียกโดย JavaScript (AJAX) หรือไม่
@@ -496,7 +519,8 @@ def list_grade_levels():
 def add_grade_level():
     form = GradeLevelForm()
     if form.validate_on_submit():
-        grade = GradeLevel(name=form.name.data, short_name=form.short_name.data)
+        grade = GradeLevel(name=form.name.data, short_name=form.short_name.data,
+                           graduation_credits=form.graduation_credits.data)
         db.session.add(grade)
         db.session.commit()
         flash('เพิ่มระดับชั้นใหม่เรียบร้อยแล้ว', 'success')
@@ -512,6 +536,7 @@ def edit_grade_level(grade_id):
     if form.validate_on_submit():
         grade.name = form.name.data
         grade.short_name = form.short_name.data
+        grade.graduation_credits = form.graduation_credits.data
         db.session.commit()
         flash('แก้ไขข้อมูลระดับชั้นเรียบร้อยแล้ว', 'success')
         return redirect(url_for('admin.list_grade_levels'))
@@ -638,6 +663,25 @@ def delete_academic_year(year_id):
     flash('ลบปีการศึกษาเรียบร้อยแล้ว', 'info')
     return redirect(url_for('admin.list_academic_years'))
 
+@bp.route('/academic-years/<int:year_id>/archive', methods=['GET', 'POST'])
+@login_required
+def archive_academic_year_view(year_id):
+    """[NEW] Previews (GET) or starts (POST) moving a closed year's detailed rows into the archive tables."""
+    year = AcademicYear.query.get_or_404(year_id)
+    form = FlaskForm()
+
+    if request.method == 'POST':
+        if not form.validate_on_submit():
+            flash('Invalid request (CSRF token missing or expired)', 'danger')
+            return redirect(url_for('admin.archive_academic_year_view', year_id=year.id))
+        job_id = start_job('academic_year_archive', run_archive_job, year.id, user_id=current_user.id)
+        current_app.logger.info(f"Started academic year archive job {job_id} (year {year.year})")
+        return redirect(url_for('admin.import_progress', job_id=job_id, next=url_for('admin.list_academic_years')))
+
+    preview = archive_academic_year(year.id, dry_run=True)
+    return render_template('admin/academic_year_archive.html', title=f'เก็บข้อมูลปีการศึกษา {year.year} เข้าคลัง',
+                           form=form, year=year, preview=preview)
+
 @bp.route('/semesters')
 def list_semesters():
     semesters = Semester.query.order_by(Semester.id.desc()).all()
@@ -1184,35 +1228,38 @@ def delete_classroom(classroom_id):
 @bp.route('/students')
 @login_required
 def list_students():
+    """
+    [REVISED] Keyset pagination on (student_id, id), indexed prefix search on
+    student code and normalized names, and classroom / grade level / status
+    filters resolved through EXISTS on indexed enrollment columns. Current
+    classrooms are fetched for the whole page in one query.
+    """
     if not current_user.has_role('Admin'):
         abort(403)
 
     # --- START: ส่วนตรรกะการกรองข้อมูล ---
-    page = request.args.get('page', 1, type=int)
     # อ่านค่าจาก query string สำหรับการกรอง
-    q = request.args.get('q', '', type=str)
+    q = request.args.get('q', '', type=str).strip()
     classroom_id = request.args.get('classroom_id', 0, type=int)
+    grade_level_id = request.args.get('grade_level_id', 0, type=int)
     status = request.args.get('status', '', type=str)
 
     # สร้าง query เริ่มต้น
     query = Student.query
-
-    # 1. กรองด้วยคำค้นหา (Search Query)
-    if q:
-        search_term = f"%{q}%"
-        query = query.filter(or_(
-            Student.student_id.like(search_term),
-            Student.first_name.like(search_term),
-            Student.last_name.like(search_term)
-        ))
-
     current_year = AcademicYear.query.order_by(AcademicYear.year.desc()).first()
 
-    # 2. กรองด้วยห้องเรียน (Classroom)
-    if classroom_id and current_year:
-        query = query.join(Enrollment).filter(
-            Enrollment.classroom_id == classroom_id
-        )
+    # 1. กรองด้วยคำค้นหา (Search Query) — prefix บนคอลัมน์ที่มี index
+    name_filter = _name_search_filter(q, Student.first_name_key, Student.last_name_key, Student.student_id)
+    if name_filter is not None:
+        query = query.filter(name_filter)
+
+    # 2. กรองด้วยห้องเรียน (Classroom) / ระดับชั้นในปีปัจจุบัน
+    if classroom_id:
+        query = query.filter(Student.enrollments.any(Enrollment.classroom_id == classroom_id))
+    elif grade_level_id and current_year:
+        year_classrooms = db.session.query(Classroom.id).filter(
+            Classroom.grade_level_id == grade_level_id, Classroom.academic_year_id == current_year.id)
+        query = query.filter(Student.enrollments.any(Enrollment.classroom_id.in_(year_classrooms)))
 
     # 3. กรองด้วยสถานะ (Status)
     if status:
@@ -1220,11 +1267,22 @@ def list_students():
     
     # --- END: ส่วนตรรกะการกรองข้อมูล ---
 
-    # ดึงข้อมูลนักเรียนพร้อม pagination หลังจากกรองแล้ว
-    pagination = query.order_by(Student.student_id).paginate(
-        page=page, per_page=20, error_out=False
-    )
+    pagination = keyset_paginate(query, [Student.student_id, Student.id],
+                                 after=request.args.get('after'), before=request.args.get('before'), per_page=20)
+    pagination.total = approximate_count(
+        query, ('students', name_search_key(q), classroom_id, grade_level_id, status))
     students = pagination.items
+
+    # ห้องเรียนปีปัจจุบันของทั้งหน้าในครั้งเดียว (แทน student.enrollments ทีละคน)
+    current_classrooms = {}
+    if current_year and students:
+        for student_pk, classroom_name in db.session.query(Enrollment.student_id, Classroom.name).join(
+            Classroom, Enrollment.classroom_id == Classroom.id
+        ).filter(
+            Enrollment.student_id.in_([s.id for s in students]),
+            Classroom.academic_year_id == current_year.id
+        ).order_by(Classroom.name):
+            current_classrooms.setdefault(student_pk, []).append(classroom_name)
     
     # ตรวจสอบ Header เพื่อแยกว่าเป็น AJAX request หรือไม่
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -1232,12 +1290,14 @@ def list_students():
         return render_template('admin/_students_table.html',
                                students=students,
                                pagination=pagination,
-                               current_year=current_year)
+                               current_year=current_year,
+                               current_classrooms=current_classrooms)
 
     # ถ้าเป็นการโหลดปกติ, ส่งข้อมูลสำหรับ Filter ไปด้วย
     classrooms = []
     if current_year:
         classrooms = Classroom.query.filter_by(academic_year_id=current_year.id).order_by(Classroom.name).all()
+    grade_levels = GradeLevel.query.order_by(GradeLevel.id).all()
     statuses = ['กำลังศึกษา', 'พักการเรียน', 'ลาออก', 'ย้ายออก', 'แขวนลอย', 'พ้นสภาพ', 'จบการศึกษา']
 
     return render_template('admin/students.html', 
@@ -1245,7 +1305,9 @@ def list_students():
                            students=students, 
                            pagination=pagination,
                            current_year=current_year,
+                           current_classrooms=current_classrooms,
                            classrooms=classrooms, # ส่งข้อมูลห้องเรียนไปที่ template
+                           grade_levels=grade_levels,
                            statuses=statuses)     # ส่งข้อมูลสถานะไปที่ template
 
 # เส้นทางสำหรับเพิ่มนักเรียนใหม่
@@ -1317,6 +1379,9 @@ def manage_enrollment(classroom_id):
 @bp.route('/enrollment/add/<int:classroom_id>/<int:student_id>', methods=['POST'])
 def add_enrollment(classroom_id, student_id):
     roll_number = request.form.get('roll_number')
+    if Enrollment.query.filter_by(classroom_id=classroom_id, student_id=student_id).first():
+        flash('นักเรียนคนนี้อยู่ในห้องนี้แล้ว', 'warning')
+        return redirect(url_for('admin.manage_enrollment', classroom_id=classroom_id))
     enrollment = Enrollment(
         classroom_id=classroom_id, 
         student_id=student_id, 
@@ -1335,148 +1400,55 @@ def remove_enrollment(classroom_id, student_id):
     flash('นำนักเรียนออกจากห้องเรียบร้อยแล้ว', 'info')
     return redirect(url_for('admin.manage_enrollment', classroom_id=classroom_id))
 
-@bp.route('/students/execute-import', methods=['GET', 'POST'])
+@bp.route('/students/execute-import', methods=['POST'])
 @login_required
 def execute_student_import():
-    # 1. รับหมายเลข Batch และหาไฟล์
-    batch = request.args.get('batch', 1, type=int)
-    temp_filename = session.get('import_filename')
-    
+    """
+    [REVISED v2] Hands the previewed rows to the set-based import engine as a
+    background job instead of redirecting through 20-row batches.
+    """
+    temp_filename = session.pop('import_filename', None)
     if not temp_filename:
         flash('ไม่พบข้อมูลสำหรับนำเข้า หรือ Session หมดอายุ', 'warning')
         return redirect(url_for('admin.import_students'))
 
-    json_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-
-    if not os.path.exists(json_filepath):
-         flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
-         session.pop('import_filename', None)
-         return redirect(url_for('admin.import_students'))
-
-    try:
-        # 3. อ่านข้อมูลและคำนวณ Batch
-        with open(json_filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        total_items = len(data)
-        if total_items == 0:
-            _cleanup_file(json_filepath)
-            flash('ไฟล์ข้อมูลว่างเปล่า', 'info')
-            session.pop('import_filename', None)
-            return redirect(url_for('admin.list_students'))
-
-        total_batches = math.ceil(total_items / BATCH_SIZE)
-        start_index = (batch - 1) * BATCH_SIZE
-        end_index = min(batch * BATCH_SIZE, total_items)
-        batch_data = data[start_index:end_index]
-
-        current_app.logger.info(f"Processing student import batch {batch}/{total_batches} ({start_index+1} to {end_index})")
-
-        # 4. ประมวลผลข้อมูล (Logic จาก tasks.py)
-        # Get current academic year ID *once*
-        current_semester = Semester.query.filter_by(is_current=True).first()
-        if not current_semester:
-             raise Exception("Cannot run student import: No current semester is set.")
-        current_academic_year_id = current_semester.academic_year_id
-        
-        # Pre-load classrooms for the current year into a map
-        classrooms_in_year = Classroom.query.filter_by(academic_year_id=current_academic_year_id).all()
-        classroom_map = {c.name: c for c in classrooms_in_year}
+    spool = PreviewSpool(temp_filename)
+    if not spool.exists():
+        flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
+        return redirect(url_for('admin.import_students'))
 
-        new_count = request.args.get('new', 0, type=int)
-        update_count = request.args.get('upd', 0, type=int)
-        error_count = request.args.get('err', 0, type=int)
-        skipped_count = request.args.get('skip', 0, type=int)
+    job_id = start_job('student_import', run_spooled_import, run_student_import, spool, user_id=current_user.id)
+    current_app.logger.info(f"Started student import job {job_id} ({spool.filename})")
+    return redirect(url_for('admin.import_progress', job_id=job_id,
+                            next=url_for('admin.list_students')))
 
-        for record in batch_data:
-            try:
-                # Skip rows with warnings (ที่มาจากหน้า preview)
-                if any(w for w in record['warnings']):
-                    skipped_count += 1
-                    continue
-
-                student_id_str = record['student_id']
-                classroom_name = record['classroom_name']
-
-                # --- Upsert Student ---
-                student = Student.query.filter_by(student_id=student_id_str).first()
-                if not student:
-                    student = Student(student_id=student_id_str)
-                    status = 'New'
-                else:
-                     status = 'Update'
-                
-                student.name_prefix = record['name_prefix']
-                student.first_name = record['first_name']
-                student.last_name = record['last_name']
-                if status == 'New':
-                     student.status = 'กำลังศึกษา' 
-                db.session.add(student)
-                db.session.flush() # Ensure student has ID
-
-                # --- Upsert Enrollment ---
-                classroom = classroom_map.get(classroom_name)
-                if classroom:
-                    Enrollment.query.filter(
-                        Enrollment.student_id == student.id,
-                        Enrollment.classroom_id.in_(
-                            db.session.query(Classroom.id).filter_by(academic_year_id=current_academic_year_id)
-                        )
-                    ).delete(synchronize_session=False)
-
-                    roll_number_val = None
-                    if pd.notna(record['roll_number']):
-                         try:
-                             roll_number_val = int(float(record['roll_number']))
-                         except (ValueError, TypeError):
-                              pass
-                              
-                    enrollment = Enrollment(
-                        student=student,
-                        classroom=classroom,
-                        roll_number=roll_number_val
-                    )
-                    db.session.add(enrollment)
-                    
-                    if status == 'New': new_count += 1
-                    else: update_count += 1
-                else:
-                    error_count += 1
-                    current_app.logger.warning(f"Row {record.get('row_num', '?')} ({student_id_str}): Classroom '{classroom_name}' not found during execution.")
-                    db.session.rollback() # Rollback student add/update for this record
-                    continue
+# kind -> (title, done message, failed message) ของหน้าแสดงความคืบหน้างานเบื้องหลัง
+JOB_PROGRESS_TEXT = {
+    'student_promotion': ('กำลังเลื่อนชั้นนักเรียน', 'เลื่อนชั้นนักเรียนสำเร็จ!', 'เกิดข้อผิดพลาดระหว่างเลื่อนชั้นนักเรียน'),
+    'lesson_plan_rollover': ('กำลังคัดลอกแผนการสอน', 'คัดลอกแผนการสอนสำเร็จ!', 'เกิดข้อผิดพลาดระหว่างคัดลอกแผนการสอน'),
+    'academic_year_archive': ('กำลังเก็บข้อมูลปีการศึกษาเข้าคลัง', 'เก็บข้อมูลเข้าคลังสำเร็จ!', 'เกิดข้อผิดพลาดระหว่างเก็บข้อมูลเข้าคลัง'),
+}
+IMPORT_PROGRESS_TEXT = ('กำลังนำเข้าข้อมูล', 'นำเข้าข้อมูลสำเร็จ!', 'เกิดข้อผิดพลาดระหว่างนำเข้าข้อมูล')
 
-            except Exception as rec_err:
-                 db.session.rollback()
-                 error_count += 1
-                 current_app.logger.error(f"Error processing student import record {record.get('student_id','?')}: {rec_err}", exc_info=True)
-                 continue
-
-        db.session.commit() # Commit หลังจากจบ Batch
-
-        # 5. ตัดสินใจขั้นตอนต่อไป
-        if batch >= total_batches:
-            _cleanup_file(json_filepath)
-            session.pop('import_filename', None)
-            flash(f'นำเข้าข้อมูลนักเรียนสำเร็จ! (ใหม่: {new_count}, อัปเดต: {update_count}, ข้าม: {skipped_count}, ผิดพลาด: {error_count})', 'success')
-            return redirect(url_for('admin.list_students'))
-        else:
-            flash(f'กำลังประมวลผล... (ส่วนที่ {batch}/{total_batches} - {end_index}/{total_items} รายการ)', 'info')
-            next_url = url_for('admin.execute_student_import', 
-                               batch=batch + 1, 
-                               new=new_count, 
-                               upd=update_count, 
-                               err=error_count, 
-                               skip=skipped_count)
-            return redirect(next_url)
-
-    except Exception as e:
-        db.session.rollback()
-        _cleanup_file(json_filepath)
-        session.pop('import_filename', None)
-        current_app.logger.error(f"Critical error during student import batch {batch}: {e}", exc_info=True)
-        flash(f'เกิดข้อผิดพลาดร้ายแรงระหว่างประมวลผลส่วนที่ {batch}: {e}', 'danger')
-        return redirect(url_for('admin.import_students'))
+@bp.route('/import/progress/<job_id>')
+@login_required
+def import_progress(job_id):
+    job = get_job(job_id)
+    if not job or job.get('user_id') != current_user.id:
+        abort(404)
+    next_url = request.args.get('next', '')
+    # เฉพาะ path ภายในเว็บเดียวกัน (กัน //evil.com และ /\evil.com ที่เบราว์เซอร์ตีความเป็นโดเมนอื่น)
+    parsed_next = urlparse(next_url)
+    if (not next_url.startswith('/') or next_url.startswith('//') or '\\' in next_url
+            or parsed_next.scheme or parsed_next.netloc):
+        next_url = url_for('admin.index')
+    title, done_message, failed_message = JOB_PROGRESS_TEXT.get(job.get('kind'), IMPORT_PROGRESS_TEXT)
+    return render_template('admin/import_progress.html',
+                           title=title,
+                           done_message=done_message,
+                           failed_message=failed_message,
+                           job=job,
+                           next_url=next_url)
 
 # เส้นทางสำหรับดาวน์โหลดไฟล์ Template
 @bp.route('/students/download-template')
@@ -1491,32 +1463,6 @@ def download_student_template():
         flash('ไม่พบไฟล์ Template', 'danger')
         return redirect(url_for('admin.list_students'))
 
-def _read_uploaded_file_to_df(file):
-    """
-    Helper function to read an uploaded file (.csv or .xlsx) into a pandas DataFrame.
-    Handles common CSV encodings (UTF-8 and TIS-620).
-    Returns a DataFrame on success, or None on failure.
-    """
-    try:
-        if file.filename.endswith('.csv'):
-            # Ensure reading from the start of the file stream
-            file.seek(0)
-            try:
-                # 1. Try reading with the universal standard (UTF-8)
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                # 2. If it fails, rewind and try the Thai standard (TIS-620)
-                file.seek(0)
-                df = pd.read_csv(file, encoding='tis-620')
-        else:
-            file.seek(0)
-            df = pd.read_excel(file)
-        return df
-    except Exception as e:
-        # Log the error for debugging purposes
-        current_app.logger.error(f"Error reading uploaded file '{file.filename}': {e}")
-        return None
-
 # เส้นทางสำหรับหน้า Import (เวอร์ชันอัปเดต)
 @bp.route('/students/import', methods=['GET', 'POST'])
 def import_students():
@@ -1532,53 +1478,18 @@ def import_students():
             flash('ประเภทไฟล์ไม่ถูกต้อง กรุณาอัปโหลดไฟล์ .csv หรือ .xlsx เท่านั้น', 'danger')
             return redirect(request.url)
 
-        df = _read_uploaded_file_to_df(file)
-        if df is None:
-            flash('เกิดข้อผิดพลาดในการอ่านไฟล์ อาจมีรูปแบบไม่ถูกต้อง', 'danger')
-            return redirect(request.url)
-
-        preview_data = []
         required_columns = ['student_id', 'name_prefix', 'first_name', 'last_name', 'classroom_name', 'roll_number']
-        
-        if not all(col in df.columns for col in required_columns):
-            flash(f'ไฟล์ขาดคอลัมน์ที่จำเป็น กรุณาใช้คอลัมน์เหล่านี้: {", ".join(required_columns)}', 'danger')
+        try:
+            spool, preview_data, summary = build_preview(file, required_columns, build_student_preview, 'import')
+        except UploadFormatError as e:
+            flash(str(e), 'danger')
             return redirect(request.url)
 
-        for index, row in df.iterrows():
-            student_id = str(row['student_id'])
-            classroom_name = str(row['classroom_name'])
-            roll_number = row['roll_number']
-            
-            existing_student = Student.query.filter_by(student_id=student_id).first()
-            classroom = Classroom.query.filter_by(name=classroom_name).first()
-            
-            record = {
-                'row_num': index + 2,
-                'student_id': student_id,
-                'name_prefix': row['name_prefix'],
-                'first_name': row['first_name'],
-                'last_name': row['last_name'],
-                'classroom_name': classroom_name,
-                'roll_number': roll_number,
-                'status': 'Update' if existing_student else 'New',
-                'classroom_found': bool(classroom),
-                'warnings': []
-            }
-            if not classroom:
-                record['warnings'].append(f'ไม่พบห้องเรียน "{classroom_name}"')
-
-            if pd.notna(roll_number) and not str(roll_number).replace('.0', '').isnumeric():
-                record['warnings'].append(f'เลขที่ "{roll_number}" ไม่ใช่ตัวเลข')
+        if not summary['total']:
+            flash('ไฟล์ที่อัปโหลดไม่มีข้อมูลอยู่ภายใน กรุณาตรวจสอบไฟล์อีกครั้ง', 'warning')
+            return redirect(request.url)
 
-            preview_data.append(record)
-        
-        temp_filename = f"import_{uuid.uuid4().hex}.json"
-        temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-        with open(temp_filepath, 'w', encoding='utf-8') as f:
-            json.dump(preview_data, f)
-        
-        session['import_filename'] = temp_filename
+        session['import_filename'] = spool.filename
         form = FlaskForm()
         return render_template('admin/import_preview.html', 
                             title='นำเข้าข้อมูลนักเรียน',
@@ -1586,6 +1497,7 @@ def import_students():
                             required_columns='`student_id`, `name_prefix`, `first_name`, `last_name`, `classroom_name`, `roll_number`',
                             download_url=url_for('admin.download_student_template'),
                             data=preview_data,
+                            summary=summary,
                             form=form)
 
     return render_template('admin/import_students.html', title='นำเข้าข้อมูลนักเรียน', form=form)
@@ -1612,46 +1524,18 @@ def import_teachers():
             flash('กรุณาเลือกไฟล์ที่ต้องการอัปโหลด', 'warning')
             return redirect(request.url)
         
-        df = _read_uploaded_file_to_df(file)
-        if df is None:
-            flash('เกิดข้อผิดพลาดในการอ่านไฟล์ อาจมีรูปแบบไม่ถูกต้อง', 'danger')
+        required_columns = ['temp_id', 'name_prefix', 'first_name', 'last_name']
+        try:
+            spool, preview_data, summary = build_preview(file, required_columns, build_teacher_preview, 'teacher_import')
+        except UploadFormatError as e:
+            flash(str(e), 'danger')
             return redirect(request.url)
 
-        if df.empty:
+        if not summary['total']:
             flash('ไฟล์ที่อัปโหลดไม่มีข้อมูลอยู่ภายใน กรุณาตรวจสอบไฟล์อีกครั้ง', 'warning')
             return redirect(request.url)
-        
-        preview_data = []
-        required_columns = ['temp_id', 'name_prefix', 'first_name', 'last_name']
-        if not all(col in df.columns for col in required_columns):
-            flash(f'ไฟล์ขาดคอลัมน์ที่จำเป็น: {", ".join(required_columns)}', 'danger')
-            return redirect(request.url)
 
-        for index, row in df.iterrows():
-            username = str(row['temp_id'])
-            email = str(row.get('email', '')) if pd.notna(row.get('email')) else ''
-            existing_user = User.query.filter((User.username == username) | ((User.email == email) & (User.email != ''))).first()
-            
-            record = {
-                'row_num': index + 2, 'username': username, 'name_prefix': row['name_prefix'],
-                'first_name': row['first_name'], 'last_name': row['last_name'], 'email': email,
-                'status': 'Update' if existing_user else 'New',
-                'roles': [r.strip() for r in str(row.get('roles', '')).split(',') if r.strip()],
-                'homeroom_classroom': str(row.get('homeroom_classroom', '')) if pd.notna(row.get('homeroom_classroom')) else '',
-                'department_head_of': str(row.get('department_head_of', '')) if pd.notna(row.get('department_head_of')) else '',
-                'subject_group_member_of': str(row.get('subject_group_member_of', '')) if pd.notna(row.get('subject_group_member_of')) else '',
-                'warnings': []
-            }
-            preview_data.append(record)
-        
-        # --- (ส่วนของการบันทึกไฟล์ชั่วคราวและแสดงผลเหมือนเดิม) ---
-        temp_filename = f"teacher_import_{uuid.uuid4().hex}.json"
-        temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-        with open(temp_filepath, 'w', encoding='utf-8') as f:
-            json.dump(preview_data, f)
-        
-        session['teacher_import_filename'] = temp_filename
+        session['teacher_import_filename'] = spool.filename
         
         return render_template('admin/import_teachers_preview.html',
                             title='ตรวจสอบข้อมูลครูก่อนนำเข้า',
@@ -1659,180 +1543,32 @@ def import_teachers():
                             required_columns='`temp_id`, `name_prefix`, `first_name`, `last_name`, `email`, `roles`, `homeroom_classroom`, `department_head_of`, `subject_group_member_of`',
                             download_url=url_for('admin.download_teacher_template'),
                             data=preview_data,
+                            summary=summary,
                             form=form)
     return render_template('admin/import_teachers.html', title='นำเข้าข้อมูลครู', form=form)
 
-@bp.route('/teachers/execute-import', methods=['GET', 'POST'])
+@bp.route('/teachers/execute-import', methods=['POST'])
 @login_required # Make sure login_required is here
 def execute_teacher_import():
-    # 1. รับหมายเลข Batch และหาไฟล์
-    batch = request.args.get('batch', 1, type=int)
-    temp_filename = session.get('teacher_import_filename')
-    
+    """
+    [REVISED v2] Runs the bulk teacher import engine as a background job
+    (batched upserts, pooled password hashing) instead of 20-row redirects.
+    """
+    temp_filename = session.pop('teacher_import_filename', None)
     if not temp_filename:
         flash('ไม่พบข้อมูลสำหรับนำเข้า หรือ Session หมดอายุ', 'warning')
         return redirect(url_for('admin.import_teachers'))
 
-    json_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-
-    if not os.path.exists(json_filepath):
-         flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
-         session.pop('teacher_import_filename', None)
-         return redirect(url_for('admin.import_teachers'))
-
-    try:
-        # 3. อ่านข้อมูลและคำนวณ Batch
-        with open(json_filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        total_items = len(data)
-        if total_items == 0:
-            _cleanup_file(json_filepath)
-            flash('ไฟล์ข้อมูลว่างเปล่า', 'info')
-            session.pop('teacher_import_filename', None)
-            return redirect(url_for('admin.list_users'))
-
-        total_batches = math.ceil(total_items / BATCH_SIZE)
-        start_index = (batch - 1) * BATCH_SIZE
-        end_index = min(batch * BATCH_SIZE, total_items)
-        batch_data = data[start_index:end_index]
-
-        current_app.logger.info(f"Processing teacher import batch {batch}/{total_batches} ({start_index+1} to {end_index})")
-
-        # 4. ประมวลผลข้อมูล
-        new_count = request.args.get('new', 0, type=int)
-        update_count = request.args.get('err', 0, type=int) 
-        error_count = request.args.get('skip', 0, type=int) 
-
-        # --- [ START FIX SAWarning V6 ] ---
-        # Pre-load all existing Roles, Classrooms, and Groups *once* per batch (or even once globally if preferred)
-        # This prevents querying inside the loop, which stops the autoflush warning.
-        
-        # 1. Pre-load Roles
-        all_roles_in_db = Role.query.all()
-        role_map = {role.name: role for role in all_roles_in_db}
-
-        # 2. Pre-load Classrooms (Ideally, filter by current year if possible)
-        all_classrooms_in_db = Classroom.query.all()
-        classroom_map = {c.name: c for c in all_classrooms_in_db}
-        
-        # 3. Pre-load SubjectGroups
-        all_groups_in_db = SubjectGroup.query.all()
-        group_map = {g.name: g for g in all_groups_in_db}
-        # --- [ END FIX SAWarning V6 ] ---
-
-
-        for record in batch_data:
-            try:
-                username = record['username']
-                email = record.get('email', '') if pd.notna(record.get('email')) and record.get('email') else None
-
-                query = db.session.query(User)
-                if email:
-                    user = query.filter(or_(User.username == username, User.email == email)).first()
-                else:
-                    user = query.filter(User.username == username).first()
-
-                if user:
-                    # Update existing user
-                    user.name_prefix = record['name_prefix'] if pd.notna(record['name_prefix']) else None
-                    user.first_name = record['first_name'] if pd.notna(record['first_name']) else ''
-                    user.last_name = record['last_name'] if pd.notna(record['last_name']) else ''
-                    user.email = email
-                    update_count += 1
-                else:
-                    # Create new user
-                    user = User(
-                        username=username,
-                        name_prefix=record['name_prefix'] if pd.notna(record['name_prefix']) else None,
-                        first_name=record['first_name'] if pd.notna(record['first_name']) else '',
-                        last_name=record['last_name'] if pd.notna(record['last_name']) else '',
-                        email=email,
-                        must_change_username=True,
-                        must_change_password=True
-                    )
-                    db.session.add(user)
-                    user.set_password('ntu1234') # (ต้องใช้ pbkdf2 จาก models.py)
-                    new_count += 1
-                
-                # --- [ START FIX SAWarning V6 ] ---
-                # --- Handle Roles (using the pre-loaded map) ---
-                user.roles.clear() 
-                for role_name in record.get('roles', []):
-                    role = role_map.get(role_name) # Get from map (no query)
-                    if not role:
-                        # Create new role if not in map
-                        role = Role(name=role_name, description=f"{role_name} Role")
-                        db.session.add(role)
-                        role_map[role_name] = role # Add to map for this batch
-                    if role not in user.roles:
-                         user.roles.append(role)
-                
-                db.session.flush() # Flush *after* adding new roles, before linking advisors
-
-                # --- Handle Homeroom Advisor (using map) ---
-                homeroom_name = record.get('homeroom_classroom')
-                if homeroom_name:
-                    classroom = classroom_map.get(homeroom_name) # Get from map
-                    if classroom and user not in classroom.advisors:
-                        classroom.advisors.append(user)
-
-                # --- Handle Department Head (using map) ---
-                dept_head_name = record.get('department_head_of')
-                if dept_head_name:
-                    group = group_map.get(dept_head_name) # Get from map
-                    if group:
-                        if user not in group.members: group.members.append(user)
-                        group.head = user
-
-                # --- Handle Subject Group Member (using map) ---
-                member_groups_str = record.get('subject_group_member_of')
-                if member_groups_str:
-                    group_names = [g.strip() for g in member_groups_str.split(',') if g.strip()]
-                    for group_name in group_names:
-                        subj_group = group_map.get(group_name) # Get from map
-                        if subj_group and user not in subj_group.members:
-                            subj_group.members.append(user)
-                # --- [ END FIX SAWarning V6 ] ---
-
-            except IntegrityError as ie:
-                db.session.rollback() # Rollback record ที่ซ้ำ
-                error_count += 1
-                current_app.logger.warning(f"Teacher import skipped duplicate: {username} or {email}. Error: {ie}")
-            except Exception as user_err:
-                db.session.rollback() # Rollback record ที่มีปัญหา
-                error_count += 1
-                error_msg = f"Row {record.get('row_num', '?')} ({record.get('username','?')}) Error: {user_err}"
-                current_app.logger.error(f"Error processing teacher import record: {error_msg}", exc_info=True)
-                continue # ข้ามไปทำรายการถัดไปใน Batch
-
-        db.session.commit() # Commit หลังจากจบ Batch
-
-        # 5. ตัดสินใจขั้นตอนต่อไป
-        if batch >= total_batches:
-            # Batch สุดท้าย: ลบไฟล์และกลับหน้าหลัก
-            _cleanup_file(json_filepath)
-            session.pop('teacher_import_filename', None)
-            flash(f'นำเข้าข้อมูลครูสำเร็จ! (ใหม่: {new_count}, อัปเดต: {update_count}, ข้าม/ผิดพลาด: {error_count})', 'success')
-            return redirect(url_for('admin.list_users'))
-        else:
-            # ยังมี Batch ต่อไป: Redirect ไปยัง Batch ถัดไป
-            flash(f'กำลังประมวลผล... (ส่วนที่ {batch}/{total_batches} - {end_index}/{total_items} รายการ)', 'info')
-            next_url = url_for('admin.execute_teacher_import', 
-                               batch=batch + 1, 
-                               new=new_count, 
-                               err=update_count, 
-                               skip=error_count) 
-            return redirect(next_url)
-
-    except Exception as e:
-        db.session.rollback()
-        _cleanup_file(json_filepath)
-        session.pop('teacher_import_filename', None)
-        current_app.logger.error(f"Critical error during teacher import batch {batch}: {e}", exc_info=True)
-        flash(f'เกิดข้อผิดพลาดร้ายแรงระหว่างประมวลผลส่วนที่ {batch}: {e}', 'danger')
+    spool = PreviewSpool(temp_filename)
+    if not spool.exists():
+        flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
         return redirect(url_for('admin.import_teachers'))
 
+    job_id = start_job('teacher_import', run_spooled_import, run_teacher_import, spool, user_id=current_user.id)
+    current_app.logger.info(f"Started teacher import job {job_id} ({spool.filename})")
+    return redirect(url_for('admin.import_progress', job_id=job_id,
+                            next=url_for('admin.list_users')))
+
 # --- ศูนย์บัญชาการกลุ่มสาระฯ (แทนที่ assign_heads เดิม) ---
 @bp.route('/subject-group/<int:group_id>/manage')
 def manage_subject_group(group_id):
@@ -2056,44 +1792,20 @@ def import_subjects():
             flash('กรุณาเลือกไฟล์ที่ต้องการอัปโหลด', 'warning')
             return redirect(request.url)
         
-        df = _read_uploaded_file_to_df(file)
-        if df is None:
-            flash('เกิดข้อผิดพลาดในการอ่านไฟล์ อาจมีรูปแบบไม่ถูกต้อง', 'danger')
-            return redirect(request.url)
-
-        preview_data = []
         required_columns = ['subject_code', 'name', 'credit', 'subject_group', 'subject_type', 'grade_levels']
-        if not all(col in df.columns for col in required_columns):
-            flash(f'ไฟล์ขาดคอลัมน์ที่จำเป็น: {", ".join(required_columns)}', 'danger')
+        try:
+            spool, preview_data, summary = build_preview(file, required_columns, build_subject_preview, 'subject_import')
+        except UploadFormatError as e:
+            flash(str(e), 'danger')
             return redirect(request.url)
 
-        for index, row in df.iterrows():
-            record = { 'row_num': index + 2, 'warnings': [], 'data': row.to_dict() }
-            
-            if Subject.query.filter_by(subject_code=str(row['subject_code'])).first():
-                record['warnings'].append('รหัสวิชานี้มีอยู่แล้วในระบบ')
-            if not SubjectGroup.query.filter_by(name=str(row['subject_group'])).first():
-                record['warnings'].append(f"ไม่พบกลุ่มสาระฯ '{row['subject_group']}'")
-            if not SubjectType.query.filter_by(name=str(row['subject_type'])).first():
-                record['warnings'].append(f"ไม่พบประเภทวิชา '{row['subject_type']}'")
-            
-            grade_levels_str = str(row.get('grade_levels', ''))
-            grade_short_names = [g.strip() for g in grade_levels_str.split(',') if g.strip()]
-            found_grades = GradeLevel.query.filter(GradeLevel.short_name.in_(grade_short_names)).all()
-            if len(found_grades) != len(grade_short_names):
-                record['warnings'].append('พบชื่อย่อระดับชั้นบางส่วนที่ไม่มีอยู่จริง')
+        if not summary['total']:
+            flash('ไฟล์ที่อัปโหลดไม่มีข้อมูลอยู่ภายใน กรุณาตรวจสอบไฟล์อีกครั้ง', 'warning')
+            return redirect(request.url)
 
-            preview_data.append(record)
+        session['subject_import_filename'] = spool.filename
         
-        # --- (ส่วนของการบันทึกไฟล์ชั่วคราวและแสดงผลเหมือนเดิม) ---
-        temp_filename = f"subject_import_{uuid.uuid4().hex}.json"
-        temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-        with open(temp_filepath, 'w', encoding='utf-8') as f:
-            json.dump(preview_data, f)
-        session['subject_import_filename'] = temp_filename
-        
-        return render_template('admin/import_subjects_preview.html', title='ตรวจสอบข้อมูลรายวิชาก่อนนำเข้า', data=preview_data, form=form)
+        return render_template('admin/import_subjects_preview.html', title='ตรวจสอบข้อมูลรายวิชาก่อนนำเข้า', data=preview_data, summary=summary, form=form)
             
     return render_template('admin/import_subjects.html',
                         title='นำเข้าข้อมูลรายวิชา',
@@ -2103,120 +1815,28 @@ def import_subjects():
                         upload_form=FlaskForm(),
                         form=form)
 
-@bp.route('/subjects/execute-import', methods=['GET', 'POST'])
-@login_required # Make sure login_required is here
+@bp.route('/subjects/execute-import', methods=['POST'])
+@login_required
 def execute_subject_import():
-    # 1. รับหมายเลข Batch และหาไฟล์
-    batch = request.args.get('batch', 1, type=int)
-    temp_filename = session.get('subject_import_filename')
-    
+    """
+    [REVISED v2] Runs the bulk subject import engine as a background job
+    instead of 20-row redirects.
+    """
+    temp_filename = session.pop('subject_import_filename', None)
     if not temp_filename:
         flash('ไม่พบข้อมูลสำหรับนำเข้า หรือ Session หมดอายุ', 'warning')
         return redirect(url_for('admin.import_subjects'))
 
-    json_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-
-    if not os.path.exists(json_filepath):
-         flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
-         session.pop('subject_import_filename', None)
-         return redirect(url_for('admin.import_subjects'))
-
-    try:
-        # 3. อ่านข้อมูลและคำนวณ Batch
-        with open(json_filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        total_items = len(data)
-        if total_items == 0:
-            _cleanup_file(json_filepath)
-            flash('ไฟล์ข้อมูลว่างเปล่า', 'info')
-            session.pop('subject_import_filename', None)
-            return redirect(url_for('admin.list_subjects'))
-
-        total_batches = math.ceil(total_items / BATCH_SIZE)
-        start_index = (batch - 1) * BATCH_SIZE
-        end_index = min(batch * BATCH_SIZE, total_items)
-        batch_data = data[start_index:end_index]
-
-        current_app.logger.info(f"Processing subject import batch {batch}/{total_batches} ({start_index+1} to {end_index})")
-
-        # 4. ประมวลผลข้อมูล (Logic จาก tasks.py)
-        imported_count = request.args.get('new', 0, type=int)
-        skipped_count = request.args.get('skip', 0, type=int)
-        error_count = request.args.get('err', 0, type=int)
-        
-        # Pre-load lookups
-        all_groups = {g.name: g for g in SubjectGroup.query.all()}
-        all_types = {t.name: t for t in SubjectType.query.all()}
-        all_grades = {gl.short_name: gl for gl in GradeLevel.query.all()}
-
-        for record in batch_data:
-            try:
-                # Skip rows with warnings (except for 'already exists')
-                if any(w != 'รหัสวิชานี้มีอยู่แล้วในระบบ' for w in record['warnings']):
-                    skipped_count += 1
-                    continue
-
-                data_row = record['data']
-                subject_code_str = str(data_row['subject_code'])
-
-                if Subject.query.filter_by(subject_code=subject_code_str).first():
-                    skipped_count += 1
-                    continue
-
-                subject_group = all_groups.get(str(data_row['subject_group']))
-                subject_type = all_types.get(str(data_row['subject_type']))
-                grade_levels_str = str(data_row.get('grade_levels', ''))
-                grade_short_names = [g.strip() for g in grade_levels_str.split(',') if g.strip()]
-                grades = [all_grades.get(g_name) for g_name in grade_short_names if all_grades.get(g_name)]
-
-                if not subject_group or not subject_type or len(grades) != len(grade_short_names):
-                     error_count += 1
-                     current_app.logger.warning(f"Row {record.get('row_num', '?')} ({subject_code_str}): Related data missing in DB (Group, Type, or Grade).")
-                     continue
-
-                new_subject = Subject(
-                    subject_code=subject_code_str,
-                    name=str(data_row['name']),
-                    credit=float(data_row['credit']),
-                    subject_group=subject_group,
-                    subject_type=subject_type,
-                    grade_levels=grades
-                )
-                db.session.add(new_subject)
-                imported_count += 1
-
-            except Exception as rec_err:
-                 db.session.rollback()
-                 error_count += 1
-                 current_app.logger.error(f"Error processing subject import record {record['data'].get('subject_code','?')}: {rec_err}", exc_info=True)
-                 continue
-
-        db.session.commit() # Commit หลังจากจบ Batch
-
-        # 5. ตัดสินใจขั้นตอนต่อไป
-        if batch >= total_batches:
-            _cleanup_file(json_filepath)
-            session.pop('subject_import_filename', None)
-            flash(f'นำเข้าข้อมูลรายวิชาสำเร็จ! (ใหม่: {imported_count}, ข้าม: {skipped_count}, ผิดพลาด: {error_count})', 'success')
-            return redirect(url_for('admin.list_subjects'))
-        else:
-            flash(f'กำลังประมวลผล... (ส่วนที่ {batch}/{total_batches} - {end_index}/{total_items} รายการ)', 'info')
-            next_url = url_for('admin.execute_subject_import', 
-                               batch=batch + 1, 
-                               new=imported_count, 
-                               skip=skipped_count, 
-                               err=error_count)
-            return redirect(next_url)
-
-    except Exception as e:
-        db.session.rollback()
-        _cleanup_file(json_filepath)
-        session.pop('subject_import_filename', None)
-        current_app.logger.error(f"Critical error during subject import batch {batch}: {e}", exc_info=True)
-        flash(f'เกิดข้อผิดพลาดร้ายแรงระหว่างประมวลผลส่วนที่ {batch}: {e}', 'danger')
+    spool = PreviewSpool(temp_filename)
+    if not spool.exists():
+        flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
         return redirect(url_for('admin.import_subjects'))
 
+    job_id = start_job('subject_import', run_spooled_import, run_subject_import, spool, user_id=current_user.id)
+    current_app.logger.info(f"Started subject import job {job_id} ({spool.filename})")
+    return redirect(url_for('admin.import_progress', job_id=job_id,
+                            next=url_for('admin.list_subjects')))
+
 @bp.route('/assignments', methods=['GET'])
 # @login_required # หมายเหตุ: หากระบบ login พร้อมใช้งานแล้ว สามารถเปิดใช้งานบรรทัดนี้ได้
 def manage_assignments():
@@ -2600,54 +2220,18 @@ def import_standards():
             flash('ประเภทไฟล์ไม่ถูกต้อง กรุณาอัปโหลดไฟล์ .csv หรือ .xlsx เท่านั้น', 'danger')
             return redirect(request.url)
 
-        df = _read_uploaded_file_to_df(file)
-        if df is None:
-            flash('เกิดข้อผิดพลาดในการอ่านไฟล์ อาจมีรูปแบบไม่ถูกต้อง', 'danger')
-            return redirect(request.url)
-        if df.empty:
+        required_columns = ['subject_group', 'strand', 'standard_code', 'standard_description', 'indicator_code', 'indicator_description']
+        try:
+            spool, _, summary = build_preview(file, required_columns, build_standards_preview, 'standards_import')
+        except UploadFormatError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('admin.import_standards'))
+
+        if not summary['total']:
             flash('ไฟล์ที่อัปโหลดไม่มีข้อมูลอยู่ภายใน กรุณาตรวจสอบไฟล์อีกครั้ง', 'warning')
             return redirect(request.url)
 
-        required_columns = ['subject_group', 'strand', 'standard_code', 'standard_description', 'indicator_code', 'indicator_description']
-        if not all(col in df.columns for col in required_columns):
-            flash('ไฟล์ Excel ต้องมีคอลัมน์: ' + ', '.join(required_columns), 'danger')
-            return redirect(url_for('admin.import_standards')) # ใช้ redirect(url_for(...))
-
-        preview_data = []
-        for index, row in df.iterrows():
-            record = {
-                'row_num': index + 2,
-                'subject_group': str(row['subject_group']),
-                'strand': str(row['strand']),
-                'standard_code': str(row['standard_code']),
-                'standard_description': str(row['standard_description']),
-                'indicator_code': str(row['indicator_code']),
-                'indicator_description': str(row['indicator_description']),
-                'warnings': []
-            }
-            # *** ตรวจสอบ Standard ซ้ำ (Logic เดิม) ***
-            # (ตรวจสอบ Standard ซ้ำที่นี่...)
-            standard = Standard.query.filter_by(code=record['standard_code']).first()
-            if standard:
-                 # Check if the existing standard belongs to the *same* strand and group
-                 strand = LearningStrand.query.filter_by(name=record['strand']).join(SubjectGroup).filter(SubjectGroup.name==record['subject_group']).first()
-                 if strand and standard.learning_strand_id == strand.id:
-                      # Now check indicator
-                      indicator = Indicator.query.filter_by(standard_id=standard.id, code=record['indicator_code']).first()
-                      if indicator:
-                           record['warnings'].append(f"มาตรฐาน/ตัวชี้วัด {record['standard_code']}/{record['indicator_code']} มีอยู่แล้ว")
-                 # If strand doesn't match, it's potentially okay, but maybe add a different warning?
-            
-            preview_data.append(record)
-
-        temp_filename = f"standards_import_{uuid.uuid4().hex}.json"
-        temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-        # *** ตรวจสอบและสร้างโฟลเดอร์ (Logic เดิม) ***
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True) 
-        with open(temp_filepath, 'w', encoding='utf-8') as f:
-            json.dump(preview_data, f)
-        
-        session['import_temp_file'] = temp_filename
+        session['import_temp_file'] = spool.filename
         return redirect(url_for('admin.import_standards_preview')) # Redirect หลัง POST สำเร็จ
             
     # *** ส่ง form ตัวเดียวกันนี้ไปให้ Template ตอน GET ***
@@ -2663,16 +2247,16 @@ def import_standards_preview():
         flash('ไม่พบข้อมูลสำหรับแสดงตัวอย่าง', 'warning')
         return redirect(url_for('admin.import_standards'))
         
-    temp_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
+    spool = PreviewSpool(temp_filename)
     try:
-        with open(temp_filepath, 'r', encoding='utf-8') as f:
-            # โหลดข้อมูลดิบ (เป็น list of dictionaries)
-            raw_data = json.load(f)
+        # โหลดเฉพาะแถวแรก ๆ มาแสดง (ไฟล์ใหญ่ไม่ต้องโหลดทั้งก้อน)
+        raw_data = spool.head()
 
         # แปลงโครงสร้างข้อมูลให้เข้ากับ Template เวอร์ชันเก่า
         preview_data_for_template = {
             'headers': [],
-            'rows': []
+            'rows': [],
+            'total': len(spool)
         }
         if raw_data: # ตรวจสอบว่ามีข้อมูลหรือไม่
             # ใช้ข้อมูลแถวแรกสุดเพื่อสร้าง Headers
@@ -2694,138 +2278,33 @@ def import_standards_preview():
         flash(f'เกิดข้อผิดพลาดในการแสดงผลตัวอย่าง: {e}', 'danger')
         return redirect(url_for('admin.import_standards'))
 
-@bp.route('/execute-import-standards', methods=['GET', 'POST']) # <-- ตรวจสอบว่ามี GET, POST
+@bp.route('/execute-import-standards', methods=['POST'])
 @login_required
 def execute_import_standards():
+    """
+    [REVISED v2] Runs the hierarchical bulk upsert (strand -> standard ->
+    indicator) as a background job; the progress page shows its diff summary.
+    """
+    form = DummyForm()
+    if not form.validate_on_submit():
+        flash('CSRF Token ไม่ถูกต้อง หรือ Session หมดอายุ', 'danger')
+        return redirect(url_for('admin.import_standards'))
 
-    # --- [ START V21.1 FIX ] ---
-    # ตรวจสอบ CSRF เฉพาะเมื่อเป็น POST request (Batch 1) เท่านั้น
-    if request.method == 'POST':
-        form = DummyForm() # สร้าง Form เฉพาะตอน POST
-        if not form.validate_on_submit():
-            flash('CSRF Token ไม่ถูกต้อง หรือ Session หมดอายุ', 'danger')
-            return redirect(url_for('admin.import_standards'))
-    # --- [ END V21.1 FIX ] ---
-
-    # --- ส่วน Logic การทำงาน Batch (เหมือนเดิม) ---
-    batch = request.args.get('batch', 1, type=int)
-    temp_filename = session.get('import_temp_file')
-
+    temp_filename = session.pop('import_temp_file', None)
     if not temp_filename:
         flash('ไม่พบข้อมูลสำหรับนำเข้า หรือ Session หมดอายุ', 'warning')
         return redirect(url_for('admin.import_standards'))
 
-    json_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], temp_filename)
-
-    if not os.path.exists(json_filepath):
-         flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
-         session.pop('import_temp_file', None)
-         return redirect(url_for('admin.import_standards'))
-
-    try:
-        # อ่านข้อมูลและคำนวณ Batch
-        with open(json_filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        total_items = len(data)
-        if total_items == 0:
-            _cleanup_file(json_filepath)
-            flash('ไฟล์ข้อมูลว่างเปล่า', 'info')
-            session.pop('import_temp_file', None)
-            return redirect(url_for('admin.manage_standards'))
-
-        total_batches = math.ceil(total_items / BATCH_SIZE)
-        start_index = (batch - 1) * BATCH_SIZE
-        end_index = min(batch * BATCH_SIZE, total_items)
-        batch_data = data[start_index:end_index]
-
-        current_app.logger.info(f"Processing standard import batch {batch}/{total_batches} ({start_index+1} to {end_index})")
-
-        # ประมวลผลข้อมูล
-        imported_count = request.args.get('new', 0, type=int)
-        skipped_count = request.args.get('skip', 0, type=int)
-        error_count = request.args.get('err', 0, type=int)
-
-        all_groups = {g.name: g for g in SubjectGroup.query.all()}
-        all_strands = {(s.name, s.subject_group_id): s for s in LearningStrand.query.all()}
-        all_standards = {(s.code, s.learning_strand_id): s for s in Standard.query.all()}
-
-        for row in batch_data:
-            try:
-                if 'warnings' in row and row['warnings']:
-                    skipped_count += 1
-                    continue
-
-                group_name = row.get('subject_group')
-                subject_group = all_groups.get(group_name)
-                if not subject_group:
-                    subject_group = SubjectGroup(name=group_name)
-                    db.session.add(subject_group)
-                    db.session.flush()
-                    all_groups[group_name] = subject_group
-
-                strand_name = row.get('strand')
-                strand = all_strands.get((strand_name, subject_group.id))
-                if not strand:
-                    strand = LearningStrand(name=strand_name, subject_group=subject_group)
-                    db.session.add(strand)
-                    db.session.flush()
-                    all_strands[(strand_name, subject_group.id)] = strand
-
-                std_code = row.get('standard_code')
-                standard = all_standards.get((std_code, strand.id))
-                if not standard:
-                    standard = Standard(code=std_code, description=row.get('standard_description'), learning_strand=strand)
-                    db.session.add(standard)
-                    db.session.flush()
-                    all_standards[(std_code, strand.id)] = standard
-
-                indicator_code = row.get('indicator_code')
-                existing_indicator = Indicator.query.filter_by(standard_id=standard.id, code=indicator_code).first()
-                if existing_indicator:
-                     skipped_count += 1
-                     continue
-
-                indicator = Indicator(
-                    standard_id=standard.id,
-                    code=indicator_code,
-                    description=row.get('indicator_description'),
-                    creator_type='ADMIN'
-                )
-                db.session.add(indicator)
-                imported_count += 1
-
-            except Exception as rec_err:
-                 db.session.rollback()
-                 error_count += 1
-                 current_app.logger.error(f"Error processing standard import record {row.get('standard_code','?')}: {rec_err}", exc_info=True)
-                 continue
-
-        db.session.commit()
-
-        # ตัดสินใจขั้นตอนต่อไป
-        if batch >= total_batches:
-            _cleanup_file(json_filepath)
-            session.pop('import_temp_file', None)
-            flash(f'นำเข้าข้อมูลมาตรฐานสำเร็จ! (ใหม่: {imported_count}, ข้าม: {skipped_count}, ผิดพลาด: {error_count})', 'success')
-            return redirect(url_for('admin.manage_standards'))
-        else:
-            flash(f'กำลังประมวลผล... (ส่วนที่ {batch}/{total_batches} - {end_index}/{total_items} รายการ)', 'info')
-            next_url = url_for('admin.execute_import_standards',
-                               batch=batch + 1,
-                               new=imported_count,
-                               skip=skipped_count,
-                               err=error_count)
-            return redirect(next_url)
-
-    except Exception as e:
-        db.session.rollback()
-        _cleanup_file(json_filepath)
-        session.pop('import_temp_file', None)
-        current_app.logger.error(f"Critical error during standard import batch {batch}: {e}", exc_info=True)
-        flash(f'เกิดข้อผิดพลาดร้ายแรงระหว่างประมวลผลส่วนที่ {batch}: {e}', 'danger')
+    spool = PreviewSpool(temp_filename)
+    if not spool.exists():
+        flash(f'ไม่พบไฟล์นำเข้าชั่วคราว ({temp_filename}) กรุณาลองอัปโหลดใหม่อีกครั้ง', 'danger')
         return redirect(url_for('admin.import_standards'))
 
+    job_id = start_job('standards_import', run_spooled_import, run_standards_import, spool, user_id=current_user.id)
+    current_app.logger.info(f"Started standards import job {job_id} ({spool.filename})")
+    return redirect(url_for('admin.import_progress', job_id=job_id,
+                            next=url_for('admin.manage_standards')))
+
 @bp.route('/download-indicator-template')
 # @login_required
 def download_indicator_template():
@@ -3854,10 +3333,14 @@ def promote_students_page():
                            form=form,
                            academic_years=academic_years)
 
-@bp.route('/promote-students/execute', methods=['GET']) # Use GET for simplicity, POST recommended for actions
+@bp.route('/promote-students/execute', methods=['GET', 'POST'])
 @login_required
 # @admin_required
 def execute_promotion():
+    """
+    [REVISED] GET shows the dry-run plan (per-classroom promoted / flagged /
+    graduated counts); POST runs the promotion as a background job.
+    """
     source_year_id = session.get('promotion_source_year_id')
     target_year_id = session.get('promotion_target_year_id')
 
@@ -3865,33 +3348,91 @@ def execute_promotion():
         flash('ไม่พบข้อมูลปีการศึกษาสำหรับดำเนินการเลื่อนชั้น', 'warning')
         return redirect(url_for('admin.promote_students_page'))
 
-    # Clear session variables
-    session.pop('promotion_source_year_id', None)
-    session.pop('promotion_target_year_id', None)
+    form = FlaskForm()
+    if request.method == 'POST':
+        if not form.validate_on_submit():
+            flash('Invalid request (CSRF token missing or expired)', 'danger')
+            return redirect(url_for('admin.execute_promotion'))
+        # Clear session variables
+        session.pop('promotion_source_year_id', None)
+        session.pop('promotion_target_year_id', None)
+
+        job_id = start_job('student_promotion', run_promotion_job, source_year_id, target_year_id,
+                           user_id=current_user.id)
+        current_app.logger.info(f"Started promotion job {job_id} ({source_year_id} -> {target_year_id})")
+        return redirect(url_for('admin.import_progress', job_id=job_id,
+                                next=url_for('admin.list_students')))
+
+    plan = promote_students_to_next_year(source_year_id, target_year_id, dry_run=True)
+    if 'classrooms' not in plan:
+        for error in plan.get('errors', []):
+            flash(f'ข้อผิดพลาด: {error}', 'danger')
+        return redirect(url_for('admin.promote_students_page'))
+
+    return render_template('admin/promote_students_preview.html',
+                           title='ตรวจสอบแผนการเลื่อนชั้น',
+                           form=form,
+                           plan=plan,
+                           source_year=db.session.get(AcademicYear, source_year_id),
+                           target_year=db.session.get(AcademicYear, target_year_id))
 
-    # Call the service function
-    result = promote_students_to_next_year(source_year_id, target_year_id)
+@bp.route('/lesson-plans/rollover', methods=['GET', 'POST'])
+@login_required
+# @admin_required
+def lesson_plan_rollover():
+    """[NEW] Copies every lesson plan of one academic year into another as a background job."""
+    form = FlaskForm()
+    academic_years = AcademicYear.query.order_by(AcademicYear.year.desc()).all()
+    subject_groups = SubjectGroup.query.order_by(SubjectGroup.name).all()
 
-    # Display results
-    if result.get('errors'):
-        for error in result['errors']:
-            flash(f'ข้อผิดพลาด: {error}', 'danger')
-    else:
-        flash(f"ดำเนินการเลื่อนชั้นสำเร็จ: เลื่อนชั้น {result.get('promoted', 0)} คน, "
-              f"จบการศึกษา {result.get('graduated', 0)} คน, "
-              f"รอพิจารณาซ้ำชั้น {result.get('flagged_repeat', 0)} คน", 'success')
+    if request.method == 'POST':
+        if not form.validate_on_submit():
+            flash('Invalid request (CSRF token missing or expired)', 'danger')
+            return redirect(url_for('admin.lesson_plan_rollover'))
+        source_year_id = request.form.get('source_year_id', type=int)
+        target_year_id = request.form.get('target_year_id', type=int)
+        subject_group_id = request.form.get('subject_group_id', type=int)
 
-    # Redirect back to the list of students or another appropriate page
-    return redirect(url_for('admin.list_students'))    
+        if not source_year_id or not target_year_id:
+            flash('กรุณาเลือกปีการศึกษาต้นทางและปลายทาง', 'danger')
+            return redirect(url_for('admin.lesson_plan_rollover'))
+        if source_year_id == target_year_id:
+            flash('ปีการศึกษาต้นทางและปลายทางต้องแตกต่างกัน', 'danger')
+            return redirect(url_for('admin.lesson_plan_rollover'))
+
+        subject_ids = None
+        if subject_group_id:
+            subject_ids = [sid for (sid,) in db.session.query(Subject.id).filter_by(subject_group_id=subject_group_id).all()]
+
+        job_id = start_job('lesson_plan_rollover', run_lesson_plan_rollover_job, source_year_id, target_year_id,
+                           subject_ids, user_id=current_user.id)
+        current_app.logger.info(f"Started lesson plan rollover job {job_id} ({source_year_id} -> {target_year_id})")
+        return redirect(url_for('admin.import_progress', job_id=job_id,
+                                next=url_for('admin.lesson_plan_rollover')))
+
+    # จำนวนแผนต่อปี ให้เห็นก่อนเลือก
+    plan_counts = dict(db.session.query(LessonPlan.academic_year_id, func.count(LessonPlan.id)).group_by(
+        LessonPlan.academic_year_id).all())
+    return render_template('admin/lesson_plan_rollover.html',
+                           title='คัดลอกแผนการสอนข้ามปีการศึกษา',
+                           form=form,
+                           academic_years=academic_years,
+                           subject_groups=subject_groups,
+                           plan_counts=plan_counts)
 
 @bp.route('/api/users/simple-list') # Adjust blueprint ('bp') if needed
 @login_required # Or remove if public access is intended
 def get_simple_user_list():
-    """ Returns a simple list of users (ID and Full Name). """
+    """
+    Returns a simple list of users (ID and Full Name).
+    [REVISED] Served from app.typeahead; ``?q=`` filters by name/username
+    (capped by ``?limit=``), without it the full list is returned as before.
+    """
     try:
-        users = User.query.order_by(User.first_name, User.last_name).all()
-        user_list = [{'id': u.id, 'full_name': u.full_name} for u in users]
-        return jsonify(user_list)
+        query = request.args.get('q', '').strip()
+        users = search_source(SOURCE_USERS, query, parse_limit(request.args.get('limit'))) if query \
+            else get_index(SOURCE_USERS).items
+        return typeahead_response([{'id': u['id'], 'full_name': u['full_name']} for u in users])
     except Exception as e:
         # Log the error
         current_app.logger.error(f"Error fetching simple user list: {e}")
@@ -3910,7 +3451,7 @@ def backup_restore_page():
 @login_required
 # @admin_required
 def backup_create_api():
-    """Creates a backup zip containing the database and uploaded files."""
+    """[REVISED] Streams a backup zip (online DB snapshot and/or logical dump + uploads) straight to the client."""
     # --- [START LOG] Log backup start ---
     log_action("Backup Started")
     try:
@@ -3920,103 +3461,49 @@ def backup_create_api():
         current_app.logger.error(f"Failed to commit backup start log: {log_err}")
     # --- [END LOG] ---
 
-    backup_stage_path = None # Define for potential cleanup in except block
-    final_zip_path = None    # Define for potential cleanup in except block
-
+    archive = BackupArchive(current_app._get_current_object(), include_logical=request.form.get('include_logical') == '1')
     try:
-        # --- Configuration ---
-        db_uri = current_app.config.get('SQLALCHEMY_DATABASE_URI', '')
-        uploads_folder = current_app.config.get('UPLOAD_FOLDER', os.path.join(current_app.root_path, 'static', 'uploads'))
-        backup_temp_dir = os.path.join(current_app.instance_path, 'backup_temp')
-
-        # --- Timestamp and Temp Directory ---
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename_base = f"edhub_backup_{timestamp}"
-        os.makedirs(backup_temp_dir, exist_ok=True)
-        backup_stage_path = os.path.join(backup_temp_dir, backup_filename_base)
-        os.makedirs(backup_stage_path, exist_ok=True)
-
-        db_backup_successful = False
-        db_backup_filename = None
-
-        # --- 1. Backup Database ---
-        if db_uri.startswith('sqlite:///'):
-            db_path = db_uri.split('sqlite:///')[-1]
-            if os.path.exists(db_path):
-                db_backup_filename = f"database_{timestamp}.db"
-                shutil.copy2(db_path, os.path.join(backup_stage_path, db_backup_filename))
-                db_backup_successful = True
-            else:
-                 current_app.logger.error(f"SQLite DB file not found at: {db_path}")
-                 raise ValueError("ไม่พบไฟล์ฐานข้อมูล SQLite")
-        # --- Add logic for PostgreSQL/MySQL ---
-        else:
-             raise NotImplementedError("ประเภทฐานข้อมูลนี้ยังไม่รองรับการสำรองข้อมูลอัตโนมัติ")
-
-        if not db_backup_successful:
-             raise ValueError("ไม่สามารถสำรองข้อมูลฐานข้อมูลได้")
-
-        # --- 2. Backup Uploaded Files ---
-        files_backup_filename = f"uploads_{timestamp}.zip"
-        files_zip_path = os.path.join(backup_stage_path, files_backup_filename)
-        if os.path.exists(uploads_folder) and os.path.isdir(uploads_folder):
-            with zipfile.ZipFile(files_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, _, files in os.walk(uploads_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, uploads_folder)
-                        zipf.write(file_path, arcname)
-        else:
-            with zipfile.ZipFile(files_zip_path, 'w') as zipf: pass # Create empty zip
-            current_app.logger.warning(f"Uploads folder not found: {uploads_folder}. Created empty zip.")
-
-        # --- 3. Combine into a single Zip file ---
-        final_zip_filename = f"{backup_filename_base}.zip"
-        final_zip_path = os.path.join(backup_temp_dir, final_zip_filename)
-        with zipfile.ZipFile(final_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-             zipf.write(os.path.join(backup_stage_path, db_backup_filename), arcname=db_backup_filename)
-             zipf.write(files_zip_path, arcname=files_backup_filename)
-
-        # --- Clean up staged files ---
-        shutil.rmtree(backup_stage_path)
+        archive.prepare() # snapshot ก่อนเริ่มส่ง response เพื่อให้แจ้ง error ได้ตามปกติ
+    except Exception as e:
+        archive.cleanup()
+        current_app.logger.error(f"Backup creation failed: {e}", exc_info=True)
+        _log_backup_result(f"Backup Failed: {type(e).__name__}", {'error': str(e)})
+        flash(f"การสร้างไฟล์สำรองข้อมูลล้มเหลว: {str(e)}", 'danger')
+        return redirect(url_for('admin.backup_restore_page'))
 
-        # --- [START LOG] Log backup success ---
-        log_action("Backup Success", new_value={'filename': final_zip_filename})
+    def generate():
         try:
-            db.session.commit() # Commit success log
-        except Exception as log_err:
-            db.session.rollback()
-            current_app.logger.error(f"Failed to commit backup success log: {log_err}")
-        # --- [END LOG] ---
+            yield from archive.stream()
+        except Exception as e:
+            # header ถูกส่งไปแล้ว ทำได้แค่ตัดการเชื่อมต่อ (zip ที่ได้จะไม่สมบูรณ์และเปิดไม่ได้)
+            current_app.logger.error(f"Backup streaming failed: {e}", exc_info=True)
+            _log_backup_result(f"Backup Failed: {type(e).__name__}", {'filename': archive.filename, 'error': str(e)})
+            raise
+        else:
+            _log_backup_result("Backup Success", {'filename': archive.filename,
+                                                  'members': len(archive.manifest['members'])})
+        finally:
+            archive.cleanup()
 
-        # --- 4. Send the final Zip file for download ---
-        return send_file(final_zip_path, as_attachment=True, download_name=final_zip_filename)
+    return Response(stream_with_context(generate()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{archive.filename}"',
+                             'X-Accel-Buffering': 'no'})
 
-    except Exception as e:
-        current_app.logger.error(f"Backup creation failed: {e}", exc_info=True)
-        # Clean up temporary files on error
-        if backup_stage_path and os.path.exists(backup_stage_path):
-             shutil.rmtree(backup_stage_path)
-        if final_zip_path and os.path.exists(final_zip_path):
-             os.remove(final_zip_path)
-
-        # --- [START LOG] Log backup failure ---
-        log_action(f"Backup Failed: {type(e).__name__}", new_value={'error': str(e)})
-        try:
-            db.session.commit() # Commit failure log
-        except Exception as log_err:
-             db.session.rollback()
-             current_app.logger.error(f"Failed to commit backup failure log: {log_err}")
-        # --- [END LOG] ---
 
-        return jsonify({"status": "error", "message": f"การสร้างไฟล์สำรองข้อมูลล้มเหลว: {str(e)}"}), 500
+def _log_backup_result(action, new_value):
+    log_action(action, new_value=new_value)
+    try:
+        db.session.commit()
+    except Exception as log_err:
+        db.session.rollback()
+        current_app.logger.error(f"Failed to commit backup log: {log_err}")
 
 # --- API Route for Restoring Data ---
 @bp.route('/api/backup/restore', methods=['POST'])
 @login_required
 # @admin_required
 def backup_restore_api():
-    restore_temp_dir = os.path.join(current_app.instance_path, 'restore_temp')
+    """[REVISED] Restores a backup zip by streaming its members into verified staging copies, then swapping them in."""
     filename = None # Define filename early for logging
 
     # --- [START LOG] Log restore start ---
@@ -4040,62 +3527,19 @@ def backup_restore_api():
 
         filename = secure_filename(backup_zip_file.filename) # Store filename for logging
 
-        # --- Configuration ---
-        db_uri = current_app.config.get('SQLALCHEMY_DATABASE_URI', '')
-        uploads_folder = current_app.config.get('UPLOAD_FOLDER', os.path.join(current_app.root_path, 'static', 'uploads'))
-
-        # --- Prepare Temp Directory ---
-        if os.path.exists(restore_temp_dir):
-            shutil.rmtree(restore_temp_dir)
-        os.makedirs(restore_temp_dir, exist_ok=True)
-
-        # --- Use Stream Processing and Validation ---
-        extracted_db_path = None
-        extracted_uploads_zip_path = None
-        with zipfile.ZipFile(backup_zip_file.stream, 'r') as zip_ref:
-            current_app.logger.info(f"Successfully opened uploaded zip file: {filename}")
-            extracted_files = zip_ref.namelist()
-            for fname in extracted_files:
-                if fname.endswith(('.db', '.sql')):
-                    extracted_db_path = os.path.join(restore_temp_dir, fname)
-                elif fname.startswith('uploads_') and fname.endswith('.zip'):
-                    extracted_uploads_zip_path = os.path.join(restore_temp_dir, fname)
-            zip_ref.extractall(restore_temp_dir)
-            current_app.logger.info(f"Extracted contents to: {restore_temp_dir}")
-
-        if not extracted_db_path or not os.path.exists(extracted_db_path):
-             raise ValueError("ไม่พบไฟล์ฐานข้อมูล (.db หรือ .sql) หลังจากแตกไฟล์ Zip")
-
-        # --- !! DANGER ZONE: Perform Restore !! ---
-        # 1. Restore Database
-        if db_uri.startswith('sqlite:///'):
-            db_path = db_uri.split('sqlite:///')[-1]
-            os.makedirs(os.path.dirname(db_path), exist_ok=True)
-            # Make a backup of the current DB before overwriting (optional but recommended)
-            current_db_backup_path = f"{db_path}.before_restore_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            if os.path.exists(db_path): shutil.copy2(db_path, current_db_backup_path)
-            # Replace
-            shutil.move(extracted_db_path, db_path)
-            current_app.logger.info(f"SQLite DB restored from {os.path.basename(extracted_db_path)} to {db_path}")
-        # --- Add logic for PostgreSQL/MySQL ---
-        else:
-             raise NotImplementedError("ประเภทฐานข้อมูลนี้ยังไม่รองรับการกู้คืนข้อมูลอัตโนมัติ")
-
-        # 2. Restore Uploaded Files
-        if extracted_uploads_zip_path and os.path.exists(extracted_uploads_zip_path):
-            if os.path.exists(uploads_folder): shutil.rmtree(uploads_folder) # Clear existing
-            os.makedirs(uploads_folder, exist_ok=True)
-            with zipfile.ZipFile(extracted_uploads_zip_path, 'r') as zip_ref:
-                 zip_ref.extractall(uploads_folder)
-            current_app.logger.info(f"Uploaded files restored from {os.path.basename(extracted_uploads_zip_path)} to {uploads_folder}")
-        else:
-             current_app.logger.warning("Uploads zip file not found. Skipping file restore.")
+        # --- Stream, verify and swap (ไม่แตกไฟล์ทั้งก้อน ไม่แตะข้อมูลจริงจนกว่าจะตรวจครบ) ---
+        db.session.remove() # คืน connection ของ request นี้ก่อนเขียนทับฐานข้อมูล
+        summary = ArchiveRestore(current_app._get_current_object(), backup_zip_file.stream).run()
+        current_app.logger.info(f"Restore from {filename} finished: database={summary['database']}, "
+                                f"files={summary['files']}, warnings={summary['warnings']}")
 
-        # --- Clean up Temp Directory ---
-        shutil.rmtree(restore_temp_dir)
+        # ดัชนีค้นหาไม่ได้อยู่ในข้อมูลสำรองแบบ logical: สร้างใหม่ทันที
+        ensure_indicator_search_index()
+        ensure_global_search_index()
 
         # --- [START LOG] Log restore success ---
-        log_action("Restore Success", new_value={'filename': filename})
+        log_action("Restore Success", new_value={'filename': filename, 'database': summary['database'],
+                                                 'files': summary['files']})
         try:
             db.session.commit() # Commit success log
         except Exception as log_err:
@@ -4104,22 +3548,22 @@ def backup_restore_api():
         # --- [END LOG] ---
 
         flash('กู้คืนข้อมูลสำเร็จ! ระบบอาจต้องใช้เวลาสักครู่ในการโหลดข้อมูลใหม่', 'success')
-        return jsonify({"status": "success", "message": "กู้คืนข้อมูลสำเร็จ"})
+        for warning in summary['warnings']:
+            flash(warning, 'warning')
+        return jsonify({"status": "success", "message": "กู้คืนข้อมูลสำเร็จ", "warnings": summary['warnings']})
 
     # --- Catch specific Zip errors ---
     except zipfile.BadZipFile as bzfe:
         current_app.logger.error(f"Restore failed - Bad Zip File: {bzfe}", exc_info=True)
-        if os.path.exists(restore_temp_dir): shutil.rmtree(restore_temp_dir)
         # --- [START LOG] Log failure ---
         log_action(f"Restore Failed: BadZipFile", new_value={'filename': filename, 'error': str(bzfe)})
         try: db.session.commit()
         except: db.session.rollback()
         # --- [END LOG] ---
         return jsonify({"status": "error", "message": "ไฟล์ ZIP ไม่ถูกต้องหรือเสียหาย"}), 400
-    # --- Catch validation errors (like wrong confirmation) ---
+    # --- Catch validation errors (like wrong confirmation or checksum mismatch) ---
     except ValueError as ve:
          current_app.logger.warning(f"Restore validation failed: {ve}")
-         if os.path.exists(restore_temp_dir): shutil.rmtree(restore_temp_dir)
          # Log validation failure
          log_action(f"Restore Failed: Validation", new_value={'filename': filename, 'error': str(ve)})
          try: db.session.commit()
@@ -4128,7 +3572,6 @@ def backup_restore_api():
     # --- Catch other general errors ---
     except Exception as e:
         current_app.logger.error(f"Restore operation failed: {e}", exc_info=True)
-        if os.path.exists(restore_temp_dir): shutil.rmtree(restore_temp_dir)
         # --- [START LOG] Log general failure ---
         log_action(f"Restore Failed: {type(e).__name__}", new_value={'filename': filename, 'error': str(e)})
         try: db.session.commit()
@@ -4164,6 +3607,43 @@ def copy_schedule_structure_api():
         return jsonify({'status': 'error', 'message': message}), status_code
 # --- [END ADDITION] ---
 
+@bp.route('/schedule/clone-semester', methods=['GET', 'POST'])
+@login_required
+def clone_semester():
+    """[NEW] Copies slots, courses, teacher assignments and timetable entries between semesters (with dry-run diff)."""
+    if not current_user.has_role('Admin'):
+        abort(403)
+    form = FlaskForm()
+    semesters = Semester.query.join(AcademicYear).options(joinedload(Semester.academic_year)).order_by(
+        AcademicYear.year.desc(), Semester.term.desc()).all()
+    summary = None
+    selected = {'source': None, 'target': None, 'scopes': list(SEMESTER_CLONE_SCOPES)}
+
+    if request.method == 'POST' and form.validate_on_submit():
+        selected = {'source': request.form.get('source_semester_id', type=int),
+                    'target': request.form.get('target_semester_id', type=int),
+                    'scopes': request.form.getlist('scopes')}
+        dry_run = request.form.get('action') != 'apply'
+        if not selected['source'] or not selected['target'] or not selected['scopes']:
+            flash('กรุณาเลือกภาคเรียนต้นทาง ปลายทาง และรายการที่ต้องการคัดลอก', 'danger')
+        else:
+            summary = clone_semester_setup(selected['source'], selected['target'], selected['scopes'], dry_run=dry_run)
+            for error in summary['errors']:
+                flash(error, 'danger')
+            if not dry_run and not summary['errors']:
+                log_action("Clone Semester Setup", model=Semester, record_id=selected['target'],
+                           new_value={k: v for k, v in summary.items() if k != 'errors'})
+                db.session.commit()
+                flash('คัดลอกข้อมูลภาคเรียนเรียบร้อยแล้ว', 'success')
+
+    return render_template('admin/clone_semester.html',
+                           title='คัดลอกข้อมูลตั้งต้นภาคเรียน',
+                           form=form,
+                           semesters=semesters,
+                           scopes=SEMESTER_CLONE_SCOPES,
+                           selected=selected,
+                           summary=summary)
+
 # --- [START ADDITION] API Endpoint for Semester List Dropdown ---
 @bp.route('/api/semesters-list')
 @login_required
@@ -0,0 +1,198 @@
+# FILE: app/archive.py
+"""
+Academic-year archival: moves the detailed rows of a closed year (scores,
+attendance, qualitative scores, audit log, notifications) out of the hot
+tables into the archived_* tables, so day-to-day queries and indexes only
+carry the years still in use. CourseGrade (and therefore transcripts) is
+never archived.
+
+Rows are moved ARCHIVE_CHUNK at a time, one transaction per chunk (copy into
+the archive, then delete from the live table), so an interrupted run leaves
+every row in exactly one place and can simply be started again.
+
+Readers that may touch an archived year use ``archive_union``: live rows plus
+archived rows whose natural key has no live row, so a value corrected after
+archiving wins over the archived copy.
+"""
+from datetime import datetime, time, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, exists, func, insert, literal, select, union_all
+
+from app import db
+from app.models import (AcademicYear, ArchivedAttendanceRecord, ArchivedAuditLog, ArchivedNotification,
+                        ArchivedQualitativeScore, ArchivedScore, AssessmentItem, AttendanceRecord, AuditLog, Course,
+                        GradedItem, LearningUnit, LessonPlan, Notification, QualitativeScore, Score, Semester,
+                        TimetableEntry)
+
+ARCHIVE_CHUNK = 5000
+
+# ตารางหลัก -> ตาราง archive (ลำดับนี้คือลำดับที่ย้าย)
+ARCHIVE_MODELS = {
+    Score: ArchivedScore,
+    AttendanceRecord: ArchivedAttendanceRecord,
+    QualitativeScore: ArchivedQualitativeScore,
+    AuditLog: ArchivedAuditLog,
+    Notification: ArchivedNotification,
+}
+
+# คอลัมน์ที่ระบุ "แถวเดียวกัน" ระหว่างตารางหลักกับ archive (ตาม unique constraint ของตารางหลัก)
+NATURAL_KEYS = {
+    Score: ('student_id', 'graded_item_id', 'assessment_item_id'),
+    AttendanceRecord: ('student_id', 'timetable_entry_id', 'attendance_date'),
+    QualitativeScore: ('student_id', 'assessment_topic_id', 'course_id'),
+}
+
+# audit log / notification ไม่ผูกกับปีการศึกษา จึงแบ่งตามเวลาที่บันทึก
+TIMESTAMP_COLUMNS = {
+    AuditLog: 'timestamp',
+    Notification: 'created_at',
+}
+
+
+def _copied_columns(model):
+    return [column.name for column in model.__table__.columns if column.name != 'id']
+
+
+def _year_cutoff(year_id):
+    """Start of the day after the last semester of the year ends, or None if an end date is missing."""
+    end_dates = [end for (end,) in db.session.query(Semester.end_date).filter(Semester.academic_year_id == year_id)]
+    if not end_dates or any(end is None for end in end_dates):
+        return None
+    return datetime.combine(max(end_dates) + timedelta(days=1), time.min)
+
+
+def _time_window(year):
+    """(lower, upper) bounds for audit log / notification rows of ``year``; lower is the previous year's cutoff."""
+    upper = _year_cutoff(year.id)
+    if upper is None:
+        return None
+    previous = AcademicYear.query.filter(AcademicYear.year < year.year).order_by(AcademicYear.year.desc()).first()
+    lower = _year_cutoff(previous.id) if previous else None
+    return lower, upper
+
+
+def _year_scope(model, year, window):
+    """WHERE clauses selecting the live rows of ``model`` that belong to ``year`` (None = cannot tell)."""
+    plan_units = select(LearningUnit.id).join(LessonPlan).where(LessonPlan.academic_year_id == year.id)
+    year_courses = select(Course.id).join(Semester).where(Semester.academic_year_id == year.id)
+    if model is Score:
+        return [Score.graded_item_id.in_(select(GradedItem.id).where(GradedItem.learning_unit_id.in_(plan_units)))
+                | Score.assessment_item_id.in_(select(AssessmentItem.id).where(AssessmentItem.learning_unit_id.in_(plan_units)))]
+    if model is AttendanceRecord:
+        return [AttendanceRecord.timetable_entry_id.in_(select(TimetableEntry.id).where(TimetableEntry.course_id.in_(year_courses)))]
+    if model is QualitativeScore:
+        return [QualitativeScore.course_id.in_(year_courses)]
+    if window is None:
+        return None
+    lower, upper = window
+    column = getattr(model, TIMESTAMP_COLUMNS[model])
+    return [column < upper] if lower is None else [column >= lower, column < upper]
+
+
+def _archive_chunk(model, ids, year_id):
+    """Copies the live rows ``ids`` of ``model`` into its archive table and deletes them from the live table."""
+    archive = ARCHIVE_MODELS[model]
+    columns = _copied_columns(model)
+    keys = NATURAL_KEYS.get(model)
+    if keys:
+        # แถวที่ถูกแก้ไขหลัง archive ไปแล้วรอบก่อน: สำเนาเดิมใน archive ถือว่าหมดอายุ
+        db.session.execute(delete(archive).where(exists().where(
+            model.id.in_(ids), *[getattr(archive, key).is_not_distinct_from(getattr(model, key)) for key in keys])))
+    db.session.execute(insert(archive).from_select(
+        ['source_id', 'academic_year_id', *columns],
+        select(model.id, literal(year_id), *[getattr(model, name) for name in columns]).where(model.id.in_(ids))))
+    db.session.execute(delete(model).where(model.id.in_(ids)))
+
+
+def archive_academic_year(year_id, dry_run=False, job=None):
+    """
+    [NEW] Moves the detailed rows of a closed academic year into the archive tables.
+
+    The year must not hold the current semester and must not be the newest
+    year. ``archived_at`` is set before the first row moves, so readers
+    include the archive even if the run stops part-way; running it again
+    finishes the move (and moves rows written after the previous run).
+
+    Returns:
+        dict: Summary ({'counts': {table: rows}, 'archived': bool, 'warnings': [...], 'errors': [...]}).
+    """
+    year = db.session.get(AcademicYear, year_id)
+    if not year:
+        return {'errors': ['Invalid academic year ID.']}
+    if Semester.query.filter_by(academic_year_id=year.id, is_current=True).first():
+        return {'errors': [f'ปีการศึกษา {year.year} มีภาคเรียนปัจจุบันอยู่ ยังเก็บเข้าคลังไม่ได้']}
+    newest_year = db.session.query(func.max(AcademicYear.year)).scalar()
+    if year.year >= newest_year:
+        return {'errors': [f'ปีการศึกษา {year.year} เป็นปีล่าสุด ยังเก็บเข้าคลังไม่ได้']}
+
+    summary = {'counts': {}, 'archived': False, 'warnings': [], 'errors': []}
+    window = _time_window(year)
+    scopes = {}
+    for model in ARCHIVE_MODELS:
+        scope = _year_scope(model, year, window)
+        if scope is None:
+            summary['warnings'].append(f'ข้าม {model.__tablename__}: บางภาคเรียนของปี {year.year} ไม่มีวันสิ้นสุดภาคเรียน')
+            continue
+        scopes[model] = scope
+        summary['counts'][model.__tablename__] = db.session.query(func.count(model.id)).filter(*scope).scalar()
+
+    if dry_run:
+        return summary
+
+    # ตั้ง archived_at ก่อนย้ายแถวแรก: ผู้อ่านจะรวมตาราง archive ทันที แม้รอบนี้ล้มกลางทาง
+    # (ทุกแถวอยู่ที่ตารางหลักหรือ archive ที่ใดที่หนึ่งเสมอ จึงอ่านได้ครบตลอดเวลา)
+    if not year.archived_at:
+        year.archived_at = datetime.utcnow()
+        db.session.commit()
+
+    total = sum(summary['counts'].values())
+    moved = 0
+    if job is not None:
+        job.update(done=0, total=total, message=f'กำลังย้ายข้อมูลปีการศึกษา {year.year} เข้าคลัง')
+
+    for model, scope in scopes.items():
+        while True:
+            ids = [row_id for (row_id,) in db.session.query(model.id).filter(*scope).order_by(model.id).limit(ARCHIVE_CHUNK)]
+            if not ids:
+                break
+            try:
+                _archive_chunk(model, ids, year.id)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                summary['errors'].append(f"ย้าย {model.__tablename__} {len(ids)} แถวไม่สำเร็จ: {e}")
+                current_app.logger.error(f"Error archiving {model.__tablename__} of year {year.year}: {e}", exc_info=True)
+                break
+            moved += len(ids)
+            if job is not None:
+                job.update(done=min(moved, total))
+
+    summary['archived'] = not summary['errors']
+
+    current_app.logger.info(f"Academic year {year.year} archive: {summary}")
+    return summary
+
+
+def run_archive_job(job, year_id):
+    """Background-job wrapper for archive_academic_year."""
+    return archive_academic_year(year_id, job=job)
+
+
+def archive_union(model, columns, criteria):
+    """
+    SELECT of ``columns`` over the live rows of ``model`` plus the archived rows
+    that no live row supersedes (same natural key).
+
+    Args:
+        model: A model in ARCHIVE_MODELS that has a NATURAL_KEYS entry.
+        columns (list[str]): Column names present in both tables.
+        criteria (callable): table class -> list of WHERE clauses, applied to
+            the live model and to the archive model alike.
+    """
+    archive = ARCHIVE_MODELS[model]
+    keys = NATURAL_KEYS[model]
+    live = select(*[getattr(model, name).label(name) for name in columns]).where(*criteria(model))
+    superseded = exists().where(*[getattr(model, key).is_not_distinct_from(getattr(archive, key)) for key in keys])
+    archived = select(*[getattr(archive, name).label(name) for name in columns]).where(*criteria(archive), ~superseded)
+    return union_all(live, archived)
@@ -0,0 +1,352 @@
+# FILE: app/backup_store.py
+"""
+Incremental backups kept on the server in a content-addressed store.
+
+    <BACKUP_REPOSITORY>/blobs/ab/<sha256>     file contents, named by their hash
+    <BACKUP_REPOSITORY>/manifests/<id>.json   one manifest per backup
+
+Nothing is written twice: an upload file or table dump whose bytes are
+already in the store is only referenced again. Upload files whose size and
+mtime match the parent backup are not even re-read.
+
+Tables are dumped as deterministic gzip'ed JSONL (the row format of
+app/backups.py). The append-heavy tables in INCREMENTAL_TABLES are split
+into blocks of BLOCK_SIZE ids; an incremental backup asks the database for a
+fingerprint of every block (row count, sum of ids, plus the change columns
+listed for the table) and re-exports only blocks that are new or whose
+fingerprint differs from the parent's. Every manifest still lists all blocks
+and files, so a restore replays the base backup plus the increments simply by
+following the hashes, without walking the chain.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import Boolean, DateTime, Integer, cast, create_engine, func, select
+from sqlalchemy.pool import NullPool
+
+from app import db
+from app.backups import (BACKUP_FORMAT_VERSION, STREAM_CHUNK_SIZE, alembic_revision, dumpable_tables,
+                         finish_logical_restore, iter_table_rows, json_default, load_table_rows,
+                         open_dump_connection, sqlite_database_path, take_sqlite_snapshot)
+
+BLOCK_SIZE = 5000 # จำนวน id ต่อ 1 บล็อก
+# ตาราง -> คอลัมน์ที่ใช้ตรวจว่าแถวในบล็อกถูกแก้ไข (นอกเหนือจากจำนวนแถว/ผลรวม id ที่ตรวจการเพิ่ม/ลบ)
+INCREMENTAL_TABLES = {
+    'audit_log': (),
+    'score': ('updated_at',),
+    'attendance_record': ('recorded_at',),
+    'notification': ('is_read',), # ไม่มีเวลาแก้ไข สิ่งที่เปลี่ยนได้มีแค่สถานะการอ่าน
+    # ตารางคลังข้อมูลปีเก่า: เพิ่ม/ลบเป็นก้อนตอน archive เท่านั้น จำนวนแถวและผลรวม id พอ
+    'archived_score': (),
+    'archived_attendance_record': (),
+    'archived_qualitative_score': (),
+    'archived_audit_log': (),
+    'archived_notification': (),
+}
+
+
+def repository_path(app):
+    return app.config.get('BACKUP_REPOSITORY') or os.path.join(app.instance_path, 'backups')
+
+
+def _normalize(value):
+    # ให้ค่าที่อ่านจากฐานข้อมูลเทียบกับค่าที่โหลดจาก manifest (JSON) ได้ตรง ๆ
+    return json.loads(json.dumps(value, default=json_default))
+
+
+class BlobStore:
+    """Immutable files named by the sha256 of their bytes."""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def write(self, chunks):
+        """Stores the bytes of ``chunks``; returns (sha256, size, newly_written)."""
+        digest, size = hashlib.sha256(), 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            key = digest.hexdigest()
+            if self.has(key):
+                os.remove(tmp_path)
+                return key, size, False
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+            os.replace(tmp_path, self.path(key))
+            return key, size, True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def read_chunks(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def verify(self, digest):
+        hasher = hashlib.sha256()
+        for chunk in self.read_chunks(digest):
+            hasher.update(chunk)
+        return hasher.hexdigest() == digest
+
+
+def _gzip_chunks(chunks):
+    """gzip with a fixed header (mtime=0) so identical rows always hash to the same blob."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0, filename='') as gz:
+        for chunk in chunks:
+            gz.write(chunk)
+            if buffer.tell() >= STREAM_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _gunzip_lines(store, digest):
+    with gzip.open(store.path(digest), 'rb') as gz:
+        yield from gz
+
+
+class BackupRepository:
+
+    def __init__(self, root):
+        self.root = root
+        self.blobs = BlobStore(os.path.join(root, 'blobs'))
+        self.manifest_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    # --- manifests ---
+    def list_backups(self):
+        """Manifests, oldest first."""
+        names = sorted(n for n in os.listdir(self.manifest_dir) if n.endswith('.json'))
+        return [self.load_manifest(n[:-5]) for n in names]
+
+    def load_manifest(self, backup_id):
+        if not backup_id or os.sep in backup_id or '/' in backup_id or backup_id.startswith('.'):
+            raise ValueError(f"รหัสข้อมูลสำรองไม่ถูกต้อง: {backup_id}")
+        path = os.path.join(self.manifest_dir, f"{backup_id}.json")
+        if not os.path.exists(path):
+            raise ValueError(f"ไม่พบข้อมูลสำรอง {backup_id}")
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest):
+        path = os.path.join(self.manifest_dir, f"{manifest['id']}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path) # manifest ปรากฏหลัง blob ครบแล้วเท่านั้น
+
+    # --- backup ---
+    def create_backup(self, app, full=False):
+        """
+        Writes a new backup and returns its manifest. Incremental unless
+        ``full`` is set or there is no earlier backup (or it is of another schema).
+        """
+        engine = db.engine
+        previous = self.list_backups()
+        parent = previous[-1] if previous and not full else None
+        created_at = datetime.now()
+        manifest = {
+            'format': 'edhub-backup-store',
+            'version': BACKUP_FORMAT_VERSION,
+            'id': created_at.strftime('%Y%m%d_%H%M%S_%f'),
+            'created_at': created_at.isoformat(timespec='seconds'),
+            'dialect': engine.dialect.name,
+            'alembic_revision': None,
+            'tables': {},
+            'uploads': {},
+            'stats': {'blobs_written': 0, 'bytes_written': 0, 'blocks_exported': 0, 'blocks_reused': 0,
+                      'files_hashed': 0, 'files_reused': 0},
+        }
+
+        snapshot_path = take_sqlite_snapshot(app, engine) if sqlite_database_path(engine) else None
+        dump_engine, connection = open_dump_connection(engine, snapshot_path)
+        try:
+            manifest['alembic_revision'] = alembic_revision(connection)
+            if parent and parent.get('alembic_revision') != manifest['alembic_revision']:
+                parent = None # schema เปลี่ยน บล็อกเดิมใช้ต่อไม่ได้
+            manifest['kind'] = 'incremental' if parent else 'full'
+            manifest['parent'] = parent['id'] if parent else None
+            manifest['base'] = (parent.get('base') or parent['id']) if parent else None
+
+            for table, columns in dumpable_tables(connection):
+                parent_entry = parent['tables'].get(table.name) if parent else None
+                if parent_entry and parent_entry.get('columns') != columns:
+                    parent_entry = None
+                if table.name in INCREMENTAL_TABLES:
+                    entry = self._dump_blocks(connection, table, columns, parent_entry, manifest['stats'])
+                else:
+                    entry = self._dump_table(connection, table, columns, manifest['stats'])
+                manifest['tables'][table.name] = entry
+        finally:
+            connection.close()
+            if dump_engine is not None:
+                dump_engine.dispose()
+            if snapshot_path and os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+
+        uploads_folder = app.config.get('UPLOAD_FOLDER') or os.path.join(app.root_path, 'static', 'uploads')
+        manifest['uploads'] = self._store_uploads(uploads_folder, parent['uploads'] if parent else {},
+                                                  manifest['stats'])
+        self._save_manifest(manifest)
+        app.logger.info(f"Backup {manifest['id']} ({manifest['kind']}) stored: {manifest['stats']}")
+        return manifest
+
+    def _store(self, chunks, stats):
+        digest, size, written = self.blobs.write(chunks)
+        if written:
+            stats['blobs_written'] += 1
+            stats['bytes_written'] += size
+        return digest
+
+    def _dump_table(self, connection, table, columns, stats):
+        rows = {'count': 0}
+
+        def counted():
+            for chunk in iter_table_rows(connection, table, columns):
+                rows['count'] += chunk.count(b'\n')
+                yield chunk
+
+        digest = self._store(_gzip_chunks(counted()), stats)
+        return {'columns': columns, 'rows': rows['count'], 'blob': digest}
+
+    def _block_fingerprints(self, connection, table):
+        pk = table.c.id
+        block = (pk // BLOCK_SIZE).label('block')
+        measures = [func.count(), func.sum(pk)]
+        for name in INCREMENTAL_TABLES[table.name]:
+            column = table.c[name]
+            if isinstance(column.type, DateTime):
+                measures.append(func.max(column))
+            elif isinstance(column.type, Boolean):
+                measures.append(func.sum(cast(column, Integer)))
+            else:
+                measures.append(func.sum(column))
+        result = connection.execute(select(block, *measures).group_by(block).order_by(block))
+        return {row[0]: _normalize(list(row[1:])) for row in result}
+
+    def _dump_blocks(self, connection, table, columns, parent_entry, stats):
+        fingerprints = self._block_fingerprints(connection, table)
+        previous = {b['block']: b for b in parent_entry['blocks']} if parent_entry else {}
+        blocks, total = [], 0
+        for number, fingerprint in fingerprints.items():
+            reused = previous.get(number)
+            if reused and reused['fingerprint'] == fingerprint and self.blobs.has(reused['blob']):
+                stats['blocks_reused'] += 1
+                blocks.append(reused)
+            else:
+                lo = number * BLOCK_SIZE
+                where = (table.c.id >= lo) & (table.c.id < lo + BLOCK_SIZE)
+                digest = self._store(_gzip_chunks(iter_table_rows(connection, table, columns, where=where)), stats)
+                stats['blocks_exported'] += 1
+                blocks.append({'block': number, 'rows': fingerprint[0], 'fingerprint': fingerprint, 'blob': digest})
+            total += fingerprint[0]
+        return {'columns': columns, 'rows': total, 'block_size': BLOCK_SIZE, 'blocks': blocks}
+
+    def _store_uploads(self, uploads_folder, parent_uploads, stats):
+        uploads = {}
+        if not os.path.isdir(uploads_folder):
+            return uploads
+        for root, dirs, files in os.walk(uploads_folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    continue
+                relpath = os.path.relpath(path, uploads_folder).replace(os.sep, '/')
+                st = os.stat(path)
+                known = parent_uploads.get(relpath)
+                if known and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns \
+                        and self.blobs.has(known['sha256']):
+                    stats['files_reused'] += 1
+                    uploads[relpath] = known
+                    continue
+                stats['files_hashed'] += 1
+                uploads[relpath] = {'sha256': self._store(_read_file(path), stats),
+                                    'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        return uploads
+
+    # --- restore ---
+    def table_lines(self, entry):
+        """JSONL lines of one table entry of a manifest (whole-table blob or blocks)."""
+        digests = [entry['blob']] if 'blob' in entry else [b['blob'] for b in entry['blocks']]
+        for digest in digests:
+            yield from _gunzip_lines(self.blobs, digest)
+
+    def missing_blobs(self, manifest):
+        digests = set(f['sha256'] for f in manifest['uploads'].values())
+        for entry in manifest['tables'].values():
+            digests.update([entry['blob']] if 'blob' in entry else [b['blob'] for b in entry['blocks']])
+        return sorted(d for d in digests if not self.blobs.has(d))
+
+    def restore(self, backup_id, dest_dir):
+        """
+        Rebuilds backup ``backup_id`` into ``dest_dir``: a fresh SQLite
+        database (``database.db``, schema from the models) and an ``uploads``
+        folder. Does not touch the live database or upload folder.
+        Returns {'tables': {name: rows}, 'files': n}.
+        """
+        manifest = self.load_manifest(backup_id)
+        missing = self.missing_blobs(manifest)
+        if missing:
+            raise ValueError(f"ข้อมูลสำรอง {backup_id} ขาดไฟล์ในคลัง {len(missing)} ไฟล์")
+        os.makedirs(dest_dir, exist_ok=True)
+        db_path = os.path.join(dest_dir, 'database.db')
+        if os.path.exists(db_path):
+            raise ValueError(f"มีไฟล์ {db_path} อยู่แล้ว")
+
+        summary = {'tables': {}, 'files': 0}
+        with db.engine.connect() as live:
+            live_revision = alembic_revision(live) # schema ที่สร้างจาก models ปัจจุบัน
+        engine = create_engine(f"sqlite:///{db_path}", poolclass=NullPool)
+        try:
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                for table in db.metadata.sorted_tables:
+                    entry = manifest['tables'].get(table.name)
+                    if entry:
+                        summary['tables'][table.name] = load_table_rows(connection, table, entry['columns'],
+                                                                        self.table_lines(entry))
+                finish_logical_restore(connection, live_revision)
+        finally:
+            engine.dispose()
+
+        uploads_dir = os.path.join(dest_dir, 'uploads')
+        for relpath, info in manifest['uploads'].items():
+            target = os.path.join(uploads_dir, *relpath.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(self.blobs.path(info['sha256']), target)
+            summary['files'] += 1
+        return summary
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
@@ -0,0 +1,619 @@
+# FILE: app/backups.py
+"""
+Backup archives streamed straight to the client, and their restore.
+
+A backup is one zip file written on the fly, with no staging copies:
+
+    database.db           consistent snapshot taken with sqlite3's online
+                          backup API (SQLite only)
+    db/<table>.jsonl      logical dump, one JSON array per row in the column
+                          order recorded in the manifest (deflate-compressed)
+    uploads/<path>        the upload folder, file by file
+    manifest.json         format, dialect, alembic revision, row counts and
+                          the size / sha256 of every member above
+
+The logical dump is dialect-independent (it is what a PostgreSQL database
+gets, and what lets a SQLite backup be loaded somewhere else). It is read
+with server-side cursors in batches of LOGICAL_DUMP_BATCH rows, inside one
+snapshot transaction so all tables agree. FTS tables are not dumped; they
+are rebuilt at startup.
+
+ArchiveRestore reads such an archive member by member (no extraction),
+checking each against the manifest while it builds staging copies, and only
+then swaps them in.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+from base64 import b64decode, b64encode
+from datetime import date, datetime
+from datetime import time as dt_time
+from decimal import Decimal
+
+from sqlalchemy import Integer, create_engine, inspect, select, text
+from sqlalchemy.pool import NullPool
+
+from app import db
+
+BACKUP_FORMAT = 'edhub-backup'
+BACKUP_FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+SQLITE_SNAPSHOT_NAME = 'database.db'
+LOGICAL_DUMP_DIR = 'db/'
+UPLOADS_DIR = 'uploads/'
+
+STREAM_CHUNK_SIZE = 256 * 1024 # ส่งออกทีละก้อน ~256KB
+LOGICAL_DUMP_BATCH = 1000
+# ไฟล์ที่บีบอัดมาแล้ว เก็บแบบ STORED ไม่ต้องเสีย CPU deflate ซ้ำ
+PRECOMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.pdf', '.docx', '.xlsx', '.pptx', '.mp4'}
+
+
+def sqlite_database_path(engine):
+    """Absolute path of the database file when ``engine`` is file-backed SQLite, else None."""
+    if engine.dialect.name != 'sqlite':
+        return None
+    database = engine.url.database
+    if not database or database == ':memory:' or database.startswith('file:'):
+        return None
+    return os.path.abspath(database)
+
+
+def snapshot_sqlite(source_path, dest_path):
+    """
+    Copies the live database into ``dest_path`` with sqlite3's backup API.
+    The copy is done in one read transaction, so it is a consistent snapshot
+    even while other connections are writing (in WAL mode they are not blocked).
+    """
+    source = sqlite3.connect(source_path)
+    try:
+        dest = sqlite3.connect(dest_path)
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b64encode(bytes(value)).decode('ascii')
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def alembic_revision(connection):
+    if not inspect(connection).has_table('alembic_version'):
+        return None
+    return connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+
+
+def iter_table_rows(connection, table, columns, batch_size=LOGICAL_DUMP_BATCH, where=None):
+    """Yields JSONL bytes for ``table`` one batch at a time (server-side cursor)."""
+    stmt = select(*[table.c[name] for name in columns])
+    if where is not None:
+        stmt = stmt.where(where)
+    if table.primary_key.columns:
+        stmt = stmt.order_by(*table.primary_key.columns)
+    result = connection.execution_options(yield_per=batch_size).execute(stmt)
+    for rows in result.partitions():
+        yield b''.join(json.dumps(list(row), ensure_ascii=False, default=json_default,
+                                  separators=(',', ':')).encode('utf-8') + b'\n' for row in rows)
+
+
+def dumpable_tables(connection):
+    """(table, column names) for every model table present in the database, in FK order."""
+    inspector = inspect(connection)
+    existing = set(inspector.get_table_names())
+    tables = []
+    for table in db.metadata.sorted_tables:
+        if table.name in existing:
+            present = {c['name'] for c in inspector.get_columns(table.name)}
+            tables.append((table, [c.name for c in table.columns if c.name in present]))
+    return tables
+
+
+def _column_decoder(column):
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        pass
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is date:
+        return date.fromisoformat
+    if python_type is dt_time:
+        return dt_time.fromisoformat
+    if python_type is bytes:
+        return b64decode
+    if python_type is Decimal:
+        return Decimal
+    return None
+
+
+def load_table_rows(connection, table, columns, lines, batch_size=LOGICAL_DUMP_BATCH):
+    """
+    Inserts rows written by iter_table_rows (JSONL lines, values in ``columns``
+    order) into ``table``, turning ISO dates / base64 back into Python values.
+    Columns the table no longer has are dropped. Returns the number of rows inserted.
+    """
+    kept = [(i, name, _column_decoder(table.c[name])) for i, name in enumerate(columns) if name in table.c]
+    batch, total = [], 0
+    for line in lines:
+        if not line.strip():
+            continue
+        values = json.loads(line)
+        row = {}
+        for i, name, decode in kept:
+            value = values[i]
+            row[name] = decode(value) if decode and value is not None else value
+        batch.append(row)
+        if len(batch) >= batch_size:
+            connection.execute(table.insert(), batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+        total += len(batch)
+    return total
+
+
+def finish_logical_restore(connection, revision=None):
+    """
+    After loading a logical dump: clear the "index built" settings so the FTS /
+    trigram search indexes (not part of the dump) are rebuilt, and stamp
+    ``revision`` — the revision of the schema the rows were loaded into, not
+    the one of the backup — when the database was created from the models.
+    """
+    from app.global_search import INDEX_SETTING_KEY
+    from app.indicator_search import SEGMENTER_SETTING_KEY
+    setting = db.metadata.tables['setting']
+    connection.execute(setting.delete().where(setting.c.key.in_([INDEX_SETTING_KEY, SEGMENTER_SETTING_KEY])))
+    if revision:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS alembic_version "
+                                "(version_num VARCHAR(32) NOT NULL PRIMARY KEY)"))
+        connection.execute(text("DELETE FROM alembic_version"))
+        connection.execute(text("INSERT INTO alembic_version (version_num) VALUES (:revision)"), {'revision': revision})
+
+
+def take_sqlite_snapshot(app, engine):
+    """Snapshots the live SQLite file into instance/backup_temp and returns the temp path (caller removes it)."""
+    source_path = sqlite_database_path(engine)
+    if not source_path or not os.path.exists(source_path):
+        raise ValueError("ไม่พบไฟล์ฐานข้อมูล SQLite")
+    temp_dir = os.path.join(app.instance_path, 'backup_temp')
+    os.makedirs(temp_dir, exist_ok=True)
+    fd, snapshot_path = tempfile.mkstemp(suffix='.db', dir=temp_dir)
+    os.close(fd)
+    started = time.monotonic()
+    try:
+        snapshot_sqlite(source_path, snapshot_path)
+    except Exception:
+        os.remove(snapshot_path)
+        raise
+    app.logger.info(f"SQLite snapshot taken in {time.monotonic() - started:.2f}s")
+    return snapshot_path
+
+
+def open_dump_connection(engine, snapshot_path=None):
+    """
+    (dump_engine, connection) whose reads all see one snapshot: the SQLite
+    snapshot file, or a REPEATABLE READ transaction on other databases.
+    Close the connection and dispose dump_engine (when not None) afterwards.
+    """
+    if snapshot_path:
+        dump_engine = create_engine(f"sqlite:///{snapshot_path}", poolclass=NullPool)
+        return dump_engine, dump_engine.connect()
+    if engine.dialect.name == 'sqlite':
+        raise ValueError("ฐานข้อมูล SQLite แบบ in-memory ไม่สามารถสำรองข้อมูลได้")
+    connection = engine.connect().execution_options(isolation_level='REPEATABLE READ')
+    connection.begin()
+    return None, connection
+
+
+def _file_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _ChunkSink:
+    """
+    Write-only file object for zipfile. It is not seekable, so zipfile writes
+    data descriptors instead of seeking back; the generator drains what was
+    written after every chunk.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.pending = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.pending += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.pending = 0
+        return data
+
+
+class BackupArchive:
+    """
+    One backup. prepare() does everything that can fail before the response
+    starts (finding the database, taking the SQLite snapshot); stream() then
+    yields the zip bytes; cleanup() removes the snapshot file.
+    """
+
+    def __init__(self, app, include_logical=False):
+        self.app = app
+        self.engine = db.engine
+        self.uploads_folder = app.config.get('UPLOAD_FOLDER') or os.path.join(app.root_path, 'static', 'uploads')
+        self.created_at = datetime.now()
+        self.filename = f"edhub_backup_{self.created_at.strftime('%Y%m%d_%H%M%S')}.zip"
+        self.sqlite_path = sqlite_database_path(self.engine)
+        # ฐานข้อมูลอื่นที่ไม่ใช่ SQLite มีได้แค่ logical dump
+        self.include_logical = include_logical or self.sqlite_path is None
+        self.snapshot_path = None
+        self.manifest = None
+
+    def prepare(self):
+        if self.engine.dialect.name == 'sqlite' and not self.sqlite_path:
+            raise ValueError("ฐานข้อมูล SQLite แบบ in-memory ไม่สามารถสำรองข้อมูลได้")
+        if self.sqlite_path:
+            self.snapshot_path = take_sqlite_snapshot(self.app, self.engine)
+        return self
+
+    def cleanup(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        self.snapshot_path = None
+
+    def _logical_members(self, connection, manifest):
+        for table, columns in dumpable_tables(connection):
+            entry = manifest['tables'][table.name] = {'columns': columns, 'rows': 0}
+
+            def rows(table=table, columns=columns, entry=entry):
+                for chunk in iter_table_rows(connection, table, columns):
+                    entry['rows'] += chunk.count(b'\n')
+                    yield chunk
+
+            yield f"{LOGICAL_DUMP_DIR}{table.name}.jsonl", rows(), zipfile.ZIP_DEFLATED
+
+    def _upload_members(self):
+        if not os.path.isdir(self.uploads_folder):
+            self.app.logger.warning(f"Uploads folder not found: {self.uploads_folder}. Skipping uploads.")
+            return
+        for root, dirs, files in os.walk(self.uploads_folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    continue
+                arcname = UPLOADS_DIR + os.path.relpath(path, self.uploads_folder).replace(os.sep, '/')
+                compress = (zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in PRECOMPRESSED_EXTENSIONS
+                            else zipfile.ZIP_DEFLATED)
+                yield arcname, _file_chunks(path), compress
+
+    def _members(self, connection, manifest):
+        """(arcname, chunk iterator, compress_type) for every member, in archive order."""
+        if self.snapshot_path:
+            yield SQLITE_SNAPSHOT_NAME, _file_chunks(self.snapshot_path), zipfile.ZIP_DEFLATED
+        if self.include_logical:
+            yield from self._logical_members(connection, manifest)
+        yield from self._upload_members()
+
+    def stream(self):
+        sink = _ChunkSink()
+        manifest = self.manifest = {
+            'format': BACKUP_FORMAT,
+            'version': BACKUP_FORMAT_VERSION,
+            'created_at': self.created_at.isoformat(timespec='seconds'),
+            'dialect': self.engine.dialect.name,
+            'alembic_revision': None,
+            'database': 'sqlite' if self.snapshot_path else None,
+            'logical': self.include_logical,
+            'tables': {},
+            'members': {},
+        }
+        dump_engine, connection = open_dump_connection(self.engine, self.snapshot_path)
+        try:
+            manifest['alembic_revision'] = alembic_revision(connection)
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for arcname, chunks, compress in self._members(connection, manifest):
+                    info = zipfile.ZipInfo(arcname, date_time=self.created_at.timetuple()[:6])
+                    info.compress_type = compress
+                    digest, size = hashlib.sha256(), 0
+                    with zf.open(info, 'w', force_zip64=True) as dest:
+                        for chunk in chunks:
+                            dest.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                            if sink.pending >= STREAM_CHUNK_SIZE:
+                                yield sink.drain()
+                    manifest['members'][arcname] = {'size': size, 'sha256': digest.hexdigest()}
+                    if sink.pending:
+                        yield sink.drain()
+                zf.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=1))
+            yield sink.drain()
+        finally:
+            connection.close()
+            if dump_engine is not None:
+                dump_engine.dispose()
+
+
+# --- Restore ---
+
+def _member_chunks(zf, name):
+    with zf.open(name) as src:
+        while True:
+            chunk = src.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _checked(chunks, name, expected):
+    """Passes ``chunks`` through, raising ValueError at the end if they do not match the manifest entry."""
+    digest, size = hashlib.sha256(), 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+        yield chunk
+    if expected is not None and (size != expected['size'] or digest.hexdigest() != expected['sha256']):
+        raise ValueError(f"ไฟล์ {name} ในข้อมูลสำรองไม่ตรงกับ checksum (ไฟล์อาจเสียหาย)")
+
+
+def _lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        *complete, pending = pending.split(b'\n')
+        yield from complete
+    if pending:
+        yield pending
+
+
+def _write_chunks(chunks, dest_path):
+    with open(dest_path, 'wb') as dest:
+        for chunk in chunks:
+            dest.write(chunk)
+
+
+def _upload_parts(name):
+    """Path parts of an archive member below the upload folder; rejects absolute paths and '..'."""
+    parts = name.split('/')
+    if not name or name.startswith('/') or '\\' in name or any(p in ('', '.', '..') for p in parts) or ':' in parts[0]:
+        raise ValueError(f"ชื่อไฟล์ในข้อมูลสำรองไม่ปลอดภัย: {name}")
+    return parts
+
+
+def _check_sqlite_file(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        has_users = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user'").fetchone()
+        revision = None
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'alembic_version'").fetchone():
+            revision = conn.execute("SELECT version_num FROM alembic_version").fetchone()
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"ไฟล์ฐานข้อมูลในข้อมูลสำรองเสียหาย: {e}")
+    finally:
+        conn.close()
+    if result != 'ok' or not has_users:
+        raise ValueError("ไฟล์ฐานข้อมูลในข้อมูลสำรองไม่สมบูรณ์หรือไม่ใช่ฐานข้อมูลของระบบ")
+    return revision[0] if revision else None
+
+
+def _swap_directory(side_dir, target, stamp):
+    """Puts ``side_dir`` in place of ``target`` with two renames on the same filesystem."""
+    old_dir = None
+    if os.path.exists(target):
+        old_dir = f"{target}.old-{stamp}"
+        os.rename(target, old_dir)
+    try:
+        os.rename(side_dir, target)
+    except OSError:
+        if old_dir:
+            os.rename(old_dir, target)
+        raise
+    if old_dir:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _reset_sequences(connection):
+    # โหลด id เดิมกลับเข้าไปตรง ๆ: ให้ sequence ของ PostgreSQL เดินต่อจาก id สูงสุด
+    for table in db.metadata.sorted_tables:
+        if 'id' in table.c and table.c.id.primary_key and isinstance(table.c.id.type, Integer):
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM \"{table.name}\"), 0) + 1, false)"
+            ))
+
+
+class ArchiveRestore:
+    """
+    Restores an archive written by BackupArchive (or the older
+    database_*.db + uploads_*.zip layout) without extracting it.
+
+    Every member is streamed once into a staging copy next to its target and
+    checked against the manifest checksums on the way; nothing live is touched
+    until all staging copies are complete and valid. Then:
+
+    * SQLite: the staging database is copied into the live one with the
+      backup API — one write transaction, so open connections in other
+      workers see either the old or the new database, never a mix, and no
+      stale -wal/-journal file is left pointing at a replaced file. The
+      previous database is kept as ``<db>.before_restore_<stamp>``.
+    * Other databases: the logical dump is loaded in one transaction.
+    * Uploads: the staging folder replaces the upload folder by rename.
+    """
+
+    def __init__(self, app, fileobj):
+        self.app = app
+        self.fileobj = fileobj
+        self.engine = db.engine
+        self.live_sqlite = sqlite_database_path(self.engine)
+        self.uploads_folder = app.config.get('UPLOAD_FOLDER') or os.path.join(app.root_path, 'static', 'uploads')
+        self.stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.staging_db = f"{self.live_sqlite}.restore-{self.stamp}" if self.live_sqlite else None
+        self.staging_uploads = f"{self.uploads_folder.rstrip(os.sep)}.restore-{self.stamp}"
+        self.summary = {'database': None, 'tables': {}, 'files': 0, 'warnings': []}
+
+    def run(self):
+        try:
+            with zipfile.ZipFile(self.fileobj) as zf:
+                self._read_layout(zf)
+                self._stage_database(zf)
+                uploads_staged = self._stage_uploads(zf)
+                self._swap_database(zf)
+            if uploads_staged:
+                _swap_directory(self.staging_uploads, self.uploads_folder, self.stamp)
+            else:
+                self.summary['warnings'].append("ไม่มีไฟล์อัปโหลดในข้อมูลสำรอง ไฟล์อัปโหลดเดิมยังคงอยู่")
+        finally:
+            if self.staging_db and os.path.exists(self.staging_db):
+                os.remove(self.staging_db)
+            if os.path.exists(self.staging_uploads):
+                shutil.rmtree(self.staging_uploads, ignore_errors=True)
+        return self.summary
+
+    def _read_layout(self, zf):
+        names = zf.namelist()
+        self.manifest = None
+        if MANIFEST_NAME in names:
+            try:
+                self.manifest = json.loads(zf.read(MANIFEST_NAME))
+            except ValueError:
+                raise ValueError("manifest.json ในข้อมูลสำรองเสียหาย")
+            if self.manifest.get('format') != BACKUP_FORMAT or self.manifest.get('version', 0) > BACKUP_FORMAT_VERSION:
+                raise ValueError("ไฟล์สำรองข้อมูลนี้มาจากระบบรุ่นอื่นที่ไม่รองรับ")
+            self.expected = self.manifest['members']
+            missing = [name for name in self.expected if name not in names]
+            if missing:
+                raise ValueError(f"ข้อมูลสำรองไม่ครบ ขาดไฟล์ {len(missing)} ไฟล์ เช่น {missing[0]}")
+            self.db_member = SQLITE_SNAPSHOT_NAME if SQLITE_SNAPSHOT_NAME in self.expected else None
+            self.logical = bool(self.manifest.get('logical'))
+            self.upload_members = [n for n in self.expected if n.startswith(UPLOADS_DIR)]
+            self.legacy_uploads_zip = None
+        else:
+            # รูปแบบเดิม (ก่อนมี manifest): ตรวจได้แค่ CRC ของ zip และ integrity ของฐานข้อมูล
+            self.expected = {}
+            self.db_member = next((n for n in names if n.endswith('.db') and '/' not in n), None)
+            self.logical = False
+            self.upload_members = []
+            self.legacy_uploads_zip = next((n for n in names if n.startswith('uploads_') and n.endswith('.zip')), None)
+
+        if self.live_sqlite and not self.db_member and not self.logical:
+            raise ValueError("ไม่พบไฟล์ฐานข้อมูลในข้อมูลสำรอง")
+        if not self.live_sqlite and not self.logical:
+            raise ValueError("ข้อมูลสำรองนี้ไม่มี logical dump จึงกู้คืนลงฐานข้อมูลชนิดนี้ไม่ได้ "
+                             "(สร้างข้อมูลสำรองโดยเลือก logical dump)")
+
+    def _logical_lines(self, zf, table_name):
+        name = f"{LOGICAL_DUMP_DIR}{table_name}.jsonl"
+        return _lines(_checked(_member_chunks(zf, name), name, self.expected.get(name)))
+
+    def _stage_database(self, zf):
+        if not self.live_sqlite:
+            # ยังไม่แตะฐานข้อมูลจริง: ตรวจ checksum ของ dump ทุกตารางก่อน
+            for table_name in self.manifest['tables']:
+                for _ in self._logical_lines(zf, table_name):
+                    pass
+            self.summary['database'] = 'logical'
+            return
+
+        with self.engine.connect() as live:
+            live_revision = alembic_revision(live)
+        if self.db_member:
+            _write_chunks(_checked(_member_chunks(zf, self.db_member), self.db_member,
+                                   self.expected.get(self.db_member)), self.staging_db)
+            revision = _check_sqlite_file(self.staging_db)
+            if revision != live_revision:
+                self.summary['warnings'].append(
+                    f"ข้อมูลสำรองเป็น schema รุ่น {revision or '-'} (ปัจจุบัน {live_revision or '-'}) "
+                    "ให้รัน flask db upgrade หลังกู้คืน")
+            self.summary['database'] = 'sqlite'
+            return
+
+        # logical dump -> ไฟล์ staging ที่สร้างจาก models ปัจจุบัน
+        staging_engine = create_engine(f"sqlite:///{self.staging_db}", poolclass=NullPool)
+        try:
+            db.metadata.create_all(staging_engine)
+            with staging_engine.begin() as connection:
+                for table in db.metadata.sorted_tables:
+                    entry = self.manifest['tables'].get(table.name)
+                    if entry:
+                        self.summary['tables'][table.name] = load_table_rows(
+                            connection, table, entry['columns'], self._logical_lines(zf, table.name))
+                finish_logical_restore(connection, live_revision)
+        finally:
+            staging_engine.dispose()
+        _check_sqlite_file(self.staging_db)
+        self.summary['database'] = 'logical'
+
+    def _stage_uploads(self, zf):
+        if self.legacy_uploads_zip:
+            with zipfile.ZipFile(zf.open(self.legacy_uploads_zip)) as inner:
+                self._stage_upload_members([(inner, info.filename, info.filename, None)
+                                            for info in inner.infolist() if not info.is_dir()])
+            return True
+        if not self.upload_members:
+            return False
+        self._stage_upload_members([(zf, name, name[len(UPLOADS_DIR):], self.expected[name])
+                                    for name in self.upload_members])
+        return True
+
+    def _stage_upload_members(self, members):
+        os.makedirs(self.staging_uploads, exist_ok=True)
+        for archive, name, relative, expected in members:
+            target = os.path.join(self.staging_uploads, *_upload_parts(relative))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_chunks(_checked(_member_chunks(archive, name), name, expected), target)
+            self.summary['files'] += 1
+
+    def _swap_database(self, zf):
+        if self.live_sqlite:
+            if os.path.exists(self.live_sqlite):
+                snapshot_sqlite(self.live_sqlite, f"{self.live_sqlite}.before_restore_{self.stamp}")
+            self.engine.dispose() # คืน connection ใน pool ของ process นี้ก่อนเขียนทับ
+            source = sqlite3.connect(self.staging_db)
+            try:
+                dest = sqlite3.connect(self.live_sqlite, timeout=30)
+                try:
+                    source.backup(dest)
+                finally:
+                    dest.close()
+            finally:
+                source.close()
+            return
+
+        with self.engine.begin() as connection:
+            for table in reversed(db.metadata.sorted_tables):
+                connection.execute(table.delete())
+            for table in db.metadata.sorted_tables:
+                entry = self.manifest['tables'].get(table.name)
+                if entry:
+                    self.summary['tables'][table.name] = load_table_rows(
+                        connection, table, entry['columns'], self._logical_lines(zf, table.name))
+            finish_logical_restore(connection)
+            if connection.dialect.name == 'postgresql':
+                _reset_sequences(connection)
+        self.engine.dispose()
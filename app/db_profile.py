@@ -0,0 +1,117 @@
+# FILE: app/db_profile.py
+"""
+Database profile: engine options and per-connection settings by dialect.
+
+SQLite (the default ``app.db`` under several gunicorn workers) is switched
+to WAL so page loads no longer block score/attendance commits and vice
+versa, with synchronous=NORMAL (fsync at checkpoints instead of every
+commit; safe in WAL), a busy timeout, a larger page cache and memory-mapped
+reads. Every pooled connection gets the pragmas from a ``connect`` listener.
+
+Writers still take turns in SQLite, so short write transactions go through
+``retry_on_busy``: when the busy timeout runs out the whole unit of work is
+rolled back and re-run after a short, jittered back-off instead of
+returning "database is locked" to the teacher.
+"""
+import random
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+BUSY_MESSAGES = ('database is locked', 'database is busy', 'database table is locked')
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database URI (pool sizing per dialect)."""
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or config['DB_PROFILE'] != 'tuned':
+        return {}
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        if _is_memory_sqlite(url):
+            return {} # Flask-SQLAlchemy ใช้ StaticPool ให้เอง
+        # ไฟล์ SQLite: เปิด connection ถูก แต่ writer ได้ทีละคน pool ไม่ต้องใหญ่
+        return {
+            'pool_size': config['SQLITE_POOL_SIZE'],
+            'max_overflow': config['SQLITE_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000},
+        }
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def sqlite_pragmas(config):
+    """(pragma, value) pairs run on every new SQLite connection, in order."""
+    return [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT_MS']),
+        ('cache_size', -config['SQLITE_CACHE_SIZE_KB']), # ค่าติดลบ = หน่วย KiB
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+    ]
+
+
+def install_sqlite_pragmas(engine, config):
+    """Registers a connect listener applying sqlite_pragmas to ``engine`` (no-op for other dialects)."""
+    if config['DB_PROFILE'] != 'tuned' or engine.dialect.name != 'sqlite' or _is_memory_sqlite(engine.url):
+        return
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+
+def configure_database(app, db):
+    """Applies the profile's per-connection settings to the app's engine (call right after db.init_app)."""
+    with app.app_context():
+        install_sqlite_pragmas(db.engine, app.config)
+
+
+def is_busy_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error.orig).lower() for message in BUSY_MESSAGES)
+
+
+def retry_on_busy(work, session=None, attempts=None, base_delay=None):
+    """
+    Runs ``work()`` (which must make its changes and commit) and re-runs it
+    when SQLite reports the database as locked. Other errors propagate.
+
+    Only for short transactions whose whole unit of work is inside ``work``:
+    the session is rolled back before each retry, so anything added before
+    the call is discarded.
+    """
+    if session is None:
+        from app import db
+        session = db.session
+    config = current_app.config
+    attempts = attempts or config['DB_BUSY_RETRIES']
+    base_delay = base_delay if base_delay is not None else config['DB_BUSY_RETRY_DELAY']
+    for attempt in range(1, attempts + 1):
+        try:
+            return work()
+        except OperationalError as e:
+            session.rollback()
+            if attempt == attempts or not is_busy_error(e):
+                raise
+            delay = base_delay * (2 ** (attempt - 1)) * (0.5 + random.random())
+            current_app.logger.warning(f"Database busy, retrying write ({attempt}/{attempts}) in {delay:.3f}s")
+            time.sleep(delay)
@@ -0,0 +1,345 @@
+# FILE: app/global_search.py
+"""
+Global search across students, users, subjects, classrooms and lesson plans.
+
+Every searchable record has one SearchDocument row (title, subtitle and a
+lower-cased ``terms`` text). Rows are rewritten incrementally:
+
+* ORM writes — an after_flush listener refreshes the documents of the
+  flushed objects (and the lesson plans of a renamed subject).
+* Bulk INSERT/UPDATE statements — the writer calls refresh_search_documents().
+
+Index per database:
+
+* SQLite: FTS5 external-content table ``search_document_fts`` with the
+  trigram tokenizer (substring matching without word segmentation, so Thai
+  names work), kept in step with search_document by triggers; ranked by bm25.
+* PostgreSQL: pg_trgm GIN index on search_document.terms, ranked by similarity().
+* Otherwise: LIKE on search_document.terms.
+"""
+import time
+from collections import defaultdict
+
+from flask import current_app, url_for
+from sqlalchemy import bindparam, event, func, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import (AcademicYear, Classroom, LessonPlan, SearchDocument, Setting, Student, Subject, User,
+                        name_search_key)
+
+TYPE_STUDENT = 'student'
+TYPE_USER = 'user'
+TYPE_SUBJECT = 'subject'
+TYPE_CLASSROOM = 'classroom'
+TYPE_LESSON_PLAN = 'lesson_plan'
+
+TYPE_LABELS = {
+    TYPE_STUDENT: 'นักเรียน',
+    TYPE_USER: 'บุคลากร',
+    TYPE_SUBJECT: 'รายวิชา',
+    TYPE_CLASSROOM: 'ห้องเรียน',
+    TYPE_LESSON_PLAN: 'แผนการสอน',
+}
+
+# บทบาท -> ประเภทที่ค้นได้ (ต้องเปิดหน้าปลายทางได้ด้วย)
+ROLE_TYPES = {
+    'Admin': (TYPE_STUDENT, TYPE_USER, TYPE_SUBJECT, TYPE_CLASSROOM, TYPE_LESSON_PLAN),
+    'Academic': (TYPE_LESSON_PLAN,),
+}
+
+FTS_TABLE = 'search_document_fts'
+INDEX_VERSION = '1' # เปลี่ยนเมื่อรูปแบบเอกสารเปลี่ยน -> rebuild ตอนเริ่มแอป
+INDEX_SETTING_KEY = 'global_search_index_version'
+PER_TYPE_LIMIT = 5
+REFRESH_CHUNK_SIZE = 500 # ต่ำกว่าขีดจำกัดตัวแปรของ SQLite (999) สำหรับ IN (...)
+MIN_TRIGRAM_LENGTH = 3 # คำที่สั้นกว่านี้ FTS5 trigram ค้นไม่ได้ ใช้ LIKE แทน
+
+BACKEND_FTS5 = 'fts5'
+BACKEND_TRIGRAM = 'trigram'
+BACKEND_LIKE = 'like'
+
+FTS_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "terms, content='search_document', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ai AFTER INSERT ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE} (rowid, terms) VALUES (new.id, new.terms); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ad AFTER DELETE ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, terms) VALUES ('delete', old.id, old.terms); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_au AFTER UPDATE ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, terms) VALUES ('delete', old.id, old.terms); "
+    f"INSERT INTO {FTS_TABLE} (rowid, terms) VALUES (new.id, new.terms); END",
+]
+TRIGRAM_INDEX = 'ix_search_document_terms_trgm'
+TRIGRAM_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} ON search_document USING gin (terms gin_trgm_ops)"
+
+_backends = {} # str(engine.url) -> BACKEND_*
+
+
+def _terms(*values):
+    return name_search_key(' '.join(str(v) for v in values if v not in (None, ''))) or ''
+
+
+# --- Document builders: (connection, ids or None) -> iterable of row dicts ---
+
+def _student_documents(connection, ids):
+    t = Student.__table__
+    query = select(t.c.id, t.c.student_id, t.c.name_prefix, t.c.first_name, t.c.last_name, t.c.status)
+    if ids is not None:
+        query = query.where(t.c.id.in_(ids))
+    for row_id, code, prefix, first, last, status in connection.execute(query):
+        yield {'entity_id': row_id, 'title': f"{prefix or ''}{first} {last}".strip(),
+               'subtitle': f"รหัส {code}" + (f" · {status}" if status else ''),
+               'terms': _terms(code, first, last)}
+
+
+def _user_documents(connection, ids):
+    t = User.__table__
+    query = select(t.c.id, t.c.username, t.c.name_prefix, t.c.first_name, t.c.last_name, t.c.job_title)
+    if ids is not None:
+        query = query.where(t.c.id.in_(ids))
+    for row_id, username, prefix, first, last, job_title in connection.execute(query):
+        yield {'entity_id': row_id, 'title': f"{prefix or ''}{first} {last}".strip(), # เหมือน User.full_name
+               'subtitle': ' · '.join(v for v in (username, job_title) if v),
+               'terms': _terms(username, first, last)}
+
+
+def _subject_documents(connection, ids):
+    t = Subject.__table__
+    query = select(t.c.id, t.c.subject_code, t.c.name, t.c.credit)
+    if ids is not None:
+        query = query.where(t.c.id.in_(ids))
+    for row_id, code, name, credit in connection.execute(query):
+        yield {'entity_id': row_id, 'title': f"{code} {name}",
+               'subtitle': f"{credit:g} หน่วยกิต" if credit is not None else None,
+               'terms': _terms(code, name)}
+
+
+def _classroom_documents(connection, ids):
+    t, y = Classroom.__table__, AcademicYear.__table__
+    query = select(t.c.id, t.c.name, y.c.year).join(y, t.c.academic_year_id == y.c.id)
+    if ids is not None:
+        query = query.where(t.c.id.in_(ids))
+    for row_id, name, year in connection.execute(query):
+        yield {'entity_id': row_id, 'title': name, 'subtitle': f"ปีการศึกษา {year}",
+               'terms': _terms(name, year)}
+
+
+def _lesson_plan_documents(connection, ids):
+    t, s, y = LessonPlan.__table__, Subject.__table__, AcademicYear.__table__
+    query = select(t.c.id, s.c.subject_code, s.c.name, y.c.year, t.c.status).join(
+        s, t.c.subject_id == s.c.id).join(y, t.c.academic_year_id == y.c.id)
+    if ids is not None:
+        query = query.where(t.c.id.in_(ids))
+    for row_id, code, name, year, status in connection.execute(query):
+        yield {'entity_id': row_id, 'title': f"แผนการสอน {code} {name}",
+               'subtitle': ' · '.join(v for v in (f"ปีการศึกษา {year}", status) if v),
+               'terms': _terms(code, name, year)}
+
+
+_BUILDERS = {
+    TYPE_STUDENT: _student_documents,
+    TYPE_USER: _user_documents,
+    TYPE_SUBJECT: _subject_documents,
+    TYPE_CLASSROOM: _classroom_documents,
+    TYPE_LESSON_PLAN: _lesson_plan_documents,
+}
+_TYPE_BY_MODEL = {
+    Student: TYPE_STUDENT,
+    User: TYPE_USER,
+    Subject: TYPE_SUBJECT,
+    Classroom: TYPE_CLASSROOM,
+    LessonPlan: TYPE_LESSON_PLAN,
+}
+
+
+def _refresh(connection, entity_type, ids=None):
+    """Rewrites the documents of ``ids`` (all of ``entity_type`` when None); missing entities lose theirs."""
+    documents = SearchDocument.__table__
+    if ids is None:
+        connection.execute(documents.delete().where(documents.c.entity_type == entity_type))
+        chunks = [None]
+    else:
+        ids = sorted(set(ids))
+        chunks = [ids[i:i + REFRESH_CHUNK_SIZE] for i in range(0, len(ids), REFRESH_CHUNK_SIZE)]
+    count = 0
+    for chunk in chunks:
+        if chunk is not None:
+            connection.execute(documents.delete().where(
+                documents.c.entity_type == entity_type, documents.c.entity_id.in_(chunk)))
+        rows = [{'entity_type': entity_type, **doc} for doc in _BUILDERS[entity_type](connection, chunk)]
+        if rows:
+            connection.execute(documents.insert(), rows)
+        count += len(rows)
+    return count
+
+
+def refresh_search_documents(session, entity_type, ids):
+    """
+    For bulk INSERT/UPDATE statements that bypass the flush listener. Runs in
+    the session's transaction; the caller commits.
+    """
+    ids = [i for i in ids if i]
+    if ids:
+        _refresh(session.connection(), entity_type, ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_flushed_documents(session, flush_context):
+    changed = defaultdict(set)
+    renamed_subject_ids = set()
+    for obj in (*session.new, *session.deleted):
+        entity_type = _TYPE_BY_MODEL.get(type(obj))
+        if entity_type and obj.id:
+            changed[entity_type].add(obj.id)
+    for obj in session.dirty:
+        entity_type = _TYPE_BY_MODEL.get(type(obj))
+        if entity_type and obj.id and session.is_modified(obj, include_collections=False):
+            changed[entity_type].add(obj.id)
+            if isinstance(obj, Subject):
+                renamed_subject_ids.add(obj.id)
+    if not changed:
+        return
+
+    connection = session.connection()
+    if renamed_subject_ids:
+        # ชื่อ/รหัสวิชาอยู่ในเอกสารของแผนการสอนด้วย
+        plans = LessonPlan.__table__
+        changed[TYPE_LESSON_PLAN].update(plan_id for plan_id, in connection.execute(
+            select(plans.c.id).where(plans.c.subject_id.in_(renamed_subject_ids))))
+    for entity_type, ids in changed.items():
+        _refresh(connection, entity_type, ids)
+
+
+def _backend_for(bind):
+    return _backends.get(str(bind.engine.url), BACKEND_LIKE)
+
+
+def ensure_global_search_index():
+    """
+    Creates the FTS5 table/triggers (SQLite) or the pg_trgm index (PostgreSQL)
+    and rebuilds every document when the index is new or INDEX_VERSION
+    changed. Called from create_app; never raises.
+    """
+    engine = db.engine
+    backend = BACKEND_LIKE
+    try:
+        if engine.dialect.name == 'sqlite':
+            try:
+                with engine.begin() as conn:
+                    for statement in FTS_DDL:
+                        conn.execute(text(statement))
+                backend = BACKEND_FTS5
+            except SQLAlchemyError as e:
+                # SQLite ก่อน 3.34 ไม่มี trigram tokenizer
+                current_app.logger.warning(f"FTS5 trigram index unavailable for global search: {e}")
+        elif engine.dialect.name == 'postgresql':
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                    conn.execute(text(TRIGRAM_INDEX_DDL))
+                backend = BACKEND_TRIGRAM
+            except SQLAlchemyError as e:
+                current_app.logger.warning(f"pg_trgm index unavailable for global search: {e}")
+
+        setting = Setting.__table__
+        with engine.begin() as conn:
+            built = conn.execute(select(setting.c.value).where(setting.c.key == INDEX_SETTING_KEY)).scalar()
+            if built != INDEX_VERSION:
+                count = sum(_refresh(conn, entity_type) for entity_type in _BUILDERS)
+                if backend == BACKEND_FTS5:
+                    # สร้าง index ใหม่ทั้งหมดจาก search_document (กรณีตาราง FTS เพิ่งถูกสร้างทีหลัง)
+                    conn.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"))
+                if built is None:
+                    conn.execute(setting.insert().values(key=INDEX_SETTING_KEY, value=INDEX_VERSION))
+                else:
+                    conn.execute(setting.update().where(setting.c.key == INDEX_SETTING_KEY).values(value=INDEX_VERSION))
+                current_app.logger.info(f"Global search index rebuilt ({count} documents).")
+    except SQLAlchemyError as e:
+        current_app.logger.warning(f"Global search index could not be prepared: {e}")
+    _backends[str(engine.url)] = backend
+    return backend
+
+
+def _like_pattern(word):
+    return '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _candidates(words, types, per_type):
+    """Best ``per_type`` matches of every entity type, cut per type in SQL (ROW_NUMBER), best first within a type."""
+    backend = _backend_for(db.engine)
+    long_words = [w for w in words if len(w) >= MIN_TRIGRAM_LENGTH]
+    if backend == BACKEND_FTS5 and long_words:
+        short_words = [w for w in words if len(w) < MIN_TRIGRAM_LENGTH]
+        params = {'match': ' '.join('"' + w.replace('"', '""') + '"' for w in long_words), 'per_type': per_type}
+        params['types'] = list(types)
+        extra = ''
+        for i, word in enumerate(short_words):
+            extra += f" AND d.terms LIKE :w{i} ESCAPE '\\'"
+            params[f'w{i}'] = _like_pattern(word)
+        # ตัดจำนวนต่อประเภทใน SQL: นักเรียนชื่อซ้ำเป็นร้อยต้องไม่เบียดรายวิชา/ห้องเรียนออกจากผลลัพธ์
+        return db.session.execute(text(
+            "SELECT entity_type, entity_id, title, subtitle FROM ("
+            "SELECT entity_type, entity_id, title, subtitle, "
+            "ROW_NUMBER() OVER (PARTITION BY entity_type ORDER BY score) AS type_rank FROM ("
+            f"SELECT d.entity_type, d.entity_id, d.title, d.subtitle, {FTS_TABLE}.rank AS score FROM {FTS_TABLE} "
+            f"JOIN search_document d ON d.id = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH :match AND d.entity_type IN :types{extra})) "
+            "WHERE type_rank <= :per_type ORDER BY type_rank"
+        ).bindparams(bindparam('types', expanding=True)), params).all()
+
+    documents = SearchDocument.__table__
+    if backend == BACKEND_TRIGRAM:
+        order = [func.similarity(documents.c.terms, ' '.join(words)).desc()]
+    else:
+        order = [func.length(documents.c.terms), documents.c.title]
+    type_rank = func.row_number().over(partition_by=documents.c.entity_type, order_by=order).label('type_rank')
+    query = select(documents.c.entity_type, documents.c.entity_id, documents.c.title, documents.c.subtitle,
+                   type_rank).where(documents.c.entity_type.in_(types))
+    for word in words:
+        query = query.where(documents.c.terms.like(_like_pattern(word), escape='\\'))
+    ranked = query.subquery()
+    return db.session.execute(
+        select(ranked.c.entity_type, ranked.c.entity_id, ranked.c.title, ranked.c.subtitle).where(
+            ranked.c.type_rank <= per_type).order_by(ranked.c.type_rank)).all()
+
+
+def searchable_types(user):
+    """Entity types ``user`` may search (empty when the user has no searching role)."""
+    return {t for role, types in ROLE_TYPES.items() if user.has_role(role) for t in types}
+
+
+def _url_for_result(entity_type, entity_id):
+    if entity_type == TYPE_STUDENT:
+        return url_for('admin.view_student_profile', student_id=entity_id)
+    if entity_type == TYPE_USER:
+        return url_for('admin.edit_user', user_id=entity_id)
+    if entity_type == TYPE_SUBJECT:
+        return url_for('admin.edit_subject', subject_id=entity_id)
+    if entity_type == TYPE_CLASSROOM:
+        return url_for('admin.edit_classroom', classroom_id=entity_id)
+    return url_for('academic.review_plan', plan_id=entity_id)
+
+
+def search_everything(query_str, user, per_type=PER_TYPE_LIMIT):
+    """
+    Returns {'query', 'took_ms', 'groups': [{'type', 'label', 'results': [...]}]}
+    with at most ``per_type`` results per entity type visible to ``user``,
+    best match first.
+    """
+    started = time.perf_counter()
+    words = (name_search_key(query_str) or '').split()
+    types = searchable_types(user)
+    grouped = defaultdict(list)
+    if words and types:
+        for entity_type, entity_id, title, subtitle in _candidates(words, types, per_type):
+            grouped[entity_type].append({
+                'type': entity_type, 'id': entity_id, 'title': title, 'subtitle': subtitle,
+                'url': _url_for_result(entity_type, entity_id),
+            })
+    return {
+        'query': query_str,
+        'took_ms': round((time.perf_counter() - started) * 1000, 1),
+        'groups': [{'type': t, 'label': TYPE_LABELS[t], 'results': grouped[t]} for t in TYPE_LABELS if grouped.get(t)],
+    }
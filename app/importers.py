@@ -0,0 +1,1027 @@
+# FILE: app/importers.py
+"""
+Set-based import engines used by the admin import pages.
+
+Each engine loads the validated preview records once, resolves existing rows
+with IN queries instead of one query per record, and writes in chunks with
+bulk INSERT/UPDATE statements. The engines are written as background job
+bodies (see app/jobs.py) but can be called directly with ``job=None``.
+
+Uploads are read with iter_upload_batches, which streams CSV through chunked
+pandas reads and XLSX through openpyxl's read-only mode, and previewed rows
+are spooled to a JSON-lines file (PreviewSpool) between the preview and
+execute requests, so no step holds the whole roster in memory.
+"""
+import codecs
+import json
+import math
+import os
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import pandas as pd
+from flask import current_app
+from openpyxl import load_workbook
+from sqlalchemy import delete, insert, tuple_, update
+from werkzeug.security import generate_password_hash
+
+from app import db
+from app.global_search import TYPE_STUDENT, TYPE_SUBJECT, TYPE_USER, refresh_search_documents
+from app.indicator_search import reindex_indicators
+from app.models import (PASSWORD_HASH_METHOD, Classroom, Course, Enrollment, GradeLevel, Indicator, LearningStrand,
+                        Role, Semester, Standard, Student, Subject, SubjectGroup, SubjectType, User,
+                        bump_revisions_for_shared_indicators, bump_timetable_version, classroom_advisors,
+                        course_teachers, name_search_key, subject_grade_levels, subject_group_members, user_roles)
+
+IMPORT_CHUNK_SIZE = 500 # ต่ำกว่าขีดจำกัดตัวแปรของ SQLite (999) สำหรับ IN (...)
+PREVIEW_ROW_LIMIT = 300 # จำนวนแถวที่แสดงบนหน้า preview (สรุปยอดยังนับครบทุกแถว)
+DEFAULT_TEACHER_PASSWORD = 'ntu1234'
+SUBJECT_EXISTS_WARNING = 'รหัสวิชานี้มีอยู่แล้วในระบบ'
+
+
+class UploadFormatError(ValueError):
+    """Raised when an uploaded file cannot be read or lacks required columns."""
+
+
+def chunked(items, size=IMPORT_CHUNK_SIZE):
+    """Yields successive slices of ``items`` of at most ``size`` elements."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def batched(iterable, size=IMPORT_CHUNK_SIZE):
+    """Like chunked() but for streams (e.g. a PreviewSpool); yields lists."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def hash_passwords(passwords, max_workers=None):
+    """
+    Hashes passwords with the same method as User.set_password, in parallel.
+
+    pbkdf2 at 260k iterations is what dominates a teacher import. hashlib's
+    pbkdf2_hmac releases the GIL, so a thread pool scales with CPU cores
+    without pickling anything to worker processes.
+
+    Returns:
+        list: Hashes in the same order as ``passwords``.
+    """
+    passwords = list(passwords)
+    if not passwords:
+        return []
+    workers = max_workers or min(len(passwords), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda pw: generate_password_hash(pw, method=PASSWORD_HASH_METHOD), passwords))
+
+
+def fetch_existing_map(column, keys, *entities):
+    """
+    Maps each key found in ``column`` to its row using chunked IN queries.
+
+    Args:
+        column: Model column to match, e.g. ``Student.student_id``.
+        keys (iterable): Values to look up.
+        *entities: Columns to load; defaults to the whole model.
+
+    Returns:
+        dict: {key: row}
+    """
+    keys = list({k for k in keys if k is not None})
+    entities = entities or (column.class_,)
+    result = {}
+    for chunk in chunked(keys):
+        rows = db.session.query(column, *entities).filter(column.in_(chunk)).all()
+        for row in rows:
+            result[row[0]] = row[1] if len(entities) == 1 else row[1:]
+    return result
+
+
+def is_blank(value):
+    """True for None, empty strings and NaN cells coming from pandas."""
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    return isinstance(value, str) and not value.strip()
+
+
+def parse_roll_number(value):
+    """Returns the roll number as int, or None for blanks/NaN/non-numeric values."""
+    if is_blank(value):
+        return None
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return None
+
+
+def _clean_cell(value):
+    """Normalises a cell to str or None so CSV and XLSX rows look the same."""
+    if is_blank(value):
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _detect_csv_encoding(stream, block_size=1 << 20):
+    """
+    Returns 'utf-8' if the whole stream decodes as UTF-8, else 'tis-620'.
+    Decodes block by block so a late non-UTF-8 byte is caught without
+    loading the file.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    stream.seek(0)
+    try:
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                decoder.decode(b'', final=True)
+                return 'utf-8'
+            decoder.decode(block)
+    except UnicodeDecodeError:
+        return 'tis-620'
+    finally:
+        stream.seek(0)
+
+
+def _iter_csv_rows(file, chunk_size):
+    encoding = _detect_csv_encoding(file)
+    try:
+        # dtype=str: ไม่ให้ pandas เดาชนิดแยกทีละ chunk (เช่น รหัส 0123 กลายเป็น 123.0)
+        reader = pd.read_csv(file, encoding=encoding, dtype=str, chunksize=chunk_size)
+    except pd.errors.EmptyDataError:
+        yield []
+        return
+
+    header_sent = False
+    row_num = 2
+    with reader:
+        for chunk in reader:
+            chunk.columns = [str(c).strip() for c in chunk.columns]
+            if not header_sent:
+                yield list(chunk.columns)
+                header_sent = True
+            for record in chunk.to_dict('records'):
+                yield row_num, {k: _clean_cell(v) for k, v in record.items()}
+                row_num += 1
+    if not header_sent:
+        yield []
+
+
+def _iter_xlsx_rows(file):
+    file.seek(0)
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header_row = next(rows, None)
+        if header_row is None:
+            yield []
+            return
+        header = [str(h).strip() if h is not None else '' for h in header_row]
+        yield header
+        for row_num, values in enumerate(rows, start=2):
+            if all(is_blank(v) for v in values):
+                continue
+            yield row_num, {
+                col: _clean_cell(values[i]) if i < len(values) else None
+                for i, col in enumerate(header) if col
+            }
+    finally:
+        workbook.close()
+
+
+def iter_upload_batches(file, required_columns, batch_size=IMPORT_CHUNK_SIZE):
+    """
+    Streams an uploaded .csv/.xlsx file as batches of rows.
+
+    The header is validated before the first batch is yielded. Cell values are
+    str or None.
+
+    Args:
+        file: Uploaded FileStorage.
+        required_columns (list): Column names that must be present.
+        batch_size (int): Rows per yielded batch.
+
+    Yields:
+        list: [(row_num, row_dict), ...]
+
+    Raises:
+        UploadFormatError: Unsupported type, unreadable file or missing columns.
+    """
+    filename = (file.filename or '').lower()
+    if filename.endswith('.csv'):
+        rows = _iter_csv_rows(file, batch_size)
+    elif filename.endswith('.xlsx'):
+        rows = _iter_xlsx_rows(file)
+    else:
+        raise UploadFormatError('ประเภทไฟล์ไม่ถูกต้อง กรุณาอัปโหลดไฟล์ .csv หรือ .xlsx เท่านั้น')
+
+    try:
+        header = next(rows, [])
+        if not header:
+            raise UploadFormatError('ไฟล์ที่อัปโหลดไม่มีข้อมูลอยู่ภายใน กรุณาตรวจสอบไฟล์อีกครั้ง')
+        missing = [col for col in required_columns if col not in header]
+        if missing:
+            raise UploadFormatError(f'ไฟล์ขาดคอลัมน์ที่จำเป็น: {", ".join(missing)}')
+
+        batch = []
+        for item in rows:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    except UploadFormatError:
+        raise
+    except Exception as e:
+        current_app.logger.error(f"Error reading uploaded file '{file.filename}': {e}")
+        raise UploadFormatError('เกิดข้อผิดพลาดในการอ่านไฟล์ อาจมีรูปแบบไม่ถูกต้อง') from e
+    finally:
+        rows.close()
+
+
+class PreviewSpool:
+    """
+    JSON-lines file that holds preview records between the preview and the
+    execute request. Records are appended batch by batch and read back as a
+    stream.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+
+    @classmethod
+    def create(cls, prefix):
+        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+        return cls(f"{prefix}_{uuid.uuid4().hex}.jsonl")
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, records):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str))
+                f.write('\n')
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def __len__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return sum(1 for line in f if line.strip())
+
+    def head(self, limit=PREVIEW_ROW_LIMIT):
+        rows = []
+        for record in self:
+            if len(rows) >= limit:
+                break
+            rows.append(record)
+        return rows
+
+    def delete(self):
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        except OSError as e:
+            current_app.logger.error(f"Error deleting import spool {self.path}: {e}")
+
+
+def build_preview(file, required_columns, build_batch, spool_prefix, limit=PREVIEW_ROW_LIMIT):
+    """
+    Streams an upload through ``build_batch`` into a new PreviewSpool.
+
+    Args:
+        file: Uploaded FileStorage.
+        required_columns (list): Columns the template requires.
+        build_batch (callable): Turns [(row_num, row), ...] into preview records.
+        spool_prefix (str): Prefix for the spool filename.
+        limit (int): How many records to keep for rendering.
+
+    Returns:
+        tuple: (spool, first ``limit`` records, summary Counter with 'total',
+        'warnings' and one key per record status such as 'New'/'Update').
+
+    Raises:
+        UploadFormatError: Propagated from iter_upload_batches.
+    """
+    spool = PreviewSpool.create(spool_prefix)
+    shown, summary = [], Counter()
+    try:
+        for batch in iter_upload_batches(file, required_columns):
+            records = build_batch(batch)
+            spool.append(records)
+            for record in records:
+                summary['total'] += 1
+                if record.get('warnings'):
+                    summary['warnings'] += 1
+                if record.get('status'):
+                    summary[record['status']] += 1
+            if len(shown) < limit:
+                shown.extend(records[:limit - len(shown)])
+    except Exception:
+        spool.delete()
+        raise
+    if not summary['total']:
+        spool.delete()
+    return spool, shown, summary
+
+
+def run_spooled_import(job, engine, spool):
+    """Job body: runs an import engine over a PreviewSpool, then removes the spool."""
+    try:
+        return engine(job, spool, total=len(spool))
+    finally:
+        spool.delete()
+
+
+def _report(job, **kwargs):
+    if job is not None:
+        job.update(**kwargs)
+
+
+def get_current_academic_year_id():
+    current_semester = Semester.query.filter_by(is_current=True).first()
+    return current_semester.academic_year_id if current_semester else None
+
+
+def build_student_preview(rows):
+    """
+    Builds preview records for a student import.
+
+    Args:
+        rows (iterable): (row_num, dict) pairs with the template columns.
+
+    Returns:
+        list: Preview records (same shape the preview template expects).
+    """
+    rows = list(rows)
+    academic_year_id = get_current_academic_year_id()
+
+    classroom_query = db.session.query(Classroom.name)
+    if academic_year_id:
+        # ตรวจห้องเรียนของปีปัจจุบัน ให้ตรงกับตอนนำเข้าจริง
+        classroom_query = classroom_query.filter(Classroom.academic_year_id == academic_year_id)
+    classroom_names = {name for (name,) in classroom_query.all()}
+
+    student_ids = [str(row['student_id']) for _, row in rows]
+    existing_ids = set(fetch_existing_map(Student.student_id, student_ids, Student.id).keys())
+
+    preview_data = []
+    for row_num, row in rows:
+        student_id = str(row['student_id'])
+        classroom_name = str(row['classroom_name'])
+        roll_number = row['roll_number']
+        record = {
+            'row_num': row_num,
+            'student_id': student_id,
+            'name_prefix': row['name_prefix'],
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'classroom_name': classroom_name,
+            'roll_number': roll_number,
+            'status': 'Update' if student_id in existing_ids else 'New',
+            'classroom_found': classroom_name in classroom_names,
+            'warnings': []
+        }
+        if not record['classroom_found']:
+            record['warnings'].append(f'ไม่พบห้องเรียน "{classroom_name}"')
+
+        if not is_blank(roll_number) and parse_roll_number(roll_number) is None:
+            record['warnings'].append(f'เลขที่ "{roll_number}" ไม่ใช่ตัวเลข')
+
+        preview_data.append(record)
+    return preview_data
+
+
+def run_student_import(job, records, total=None):
+    """
+    Upserts students and replaces their current-year enrollments.
+
+    Rows carrying preview warnings are skipped. Records are consumed as a
+    stream and written IMPORT_CHUNK_SIZE at a time; within a chunk a later
+    row with the same student_id overrides an earlier one. Enrollments
+    already in the right classroom are kept (only the roll number is
+    updated) so group memberships and alerts stored on them survive a
+    re-import.
+
+    Args:
+        job (Job | None): Progress handle from app.jobs.
+        records (iterable): Preview records produced by build_student_preview.
+        total (int, optional): Number of records, for progress reporting.
+
+    Returns:
+        dict: Counts for new, updated, skipped and errored rows.
+    """
+    academic_year_id = get_current_academic_year_id()
+    if not academic_year_id:
+        raise ValueError("Cannot run student import: No current semester is set.")
+
+    counts = {'new': 0, 'updated': 0, 'skipped': 0, 'errors': 0}
+    classroom_map = dict(
+        db.session.query(Classroom.name, Classroom.id)
+        .filter(Classroom.academic_year_id == academic_year_id).all()
+    )
+    year_classroom_ids = set(classroom_map.values())
+    _report(job, done=0, total=total, message='กำลังนำเข้าข้อมูลนักเรียน')
+
+    done = 0
+    pending = {}
+    for record in records:
+        done += 1
+        # 1. คัดแถวที่นำเข้าได้ (ข้ามแถวที่มีคำเตือน / ห้องเรียนหายไประหว่าง preview)
+        if any(w for w in record.get('warnings', [])):
+            counts['skipped'] += 1
+        elif record['classroom_name'] not in classroom_map:
+            counts['errors'] += 1
+        else:
+            pending[str(record['student_id'])] = record
+        if len(pending) >= IMPORT_CHUNK_SIZE:
+            _write_student_chunk(list(pending.values()), classroom_map, year_classroom_ids, counts)
+            pending = {}
+            _report(job, done=done)
+    if pending:
+        _write_student_chunk(list(pending.values()), classroom_map, year_classroom_ids, counts)
+    _report(job, done=done)
+
+    return counts
+
+
+def _write_student_chunk(chunk, classroom_map, year_classroom_ids, counts):
+    chunk_ids = [r['student_id'] for r in chunk]
+    existing = fetch_existing_map(Student.student_id, chunk_ids, Student.id)
+
+    # 2. Bulk upsert Students
+    new_rows = [{
+        'student_id': r['student_id'],
+        'name_prefix': r['name_prefix'],
+        'first_name': r['first_name'],
+        'last_name': r['last_name'],
+        'status': 'กำลังศึกษา',
+    } for r in chunk if r['student_id'] not in existing]
+    update_rows = [{
+        'id': existing[r['student_id']],
+        'name_prefix': r['name_prefix'],
+        'first_name': r['first_name'],
+        'last_name': r['last_name'],
+        'first_name_key': name_search_key(r['first_name']), # bulk UPDATE ไม่ผ่าน before_flush
+        'last_name_key': name_search_key(r['last_name']),
+    } for r in chunk if r['student_id'] in existing]
+
+    if new_rows:
+        db.session.execute(insert(Student), new_rows)
+    if update_rows:
+        db.session.execute(update(Student), update_rows)
+    counts['new'] += len(new_rows)
+    counts['updated'] += len(update_rows)
+
+    pk_map = dict(existing)
+    if new_rows:
+        pk_map.update(fetch_existing_map(
+            Student.student_id, [r['student_id'] for r in new_rows], Student.id
+        ))
+    refresh_search_documents(db.session, TYPE_STUDENT, pk_map.values()) # bulk insert/update ไม่ผ่าน after_flush
+
+    # 3. Enrollments ของปีปัจจุบัน: ห้องเดิมแค่แก้เลขที่, ห้องเปลี่ยนค่อยลบแล้วสร้างใหม่
+    wanted = {
+        pk_map[r['student_id']]: (classroom_map[r['classroom_name']], parse_roll_number(r['roll_number']))
+        for r in chunk
+    }
+    current = {}
+    if year_classroom_ids:
+        current_rows = db.session.query(
+            Enrollment.student_id, Enrollment.id, Enrollment.classroom_id, Enrollment.roll_number
+        ).filter(
+            Enrollment.student_id.in_(list(wanted.keys())),
+            Enrollment.classroom_id.in_(year_classroom_ids)
+        ).all()
+        for student_pk, enrollment_id, classroom_id, roll_number in current_rows:
+            current.setdefault(student_pk, []).append((enrollment_id, classroom_id, roll_number))
+
+    to_replace, roll_updates = [], []
+    for student_pk, (classroom_id, roll_number) in wanted.items():
+        existing_enrollments = current.get(student_pk, [])
+        if len(existing_enrollments) == 1 and existing_enrollments[0][1] == classroom_id:
+            # ห้องเดิม: เก็บแถวเดิมไว้ (กลุ่มเรียน/alerts ไม่หาย)
+            if existing_enrollments[0][2] != roll_number:
+                roll_updates.append({'id': existing_enrollments[0][0], 'roll_number': roll_number})
+        else:
+            to_replace.append(student_pk)
+
+    if roll_updates:
+        db.session.execute(update(Enrollment), roll_updates)
+    if to_replace:
+        db.session.execute(
+            delete(Enrollment).where(
+                Enrollment.student_id.in_(to_replace),
+                Enrollment.classroom_id.in_(year_classroom_ids)
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.execute(insert(Enrollment), [{
+            'student_id': student_pk,
+            'classroom_id': wanted[student_pk][0],
+            'roll_number': wanted[student_pk][1],
+        } for student_pk in to_replace])
+
+    # commit ทีละ chunk ให้ transaction สั้น ไม่ล็อก SQLite นาน
+    db.session.commit()
+
+
+def _text(row, key):
+    """Cell value as str, '' for blanks (teacher/subject templates use '' for 'not given')."""
+    value = row.get(key)
+    return '' if is_blank(value) else str(value)
+
+
+def _split_names(value):
+    """Splits a comma separated cell such as 'ม.1, ม.2' into clean names."""
+    return [name.strip() for name in str(value or '').split(',') if name.strip()]
+
+
+def _insert_missing_links(table, left, right, pairs):
+    """Inserts (left, right) rows into an association table unless they exist already."""
+    if not pairs:
+        return
+    left_col, right_col = table.c[left], table.c[right]
+    left_ids = list({a for a, _ in pairs})
+    existing = set()
+    for chunk in chunked(left_ids):
+        existing.update(db.session.execute(
+            db.select(left_col, right_col).where(left_col.in_(chunk))
+        ).all())
+    missing = [{left: a, right: b} for a, b in pairs if (a, b) not in existing]
+    if missing:
+        db.session.execute(insert(table), missing)
+
+
+# --- Teachers ---
+
+def build_teacher_preview(batch):
+    """
+    Builds preview records for a teacher import batch.
+
+    Existing accounts are resolved with one IN query on usernames and one on
+    emails for the whole batch.
+    """
+    usernames = [str(row['temp_id']) for _, row in batch]
+    emails = [_text(row, 'email') for _, row in batch if _text(row, 'email')]
+    existing_usernames = set(fetch_existing_map(User.username, usernames, User.id))
+    existing_emails = set(fetch_existing_map(User.email, emails, User.id))
+
+    preview_data = []
+    for row_num, row in batch:
+        username = str(row['temp_id'])
+        email = _text(row, 'email')
+        exists = username in existing_usernames or (email and email in existing_emails)
+        preview_data.append({
+            'row_num': row_num, 'username': username, 'name_prefix': row['name_prefix'],
+            'first_name': row['first_name'], 'last_name': row['last_name'], 'email': email,
+            'status': 'Update' if exists else 'New',
+            'roles': _split_names(row.get('roles')),
+            'homeroom_classroom': _text(row, 'homeroom_classroom'),
+            'department_head_of': _text(row, 'department_head_of'),
+            'subject_group_member_of': _text(row, 'subject_group_member_of'),
+            'warnings': []
+        })
+    return preview_data
+
+
+def run_teacher_import(job, records, total=None):
+    """
+    Upserts teacher accounts with their roles, homeroom and subject group links.
+
+    Existing users are matched by username, then by email. A row whose email
+    already belongs to a different account is counted as an error (the old
+    per-row import hit an IntegrityError there). Roles are replaced, while
+    homeroom and subject group links are only added, as before.
+
+    Args:
+        job (Job | None): Progress handle from app.jobs.
+        records (iterable): Preview records produced by build_teacher_preview.
+        total (int, optional): Number of records, for progress reporting.
+
+    Returns:
+        dict: Counts for new, updated and errored rows.
+    """
+    role_map = dict(db.session.query(Role.name, Role.id).all())
+    classroom_query = db.session.query(Classroom.name, Classroom.id)
+    academic_year_id = get_current_academic_year_id()
+    if academic_year_id:
+        classroom_query = classroom_query.filter(Classroom.academic_year_id == academic_year_id)
+    classroom_map = dict(classroom_query.all())
+    group_map = dict(db.session.query(SubjectGroup.name, SubjectGroup.id).all())
+
+    counts = {'new': 0, 'updated': 0, 'errors': 0}
+    _report(job, done=0, total=total, message='กำลังนำเข้าข้อมูลครู')
+    done = 0
+    for batch in batched(records):
+        _write_teacher_batch(batch, role_map, classroom_map, group_map, counts)
+        done += len(batch)
+        _report(job, done=done)
+    return counts
+
+
+def _write_teacher_batch(batch, role_map, classroom_map, group_map, counts):
+    rows = {record['username']: record for record in batch}
+    by_username = fetch_existing_map(User.username, rows.keys(), User.id)
+    by_email = fetch_existing_map(User.email, [r['email'] for r in rows.values() if r.get('email')], User.id)
+
+    # 1. แยกแถวใหม่ / แถวอัปเดต
+    new_rows, update_rows, user_ids, claimed_emails = [], [], {}, {}
+    for username, record in rows.items():
+        email = record.get('email') or None
+        user_id = by_username.get(username) or (by_email.get(email) if email else None)
+        email_owner = by_email.get(email) if email else None
+        if (email_owner and email_owner != user_id) or (email and claimed_emails.get(email, username) != username):
+            counts['errors'] += 1
+            current_app.logger.warning(f"Teacher import skipped duplicate: {username} or {email}.")
+            continue
+        if email:
+            claimed_emails[email] = username
+
+        values = {
+            'name_prefix': record.get('name_prefix') or None,
+            'first_name': record.get('first_name') or '',
+            'last_name': record.get('last_name') or '',
+            'email': email,
+        }
+        if user_id:
+            update_rows.append({'id': user_id, **values, # bulk UPDATE ไม่ผ่าน before_flush
+                                'first_name_key': name_search_key(values['first_name']),
+                                'last_name_key': name_search_key(values['last_name'])})
+            user_ids[username] = user_id
+        else:
+            new_rows.append({'username': username, **values,
+                             'must_change_username': True, 'must_change_password': True})
+
+    if update_rows:
+        db.session.execute(update(User), update_rows)
+        # ชื่อครูถูกเก็บไว้ในตารางสอนสำเร็จรูป: ให้ภาคเรียนที่ครูเหล่านี้สอนสร้างใหม่
+        taught = db.session.query(Course.semester_id).join(course_teachers, course_teachers.c.course_id == Course.id).filter(
+            course_teachers.c.user_id.in_([row['id'] for row in update_rows])).distinct()
+        bump_timetable_version(db.session, [sid for sid, in taught])
+    if new_rows:
+        hashes = hash_passwords([DEFAULT_TEACHER_PASSWORD] * len(new_rows))
+        for row, password_hash in zip(new_rows, hashes):
+            row['password_hash'] = password_hash
+        db.session.execute(insert(User), new_rows)
+        user_ids.update(fetch_existing_map(User.username, [r['username'] for r in new_rows], User.id))
+    counts['new'] += len(new_rows)
+    counts['updated'] += len(update_rows)
+    if not user_ids:
+        db.session.commit()
+        return
+
+    # 2. Roles: แทนที่ทั้งชุด (สร้างบทบาทใหม่ถ้ายังไม่มี)
+    missing_roles = sorted({name for u in user_ids for name in rows[u].get('roles', []) if name not in role_map})
+    if missing_roles:
+        db.session.execute(insert(Role), [{'name': name, 'description': f"{name} Role"} for name in missing_roles])
+        role_map.update(fetch_existing_map(Role.name, missing_roles, Role.id))
+    db.session.execute(delete(user_roles).where(user_roles.c.user_id.in_(list(user_ids.values()))))
+    role_links = {(user_ids[u], role_map[name]) for u in user_ids for name in rows[u].get('roles', [])}
+    if role_links:
+        db.session.execute(insert(user_roles), [{'user_id': a, 'role_id': b} for a, b in role_links])
+
+    # 3. ครูที่ปรึกษา / หัวหน้ากลุ่มสาระ / สมาชิกกลุ่มสาระ (เพิ่มอย่างเดียว)
+    advisor_links, member_links, group_heads = set(), set(), {}
+    for username, user_id in user_ids.items():
+        record = rows[username]
+        classroom_id = classroom_map.get(record.get('homeroom_classroom'))
+        if classroom_id:
+            advisor_links.add((user_id, classroom_id))
+        head_group_id = group_map.get(record.get('department_head_of'))
+        if head_group_id:
+            member_links.add((user_id, head_group_id))
+            group_heads[head_group_id] = user_id
+        for group_name in _split_names(record.get('subject_group_member_of')):
+            if group_name in group_map:
+                member_links.add((user_id, group_map[group_name]))
+
+    _insert_missing_links(classroom_advisors, 'user_id', 'classroom_id', advisor_links)
+    _insert_missing_links(subject_group_members, 'user_id', 'subject_group_id', member_links)
+    if group_heads:
+        db.session.execute(update(SubjectGroup), [{'id': g, 'head_id': u} for g, u in group_heads.items()])
+    refresh_search_documents(db.session, TYPE_USER, user_ids.values())
+
+    db.session.commit()
+
+
+# --- Subjects ---
+
+def build_subject_preview(batch):
+    """Builds preview records for a subject import batch using set lookups."""
+    group_names = {name for (name,) in db.session.query(SubjectGroup.name).all()}
+    type_names = {name for (name,) in db.session.query(SubjectType.name).all()}
+    grade_names = {name for (name,) in db.session.query(GradeLevel.short_name).all()}
+    existing_codes = set(fetch_existing_map(
+        Subject.subject_code, [str(row['subject_code']) for _, row in batch], Subject.id
+    ))
+
+    preview_data = []
+    for row_num, row in batch:
+        record = {'row_num': row_num, 'warnings': [], 'data': dict(row)}
+        if str(row['subject_code']) in existing_codes:
+            record['warnings'].append(SUBJECT_EXISTS_WARNING)
+        if str(row['subject_group']) not in group_names:
+            record['warnings'].append(f"ไม่พบกลุ่มสาระฯ '{row['subject_group']}'")
+        if str(row['subject_type']) not in type_names:
+            record['warnings'].append(f"ไม่พบประเภทวิชา '{row['subject_type']}'")
+        if any(g not in grade_names for g in _split_names(row.get('grade_levels'))):
+            record['warnings'].append('พบชื่อย่อระดับชั้นบางส่วนที่ไม่มีอยู่จริง')
+        preview_data.append(record)
+    return preview_data
+
+
+def run_subject_import(job, records, total=None):
+    """
+    Inserts new subjects with their grade levels; existing codes are skipped.
+
+    Rows with preview warnings other than "already exists" are skipped. Rows
+    whose group, type or grade levels vanished since the preview, or whose
+    credit is not a number, are counted as errors.
+
+    Returns:
+        dict: Counts for new, skipped and errored rows.
+    """
+    group_map = dict(db.session.query(SubjectGroup.name, SubjectGroup.id).all())
+    type_map = dict(db.session.query(SubjectType.name, SubjectType.id).all())
+    grade_map = dict(db.session.query(GradeLevel.short_name, GradeLevel.id).all())
+
+    counts = {'new': 0, 'skipped': 0, 'errors': 0}
+    _report(job, done=0, total=total, message='กำลังนำเข้าข้อมูลรายวิชา')
+    done = 0
+    for batch in batched(records):
+        candidates = {}
+        for record in batch:
+            if any(w != SUBJECT_EXISTS_WARNING for w in record.get('warnings', [])):
+                counts['skipped'] += 1
+                continue
+            data_row = record['data']
+            code = str(data_row['subject_code'])
+            grade_names = _split_names(data_row.get('grade_levels'))
+            group_id = group_map.get(str(data_row['subject_group']))
+            type_id = type_map.get(str(data_row['subject_type']))
+            if not group_id or not type_id or any(g not in grade_map for g in grade_names):
+                counts['errors'] += 1
+                current_app.logger.warning(f"Row {record.get('row_num', '?')} ({code}): Related data missing in DB (Group, Type, or Grade).")
+                continue
+            try:
+                credit = float(data_row['credit'])
+            except (TypeError, ValueError):
+                counts['errors'] += 1
+                continue
+            if code in candidates:
+                counts['skipped'] += 1
+                continue
+            candidates[code] = {
+                'row': {'subject_code': code, 'name': str(data_row['name']), 'credit': credit,
+                        'subject_group_id': group_id, 'subject_type_id': type_id},
+                'grade_ids': {grade_map[g] for g in grade_names},
+            }
+
+        for code in fetch_existing_map(Subject.subject_code, candidates.keys(), Subject.id):
+            candidates.pop(code)
+            counts['skipped'] += 1
+
+        if candidates:
+            db.session.execute(insert(Subject), [c['row'] for c in candidates.values()])
+            subject_ids = fetch_existing_map(Subject.subject_code, candidates.keys(), Subject.id)
+            grade_links = [{'subject_id': subject_ids[code], 'grade_level_id': grade_id}
+                           for code, c in candidates.items() for grade_id in c['grade_ids']]
+            if grade_links:
+                db.session.execute(insert(subject_grade_levels), grade_links)
+            refresh_search_documents(db.session, TYPE_SUBJECT, subject_ids.values())
+            counts['new'] += len(candidates)
+        db.session.commit()
+
+        done += len(batch)
+        _report(job, done=done)
+    return counts
+
+
+# --- Standards / indicators ---
+
+STANDARD_KEY_COLUMNS = ('subject_group', 'strand', 'standard_code', 'indicator_code')
+
+
+def _query_in(query, column, ids):
+    """Runs ``query.filter(column.in_(ids))`` in chunks and concatenates the rows."""
+    rows = []
+    for chunk in chunked(list(ids)):
+        rows.extend(query.filter(column.in_(chunk)).all())
+    return rows
+
+
+def _fetch_ids_by_key(id_column, key_columns, keys):
+    """
+    Maps each key tuple (e.g. (subject_group_id, name)) in ``keys`` to its row
+    id with chunked tuple IN queries, for rows that were just bulk inserted.
+    """
+    keys = list(keys)
+    result = {}
+    for chunk in chunked(keys, IMPORT_CHUNK_SIZE // len(key_columns)): # ตัวแปรต่อ query ยังไม่เกิน IMPORT_CHUNK_SIZE
+        for row_id, *key in db.session.query(id_column, *key_columns).filter(tuple_(*key_columns).in_(chunk)):
+            result[tuple(key)] = row_id
+    return result
+
+
+def _load_standard_hierarchy(group_ids):
+    """
+    Loads the strand/standard/indicator levels under the given subject groups
+    with one query per level.
+
+    Returns:
+        tuple: (strands {(group_id, name): id},
+                standards {(strand_id, code): (id, description)},
+                indicators {(standard_id, code): (id, description, creator_type)})
+    """
+    strands = {
+        (group_id, name): strand_id
+        for strand_id, group_id, name in _query_in(
+            db.session.query(LearningStrand.id, LearningStrand.subject_group_id, LearningStrand.name),
+            LearningStrand.subject_group_id, group_ids)
+    }
+    standards = {
+        (strand_id, code): (standard_id, description)
+        for standard_id, strand_id, code, description in _query_in(
+            db.session.query(Standard.id, Standard.learning_strand_id, Standard.code, Standard.description),
+            Standard.learning_strand_id, set(strands.values()))
+    }
+    indicators = {}
+    for indicator_id, standard_id, code, description, creator_type in _query_in(
+            db.session.query(Indicator.id, Indicator.standard_id, Indicator.code, Indicator.description,
+                             Indicator.creator_type),
+            Indicator.standard_id, {v[0] for v in standards.values()}):
+        key = (standard_id, code)
+        # ตัวชี้วัดของ ADMIN มาก่อนตัวชี้วัดที่ครูสร้างเองด้วยรหัสเดียวกัน
+        if key not in indicators or creator_type == 'ADMIN':
+            indicators[key] = (indicator_id, description, creator_type)
+    return strands, standards, indicators
+
+
+def build_standards_preview(batch):
+    """
+    Builds preview records for a standards import batch.
+
+    Each row gets a status against the current library: 'New' (indicator
+    does not exist yet), 'Update' (indicator or standard description
+    differs) or 'Unchanged'. Rows with a blank key column get a warning and
+    are skipped on import.
+    """
+    group_map = dict(db.session.query(SubjectGroup.name, SubjectGroup.id).all())
+    strands, standards, indicators = _load_standard_hierarchy(set(group_map.values()))
+
+    preview_data = []
+    for row_num, row in batch:
+        record = {
+            'row_num': row_num,
+            'subject_group': _text(row, 'subject_group'),
+            'strand': _text(row, 'strand'),
+            'standard_code': _text(row, 'standard_code'),
+            'standard_description': _text(row, 'standard_description'),
+            'indicator_code': _text(row, 'indicator_code'),
+            'indicator_description': _text(row, 'indicator_description'),
+            'status': 'New',
+            'warnings': []
+        }
+        blank = [col for col in STANDARD_KEY_COLUMNS if not record[col]]
+        if blank:
+            record['warnings'].append(f"ข้อมูลไม่ครบ: {', '.join(blank)}")
+        else:
+            strand_id = strands.get((group_map.get(record['subject_group']), record['strand']))
+            standard = standards.get((strand_id, record['standard_code']))
+            indicator = indicators.get((standard[0], record['indicator_code'])) if standard else None
+            if indicator:
+                changed = (indicator[2] == 'ADMIN' and indicator[1] != record['indicator_description']) \
+                    or standard[1] != record['standard_description']
+                record['status'] = 'Update' if changed else 'Unchanged'
+        preview_data.append(record)
+    return preview_data
+
+
+def run_standards_import(job, records, total=None):
+    """
+    Hierarchical bulk upsert of subject group -> strand -> standard -> indicator.
+
+    The existing hierarchy for the file's subject groups is loaded with one
+    query per level. Missing levels are inserted top-down with executemany
+    (only the new rows' ids are read back), and only descriptions that
+    actually changed are updated. Indicators
+    created by teachers are never modified; a file row that collides with
+    one is skipped.
+
+    Args:
+        job (Job | None): Progress handle from app.jobs.
+        records (iterable): Preview records produced by build_standards_preview.
+        total (int, optional): Number of records, for progress reporting.
+
+    Returns:
+        dict: Diff summary, one counter per level and action.
+    """
+    counts = Counter()
+    _report(job, done=0, total=total, message='กำลังตรวจสอบโครงสร้างมาตรฐาน/ตัวชี้วัด')
+
+    # 1. รวมแถวเป็นชุด key (แถวหลังทับแถวก่อน) — เก็บเฉพาะ tuple เล็ก ๆ
+    rows = {}
+    standard_descriptions = {}
+    for record in records:
+        if record.get('warnings'):
+            counts['skipped'] += 1
+            continue
+        key = tuple(record[col] for col in STANDARD_KEY_COLUMNS)
+        rows[key] = record['indicator_description']
+        if record['standard_description']:
+            standard_descriptions[key[:3]] = record['standard_description']
+
+    # 2. Subject groups
+    group_map = dict(db.session.query(SubjectGroup.name, SubjectGroup.id).all())
+    missing_groups = sorted({key[0] for key in rows} - set(group_map))
+    if missing_groups:
+        db.session.execute(insert(SubjectGroup), [{'name': name} for name in missing_groups])
+        group_map.update(fetch_existing_map(SubjectGroup.name, missing_groups, SubjectGroup.id))
+        counts['groups_created'] += len(missing_groups)
+
+    group_ids = {group_map[key[0]] for key in rows}
+    strands, standards, indicators = _load_standard_hierarchy(group_ids)
+    _report(job, message='กำลังบันทึกมาตรฐาน/ตัวชี้วัด')
+
+    # 3. Strands
+    missing_strands = sorted({(group_map[g], strand) for g, strand, _, _ in rows} - set(strands))
+    if missing_strands:
+        db.session.execute(insert(LearningStrand), [
+            {'subject_group_id': group_id, 'name': name} for group_id, name in missing_strands
+        ])
+        # อ่านกลับเฉพาะ id ของแถวที่เพิ่งเพิ่ม ไม่โหลดทั้งลำดับชั้น (ตัวชี้วัดมีมากที่สุด) ซ้ำ
+        strands.update(_fetch_ids_by_key(
+            LearningStrand.id, (LearningStrand.subject_group_id, LearningStrand.name), missing_strands))
+        counts['strands_created'] += len(missing_strands)
+
+    # 4. Standards
+    new_standards, standard_updates = {}, []
+    for std_key, description in standard_descriptions.items():
+        strand_id = strands[(group_map[std_key[0]], std_key[1])]
+        existing = standards.get((strand_id, std_key[2]))
+        if existing is None:
+            new_standards[(strand_id, std_key[2])] = description
+        elif existing[1] != description:
+            standard_updates.append({'id': existing[0], 'description': description})
+    for g, strand, code, _ in rows:
+        strand_id = strands[(group_map[g], strand)]
+        if (strand_id, code) not in standards and (strand_id, code) not in new_standards:
+            new_standards[(strand_id, code)] = ''
+    if new_standards:
+        db.session.execute(insert(Standard), [
+            {'learning_strand_id': strand_id, 'code': code, 'description': description}
+            for (strand_id, code), description in new_standards.items()
+        ])
+        counts['standards_created'] += len(new_standards)
+    if standard_updates:
+        db.session.execute(update(Standard), standard_updates)
+        counts['standards_updated'] += len(standard_updates)
+    if new_standards:
+        standards.update((key, (standard_id, new_standards[key])) for key, standard_id in _fetch_ids_by_key(
+            Standard.id, (Standard.learning_strand_id, Standard.code), new_standards).items())
+
+    # 5. Indicators
+    new_indicators, indicator_updates = [], []
+    for (g, strand, std_code, ind_code), description in rows.items():
+        standard_id = standards[(strands[(group_map[g], strand)], std_code)][0]
+        existing = indicators.get((standard_id, ind_code))
+        if existing is None:
+            new_indicators.append({'standard_id': standard_id, 'code': ind_code,
+                                   'description': description, 'creator_type': 'ADMIN'})
+        elif existing[2] != 'ADMIN':
+            counts['skipped'] += 1
+        elif existing[1] != description:
+            indicator_updates.append({'id': existing[0], 'description': description})
+        else:
+            counts['unchanged'] += 1
+    for chunk in chunked(new_indicators):
+        db.session.execute(insert(Indicator), chunk)
+    for chunk in chunked(indicator_updates):
+        db.session.execute(update(Indicator), chunk)
+    if indicator_updates:
+        bump_revisions_for_shared_indicators(db.session, [u['id'] for u in indicator_updates])
+    # bulk INSERT/UPDATE ไม่ผ่าน mapper events จึงต้องอัปเดต search index เอง
+    reindex_indicators(db.session, indicator_ids=[u['id'] for u in indicator_updates],
+                       standard_ids={row['standard_id'] for row in new_indicators})
+    counts['indicators_created'] += len(new_indicators)
+    counts['indicators_updated'] += len(indicator_updates)
+
+    db.session.commit()
+    _report(job, done=total)
+    return dict(counts)
@@ -0,0 +1,249 @@
+# FILE: app/indicator_search.py
+"""
+Search index for the indicator picker (teacher.search_indicators).
+
+The picker used to run ``ILIKE '%q%'`` over Indicator.code,
+Indicator.description and Standard.code on every keystroke. Now:
+
+* SQLite: an FTS5 table ``indicator_search`` (rowid = indicator.id) holding
+  the indicator code, standard code and description of every ADMIN indicator.
+  Thai has no spaces between words, so text is segmented in Python before it
+  is indexed or queried — with pythainlp when it is installed, otherwise
+  Thai runs are split into overlapping character bigrams (substring search).
+  Results are ranked with bm25, code matches weigh more than descriptions.
+* PostgreSQL: pg_trgm GIN indexes on the same columns; ILIKE uses them and
+  results are ranked by similarity().
+* Anything else (or FTS5/pg_trgm unavailable): the original ILIKE query.
+
+The FTS table is kept in sync by mapper events for ORM writes; bulk writers
+(app.importers) call reindex_indicators() themselves.
+"""
+import re
+
+from flask import current_app
+from sqlalchemy import bindparam, event, func, inspect, or_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import contains_eager, joinedload
+
+from app import db
+from app.models import Indicator, Setting, Standard
+
+try:
+    from pythainlp.tokenize import word_tokenize as _thai_word_tokenize
+    SEGMENTER = 'pythainlp-newmm'
+except ImportError:  # pythainlp เป็น optional — ไม่มีก็ใช้ bigram แทน
+    _thai_word_tokenize = None
+    SEGMENTER = 'bigram'
+
+INDEX_TABLE = 'indicator_search'
+SEGMENTER_SETTING_KEY = 'indicator_search_segmenter'
+SEARCH_LIMIT = 50
+REINDEX_CHUNK_SIZE = 500 # ต่ำกว่าขีดจำกัดตัวแปรของ SQLite (999) สำหรับ IN (...)
+
+BACKEND_FTS5 = 'fts5'
+BACKEND_TRIGRAM = 'trigram'
+BACKEND_LIKE = 'like'
+
+# สระ/วรรณยุกต์ที่เป็น combining mark — unicode61 ถือเป็นตัวคั่นคำ ต้องบอกให้นับเป็นส่วนของคำ
+_THAI_MARKS = 'ั' + ''.join(chr(c) for c in range(0x0e34, 0x0e3b)) + ''.join(chr(c) for c in range(0x0e47, 0x0e4f))
+_THAI_RUN = re.compile(r'[ก-๎]+')
+_WORD_CHAR = re.compile(r'\w')
+
+CREATE_INDEX_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+    "code, standard_code, description, standard_id UNINDEXED, "
+    f"tokenize=\"unicode61 remove_diacritics 0 tokenchars '{_THAI_MARKS}'\")"
+)
+TRIGRAM_INDEXES = [
+    ('ix_indicator_code_trgm', 'indicator', 'code'),
+    ('ix_indicator_description_trgm', 'indicator', 'description'),
+    ('ix_standard_code_trgm', 'standard', 'code'),
+]
+
+_backends = {} # str(engine.url) -> BACKEND_*
+
+
+def segment(value):
+    """Lower-cases ``value`` and splits its Thai runs into space-separated words (or bigrams)."""
+    def split_run(match):
+        run = match.group(0)
+        if _thai_word_tokenize:
+            words = [w for w in _thai_word_tokenize(run, engine='newmm', keep_whitespace=False) if w.strip()]
+        elif len(run) <= 2:
+            words = [run]
+        else:
+            words = [run[i:i + 2] for i in range(len(run) - 1)]
+        return f" {' '.join(words)} "
+    return ' '.join(_THAI_RUN.sub(split_run, (value or '').lower()).split())
+
+
+def build_match_query(query_str):
+    """
+    FTS5 MATCH expression for a typeahead query: every whitespace-separated
+    piece becomes a prefix phrase (``"tok tok"*``), all pieces must match.
+    Returns '' when nothing searchable is left.
+    """
+    phrases = []
+    for piece in (query_str or '').split():
+        terms = segment(piece.replace('"', ' '))
+        if _WORD_CHAR.search(terms):
+            phrases.append(f'"{terms}"*')
+    return ' '.join(phrases)
+
+
+def _backend_for(bind):
+    return _backends.get(str(bind.engine.url), BACKEND_LIKE)
+
+
+def _reindex(connection, indicator_ids=None, standard_ids=None):
+    """Rewrites index rows for the given indicators/standards (everything when both are None)."""
+    ind, std = Indicator.__table__, Standard.__table__
+    query = select(ind.c.id, ind.c.code, std.c.code, ind.c.description, ind.c.standard_id).join(
+        std, ind.c.standard_id == std.c.id).where(ind.c.creator_type == 'ADMIN')
+
+    if indicator_ids is None and standard_ids is None:
+        connection.execute(text(f"DELETE FROM {INDEX_TABLE}"))
+    else:
+        conditions = []
+        if indicator_ids:
+            connection.execute(text(f"DELETE FROM {INDEX_TABLE} WHERE rowid IN :ids").bindparams(
+                bindparam('ids', expanding=True)), {'ids': list(indicator_ids)})
+            conditions.append(ind.c.id.in_(list(indicator_ids)))
+        if standard_ids:
+            connection.execute(text(f"DELETE FROM {INDEX_TABLE} WHERE standard_id IN :ids").bindparams(
+                bindparam('ids', expanding=True)), {'ids': list(standard_ids)})
+            conditions.append(ind.c.standard_id.in_(list(standard_ids)))
+        if not conditions:
+            return 0
+        query = query.where(or_(*conditions))
+
+    rows = [{'id': indicator_id, 'code': segment(code), 'standard_code': segment(standard_code),
+             'description': segment(description), 'standard_id': standard_id}
+            for indicator_id, code, standard_code, description, standard_id in connection.execute(query)]
+    if rows:
+        connection.execute(text(
+            f"INSERT INTO {INDEX_TABLE} (rowid, code, standard_code, description, standard_id) "
+            "VALUES (:id, :code, :standard_code, :description, :standard_id)"
+        ), rows)
+    return len(rows)
+
+
+def reindex_indicators(session, indicator_ids=None, standard_ids=None):
+    """
+    Refreshes the index after bulk INSERT/UPDATE statements that bypass the
+    mapper events. Runs in the session's transaction; the caller commits.
+    """
+    connection = session.connection()
+    if _backend_for(connection) != BACKEND_FTS5:
+        return 0
+    indicator_ids, standard_ids = list(indicator_ids or []), list(standard_ids or [])
+    count = 0
+    for i in range(0, len(indicator_ids), REINDEX_CHUNK_SIZE):
+        count += _reindex(connection, indicator_ids=indicator_ids[i:i + REINDEX_CHUNK_SIZE])
+    for i in range(0, len(standard_ids), REINDEX_CHUNK_SIZE):
+        count += _reindex(connection, standard_ids=standard_ids[i:i + REINDEX_CHUNK_SIZE])
+    return count
+
+
+@event.listens_for(Indicator, 'after_insert')
+@event.listens_for(Indicator, 'after_update')
+def _sync_indicator(mapper, connection, target):
+    if _backend_for(connection) == BACKEND_FTS5:
+        _reindex(connection, indicator_ids=[target.id])
+
+
+@event.listens_for(Indicator, 'after_delete')
+def _unindex_indicator(mapper, connection, target):
+    if _backend_for(connection) == BACKEND_FTS5:
+        connection.execute(text(f"DELETE FROM {INDEX_TABLE} WHERE rowid = :id"), {'id': target.id})
+
+
+@event.listens_for(Standard, 'after_update')
+def _sync_standard(mapper, connection, target):
+    if _backend_for(connection) == BACKEND_FTS5 and inspect(target).attrs.code.history.has_changes():
+        _reindex(connection, standard_ids=[target.id])
+
+
+def _ensure_fts5(engine):
+    with engine.begin() as conn:
+        conn.execute(text(CREATE_INDEX_SQL))
+
+    setting = Setting.__table__
+    with engine.begin() as conn:
+        built_with = conn.execute(select(setting.c.value).where(setting.c.key == SEGMENTER_SETTING_KEY)).scalar()
+        if built_with != SEGMENTER:
+            count = _reindex(conn)
+            if built_with is None:
+                conn.execute(setting.insert().values(key=SEGMENTER_SETTING_KEY, value=SEGMENTER))
+            else:
+                conn.execute(setting.update().where(setting.c.key == SEGMENTER_SETTING_KEY).values(value=SEGMENTER))
+            current_app.logger.info(f"Indicator search index rebuilt ({count} indicators, segmenter={SEGMENTER}).")
+
+
+def _ensure_trigram(engine):
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for name, table, column in TRIGRAM_INDEXES:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)"))
+    except SQLAlchemyError as e:
+        # ไม่มีสิทธิ์สร้าง extension: ใช้ได้ถ้า DBA ติดตั้งไว้แล้ว
+        current_app.logger.warning(f"Could not create pg_trgm indexes for indicator search: {e}")
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+
+
+def ensure_indicator_search_index():
+    """
+    Creates the search index of the current database if needed and rebuilds
+    it when it is new or was built with a different Thai segmenter. Called
+    from create_app; never raises — search falls back to ILIKE instead.
+    """
+    engine = db.engine
+    backend = BACKEND_LIKE
+    try:
+        if engine.dialect.name == 'sqlite':
+            _ensure_fts5(engine)
+            backend = BACKEND_FTS5
+        elif engine.dialect.name == 'postgresql' and _ensure_trigram(engine):
+            backend = BACKEND_TRIGRAM
+    except SQLAlchemyError as e:
+        current_app.logger.warning(f"Indicator search index unavailable, using ILIKE: {e}")
+        if engine.dialect.name == 'sqlite' and inspect(engine).has_table(INDEX_TABLE):
+            backend = BACKEND_FTS5 # ตารางมีอยู่แล้ว (เช่น worker อื่นกำลัง rebuild) ยังต้อง sync ต่อ
+    _backends[str(engine.url)] = backend
+    return backend
+
+
+def find_indicators(query_str, limit=SEARCH_LIMIT):
+    """ADMIN indicators matching ``query_str``, best match first, with ``standard`` loaded."""
+    backend = _backend_for(db.engine)
+    if backend == BACKEND_FTS5:
+        match = build_match_query(query_str)
+        if not match:
+            return []
+        ids = [row[0] for row in db.session.execute(text(
+            f"SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH :match "
+            f"ORDER BY bm25({INDEX_TABLE}, 10.0, 5.0, 1.0), rowid LIMIT :limit"
+        ), {'match': match, 'limit': limit})]
+        by_id = {i.id: i for i in Indicator.query.options(joinedload(Indicator.standard)).filter(Indicator.id.in_(ids))}
+        return [by_id[i] for i in ids if i in by_id]
+
+    search_term = f"%{query_str}%"
+    query = Indicator.query.join(Standard).options(contains_eager(Indicator.standard)).filter(
+        Indicator.creator_type == 'ADMIN',
+        or_(
+            Indicator.code.ilike(search_term),
+            Indicator.description.ilike(search_term),
+            Standard.code.ilike(search_term)
+        )
+    )
+    if backend == BACKEND_TRIGRAM:
+        query = query.order_by(func.greatest(
+            func.similarity(Indicator.code, query_str),
+            func.similarity(Standard.code, query_str),
+            func.word_similarity(query_str, Indicator.description)
+        ).desc(), Standard.code, Indicator.code)
+    else:
+        query = query.order_by(Standard.code, Indicator.code)
+    return query.limit(limit).all()
@@ -0,0 +1,129 @@
+# FILE: app/jobs.py
+"""
+Minimal in-process background jobs for long admin operations (imports,
+promotion, rollover, ...).
+
+Jobs run on a small thread pool inside the web process, each with its own
+app context. Progress is written to ``instance/jobs/<job_id>.json`` so any
+gunicorn worker can answer the polling request, not only the one that runs
+the job.
+"""
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+
+MAX_WORKERS = 2 # งานหนัก (import/promote) ไม่ควรรันพร้อมกันเยอะ เพราะจะแย่ง lock ฐานข้อมูล
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='edhub-job')
+_write_lock = threading.Lock()
+
+
+def _jobs_dir(app):
+    path = os.path.join(app.instance_path, 'jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _job_path(app, job_id):
+    # job_id มาจาก uuid4().hex เสมอ กัน path traversal จาก URL
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    return os.path.join(_jobs_dir(app), f"{job_id}.json")
+
+
+def _write_state(app, state):
+    path = _job_path(app, state['id'])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with _write_lock:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+
+
+class Job:
+    """Handle passed to a job function for reporting progress."""
+
+    def __init__(self, app, state):
+        self._app = app
+        self.state = state
+
+    @property
+    def id(self):
+        return self.state['id']
+
+    def update(self, done=None, total=None, message=None, **extra):
+        """Records progress. Cheap enough to call once per chunk."""
+        if done is not None:
+            self.state['done'] = done
+        if total is not None:
+            self.state['total'] = total
+        if message is not None:
+            self.state['message'] = message
+        self.state.update(extra)
+        self.state['updated_at'] = datetime.utcnow().isoformat()
+        _write_state(self._app, self.state)
+
+
+def _run(app, state, func, args, kwargs):
+    job = Job(app, state)
+    with app.app_context():
+        try:
+            job.update(status='running', started_at=datetime.utcnow().isoformat())
+            result = func(job, *args, **kwargs)
+            job.update(status='finished', result=result, finished_at=datetime.utcnow().isoformat())
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Background job {state['id']} ({state['kind']}) failed: {e}", exc_info=True)
+            job.update(status='failed', error=str(e), finished_at=datetime.utcnow().isoformat())
+        finally:
+            db.session.remove()
+
+
+def start_job(kind, func, *args, user_id=None, **kwargs):
+    """
+    Schedules ``func(job, *args, **kwargs)`` on the background pool.
+
+    Args:
+        kind (str): Short job type used for display/logging, e.g. 'student_import'.
+        func (callable): Job body. Receives a Job as its first argument and
+            returns a JSON-serialisable result (usually a summary dict).
+        user_id (int, optional): Owner; only this user may poll the job.
+
+    Returns:
+        str: The job id.
+    """
+    app = current_app._get_current_object()
+    state = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'user_id': user_id,
+        'status': 'queued',
+        'done': 0,
+        'total': None,
+        'message': None,
+        'result': None,
+        'error': None,
+        'created_at': datetime.utcnow().isoformat(),
+    }
+    _write_state(app, state)
+    _executor.submit(_run, app, state, func, args, kwargs)
+    return state['id']
+
+
+def get_job(job_id):
+    """Returns the last recorded state of a job, or None if unknown."""
+    path = _job_path(current_app, job_id)
+    if not path:
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
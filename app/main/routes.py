@@ -1,9 +1,11 @@
 # FILE: app/main/routes.py
-from flask import abort, current_app, g, jsonify, redirect, render_template, url_for
+from flask import abort, current_app, g, jsonify, redirect, render_template, request, url_for
 from flask_login import login_required, current_user
 from app.main import bp
 from app.models import Notification, Setting
 from app import db 
+from app.jobs import get_job
+from app.global_search import search_everything, searchable_types
 
 #@bp.route('/')
 @bp.route('/index')
@@ -48,6 +50,24 @@ def get_notifications():
 
     return jsonify(notif_data)
 
+@bp.route('/api/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """[NEW] Polling endpoint for background jobs started by the current user."""
+    job = get_job(job_id)
+    if not job or job.get('user_id') != current_user.id:
+        abort(404)
+    return jsonify(job)
+
+@bp.route('/api/search')
+@login_required
+def global_search():
+    """[NEW] Navbar search across students, users, subjects, classrooms and lesson plans."""
+    if not searchable_types(current_user):
+        abort(403)
+    query_str = request.args.get('q', '').strip()[:100]
+    return jsonify(search_everything(query_str, current_user))
+
 @bp.route('/api/notifications/<int:notification_id>/mark-read', methods=['POST'])
 @login_required
 def mark_notification_as_read(notification_id):
@@ -0,0 +1,181 @@
+# FILE: app/materialized_timetables.py
+"""
+Precomputed weekly timetables per teacher and per classroom.
+
+Every reader (teacher dashboard, teacher timetable, student dashboard,
+mobile classroom hub) used to rebuild its timetable from TimetableEntry,
+WeeklyScheduleSlot and Course joins; the teacher dashboard even found the
+next consecutive period with a correlated subquery per row.
+
+Here the whole semester is materialized in one pass into MaterializedTimetable
+rows (one JSON document per owner). A read is a single indexed query that also
+returns Semester.timetable_version; when it is ahead of the version the rows
+were built for, the semester is regenerated first.
+
+Document shape::
+
+    {'cells': [{'entry_id', 'next_entry_id', 'slot_id', 'day', 'period', 'start', 'end',
+                'course_id', 'subject_code', 'subject_name', 'classroom_id', 'classroom_name',
+                'room_name', 'teachers'}, ...],          # ordered by (day, period)
+     'blocks': [{'day', 'period_start', 'period_end', 'start', 'end', 'course_id',
+                 'entry_ids', 'subject_code', 'subject_name', 'classroom_name', 'room_name'}, ...]}
+"""
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import and_, delete, insert, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app import db
+from app.models import (Classroom, Course, MaterializedTimetable, Room, Semester, Subject, TimetableEntry, User,
+                        WeeklyScheduleSlot, course_teachers)
+
+OWNER_TEACHER = 'teacher'
+OWNER_CLASSROOM = 'classroom'
+
+EMPTY_TIMETABLE = {'cells': [], 'blocks': []}
+
+
+def _semester_cells(semester_id):
+    """All entries of the semester as flat cell dicts, plus {course_id: [teacher_id, ...]}."""
+    teacher_names = {}
+    teachers_by_course = defaultdict(list)
+    for course_id, user_id, name_prefix, first_name, last_name in db.session.query(
+        course_teachers.c.course_id, User.id, User.name_prefix, User.first_name, User.last_name
+    ).join(User, User.id == course_teachers.c.user_id).join(
+        Course, Course.id == course_teachers.c.course_id
+    ).filter(Course.semester_id == semester_id).order_by(course_teachers.c.course_id, User.id):
+        teachers_by_course[course_id].append(user_id)
+        teacher_names[user_id] = f"{name_prefix or ''}{first_name} {last_name}".strip() # เหมือน User.full_name
+
+    rows = db.session.query(
+        TimetableEntry.id, TimetableEntry.course_id, WeeklyScheduleSlot.id, WeeklyScheduleSlot.day_of_week,
+        WeeklyScheduleSlot.period_number, WeeklyScheduleSlot.start_time, WeeklyScheduleSlot.end_time,
+        Subject.subject_code, Subject.name, Classroom.id, Classroom.name, Room.name
+    ).join(WeeklyScheduleSlot, TimetableEntry.weekly_schedule_slot_id == WeeklyScheduleSlot.id
+    ).join(Course, TimetableEntry.course_id == Course.id
+    ).join(Subject, Course.subject_id == Subject.id
+    ).join(Classroom, Course.classroom_id == Classroom.id
+    ).outerjoin(Room, Course.room_id == Room.id
+    ).filter(WeeklyScheduleSlot.semester_id == semester_id
+    ).order_by(WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number, TimetableEntry.id).all()
+
+    cells = []
+    for (entry_id, course_id, slot_id, day, period, start, end, subject_code, subject_name,
+         classroom_id, classroom_name, room_name) in rows:
+        cells.append({
+            'entry_id': entry_id,
+            'next_entry_id': None,
+            'slot_id': slot_id,
+            'day': day,
+            'period': period,
+            'start': start.strftime('%H:%M') if start else '',
+            'end': end.strftime('%H:%M') if end else '',
+            'course_id': course_id,
+            'subject_code': subject_code,
+            'subject_name': subject_name,
+            'classroom_id': classroom_id,
+            'classroom_name': classroom_name,
+            'room_name': room_name,
+            'teachers': ", ".join(teacher_names[tid] for tid in teachers_by_course[course_id]),
+        })
+    return cells, teachers_by_course
+
+
+def _owner_document(cells):
+    """Links consecutive periods of the same course and merges them into blocks."""
+    cells = [dict(cell) for cell in cells]
+    by_position = {(c['day'], c['period'], c['course_id']): c for c in cells}
+    for cell in cells:
+        following = by_position.get((cell['day'], cell['period'] + 1, cell['course_id']))
+        cell['next_entry_id'] = following['entry_id'] if following else None
+
+    blocks = []
+    for cell in cells:
+        last = blocks[-1] if blocks else None
+        if (last and last['day'] == cell['day'] and last['course_id'] == cell['course_id']
+                and last['period_end'] + 1 == cell['period']):
+            last['period_end'] = cell['period']
+            last['end'] = cell['end']
+            last['entry_ids'].append(cell['entry_id'])
+            continue
+        blocks.append({
+            'day': cell['day'],
+            'period_start': cell['period'],
+            'period_end': cell['period'],
+            'start': cell['start'],
+            'end': cell['end'],
+            'course_id': cell['course_id'],
+            'entry_ids': [cell['entry_id']],
+            'subject_code': cell['subject_code'],
+            'subject_name': cell['subject_name'],
+            'classroom_name': cell['classroom_name'],
+            'room_name': cell['room_name'],
+        })
+    return {'cells': cells, 'blocks': blocks}
+
+
+def build_semester_timetables(semester_id):
+    """Returns {(owner_type, owner_id): document} for every teacher and classroom with entries."""
+    cells, teachers_by_course = _semester_cells(semester_id)
+    grouped = defaultdict(list)
+    for cell in cells:
+        grouped[(OWNER_CLASSROOM, cell['classroom_id'])].append(cell)
+        for teacher_id in teachers_by_course[cell['course_id']]:
+            grouped[(OWNER_TEACHER, teacher_id)].append(cell)
+    return {owner: _owner_document(owner_cells) for owner, owner_cells in grouped.items()}
+
+
+def refresh_semester_timetables(semester_id, version):
+    """
+    Rewrites all MaterializedTimetable rows of a semester for ``version`` in a
+    transaction of its own (GET views call this through get_weekly_timetable,
+    so the request's db.session is neither committed nor rolled back here).
+    Returns the built documents so the caller can answer without reading them
+    back.
+    """
+    documents = build_semester_timetables(semester_id)
+    materialized, semesters = MaterializedTimetable.__table__, Semester.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(delete(materialized).where(materialized.c.semester_id == semester_id))
+            if documents:
+                conn.execute(insert(materialized), [
+                    {'semester_id': semester_id, 'owner_type': owner_type, 'owner_id': owner_id,
+                     'version': version, 'data': document}
+                    for (owner_type, owner_id), document in documents.items()
+                ])
+            conn.execute(update(semesters).where(semesters.c.id == semester_id).values(
+                timetable_materialized_version=version))
+    except IntegrityError:
+        # worker อื่นกำลังสร้างพร้อมกัน: ใช้ผลที่คำนวณได้ไปก่อน รอบหน้าจะอ่านจากตาราง
+        current_app.logger.info(f"Materialized timetables for semester {semester_id} were refreshed concurrently.")
+    except SQLAlchemyError as e:
+        # เขียนไม่ได้ (เช่น ฐานข้อมูลไม่ว่าง) ไม่ควรทำให้หน้าที่แค่อ่านตารางสอนล้ม
+        current_app.logger.warning(f"Could not store materialized timetables for semester {semester_id}: {e}")
+    return documents
+
+
+def get_weekly_timetable(semester_id, owner_type, owner_id):
+    """
+    The materialized weekly timetable of a teacher or classroom (see module
+    docstring for the shape); empty when the owner has no entries.
+    """
+    row = db.session.query(
+        Semester.timetable_version, Semester.timetable_materialized_version, MaterializedTimetable.data
+    ).outerjoin(MaterializedTimetable, and_(
+        MaterializedTimetable.semester_id == Semester.id,
+        MaterializedTimetable.owner_type == owner_type,
+        MaterializedTimetable.owner_id == owner_id
+    )).filter(Semester.id == semester_id).first()
+    if row is None:
+        return EMPTY_TIMETABLE
+
+    version, materialized_version, data = row
+    if materialized_version != version:
+        data = refresh_semester_timetables(semester_id, version).get((owner_type, owner_id))
+    return data or EMPTY_TIMETABLE
+
+
+def cells_on_day(timetable, day):
+    return [cell for cell in timetable['cells'] if cell['day'] == day]
@@ -4,14 +4,26 @@ from app import login
 from app import db
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, event
+from sqlalchemy import UniqueConstraint, event, inspect
+from sqlalchemy.orm import Session
 from datetime import datetime
 from sqlalchemy import func
 
+def name_search_key(value):
+    """Normalized form of a name for indexed prefix search (lower-case, single spaces)."""
+    return ' '.join(str(value or '').lower().split()) or None
+
+def _name_search_key_default(source):
+    # ใช้ตอน INSERT (รวม bulk insert) — UPDATE ผ่าน ORM ใช้ sync_name_search_keys
+    def default(context):
+        return name_search_key(context.get_current_parameters().get(source))
+    return default
+
 # --- Association tables ---
 user_roles = db.Table('user_roles',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('role_id', db.Integer, db.ForeignKey('role.id'), primary_key=True)
+    db.Column('role_id', db.Integer, db.ForeignKey('role.id'), primary_key=True),
+    db.Index('ix_user_roles_role_id', 'role_id') # กรองผู้ใช้ตามบทบาท
 )
 subject_grade_levels = db.Table('subject_grade_levels',
     db.Column('subject_id', db.Integer, db.ForeignKey('subject.id'), primary_key=True),
@@ -75,6 +87,8 @@ class Setting(db.Model):
     key = db.Column(db.String(50), unique=True, nullable=False)
     value = db.Column(db.Text, nullable=True)
 
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
@@ -83,6 +97,9 @@ class User(UserMixin, db.Model):
     name_prefix = db.Column(db.String(20), nullable=True)
     first_name = db.Column(db.String(64), nullable=False)
     last_name = db.Column(db.String(64), nullable=False)
+    # ชื่อแบบ normalize สำหรับค้นหาด้วย index (prefix) ดู name_search_key
+    first_name_key = db.Column(db.String(64), index=True, default=_name_search_key_default('first_name'))
+    last_name_key = db.Column(db.String(64), index=True, default=_name_search_key_default('last_name'))
     job_title = db.Column(db.String(100), nullable=True)
     must_change_username = db.Column(db.Boolean, default=True, nullable=False)
     must_change_password = db.Column(db.Boolean, default=True, nullable=False)
@@ -94,6 +111,10 @@ class User(UserMixin, db.Model):
     # เราจะใช้ Flag นี้แทน must_change_password/username เพื่อบังคับไปหน้า setup
     initial_setup_complete = db.Column(db.Boolean, default=False, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_user_username_lower', func.lower(username)), # ค้นหา username แบบไม่สนตัวพิมพ์ด้วย prefix
+    )
+
     roles = db.relationship('Role', secondary=user_roles, back_populates='users')
     advised_classrooms = db.relationship('Classroom', secondary=classroom_advisors, back_populates='advisors')
     member_of_groups = db.relationship('SubjectGroup', secondary=subject_group_members, back_populates='members')
@@ -110,7 +131,7 @@ class User(UserMixin, db.Model):
         return f"{self.name_prefix or ''}{self.first_name} {self.last_name}".strip()
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256:260000')
+        self.password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
 
     def check_password(self, password):
         if self.password_hash:
@@ -145,6 +166,7 @@ class GradeLevel(db.Model):
     name = db.Column(db.String(50), nullable=False, unique=True)
     short_name = db.Column(db.String(10))
     level_group = db.Column(db.String(10), nullable=True, index=True) # เช่น 'm-ton', 'm-plai'
+    graduation_credits = db.Column(db.Float, nullable=True) # หน่วยกิตขั้นต่ำเพื่อจบหลักสูตร (None = ไม่ใช่ชั้นจบ)
     head_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     head = db.relationship('User', backref=db.backref('led_grade_level', uselist=False))
     weekly_schedule_slots = db.relationship('WeeklyScheduleSlot', backref='grade_level', lazy='dynamic')
@@ -183,6 +205,8 @@ class SubjectType(db.Model):
 class AcademicYear(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     year = db.Column(db.Integer, unique=True, nullable=False)
+    # เวลาที่ย้ายข้อมูลรายละเอียดของปีนี้ไปตาราง archived_* (None = ยังอยู่ในตารางหลักทั้งหมด)
+    archived_at = db.Column(db.DateTime, nullable=True)
     semesters = db.relationship('Semester', back_populates='academic_year', lazy='dynamic', cascade="all, delete-orphan")
     classrooms = db.relationship('Classroom', back_populates='academic_year', lazy='dynamic')
     def __repr__(self): return str(self.year)
@@ -194,10 +218,15 @@ class Semester(db.Model):
     end_date = db.Column(db.Date)
     is_current = db.Column(db.Boolean, default=False, index=True)
     academic_year_id = db.Column(db.Integer, db.ForeignKey('academic_year.id'), nullable=False)
+    # เพิ่มขึ้นทุกครั้งที่ตารางสอนของภาคเรียนเปลี่ยน ใช้ตรวจว่า conflict index ใน cache ยังใช้ได้หรือไม่
+    timetable_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # timetable_version ที่ MaterializedTimetable ของภาคเรียนนี้ถูกสร้างไว้ล่าสุด (None = ยังไม่เคยสร้าง)
+    timetable_materialized_version = db.Column(db.Integer, nullable=True)
     academic_year = db.relationship('AcademicYear', back_populates='semesters')
     curriculums = db.relationship('Curriculum', back_populates='semester', cascade="all, delete-orphan")
     weekly_schedule_slots = db.relationship('WeeklyScheduleSlot', backref='semester', lazy='dynamic', cascade="all, delete-orphan")
     time_slots = db.relationship('TimeSlot', backref='semester', lazy='dynamic', cascade="all, delete-orphan")
+    materialized_timetables = db.relationship('MaterializedTimetable', backref='semester', lazy='dynamic', cascade="all, delete-orphan")
     def __repr__(self): return f'{self.academic_year.year}/{self.term}'
 
 class Subject(db.Model):
@@ -233,7 +262,7 @@ class Curriculum(db.Model):
 class Classroom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
-    grade_level_id = db.Column(db.Integer, db.ForeignKey('grade_level.id', name='fk_classroom_grade_level'), nullable=False)
+    grade_level_id = db.Column(db.Integer, db.ForeignKey('grade_level.id', name='fk_classroom_grade_level'), nullable=False, index=True)
     academic_year_id = db.Column(db.Integer, db.ForeignKey('academic_year.id', name='fk_classroom_academic_year'), nullable=False)
     program_id = db.Column(db.Integer, db.ForeignKey('program.id', name='fk_classroom_program'), nullable=True, index=True)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id', name='fk_classroom_room'), nullable=True)
@@ -255,7 +284,9 @@ class Student(db.Model):
     name_prefix = db.Column(db.String(20), nullable=False)
     first_name = db.Column(db.String(64), nullable=False)
     last_name = db.Column(db.String(64), nullable=False)
-    status = db.Column(db.String(50), default='กำลังศึกษา')
+    first_name_key = db.Column(db.String(64), index=True, default=_name_search_key_default('first_name'))
+    last_name_key = db.Column(db.String(64), index=True, default=_name_search_key_default('last_name'))
+    status = db.Column(db.String(50), default='กำลังศึกษา', index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=True)
     user = db.relationship('User', backref=db.backref('student_profile', uselist=False))
     enrollments = db.relationship('Enrollment', back_populates='student', lazy='dynamic', cascade="all, delete-orphan")
@@ -274,6 +305,13 @@ class Enrollment(db.Model):
     classroom = db.relationship('Classroom', back_populates='enrollments')
     student_group = db.relationship('StudentGroup', back_populates='enrollments')
 
+    __table_args__ = (
+        db.Index('ix_enrollment_classroom_student', 'classroom_id', 'student_id'),
+        db.Index('uq_enrollment_student_classroom', 'student_id', 'classroom_id', unique=True), # ใช้แทน index student_id เดี่ยว
+        db.Index('ix_enrollment_classroom_roll', 'classroom_id', 'roll_number'),
+        db.Index('ix_enrollment_student_group_id', 'student_group_id'),
+    )
+
 class Course(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
@@ -306,7 +344,8 @@ class Course(db.Model):
     # Constraints
     __table_args__ = (
         db.UniqueConstraint('subject_id', 'classroom_id', 'semester_id', name='_subject_classroom_semester_uc'),
-        db.ForeignKeyConstraint(['submitted_by_id'], ['user.id'], name='fk_course_submitted_by_user')
+        db.ForeignKeyConstraint(['submitted_by_id'], ['user.id'], name='fk_course_submitted_by_user'),
+        db.Index('ix_course_semester_status', 'semester_id', 'grade_submission_status'),
     )
 
     def __repr__(self):
@@ -472,6 +511,8 @@ class Score(db.Model):
     score = db.Column(db.Float, nullable=True)
     details = db.Column(db.JSON, nullable=True)
     graded_item_id = db.Column(db.Integer, db.ForeignKey('graded_item.id'), nullable=True)
+    # เวลาแก้ไขล่าสุด (NULL = ไม่เคยแก้ไขหลังบันทึก) ใช้ตรวจบล็อกที่เปลี่ยนใน incremental backup
+    updated_at = db.Column(db.DateTime, nullable=True, onupdate=datetime.utcnow)
 
     # Relationships
     student = db.relationship('Student', back_populates='scores')
@@ -479,6 +520,12 @@ class Score(db.Model):
     rubric_level = db.relationship('RubricLevel')
     graded_item = db.relationship('GradedItem', back_populates='scores')
 
+    __table_args__ = (
+        db.Index('uq_score_student_graded_item', 'student_id', 'graded_item_id', unique=True),
+        db.Index('ix_score_graded_item_id', 'graded_item_id'),
+        db.Index('ix_score_assessment_item_id', 'assessment_item_id'),
+    )
+
     def __repr__(self):
         return f'<Score Student:{self.student_id} Item:{self.assessment_item_id}>'
 
@@ -532,6 +579,8 @@ class LessonPlan(db.Model):
     status = db.Column(db.String(50), nullable=False, default='ฉบับร่าง', index=True)
     revision_notes = db.Column(db.Text, nullable=True)
     manual_scheduling_notes = db.Column(db.Text, nullable=True) # บันทึกช่วยจำสำหรับผู้จัดตาราง
+    # เลขรุ่นเนื้อหาแผน เพิ่มขึ้นอัตโนมัติเมื่อหน่วย/หน่วยย่อย/ตัวชี้วัด/ชิ้นงานเปลี่ยน (ใช้เป็น key ของ export cache)
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Relationships
     subject = db.relationship('Subject', back_populates='lesson_plans')
@@ -753,6 +802,36 @@ class LessonPlanConstraint(db.Model):
     def __repr__(self):
         return f'<LessonPlanConstraint {self.constraint_type}={self.value}>'
                 
+class MaterializedTimetable(db.Model):
+    """[NEW] ตารางสอนรายสัปดาห์ที่คำนวณไว้แล้วของครู 1 คน หรือห้องเรียน 1 ห้อง (ดู app/materialized_timetables.py)"""
+    __tablename__ = 'materialized_timetable'
+    id = db.Column(db.Integer, primary_key=True)
+    semester_id = db.Column(db.Integer, db.ForeignKey('semester.id', ondelete='CASCADE'), nullable=False)
+    owner_type = db.Column(db.String(20), nullable=False) # 'teacher' หรือ 'classroom'
+    owner_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+
+    __table_args__ = (UniqueConstraint('semester_id', 'owner_type', 'owner_id', name='_materialized_timetable_owner_uc'),)
+
+    def __repr__(self):
+        return f'<MaterializedTimetable {self.owner_type}:{self.owner_id} Semester:{self.semester_id} v{self.version}>'
+
+class SearchDocument(db.Model):
+    """[NEW] เอกสารค้นหารวม 1 แถวต่อ นักเรียน/ผู้ใช้/รายวิชา/ห้องเรียน/แผนการสอน (ดู app/global_search.py)"""
+    __tablename__ = 'search_document'
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(20), nullable=False) # 'student', 'user', 'subject', 'classroom', 'lesson_plan'
+    entity_id = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(255), nullable=False)
+    subtitle = db.Column(db.String(255), nullable=True)
+    terms = db.Column(db.Text, nullable=False) # ข้อความตัวพิมพ์เล็กที่ normalize แล้ว (ไม่ต้องตัดคำ ใช้ trigram)
+
+    __table_args__ = (UniqueConstraint('entity_type', 'entity_id', name='_search_document_entity_uc'),)
+
+    def __repr__(self):
+        return f'<SearchDocument {self.entity_type}:{self.entity_id}>'
+
 class TimetableEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
@@ -763,7 +842,10 @@ class TimetableEntry(db.Model):
     slot = db.relationship('WeeklyScheduleSlot', backref='timetable_entry')
     attendance_records = db.relationship('AttendanceRecord', back_populates='timetable_entry', cascade="all, delete-orphan")
 
-    __table_args__ = (db.UniqueConstraint('weekly_schedule_slot_id', name='_slot_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('weekly_schedule_slot_id', name='_slot_uc'),
+        db.Index('ix_timetable_entry_course_slot', 'course_id', 'weekly_schedule_slot_id'),
+    )
 
     def __repr__(self):
         return f'<TimetableEntry Course:{self.course_id} Slot:{self.weekly_schedule_slot_id}>'
@@ -800,7 +882,10 @@ class AttendanceRecord(db.Model):
     recorder = db.relationship('User', backref='recorded_attendance')
 
     # --- UPDATE THIS LINE ---
-    __table_args__ = (db.UniqueConstraint('student_id', 'timetable_entry_id', 'attendance_date', name='_student_entry_date_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'timetable_entry_id', 'attendance_date', name='_student_entry_date_uc'),
+        db.Index('ix_attendance_record_entry_date', 'timetable_entry_id', 'attendance_date'),
+    )
 
     def __repr__(self):
         return f'<AttendanceRecord Student {self.student_id} is {self.status} on {self.attendance_date}>'
@@ -817,6 +902,10 @@ class Notification(db.Model):
 
     user = db.relationship('User', backref=db.backref('notifications', lazy='dynamic'))
 
+    __table_args__ = (
+        db.Index('ix_notification_user_read_created', 'user_id', 'is_read', 'created_at'), # กระดิ่งแจ้งเตือน: ยังไม่อ่าน เรียงล่าสุด
+    )
+
     def __repr__(self):
         return f'<Notification for User {self.user_id}>'
     
@@ -923,6 +1012,267 @@ class RepeatCandidate(db.Model):
     def __repr__(self):
         return f'<RepeatCandidate S:{self.student_id} Year:{self.academic_year_id_failed}>'
     
+# --- Academic-year archive (cold storage) ---
+# สำเนาแถวของปีการศึกษาที่ปิดแล้ว ย้ายมาจากตารางหลักโดย app.archive
+# ไม่มี foreign key เพื่อให้ลบ/แก้ข้อมูลหลักได้โดยไม่ติดแถวเก่า; source_id คือ id เดิมในตารางหลัก
+class ArchivedScore(db.Model):
+    __tablename__ = 'archived_score'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    academic_year_id = db.Column(db.Integer, nullable=False, index=True)
+    student_id = db.Column(db.Integer, nullable=False)
+    assessment_item_id = db.Column(db.Integer, nullable=True)
+    rubric_level_id = db.Column(db.Integer, nullable=True)
+    score = db.Column(db.Float, nullable=True)
+    details = db.Column(db.JSON, nullable=True)
+    graded_item_id = db.Column(db.Integer, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index('ix_archived_score_graded_item_student', 'graded_item_id', 'student_id'),)
+
+class ArchivedAttendanceRecord(db.Model):
+    __tablename__ = 'archived_attendance_record'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    academic_year_id = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=True)
+    attendance_date = db.Column(db.Date, nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)
+    timetable_entry_id = db.Column(db.Integer, nullable=False)
+    recorder_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_archived_attendance_record_entry_student', 'timetable_entry_id', 'student_id'),)
+
+class ArchivedQualitativeScore(db.Model):
+    __tablename__ = 'archived_qualitative_score'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    academic_year_id = db.Column(db.Integer, nullable=False, index=True)
+    score_value = db.Column(db.Integer, nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)
+    assessment_topic_id = db.Column(db.Integer, nullable=False)
+    course_id = db.Column(db.Integer, nullable=False, index=True)
+
+class ArchivedAuditLog(db.Model):
+    __tablename__ = 'archived_audit_log'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    academic_year_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(255), nullable=False)
+    model_name = db.Column(db.String(50), nullable=True)
+    record_id = db.Column(db.String(50), nullable=True)
+    old_value = db.Column(db.Text, nullable=True)
+    new_value = db.Column(db.Text, nullable=True)
+    timestamp = db.Column(db.DateTime, nullable=True)
+
+class ArchivedNotification(db.Model):
+    __tablename__ = 'archived_notification'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    academic_year_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    title = db.Column(db.String(255), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    url = db.Column(db.String(255), nullable=True)
+    is_read = db.Column(db.Boolean, nullable=False)
+    notification_type = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+
+# --- Lesson plan revision tracking ---
+# ทุกครั้งที่เนื้อหาที่ไปปรากฏในไฟล์ export ของแผนการสอนเปลี่ยน ให้เพิ่ม LessonPlan.revision
+# เพื่อให้ไฟล์ PDF/DOCX ที่ cache ไว้ตาม (plan_id, revision, format) หมดอายุเอง
+_PLAN_CONTENT_MODELS = (LearningUnit, SubUnit, GradedItem, AssessmentItem, Indicator, PostTeachingLog)
+
+def _unit_ids_for_shared_indicators(session, indicator_ids):
+    """LearningUnit ids that link any of the given indicators directly or through a sub-unit."""
+    linked_units = session.query(learning_unit_indicators.c.learning_unit_id).filter(
+        learning_unit_indicators.c.indicator_id.in_(indicator_ids))
+    linked_sub_units = session.query(SubUnit.learning_unit_id).join(
+        sub_unit_indicators, sub_unit_indicators.c.sub_unit_id == SubUnit.id
+    ).filter(sub_unit_indicators.c.indicator_id.in_(indicator_ids))
+    return {uid for uid, in linked_units.union(linked_sub_units).all()}
+
+def bump_revisions_for_shared_indicators(session, indicator_ids):
+    """
+    Bulk UPDATE statements on Indicator bypass before_flush, so callers that
+    rewrite shared (ADMIN) indicators in bulk call this to invalidate the
+    cached exports of every plan that uses them.
+    """
+    indicator_ids = list(indicator_ids)
+    unit_ids = set()
+    for start in range(0, len(indicator_ids), 500):
+        unit_ids.update(_unit_ids_for_shared_indicators(session, indicator_ids[start:start + 500]))
+    unit_ids.discard(None)
+    if not unit_ids:
+        return
+    plan_ids = {pid for pid, in session.query(LearningUnit.lesson_plan_id).filter(
+        LearningUnit.id.in_(unit_ids)).distinct()}
+    plan_ids.discard(None)
+    if plan_ids:
+        session.query(LessonPlan).filter(LessonPlan.id.in_(plan_ids)).update(
+            {LessonPlan.revision: LessonPlan.revision + 1}, synchronize_session=False)
+
+def _collect_plan_ids(session, objects):
+    """Resolves the LessonPlan ids affected by a set of changed plan-content objects."""
+    plan_ids = set()
+    unit_ids = set()
+    shared_indicator_ids = set()
+
+    for obj in objects:
+        if isinstance(obj, LearningUnit):
+            plan_ids.add(obj.lesson_plan_id or (obj.lesson_plan.id if obj.lesson_plan else None))
+        elif isinstance(obj, SubUnit):
+            unit = obj.learning_unit
+            if unit is not None:
+                plan_ids.add(unit.lesson_plan_id or (unit.lesson_plan.id if unit.lesson_plan else None))
+            else:
+                unit_ids.add(obj.learning_unit_id)
+        elif isinstance(obj, GradedItem):
+            if obj.learning_unit is not None:
+                plan_ids.add(obj.learning_unit.lesson_plan_id)
+            else:
+                unit_ids.add(obj.learning_unit_id)
+        elif isinstance(obj, AssessmentItem):
+            if obj.unit is not None:
+                plan_ids.add(obj.unit.lesson_plan_id)
+            else:
+                unit_ids.add(obj.learning_unit_id)
+        elif isinstance(obj, PostTeachingLog):
+            unit_ids.add(obj.learning_unit_id)
+        elif isinstance(obj, Indicator):
+            if obj.lesson_plan_id or obj.lesson_plan is not None:
+                plan_ids.add(obj.lesson_plan_id or obj.lesson_plan.id)
+            elif obj.id is not None:
+                # ตัวชี้วัดกลาง (ADMIN) ถูกแก้ไข/ลบ: กระทบทุกแผนที่ผูกตัวชี้วัดนี้ไว้
+                shared_indicator_ids.add(obj.id)
+
+    if shared_indicator_ids:
+        unit_ids.update(_unit_ids_for_shared_indicators(session, shared_indicator_ids))
+
+    unit_ids.discard(None)
+    if unit_ids:
+        plan_ids.update(pid for pid, in session.query(LearningUnit.lesson_plan_id).filter(
+            LearningUnit.id.in_(unit_ids)).distinct())
+
+    plan_ids.discard(None)
+    return plan_ids
+
+@event.listens_for(Session, 'before_flush')
+def bump_lesson_plan_revision(session, flush_context, instances):
+    """
+    Increments LessonPlan.revision once per flush for every plan whose units,
+    sub-units, indicators, graded/assessment items or post-teaching logs changed.
+    """
+    changed = [obj for obj in session.new if isinstance(obj, _PLAN_CONTENT_MODELS)]
+    changed += [obj for obj in session.deleted if isinstance(obj, _PLAN_CONTENT_MODELS)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, _PLAN_CONTENT_MODELS) and session.is_modified(obj)]
+    if not changed:
+        return
+
+    with session.no_autoflush:
+        for plan_id in _collect_plan_ids(session, changed):
+            plan = session.get(LessonPlan, plan_id)
+            if plan is None or plan in session.deleted:
+                continue
+            plan.revision = (plan.revision or 0) + 1
+
+# --- Timetable version tracking ---
+# conflict index และ payload ของหน้าจัดตาราง (app/timetable_index.py) ถูก cache ไว้ต่อ process ตาม Semester.timetable_version
+_COURSE_TIMETABLE_FIELDS = ('classroom_id', 'room_id', 'semester_id', 'teachers')
+# ตารางสอนสำเร็จรูป (app/materialized_timetables.py) เก็บชื่อวิชา/ห้อง/ครูไว้ใน JSON เปลี่ยนชื่อจึงต้องสร้างใหม่ด้วย
+_TIMETABLE_NAME_FIELDS = {
+    Subject: ('subject_code', 'name'),
+    Classroom: ('name',),
+    Room: ('name',),
+    User: ('name_prefix', 'first_name', 'last_name'),
+}
+
+def bump_timetable_version(session, semester_ids):
+    """
+    Bulk INSERT/UPDATE on TimetableEntry bypasses before_flush, so callers
+    that write entries in bulk call this to invalidate cached conflict indexes.
+    """
+    semester_ids = {sid for sid in semester_ids if sid}
+    if semester_ids:
+        session.query(Semester).filter(Semester.id.in_(semester_ids)).update(
+            {Semester.timetable_version: Semester.timetable_version + 1}, synchronize_session=False)
+
+def _timetable_semester_ids(session, obj):
+    if isinstance(obj, (LessonPlan, LessonPlanConstraint)):
+        # เงื่อนไขการจัดคาบ/บันทึกส่วนตัวของแผน แสดงอยู่ในหน้าจัดตารางของทุกภาคเรียนที่ใช้แผนนี้
+        plan_id = obj.id if isinstance(obj, LessonPlan) else obj.lesson_plan_id
+        if not plan_id:
+            return set()
+        return {sid for sid, in session.query(Course.semester_id).filter(Course.lesson_plan_id == plan_id).distinct()}
+    if isinstance(obj, User):
+        query = session.query(Course.semester_id).join(course_teachers, course_teachers.c.course_id == Course.id).filter(
+            course_teachers.c.user_id == obj.id)
+        return {sid for sid, in query.distinct()}
+    if isinstance(obj, (Subject, Classroom, Room)):
+        column = {Subject: Course.subject_id, Classroom: Course.classroom_id, Room: Course.room_id}[type(obj)]
+        return {sid for sid, in session.query(Course.semester_id).filter(column == obj.id).distinct()}
+    return {_timetable_semester_id(session, obj)}
+
+def _timetable_semester_id(session, obj):
+    if isinstance(obj, TimetableEntry):
+        slot = obj.slot if obj.slot is not None else session.get(WeeklyScheduleSlot, obj.weekly_schedule_slot_id)
+        return slot.semester_id if slot is not None else None
+    return obj.semester_id or (obj.semester.id if obj.semester is not None else None)
+
+@event.listens_for(Session, 'before_flush')
+def bump_semester_timetable_version(session, flush_context, instances):
+    """
+    Increments Semester.timetable_version once per flush when timetable entries,
+    schedule slots, the teachers/classroom/room of a course, the scheduling
+    constraints/notes of a lesson plan, or the subject/classroom/room/teacher
+    names shown in the timetable change.
+    """
+    tracked = (TimetableEntry, WeeklyScheduleSlot, Course, LessonPlanConstraint)
+    changed = [obj for obj in session.new if isinstance(obj, tracked)]
+    changed += [obj for obj in session.deleted if isinstance(obj, tracked)]
+    for obj in session.dirty:
+        if isinstance(obj, (TimetableEntry, WeeklyScheduleSlot, LessonPlanConstraint)) and session.is_modified(obj):
+            changed.append(obj)
+        elif isinstance(obj, Course):
+            state = inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in _COURSE_TIMETABLE_FIELDS):
+                changed.append(obj)
+        elif isinstance(obj, LessonPlan) and inspect(obj).attrs.manual_scheduling_notes.history.has_changes():
+            changed.append(obj)
+        elif type(obj) in _TIMETABLE_NAME_FIELDS:
+            state = inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in _TIMETABLE_NAME_FIELDS[type(obj)]):
+                changed.append(obj)
+    if not changed:
+        return
+
+    with session.no_autoflush:
+        semester_ids = set()
+        for obj in changed:
+            semester_ids |= _timetable_semester_ids(session, obj)
+        # ย้ายคาบข้าม slot: slot เดิมอยู่ในภาคเรียนเดียวกันเสมอ จึงใช้ slot ปัจจุบันพอ
+        semester_ids.discard(None)
+        for semester_id in semester_ids:
+            semester = session.get(Semester, semester_id)
+            if semester is None or semester in session.deleted:
+                continue
+            # นิพจน์ SQL (SET timetable_version = timetable_version + 1) ไม่ใช่ค่าที่อ่านมาบวกใน Python:
+            # สอง worker บันทึกพร้อมกันต้องได้ +2 ไม่งั้น advance_conflict_index จะเก็บ conflict index เก่าไว้
+            # ค่าใหม่ถูก expire หลัง flush และโหลดจากฐานข้อมูลเมื่ออ่านครั้งถัดไป
+            semester.timetable_version = Semester.timetable_version + 1
+
+# --- Name search keys ---
+@event.listens_for(Session, 'before_flush')
+def sync_name_search_keys(session, flush_context, instances):
+    """Keeps first_name_key/last_name_key of users and students in step with their names."""
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, (User, Student)):
+            for source, target in (('first_name', 'first_name_key'), ('last_name', 'last_name_key')):
+                key = name_search_key(getattr(obj, source))
+                if getattr(obj, target) != key:
+                    setattr(obj, target, key)
+
 @login.user_loader
 def load_user(id):
     return User.query.get(int(id))
\ No newline at end of file
@@ -0,0 +1,122 @@
+# FILE: app/pagination.py
+"""
+Keyset ("seek") pagination and cached approximate counts for long admin lists.
+
+OFFSET pagination reads and throws away every row before the requested page,
+so later pages of ever-growing tables (users, students of every cohort) get
+slower. Here a page is addressed by the sort key of the row it starts after
+(``?after=``) or ends before (``?before=``), which the database resolves with
+an index seek, and the total shown in the UI comes from a short-lived cache
+instead of a COUNT(*) per page.
+"""
+import base64
+import json
+import threading
+import time
+
+from sqlalchemy import and_, tuple_
+
+COUNT_CACHE_TTL = 60 # วินาที
+COUNT_CACHE_SIZE = 256
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values), ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Returns the tuple encoded by encode_cursor, or None when ``token`` is missing or malformed."""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return tuple(values)
+
+
+class KeysetPage:
+    """One page of rows plus the cursors of its neighbours (None when there is none)."""
+
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, key_columns, after=None, before=None, per_page=20, key_of=None):
+    """
+    Pages ``query`` ordered by ``key_columns`` (which must be unique together).
+
+    Args:
+        query: An ORM query without ORDER BY / LIMIT.
+        key_columns (list): Columns forming the sort key, e.g. [Student.student_id, Student.id].
+        after / before (str, optional): Cursor tokens from a previous page.
+        key_of (callable, optional): Row -> tuple of key values; defaults to
+            reading the column names as attributes of the row.
+
+    Returns:
+        KeysetPage
+    """
+    key_of = key_of or (lambda row: tuple(getattr(row, col.key) for col in key_columns))
+    size = len(key_columns)
+    key = tuple_(*key_columns) if size > 1 else key_columns[0]
+    after_values, before_values = decode_cursor(after, size), decode_cursor(before, size)
+
+    if before_values is not None:
+        bound = before_values if size > 1 else before_values[0]
+        rows = query.filter(key < bound).order_by(*[col.desc() for col in key_columns]).limit(per_page + 1).all()
+        more_before = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        prev_cursor = encode_cursor(key_of(rows[0])) if rows and more_before else None
+        next_cursor = encode_cursor(key_of(rows[-1])) if rows else None
+        return KeysetPage(rows, next_cursor, prev_cursor)
+
+    if after_values is not None:
+        query = query.filter(key > (after_values if size > 1 else after_values[0]))
+    rows = query.order_by(*key_columns).limit(per_page + 1).all()
+    more_after = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(key_of(rows[-1])) if rows and more_after else None
+    prev_cursor = encode_cursor(key_of(rows[0])) if rows and after_values is not None else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+def prefix_match(column, value):
+    """``column`` starts with ``value``, written as a range so a plain B-tree index can serve it."""
+    return and_(column >= value, column < value + '\U0010ffff')
+
+
+_counts = {} # cache_key -> (counted_at, total)
+_counts_lock = threading.Lock()
+
+
+def approximate_count(query, cache_key):
+    """
+    COUNT(*) of ``query``, reused for COUNT_CACHE_TTL seconds per ``cache_key``
+    (the filter values). Good enough for "about N results" while paging.
+    """
+    now = time.monotonic()
+    with _counts_lock:
+        hit = _counts.get(cache_key)
+    if hit and now - hit[0] < COUNT_CACHE_TTL:
+        return hit[1]
+
+    total = query.order_by(None).count()
+    with _counts_lock:
+        if len(_counts) >= COUNT_CACHE_SIZE:
+            for stale_key in [k for k, (t, _) in _counts.items() if now - t >= COUNT_CACHE_TTL] or list(_counts)[:1]:
+                _counts.pop(stale_key, None)
+        _counts[cache_key] = (now, total)
+    return total
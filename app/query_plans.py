@@ -0,0 +1,63 @@
+# FILE: app/query_plans.py
+"""
+EXPLAIN for the hottest endpoint queries (``flask perf explain``).
+
+Each entry is shaped like the query an endpoint runs, with sample ids, so the
+plan shows whether the composite indexes are picked up. Plan lines that read
+a whole table (SQLite ``SCAN <table>`` without an index, PostgreSQL
+``Seq Scan``) are flagged. On tiny development databases PostgreSQL may
+still prefer a sequential scan; judge it on production-sized data.
+"""
+from datetime import date
+
+from sqlalchemy import false, func, select
+
+from app.models import AttendanceRecord, Course, Enrollment, Notification, Score, TimetableEntry
+
+HOT_QUERIES = [
+    ('บันทึกคะแนน: score ของนักเรียนในชิ้นงาน (student_id, graded_item_id)',
+     select(Score.id, Score.score).where(Score.student_id == 1, Score.graded_item_id == 1)),
+    ('สมุดคะแนน: score ทั้งหมดของชิ้นงานในรายวิชา (graded_item_id IN ...)',
+     select(Score.student_id, Score.graded_item_id, Score.score).where(Score.graded_item_id.in_([1, 2, 3]))),
+    ('รายชื่อนักเรียนในห้อง เรียงตามเลขที่ (classroom_id, roll_number)',
+     select(Enrollment.student_id, Enrollment.roll_number).where(Enrollment.classroom_id == 1)
+     .order_by(Enrollment.roll_number)),
+    ('ห้องเรียนของนักเรียน (student_id, classroom_id)',
+     select(Enrollment.id).where(Enrollment.student_id == 1, Enrollment.classroom_id == 1)),
+    ('คาบสอนของรายวิชาในช่องตาราง (course_id, weekly_schedule_slot_id)',
+     select(TimetableEntry.id).where(TimetableEntry.course_id == 1, TimetableEntry.weekly_schedule_slot_id == 1)),
+    ('รายวิชาในภาคเรียนตามสถานะการส่งเกรด (semester_id, grade_submission_status)',
+     select(Course.id).where(Course.semester_id == 1, Course.grade_submission_status == 'รอตรวจสอบ (หน.กลุ่มสาระ)')),
+    ('จำนวนแจ้งเตือนที่ยังไม่อ่าน (ทุกหน้า)',
+     select(func.count()).select_from(Notification).where(Notification.user_id == 1, Notification.is_read == false())),
+    ('แจ้งเตือนล่าสุดที่ยังไม่อ่าน (user_id, is_read, created_at)',
+     select(Notification.id, Notification.title).where(Notification.user_id == 1, Notification.is_read == false())
+     .order_by(Notification.created_at.desc()).limit(10)),
+    ('การเช็คชื่อของคาบในวันที่กำหนด (timetable_entry_id, attendance_date)',
+     select(AttendanceRecord.student_id, AttendanceRecord.status).where(
+         AttendanceRecord.timetable_entry_id == 1, AttendanceRecord.attendance_date == date(2026, 1, 5))),
+]
+
+
+def explain(connection, statement):
+    """The query plan of ``statement`` as a list of text lines."""
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'sqlite':
+        return [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+    return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {sql}")]
+
+
+def is_full_scan(line, dialect_name):
+    if dialect_name == 'sqlite':
+        # "SCAN score" / "SCAN TABLE score" (รุ่นเก่า) = อ่านทั้งตาราง, "SCAN ... USING (COVERING) INDEX" ไม่นับ
+        return line.startswith('SCAN ') and ' USING ' not in line
+    return 'Seq Scan' in line
+
+
+def explain_hot_queries(connection):
+    """[(name, plan lines, full-scan lines)] for every HOT_QUERIES entry."""
+    results = []
+    for name, statement in HOT_QUERIES:
+        lines = explain(connection, statement)
+        results.append((name, lines, [line for line in lines if is_full_scan(line, connection.dialect.name)]))
+    return results
@@ -1,19 +1,27 @@
 # FILE: app/services.py
 
 from collections import Counter, defaultdict
+import hashlib
 import json
+import os
 import statistics
 from flask import current_app, url_for
 from flask_login import current_user
-from sqlalchemy import func
+from sqlalchemy import and_, delete, exists, func, insert, literal, select, update
 from datetime import date, datetime, timedelta
 
 from app.models import (AssessmentItem, AuditLog, Course, Enrollment, GradeLevel, QualitativeScore, RepeatCandidate, Setting, Student, Score, CourseGrade, GradedItem, 
                         LearningUnit, AttendanceRecord, Subject, TimeSlot, TimetableEntry, Classroom, Semester, AcademicYear, User,
                         LessonPlan, WeeklyScheduleSlot, AdvisorAssessmentRecord, AdvisorAssessmentScore, AssessmentTemplate, AssessmentTopic, RubricLevel, AdministrativeDepartment, Indicator, PostTeachingLog, Role, Notification,
-                        AttendanceWarning, SubUnit)
+                        AttendanceWarning, LessonPlanConstraint, SubUnit, bump_timetable_version, classroom_advisors, course_teachers,
+                        learning_unit_indicators, sub_unit_assessment_items, sub_unit_graded_items, sub_unit_indicators, subunit_topics)
 from . import db
 from sqlalchemy.orm import joinedload, aliased, selectinload
+from app.archive import archive_union
+from app.global_search import TYPE_CLASSROOM, TYPE_LESSON_PLAN, TYPE_STUDENT, refresh_search_documents
+from app.indicator_search import reindex_indicators
+from app.timetable_index import ConflictIndex
+from app.importers import chunked
 import pandas as pd
 from datetime import timedelta
 # --- Constants ---
@@ -145,6 +153,20 @@ def check_and_create_attendance_warnings(attendance_record: AttendanceRecord):
         absence_count_at_trigger=absent_count, status='ACTIVE'
     ))
 
+def _archived_course_scores_and_absences(course, student_ids):
+    """Score rows and per-student absence counts of ``course``, read from the live and archive tables."""
+    plan_items = select(GradedItem.id).join(LearningUnit).where(LearningUnit.lesson_plan_id == course.lesson_plan.id)
+    course_entries = select(TimetableEntry.id).where(TimetableEntry.course_id == course.id)
+
+    scores = archive_union(Score, ['student_id', 'graded_item_id', 'score'], lambda table: [
+        table.graded_item_id.in_(plan_items), table.student_id.in_(student_ids)])
+    absences = archive_union(AttendanceRecord, ['student_id'], lambda table: [
+        table.timetable_entry_id.in_(course_entries), table.student_id.in_(student_ids), table.status == 'ABSENT']).subquery()
+    all_scores = db.session.execute(scores).all()
+    all_attendance = db.session.execute(
+        select(absences.c.student_id, func.count()).group_by(absences.c.student_id)).all()
+    return all_scores, all_attendance
+
 def calculate_final_grades_for_course(course: Course):
     """
     Centralized function to calculate final grades for all students in a course,
@@ -157,23 +179,27 @@ def calculate_final_grades_for_course(course: Course):
     enrollments = sorted(course.classroom.enrollments, key=lambda e: e.roll_number or 999)
     student_ids = [en.student.id for en in enrollments]
     
-    all_scores = Score.query.join(GradedItem).join(LearningUnit).filter(
-        LearningUnit.lesson_plan_id == course.lesson_plan.id,
-        Score.student_id.in_(student_ids)
-    ).all()
+    if course.semester.academic_year.archived_at:
+        # ปีที่เก็บเข้าคลังแล้ว: คะแนนและการเข้าเรียนอยู่ในตาราง archived_* (รวมกับแถวที่แก้ไขภายหลัง)
+        all_scores, all_attendance = _archived_course_scores_and_absences(course, student_ids)
+    else:
+        all_scores = Score.query.join(GradedItem).join(LearningUnit).filter(
+            LearningUnit.lesson_plan_id == course.lesson_plan.id,
+            Score.student_id.in_(student_ids)
+        ).all()
+        all_attendance = db.session.query(
+            AttendanceRecord.student_id, func.count(AttendanceRecord.id)
+        ).join(
+            TimetableEntry, AttendanceRecord.timetable_entry_id == TimetableEntry.id
+        ).filter(
+            AttendanceRecord.student_id.in_(student_ids),
+            AttendanceRecord.status == 'ABSENT',
+            TimetableEntry.course_id == course.id
+        ).group_by(AttendanceRecord.student_id).all()
     all_exam_scores = CourseGrade.query.filter(
         CourseGrade.course_id == course.id,
         CourseGrade.student_id.in_(student_ids)
     ).all()
-    all_attendance = db.session.query(
-        AttendanceRecord.student_id, func.count(AttendanceRecord.id)
-    ).join(
-        TimetableEntry, AttendanceRecord.timetable_entry_id == TimetableEntry.id
-    ).filter(
-        AttendanceRecord.student_id.in_(student_ids),
-        AttendanceRecord.status == 'ABSENT',
-        TimetableEntry.course_id == course.id
-    ).group_by(AttendanceRecord.student_id).all()
     summative_items = GradedItem.query.join(LearningUnit).filter(
         LearningUnit.lesson_plan_id == course.lesson_plan.id,
         GradedItem.indicator_type == 'SUMMATIVE'
@@ -796,12 +822,23 @@ def get_lesson_plan_export_data(plan_id):
     else: school_info['school_logo_url'] = None
 
     # --- General Plan Info ---
-    course = plan.courses[0] if plan.courses else None
-    teachers = course.teachers if course else []
+    # รายวิชาแรกตาม id (plan.courses ไม่มีลำดับที่แน่นอน) เพื่อให้ครู/ระดับชั้นเหมือนเดิมทุกครั้งที่ export
+    course = min(plan.courses, key=lambda c: c.id) if plan.courses else None
+    teachers = sorted(course.teachers, key=lambda t: t.id) if course else []
     teacher_names = ", ".join([t.full_name for t in teachers]) or '-'
     grade_level = course.classroom.grade_level.name if course and course.classroom and course.classroom.grade_level else '-'
     current_teacher_id = teachers[0].id if teachers else None
 
+    # --- Post Teaching Logs (one query for all units instead of one per unit) ---
+    post_teaching_logs = {}
+    if current_teacher_id and plan.learning_units:
+        unit_ids = [unit.id for unit in plan.learning_units]
+        post_teaching_logs = {log.learning_unit_id: log for log in PostTeachingLog.query.filter(
+            PostTeachingLog.learning_unit_id.in_(unit_ids),
+            PostTeachingLog.teacher_id == current_teacher_id,
+            PostTeachingLog.classroom_id.is_(None)
+        ).all()}
+
     # --- Main Logic ---
     all_unit_export_data = []
     sorted_units = sorted(plan.learning_units, key=lambda u: u.sequence)
@@ -888,13 +925,11 @@ def get_lesson_plan_export_data(plan_id):
 
         # --- Fetch Post Teaching Log ---
         post_teaching_log_data = {'log_content': None, 'problems_obstacles': None, 'solutions': None}
-        # ... (logic remains the same) ...
-        if current_teacher_id:
-            log_entry = PostTeachingLog.query.filter_by(learning_unit_id=unit.id, teacher_id=current_teacher_id, classroom_id=None).first()
-            if log_entry:
-                post_teaching_log_data['log_content'] = log_entry.log_content
-                post_teaching_log_data['problems_obstacles'] = log_entry.problems_obstacles
-                post_teaching_log_data['solutions'] = log_entry.solutions
+        log_entry = post_teaching_logs.get(unit.id)
+        if log_entry:
+            post_teaching_log_data['log_content'] = log_entry.log_content
+            post_teaching_log_data['problems_obstacles'] = log_entry.problems_obstacles
+            post_teaching_log_data['solutions'] = log_entry.solutions
 
 
         # --- Assemble Final Data Packet ---
@@ -922,6 +957,80 @@ def get_lesson_plan_export_data(plan_id):
 
     return all_unit_export_data
 
+def get_lesson_plan_export_cover(plan: LessonPlan):
+    """Cover-page data shared by the PDF and DOCX exports (teachers in a fixed order)."""
+    settings_keys = ['school_name', 'school_logo_path', 'school_affiliation', 'school_district', 'school_province']
+    school_info = {s.key: s.value for s in Setting.query.filter(Setting.key.in_(settings_keys)).all()}
+    if school_info.get('school_logo_path'):
+        school_info['school_logo_url'] = url_for('static', filename=f"uploads/{school_info['school_logo_path']}", _external=True)
+    else:
+        school_info['school_logo_url'] = None
+
+    teachers = sorted({teacher for course in plan.courses for teacher in course.teachers}, key=lambda t: t.id)
+    return {
+        'school_info': school_info,
+        'plan_info': {
+            'subject_name': plan.subject.name,
+            'subject_code': plan.subject.subject_code,
+            'academic_year': plan.academic_year.year,
+            'teacher_names': ", ".join([t.full_name for t in teachers]) or '-'
+        }
+    }
+
+def get_lesson_plan_export(plan: LessonPlan, fmt: str, builder, inputs):
+    """
+    Returns the exported file (bytes) for a lesson plan, cached on disk per
+    (plan_id, revision, digest of ``inputs``, format). The cache is shared by
+    every worker, so the teacher and the department/academic/director
+    reviewers all reuse the same file until the plan content changes.
+
+    ``inputs`` is everything the file is rendered from (cover + unit data).
+    Hashing it catches changes that do not bump LessonPlan.revision: school
+    settings and logo, subject/teacher names, teacher reassignment, and edits
+    to standards, indicators, assessment topics or dimensions.
+
+    Args:
+        plan: The LessonPlan being exported.
+        fmt: File extension, e.g. 'pdf' or 'docx'.
+        builder: Callable with no arguments that renders and returns the file bytes.
+        inputs: JSON-serialisable data the builder renders from.
+    """
+    cache_dir = os.path.join(current_app.instance_path, 'export_cache', 'lesson_plans')
+    revision = plan.revision or 0
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"plan_{plan.id}_r{revision}_{digest}.{fmt}")
+
+    try:
+        with open(cache_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    data = builder()
+    if not data:
+        return None
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้ worker อื่นอ่านไฟล์ที่เขียนไม่เสร็จ
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+
+        # ลบไฟล์ของ revision / ข้อมูลเก่าของแผนนี้ (format เดียวกัน)
+        stale_prefix = f"plan_{plan.id}_r"
+        for name in os.listdir(cache_dir):
+            if name.startswith(stale_prefix) and name.endswith(f".{fmt}") and name != os.path.basename(cache_path):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+    except OSError as e:
+        current_app.logger.warning(f"Could not cache {fmt} export for lesson plan {plan.id}: {e}")
+
+    return data
+
 def get_student_dashboard_data(student_id):
     """
     ดึงข้อมูลสรุปผลการเรียน, การเข้าเรียน, การประเมิน, และการแจ้งเตือน
@@ -1126,105 +1235,297 @@ def get_student_dashboard_data(student_id):
         'warnings': active_warnings
     }
 
-def check_graduation_readiness(student_id, academic_year_id):
+FAILING_FINAL_GRADES = ['0', 'ร', 'มส']
+PASSING_FINAL_GRADES = ['1', '1.5', '2', '2.5', '3', '3.5', '4']
+
+
+def check_graduation_readiness_batch(academic_year_id, student_ids=None):
     """
-    [REVISED v2] Checks graduation readiness (M.3/M.6) based on grades and credits.
-    Returns detailed reasons if not ready.
+    [NEW] Graduation readiness of a whole cohort in three queries: enrollments,
+    failing-grade counts and earned credits (both grouped by student).
+
+    Graduating levels are the grade levels with ``graduation_credits`` set.
 
     Args:
-        student_id (int): The ID of the student.
-        academic_year_id (int): The ID of the academic year graduation is being considered for.
+        academic_year_id (int): The academic year graduation is being considered for.
+        student_ids (list, optional): Students to check. Defaults to every student
+            enrolled in a graduating level in that year.
 
     Returns:
-        tuple(bool | None, str): (is_ready, reason)
-             is_ready (bool): True if ready, False otherwise. None if not applicable.
-             reason (str): Explanation.
+        dict: student_id -> {'is_ready', 'reason', 'credits_earned',
+            'required_credits', 'failing_count'}. ``is_ready`` is None when the
+            check does not apply (not enrolled, not a graduating level).
     """
-    student = db.session.get(Student, student_id)
     target_year = db.session.get(AcademicYear, academic_year_id)
-    if not student or not target_year:
-        return None, 'Student or Academic Year not found'
+    if not target_year:
+        return {sid: _graduation_result(None, 'Student or Academic Year not found') for sid in student_ids or []}
 
-    enrollment = Enrollment.query.join(Classroom).filter(
-        Enrollment.student_id == student_id,
+    enrollment_query = db.session.query(Enrollment.student_id, GradeLevel.graduation_credits).join(
+        Classroom, Enrollment.classroom_id == Classroom.id
+    ).join(GradeLevel, Classroom.grade_level_id == GradeLevel.id).filter(
         Classroom.academic_year_id == academic_year_id
-    ).join(GradeLevel).options(joinedload(Enrollment.classroom).joinedload(Classroom.grade_level)).first()
+    )
+    if student_ids is None:
+        enrollment_query = enrollment_query.filter(GradeLevel.graduation_credits.isnot(None))
+    else:
+        enrollment_query = enrollment_query.filter(Enrollment.student_id.in_(student_ids))
+    required_by_student = {}
+    for student_id, required_credits in enrollment_query.all():
+        required_by_student.setdefault(student_id, required_credits)
+
+    cohort = db.session.query(Enrollment.student_id).join(
+        Classroom, Enrollment.classroom_id == Classroom.id
+    ).join(GradeLevel, Classroom.grade_level_id == GradeLevel.id).filter(
+        Classroom.academic_year_id == academic_year_id,
+        GradeLevel.graduation_credits.isnot(None)
+    )
+    if student_ids is not None:
+        cohort = cohort.filter(Enrollment.student_id.in_(student_ids))
+    cohort = cohort.scalar_subquery()
+
+    # --- 1. ผลการเรียนไม่ผ่านในปีที่จะจบ ---
+    failing_counts = dict(db.session.query(CourseGrade.student_id, func.count(CourseGrade.id)).join(
+        Course, CourseGrade.course_id == Course.id
+    ).join(Semester, Course.semester_id == Semester.id).filter(
+        CourseGrade.student_id.in_(cohort),
+        Semester.academic_year_id == academic_year_id,
+        CourseGrade.final_grade.in_(FAILING_FINAL_GRADES)
+    ).group_by(CourseGrade.student_id).all())
+
+    # --- 2. หน่วยกิตสะสมถึงปีที่จะจบ ---
+    earned_credits = dict(db.session.query(CourseGrade.student_id, func.sum(Subject.credit)).join(
+        Course, CourseGrade.course_id == Course.id
+    ).join(Subject, Course.subject_id == Subject.id).join(
+        Semester, Course.semester_id == Semester.id
+    ).join(AcademicYear, Semester.academic_year_id == AcademicYear.id).filter(
+        CourseGrade.student_id.in_(cohort),
+        AcademicYear.year <= target_year.year,
+        CourseGrade.final_grade.in_(PASSING_FINAL_GRADES)
+    ).group_by(CourseGrade.student_id).all())
+
+    results = {}
+    for student_id in (required_by_student if student_ids is None else student_ids):
+        if student_id not in required_by_student:
+            results[student_id] = _graduation_result(None, 'Student not enrolled or grade level info missing for graduation year')
+            continue
+        required_credits = required_by_student[student_id]
+        if required_credits is None:
+            results[student_id] = _graduation_result(None, 'Not a graduating level')
+            continue
 
-    if not enrollment or not enrollment.classroom or not enrollment.classroom.grade_level:
-        return None, 'Student not enrolled or grade level info missing for graduation year'
+        failing_count = failing_counts.get(student_id, 0)
+        credits_earned = earned_credits.get(student_id) or 0
+        reasons_not_ready = []
+        if failing_count > 0:
+            reasons_not_ready.append(f'มีผลการเรียนไม่ผ่าน ({failing_count} รายการ)')
+        if credits_earned < required_credits:
+            reasons_not_ready.append(f'หน่วยกิตไม่ถึงเกณฑ์ ({credits_earned:.1f}/{required_credits:g})')
 
-    grade_level = enrollment.classroom.grade_level
+        if reasons_not_ready:
+            results[student_id] = _graduation_result(False, '; '.join(reasons_not_ready), credits_earned, required_credits, failing_count)
+        else:
+            results[student_id] = _graduation_result(True, 'ผ่านเกณฑ์การจบหลักสูตร', credits_earned, required_credits, failing_count)
+    return results
 
-    # --- Check graduating level and required credits ---
-    required_credits = None
-    if grade_level.short_name == 'ม.3': required_credits = 77 # Example
-    elif grade_level.short_name == 'ม.6': required_credits = 81 # Example
-    else: return None, 'Not a graduating level'
-    # ---
 
-    reasons_not_ready = [] # Store multiple reasons
+def _graduation_result(is_ready, reason, credits_earned=None, required_credits=None, failing_count=None):
+    return {'is_ready': is_ready, 'reason': reason, 'credits_earned': credits_earned,
+            'required_credits': required_credits, 'failing_count': failing_count}
 
-    # --- 1. Check failing grades ---
-    semesters_in_year = Semester.query.filter_by(academic_year_id=academic_year_id).all()
-    semester_ids = [s.id for s in semesters_in_year]
 
-    failing_grades_count = db.session.query(func.count(CourseGrade.id)).join(Course).filter(
-         CourseGrade.student_id == student_id,
-         Course.semester_id.in_(semester_ids),
-         CourseGrade.final_grade.in_(['0', 'ร', 'มส'])
-         # Optional stricter check for unresolved remediations
-    ).scalar()
+def check_graduation_readiness(student_id, academic_year_id):
+    """
+    [REVISED v3] Checks graduation readiness (M.3/M.6) based on grades and credits.
+    Single-student form of check_graduation_readiness_batch; use the batch
+    version when checking more than a few students.
+
+    Args:
+        student_id (int): The ID of the student.
+        academic_year_id (int): The ID of the academic year graduation is being considered for.
 
-    if failing_grades_count > 0:
-        reasons_not_ready.append(f'มีผลการเรียนไม่ผ่าน ({failing_grades_count} รายการ)')
-    # ---
+    Returns:
+        tuple(bool | None, str): (is_ready, reason)
+             is_ready (bool): True if ready, False otherwise. None if not applicable.
+             reason (str): Explanation.
+    """
+    if not db.session.get(Student, student_id):
+        return None, 'Student or Academic Year not found'
+    result = check_graduation_readiness_batch(academic_year_id, [student_id])[student_id]
+    return result['is_ready'], result['reason']
 
-    # --- 2. Check accumulated credits ---
-    all_year_ids_to_include = db.session.query(AcademicYear.id).filter(
-        AcademicYear.year <= target_year.year
-    ).scalar_subquery()
+PROMOTION_CLASSROOM_CHUNK = 10 # ห้องต่อ 1 transaction ตอนเลื่อนชั้นจริง
 
-    passed_credits_result = db.session.query(func.sum(Subject.credit)).join(
-        Course, Subject.id == Course.subject_id
-    ).join(
-        CourseGrade, Course.id == CourseGrade.course_id
-    ).join(
-         Semester, Course.semester_id == Semester.id
-    ).filter(
-        CourseGrade.student_id == student_id,
-        Semester.academic_year_id.in_(all_year_ids_to_include),
-        CourseGrade.final_grade.in_(['1', '1.5', '2', '2.5', '3', '3.5', '4'])
-    ).scalar()
 
-    total_credits_earned = passed_credits_result or 0
+def _next_grade_short_name(short_name):
+    """'ม.2' -> 'ม.3'. Raises ValueError when the grade number cannot be parsed."""
+    current_grade_num_str = short_name.split('.')[-1]
+    if not current_grade_num_str.isdigit():
+        raise ValueError(f"Cannot parse grade number from '{short_name}'")
+    return f"ม.{int(current_grade_num_str) + 1}" # Assumes "ม.X" format
 
-    if total_credits_earned < required_credits:
-        reasons_not_ready.append(f'หน่วยกิตไม่ถึงเกณฑ์ ({total_credits_earned:.1f}/{required_credits})')
-    # ---
 
-    # --- Final Decision ---
-    if not reasons_not_ready:
-        return True, 'ผ่านเกณฑ์การจบหลักสูตร'
-    else:
-        return False, '; '.join(reasons_not_ready) # Join reasons with semicolon
-    # ---
+def _build_promotion_plan(source_year, target_year):
+    """
+    Decides, for every classroom of ``source_year``, who is promoted, flagged
+    for repetition or graduated, using a fixed number of grouped queries.
 
-def promote_students_to_next_year(source_academic_year_id, target_academic_year_id, promotion_criteria=None):
+    Returns:
+        tuple(list, list): (classroom plans, errors). Each plan is a dict with
+            JSON-safe summary keys plus private ``_``-prefixed action lists.
+    """
+    errors = []
+    source_classrooms = Classroom.query.filter_by(academic_year_id=source_year.id).options(
+        joinedload(Classroom.grade_level)
+    ).order_by(Classroom.name).all()
+    target_classrooms_map = dict(db.session.query(Classroom.name, Classroom.id).filter(
+        Classroom.academic_year_id == target_year.id).all())
+    grade_levels_map = {gl.short_name: gl for gl in GradeLevel.query.all()}
+
+    # --- Prefetch: enrollments, failing counts, graduation readiness, existing flags/enrollments ---
+    enrollments_by_classroom = defaultdict(list)
+    for enrollment_id, student_id, classroom_id, roll_number in db.session.query(
+            Enrollment.id, Enrollment.student_id, Enrollment.classroom_id, Enrollment.roll_number
+    ).join(Student, Enrollment.student_id == Student.id).filter(
+        Enrollment.classroom_id.in_(db.session.query(Classroom.id).filter(
+            Classroom.academic_year_id == source_year.id).scalar_subquery()),
+        Student.status == 'กำลังศึกษา'
+    ).order_by(Enrollment.classroom_id, Enrollment.roll_number):
+        enrollments_by_classroom[classroom_id].append((enrollment_id, student_id, roll_number))
+
+    failing_counts = dict(db.session.query(CourseGrade.student_id, func.count(CourseGrade.id)).join(
+        Course, CourseGrade.course_id == Course.id
+    ).join(Semester, Course.semester_id == Semester.id).filter(
+        Semester.academic_year_id == source_year.id,
+        CourseGrade.final_grade.in_(FAILING_FINAL_GRADES)
+    ).group_by(CourseGrade.student_id).all())
+    graduation = check_graduation_readiness_batch(source_year.id)
+    flagged_ids = {sid for (sid,) in db.session.query(RepeatCandidate.student_id).filter(
+        RepeatCandidate.academic_year_id_failed == source_year.id).all()}
+    enrolled_in_target = {sid for (sid,) in db.session.query(Enrollment.student_id).join(
+        Classroom, Enrollment.classroom_id == Classroom.id).filter(
+        Classroom.academic_year_id == target_year.id).all()}
+
+    plans = []
+    seen_student_ids = set()
+    for classroom in source_classrooms:
+        grade_level = classroom.grade_level
+        plan = {'classroom_id': classroom.id, 'classroom': classroom.name, 'target': None,
+                'create_target': False, 'promoted': 0, 'flagged_repeat': 0, 'graduated': 0,
+                'already_done': 0, 'error': None,
+                '_enrollments': [], '_flags': [], '_graduates': []}
+        plans.append(plan)
+        if not grade_level:
+            plan['error'] = f"Skipping {classroom.name}: Missing grade level information."
+            errors.append(plan['error'])
+            continue
+
+        is_graduating_level = grade_level.graduation_credits is not None
+        if not is_graduating_level:
+            try:
+                next_grade_short_name = _next_grade_short_name(grade_level.short_name)
+                if next_grade_short_name not in grade_levels_map:
+                    raise ValueError(f"Target grade level '{next_grade_short_name}' not found in database.")
+            except ValueError as ve:
+                plan['error'] = f"Error determining target for {classroom.name}: {ve}"
+                errors.append(plan['error'])
+                continue
+            plan['target'] = classroom.name.replace(grade_level.short_name, next_grade_short_name)
+            plan['target_grade_level_id'] = grade_levels_map[next_grade_short_name].id
+            plan['create_target'] = plan['target'] not in target_classrooms_map
+
+        for enrollment_id, student_id, roll_number in enrollments_by_classroom.get(classroom.id, []):
+            if student_id in seen_student_ids:
+                continue
+            seen_student_ids.add(student_id)
+
+            if is_graduating_level:
+                result = graduation.get(student_id) or {'is_ready': None, 'reason': 'ไม่พบข้อมูลความพร้อมจบ'}
+                if result['is_ready']:
+                    plan['_graduates'].append(student_id)
+                    plan['graduated'] += 1
+                    continue
+                reason = result['reason']
+            elif failing_counts.get(student_id, 0) == 0:
+                if student_id in enrolled_in_target:
+                    plan['already_done'] += 1
+                else:
+                    plan['_enrollments'].append({'student_id': student_id, 'roll_number': roll_number})
+                    plan['promoted'] += 1
+                continue
+            else:
+                reason = f'มีผลการเรียนไม่ผ่าน ({failing_counts[student_id]} รายการ)'
+
+            if student_id in flagged_ids:
+                plan['already_done'] += 1
+            else:
+                plan['_flags'].append({
+                    'student_id': student_id,
+                    'previous_enrollment_id': enrollment_id,
+                    'academic_year_id_failed': source_year.id,
+                    'status': 'Pending Advisor Review',
+                    'advisor_notes': reason, # Store the reason for flagging
+                })
+                plan['flagged_repeat'] += 1
+    return plans, errors
+
+
+def _apply_promotion_chunk(plans, target_classrooms_map):
+    """Writes the enrollments, flags, graduations and advisor moves of ``plans`` (no commit)."""
+    new_enrollments, new_flags, graduate_ids = [], [], []
+    for plan in plans:
+        target_id = target_classrooms_map.get(plan['target'])
+        new_enrollments.extend({**row, 'classroom_id': target_id} for row in plan['_enrollments'] if target_id)
+        new_flags.extend(plan['_flags'])
+        graduate_ids.extend(plan['_graduates'])
+
+    for rows in chunked(new_enrollments):
+        db.session.execute(insert(Enrollment), rows)
+    for rows in chunked(new_flags):
+        db.session.execute(insert(RepeatCandidate), rows)
+    for ids in chunked(graduate_ids):
+        db.session.execute(update(Student).where(Student.id.in_(ids)).values(status='จบการศึกษา'))
+    refresh_search_documents(db.session, TYPE_STUDENT, graduate_ids) # สถานะอยู่ใน subtitle
+
+    # ครูที่ปรึกษา: ย้ายไปห้องปลายทาง (ชั้นจบ: ล้างออก); ห้องต้นทางที่ไม่มีที่ปรึกษาแล้วไม่แตะห้องปลายทาง
+    source_ids = [p['classroom_id'] for p in plans if not p['error']]
+    advisors = defaultdict(list)
+    for user_id, classroom_id in db.session.query(classroom_advisors.c.user_id, classroom_advisors.c.classroom_id).filter(
+            classroom_advisors.c.classroom_id.in_(source_ids)).all():
+        advisors[classroom_id].append(user_id)
+    moves = {target_classrooms_map[p['target']]: advisors[p['classroom_id']] for p in plans
+             if p['target'] in target_classrooms_map and advisors.get(p['classroom_id'])}
+    if moves:
+        db.session.execute(delete(classroom_advisors).where(classroom_advisors.c.classroom_id.in_(list(moves))))
+        db.session.execute(insert(classroom_advisors), [
+            {'user_id': user_id, 'classroom_id': target_id}
+            for target_id, user_ids in moves.items() for user_id in set(user_ids)])
+    if advisors:
+        db.session.execute(delete(classroom_advisors).where(classroom_advisors.c.classroom_id.in_(list(advisors))))
+
+
+def promote_students_to_next_year(source_academic_year_id, target_academic_year_id, promotion_criteria=None,
+                                  dry_run=False, job=None):
     """
-    [REVISED v2 - Auto-Create Classrooms] Service function to promote students.
+    [REVISED v3 - Set-based] Service function to promote students.
+    - Eligibility for the whole source year comes from grouped queries:
+      non-graduating students with no failing grade are promoted, graduating
+      levels (GradeLevel.graduation_credits set) use check_graduation_readiness_batch.
     - Auto-creates target classrooms if they don't exist.
     - Moves advisors for non-graduating levels.
-    - Creates new Enrollments for students meeting criteria.
-    - Flags students not meeting criteria as RepeatCandidates.
+    - Bulk-inserts Enrollments and RepeatCandidates, skipping students already
+      enrolled in the target year or already flagged, so a re-run is safe.
     - Sets graduating students' status.
 
     Args:
         source_academic_year_id (int): ID of the academic year to promote FROM.
         target_academic_year_id (int): ID of the academic year to promote TO.
         promotion_criteria (dict, optional): Criteria for promotion. Defaults to None.
+        dry_run (bool): Only return the plan; nothing is written.
+        job (Job, optional): Background job to report progress to.
 
     Returns:
-        dict: Summary of actions taken (promoted, graduated, flagged, errors, classrooms_created).
+        dict: Summary (promoted, graduated, flagged_repeat, classrooms_created,
+            errors) plus ``classrooms``, the per-classroom plan.
     """
     source_year = db.session.get(AcademicYear, source_academic_year_id)
     target_year = db.session.get(AcademicYear, target_academic_year_id)
@@ -1234,176 +1535,66 @@ def promote_students_to_next_year(source_academic_year_id, target_academic_year_
     if source_year.year >= target_year.year:
          return {'errors': ['Target year must be after source year.']}
 
-    summary = {'promoted': 0, 'graduated': 0, 'flagged_repeat': 0, 'classrooms_created': 0, 'errors': []}
-    processed_student_ids = set()
-
-    # --- Graduating Levels & Promotion Check (Same as before) ---
-    graduating_grade_short_names = ['ม.3', 'ม.6'] # TODO: Configurable
-    graduating_grade_level_ids = [gl.id for gl in GradeLevel.query.filter(GradeLevel.short_name.in_(graduating_grade_short_names)).all()]
-
-    def check_promotion_eligibility(student_id, source_year_id):
-         failed_grades = db.session.query(CourseGrade).join(Course).join(Classroom).filter(
-              CourseGrade.student_id == student_id,
-              Classroom.academic_year_id == source_year_id,
-              CourseGrade.final_grade.in_(['0', 'ร', 'มส'])
-         ).count()
-         return failed_grades == 0
-    # ---
-
-    # Get source classrooms
-    source_classrooms = Classroom.query.filter_by(academic_year_id=source_year.id).options(
-        joinedload(Classroom.grade_level),
-        selectinload(Classroom.advisors) # Removed enrollments load due to lazy='dynamic'
-    ).order_by(Classroom.name).all()
-
-    # Pre-fetch target classrooms into a map for quick lookup
-    target_classrooms_map = {c.name: c for c in Classroom.query.filter_by(academic_year_id=target_year.id).all()}
-    # Pre-fetch all grade levels into a map for quick lookup by short_name
-    grade_levels_map = {gl.short_name: gl for gl in GradeLevel.query.all()}
-
-    for old_classroom in source_classrooms:
-        grade_level = old_classroom.grade_level
-        if not grade_level:
-             summary['errors'].append(f"Skipping {old_classroom.name}: Missing grade level information.")
-             continue
-
-        is_graduating_level = grade_level.id in graduating_grade_level_ids
-
-        # --- Handle Graduating Students (Same as before) ---
-        if is_graduating_level:
-            # Need to load enrollments lazily now
-            student_ids_in_class = [e.student_id for e in old_classroom.enrollments if e.student_id not in processed_student_ids]
-            if student_ids_in_class:
-                updated_count = Student.query.filter(Student.id.in_(student_ids_in_class)).update(
-                    {'status': 'จบการศึกษา'}, synchronize_session=False
-                )
-                summary['graduated'] += updated_count
-                processed_student_ids.update(student_ids_in_class)
-            old_classroom.advisors = []
-            continue
-
-        # --- [REVISED] Handle Non-Graduating Students with Auto-Create Classroom ---
-        target_classroom = None
-        target_grade_level = None
-        target_classroom_name = ""
+    if job is not None:
+        job.update(done=0, message='กำลังคำนวณแผนการเลื่อนชั้น')
+    plans, errors = _build_promotion_plan(source_year, target_year)
+    summary = {
+        'dry_run': dry_run,
+        'promoted': sum(p['promoted'] for p in plans),
+        'graduated': sum(p['graduated'] for p in plans),
+        'flagged_repeat': sum(p['flagged_repeat'] for p in plans),
+        'already_done': sum(p['already_done'] for p in plans),
+        'classrooms_created': len({p['target'] for p in plans if p['create_target']}),
+        'errors': errors,
+        'classrooms': [{k: v for k, v in p.items() if not k.startswith('_')} for p in plans],
+    }
+    if dry_run:
+        return summary
+
+    # 1. สร้างห้องปลายทางที่ยังไม่มี
+    new_classrooms = {}
+    for plan in plans:
+        if plan['create_target']:
+            new_classrooms.setdefault(plan['target'], {'name': plan['target'], 'academic_year_id': target_year.id,
+                                                       'grade_level_id': plan['target_grade_level_id']})
+    if new_classrooms:
+        db.session.execute(insert(Classroom), list(new_classrooms.values()))
+    target_classrooms_map = dict(db.session.query(Classroom.name, Classroom.id).filter(
+        Classroom.academic_year_id == target_year.id).all())
+    if new_classrooms:
+        refresh_search_documents(db.session, TYPE_CLASSROOM, [target_classrooms_map[name] for name in new_classrooms])
+        db.session.commit()
 
+    # 2. เขียนทีละกลุ่มห้อง (transaction สั้น); รันซ้ำได้เพราะข้ามคนที่ทำไปแล้ว
+    if job is not None:
+        job.update(done=0, total=len(plans), message='กำลังเลื่อนชั้นนักเรียน')
+    for start in range(0, len(plans), PROMOTION_CLASSROOM_CHUNK):
+        chunk = plans[start:start + PROMOTION_CLASSROOM_CHUNK]
         try:
-            # 1. Calculate Target Classroom Name and Grade Level
-            current_grade_num_str = grade_level.short_name.split('.')[-1]
-            if not current_grade_num_str.isdigit():
-                 raise ValueError(f"Cannot parse grade number from '{grade_level.short_name}'")
-            next_grade_num = int(current_grade_num_str) + 1
-            next_grade_short_name = f"ม.{next_grade_num}" # Assumes "ม.X" format
-
-            target_classroom_name = old_classroom.name.replace(grade_level.short_name, next_grade_short_name)
-            target_grade_level = grade_levels_map.get(next_grade_short_name)
-
-            if not target_grade_level:
-                 raise ValueError(f"Target grade level '{next_grade_short_name}' not found in database.")
-
-            # 2. Find or Create Target Classroom
-            target_classroom = target_classrooms_map.get(target_classroom_name)
-
-            if not target_classroom:
-                # --- AUTO-CREATE LOGIC ---
-                print(f"Target classroom '{target_classroom_name}' not found. Creating...") # Add logging
-                target_classroom = Classroom(
-                    name=target_classroom_name,
-                    academic_year_id=target_year.id,
-                    grade_level_id=target_grade_level.id
-                )
-                db.session.add(target_classroom)
-                db.session.flush() # IMPORTANT: Assign ID within the transaction
-                target_classrooms_map[target_classroom_name] = target_classroom # Add to map
-                summary['classrooms_created'] += 1
-                print(f"Created classroom ID: {target_classroom.id}") # Add logging
-                # --- END AUTO-CREATE ---
-            else:
-                 print(f"Found target classroom '{target_classroom_name}' with ID: {target_classroom.id}") # Add logging
-
-
-        except ValueError as ve:
-             error_msg = f"Error determining target for {old_classroom.name}: {str(ve)}"
-             summary['errors'].append(error_msg)
-             current_app.logger.warning(error_msg)
-             continue # Skip this classroom if target cannot be determined/created
-        except Exception as e: # Catch other potential errors during creation/lookup
-             error_msg = f"Unexpected error processing target for {old_classroom.name}: {str(e)}"
-             summary['errors'].append(error_msg)
-             current_app.logger.error(error_msg, exc_info=True)
-             continue
-
-
-        # 3. Move Advisors (Same as before, using the found or created target_classroom)
-        current_advisors = list(old_classroom.advisors)
-        target_classroom.advisors = current_advisors
-        old_classroom.advisors = []
-
-        # 4. Process Students (Same as before, using the found or created target_classroom)
-        # Need to load enrollments lazily now
-        is_ready, reason = check_graduation_readiness(student.id, source_year.id) # Now returns tuple
-        eligible = is_ready # Promotion eligibility still based on readiness in source year
-
-        # If graduating level, check the approval status (Assume you add a field like student.graduation_approved)
-        # if is_graduating_level:
-        #     if student.graduation_approved: # Check flag set by Academic/Director
-        #         student.status = 'จบการศึกษา'
-        #         summary['graduated'] += 1
-        #         processed_student_ids.add(student.id)
-        #         # Skip enrollment creation for graduates
-        #         continue
-        #     else:
-        #         # If graduation not approved (maybe still failing/pending), don't change status
-        #         # Log or handle this case? For now, just skip.
-        #         summary['errors'].append(f"Graduation for {student.full_name} not yet approved or student not ready.")
-        #         processed_student_ids.add(student.id) # Mark as processed for this function's scope
-        #         continue
-        # --- End Graduating level specific check ---
-
-
-        if eligible: # For non-graduating levels, 'eligible' means ready to promote
-            # Create new Enrollment in target classroom
-            new_enrollment = Enrollment(
-                student_id=student.id,
-                classroom_id=target_classroom.id,
-                roll_number=enrollment.roll_number
-            )
-            db.session.add(new_enrollment)
-            summary['promoted'] += 1
-        else: # Not eligible (failing grades or insufficient credits in source year)
-            # Flag as Repeat Candidate
-            existing_flag = RepeatCandidate.query.filter_by(
-                    student_id=student.id,
-                    academic_year_id_failed=source_year.id
-            ).first()
-            if not existing_flag:
-                flag = RepeatCandidate(
-                    student_id=student.id,
-                    previous_enrollment_id=enrollment.id,
-                    academic_year_id_failed=source_year.id,
-                    status='Pending Advisor Review',
-                    advisor_notes=reason # Store the reason for flagging
-                )
-                db.session.add(flag)
-                summary['flagged_repeat'] += 1
-            # DO NOT create a new Enrollment
-
-        processed_student_ids.add(student.id)
-
-    try:
-        print("Attempting to commit changes...") # Add logging
-        db.session.commit()
-        print("Commit successful.") # Add logging
-    except Exception as e:
-        db.session.rollback()
-        error_msg = f"Database commit failed: {str(e)}"
-        summary['errors'].append(error_msg)
-        current_app.logger.error(f"Error during promotion commit: {e}", exc_info=True)
-        print(f"Commit failed: {error_msg}") # Add logging
+            _apply_promotion_chunk(chunk, target_classrooms_map)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            error_msg = f"Database commit failed for {', '.join(p['classroom'] for p in chunk)}: {e}"
+            summary['errors'].append(error_msg)
+            current_app.logger.error(f"Error during promotion commit: {e}", exc_info=True)
+            for plan in chunk:
+                summary['promoted'] -= plan['promoted']
+                summary['graduated'] -= plan['graduated']
+                summary['flagged_repeat'] -= plan['flagged_repeat']
+        if job is not None:
+            job.update(done=min(start + PROMOTION_CLASSROOM_CHUNK, len(plans)))
+
+    current_app.logger.info(
+        f"Promotion {source_year.year} -> {target_year.year}: promoted={summary['promoted']} "
+        f"graduated={summary['graduated']} flagged={summary['flagged_repeat']} errors={len(summary['errors'])}")
+    return summary
 
 
-    print("Promotion Summary:", summary) # Add logging
-    return summary
+def run_promotion_job(job, source_academic_year_id, target_academic_year_id):
+    """Background-job wrapper; the result keeps only the totals for the progress page."""
+    summary = promote_students_to_next_year(source_academic_year_id, target_academic_year_id, job=job)
+    return {k: v for k, v in summary.items() if k not in ('classrooms', 'dry_run')}
 
 def create_blank_lesson_plan(subject_id: int, academic_year_id: int):
     """
@@ -1453,41 +1644,178 @@ def create_blank_lesson_plan(subject_id: int, academic_year_id: int):
         current_app.logger.error(f"Error creating blank lesson plan for subject {subject_id}, year {academic_year_id}: {e}", exc_info=True)
         return False, f"เกิดข้อผิดพลาดในการสร้างแผนใหม่: {str(e)}"
     
+ROLLOVER_PLAN_CHUNK = 20 # แผนต่อ 1 transaction ตอน rollover
+
+
+def _select_rows(columns, key_column, ids, *criteria):
+    """Rows of ``select(*columns)`` whose ``key_column`` is in ``ids`` (chunked IN), ordered by the first column."""
+    rows = []
+    for chunk in chunked(sorted(set(ids))):
+        rows.extend(db.session.execute(
+            select(*columns).where(key_column.in_(chunk), *criteria).order_by(columns[0])
+        ).all())
+    return rows
+
+
+def _insert_remapped(model, rows):
+    """
+    Bulk-inserts ``rows`` (dicts carrying the source id under ``'_old_id'``)
+    and returns {old_id: new_id}, using INSERT ... RETURNING in parameter order.
+    """
+    id_map = {}
+    for chunk in chunked(rows):
+        new_ids = db.session.scalars(
+            insert(model).returning(model.id, sort_by_parameter_order=True),
+            [{k: v for k, v in row.items() if k != '_old_id'} for row in chunk]
+        ).all()
+        id_map.update(zip((row['_old_id'] for row in chunk), new_ids))
+    return id_map
+
+
+def _copy_link_table(table, owner_column, target_column, owner_map, target_map=None, *criteria):
+    """Copies association rows, remapping the owner side (and the target side when ``target_map`` is given)."""
+    owner_col, target_col = table.c[owner_column], table.c[target_column]
+    links = set()
+    for owner_id, target_id in _select_rows([owner_col, target_col], owner_col, owner_map.keys(), *criteria):
+        if target_map is not None:
+            target_id = target_map.get(target_id)
+        if target_id is not None:
+            links.add((owner_map[owner_id], target_id))
+    for chunk in chunked(sorted(links)):
+        db.session.execute(insert(table), [{owner_column: a, target_column: b} for a, b in chunk])
+    return len(links)
+
+
+def _copy_lesson_plans(source_plan_ids, target_academic_year_id, creator_id=None):
+    """
+    Deep-copies lesson plans into ``target_academic_year_id`` with bulk
+    INSERT ... RETURNING per table and old->new id maps (no commit).
+
+    Copies units, graded items, assessment items, sub-units and their links;
+    standard (ADMIN) indicators are linked, teacher indicators are copied and
+    attached to the new plan only. Reflections and teaching logs are not copied.
+
+    Args:
+        creator_id (int, optional): Owner of the copied teacher indicators;
+            defaults to the original creator.
+
+    Returns:
+        tuple(dict, dict): ({old_plan_id: new_plan_id}, counts per copied table)
+    """
+    plan_rows = _select_rows([LessonPlan.id, LessonPlan.subject_id, LessonPlan.target_mid_ratio,
+                              LessonPlan.target_final_ratio, LessonPlan.manual_scheduling_notes],
+                             LessonPlan.id, source_plan_ids)
+    plan_map = _insert_remapped(LessonPlan, [{
+        '_old_id': plan_id, 'subject_id': subject_id, 'academic_year_id': target_academic_year_id,
+        'target_mid_ratio': mid_ratio, 'target_final_ratio': final_ratio,
+        'status': 'ฉบับร่าง', # Always start as draft
+        'manual_scheduling_notes': notes, # Keep manual notes
+    } for plan_id, subject_id, mid_ratio, final_ratio, notes in plan_rows])
+
+    unit_columns = ['title', 'sequence', 'midterm_score', 'final_score', 'topic', 'hours', 'learning_objectives',
+                    'learning_content', 'learning_activities', 'core_concepts', 'media_sources']
+    unit_rows = _select_rows([LearningUnit.id, LearningUnit.lesson_plan_id, *[getattr(LearningUnit, c) for c in unit_columns]],
+                             LearningUnit.lesson_plan_id, plan_map.keys())
+    unit_plan = {row.id: row.lesson_plan_id for row in unit_rows} # old unit -> old plan
+    unit_map = _insert_remapped(LearningUnit, [
+        {'_old_id': row.id, 'lesson_plan_id': plan_map[row.lesson_plan_id], **{c: getattr(row, c) for c in unit_columns}}
+        for row in unit_rows
+    ])
+
+    graded_item_map = _insert_remapped(GradedItem, [{
+        '_old_id': item_id, 'learning_unit_id': unit_map[unit_id], 'name': name, 'max_score': max_score,
+        'indicator_type': indicator_type, 'assessment_type': assessment_type,
+        'assessment_dimension_id': dimension_id, 'is_group_assignment': is_group,
+    } for item_id, unit_id, name, max_score, indicator_type, assessment_type, dimension_id, is_group in _select_rows(
+        [GradedItem.id, GradedItem.learning_unit_id, GradedItem.name, GradedItem.max_score, GradedItem.indicator_type,
+         GradedItem.assessment_type, GradedItem.assessment_dimension_id, GradedItem.is_group_assignment],
+        GradedItem.learning_unit_id, unit_map.keys())])
+
+    assessment_item_map = _insert_remapped(AssessmentItem, [
+        {'_old_id': item_id, 'learning_unit_id': unit_map[unit_id], 'assessment_topic_id': topic_id}
+        for item_id, unit_id, topic_id in _select_rows(
+            [AssessmentItem.id, AssessmentItem.learning_unit_id, AssessmentItem.assessment_topic_id],
+            AssessmentItem.learning_unit_id, unit_map.keys())
+    ])
+
+    sub_unit_rows = _select_rows([SubUnit.id, SubUnit.learning_unit_id, SubUnit.title, SubUnit.hour_sequence,
+                                  SubUnit.activities], SubUnit.learning_unit_id, unit_map.keys())
+    sub_unit_plan = {row.id: unit_plan[row.learning_unit_id] for row in sub_unit_rows} # old sub-unit -> old plan
+    sub_unit_map = _insert_remapped(SubUnit, [
+        {'_old_id': sub_id, 'learning_unit_id': unit_map[unit_id], 'title': title,
+         'hour_sequence': hour_sequence, 'activities': activities}
+        for sub_id, unit_id, title, hour_sequence, activities in sub_unit_rows
+    ])
+
+    # ตัวชี้วัดมาตรฐาน (ADMIN) ลิงก์ของเดิม; ของครู (TEACHER) คัดลอกใหม่และผูกกับแผนใหม่เท่านั้น
+    admin_indicator_ids = select(Indicator.id).where(Indicator.creator_type == 'ADMIN').scalar_subquery()
+    teacher_indicator_ids = select(Indicator.id).where(Indicator.creator_type == 'TEACHER').scalar_subquery()
+    links = _copy_link_table(learning_unit_indicators, 'learning_unit_id', 'indicator_id', unit_map, None,
+                             learning_unit_indicators.c.indicator_id.in_(admin_indicator_ids))
+    links += _copy_link_table(sub_unit_indicators, 'sub_unit_id', 'indicator_id', sub_unit_map, None,
+                              sub_unit_indicators.c.indicator_id.in_(admin_indicator_ids))
+    links += _copy_link_table(sub_unit_graded_items, 'sub_unit_id', 'graded_item_id', sub_unit_map, graded_item_map)
+    links += _copy_link_table(sub_unit_assessment_items, 'sub_unit_id', 'assessment_item_id', sub_unit_map, assessment_item_map)
+    links += _copy_link_table(subunit_topics, 'subunit_id', 'topic_id', sub_unit_map)
+
+    teacher_indicators = defaultdict(set) # old_plan_id -> {indicator_id}
+    for indicator_id, plan_id in _select_rows([Indicator.id, Indicator.lesson_plan_id], Indicator.lesson_plan_id,
+                                              plan_map.keys(), Indicator.creator_type == 'TEACHER'):
+        teacher_indicators[plan_id].add(indicator_id)
+    for table, owner_column, owner_plan in ((learning_unit_indicators, 'learning_unit_id', unit_plan),
+                                            (sub_unit_indicators, 'sub_unit_id', sub_unit_plan)):
+        owner_col = table.c[owner_column]
+        for owner_id, indicator_id in _select_rows([owner_col, table.c.indicator_id], owner_col, owner_plan.keys(),
+                                                   table.c.indicator_id.in_(teacher_indicator_ids)):
+            teacher_indicators[owner_plan[owner_id]].add(indicator_id)
+
+    indicator_rows = {indicator_id: (code, description, standard_id, original_creator)
+                      for indicator_id, code, description, standard_id, original_creator in _select_rows(
+                          [Indicator.id, Indicator.code, Indicator.description, Indicator.standard_id, Indicator.creator_id],
+                          Indicator.id, {i for ids in teacher_indicators.values() for i in ids})}
+    new_indicators = [{
+        'code': indicator_rows[i][0], 'description': indicator_rows[i][1], 'standard_id': indicator_rows[i][2],
+        'creator_type': 'TEACHER', 'creator_id': creator_id or indicator_rows[i][3], 'lesson_plan_id': plan_map[plan_id],
+    } for plan_id, ids in teacher_indicators.items() for i in sorted(ids)]
+    new_indicator_ids = []
+    for chunk in chunked(new_indicators):
+        new_indicator_ids.extend(db.session.scalars(insert(Indicator).returning(Indicator.id), chunk).all())
+    reindex_indicators(db.session, indicator_ids=new_indicator_ids) # bulk insert ไม่ผ่าน mapper events
+
+    constraints = [{'lesson_plan_id': plan_map[plan_id], 'constraint_type': constraint_type, 'value': value}
+                   for _, plan_id, constraint_type, value in _select_rows(
+                       [LessonPlanConstraint.id, LessonPlanConstraint.lesson_plan_id,
+                        LessonPlanConstraint.constraint_type, LessonPlanConstraint.value],
+                       LessonPlanConstraint.lesson_plan_id, plan_map.keys())]
+    for chunk in chunked(constraints):
+        db.session.execute(insert(LessonPlanConstraint), chunk)
+
+    refresh_search_documents(db.session, TYPE_LESSON_PLAN, plan_map.values())
+    counts = {'units': len(unit_map), 'sub_units': len(sub_unit_map), 'graded_items': len(graded_item_map),
+              'assessment_items': len(assessment_item_map), 'custom_indicators': len(new_indicator_ids),
+              'links': links, 'constraints': len(constraints)}
+    return plan_map, counts
+
+
 def copy_lesson_plan(source_plan_id: int, target_academic_year_id: int, current_user_id: int):
     """
-    Creates a copy of a lesson plan for a new academic year.
+    [REVISED] Creates a copy of a lesson plan for a new academic year
+    (single-plan form of rollover_lesson_plans).
 
     Args:
         source_plan_id: ID of the LessonPlan to copy.
         target_academic_year_id: ID of the AcademicYear for the new plan.
-        current_user_id: ID of the user performing the copy.
+        current_user_id: ID of the user performing the copy (owner of copied custom indicators).
 
     Returns:
         Tuple (bool, Union[int, str]): (True, new_plan_id) on success,
                                        (False, error_message) on failure.
     """
     try:
-        # 1. Fetch Source Plan with related data eagerly
-        source_plan = db.session.query(LessonPlan).options(
-            selectinload(LessonPlan.subject), # Load subject for error message
-            selectinload(LessonPlan.learning_units).options(
-                selectinload(LearningUnit.graded_items).selectinload(GradedItem.dimension), # Load dimension too
-                selectinload(LearningUnit.assessment_items).selectinload(AssessmentItem.topic), # Load topic
-                selectinload(LearningUnit.indicators).selectinload(Indicator.standard), # Standard indicators + standard
-                selectinload(LearningUnit.sub_units).options(
-                     selectinload(SubUnit.indicators).selectinload(Indicator.standard),
-                     selectinload(SubUnit.graded_items).selectinload(GradedItem.dimension),
-                     selectinload(SubUnit.assessment_items).selectinload(AssessmentItem.topic)
-                )
-            ),
-            selectinload(LessonPlan.custom_indicators).selectinload(Indicator.standard), # Custom indicators + standard
-            selectinload(LessonPlan.constraints)
-        ).get(source_plan_id)
-
+        source_plan = db.session.get(LessonPlan, source_plan_id)
         if not source_plan:
             return False, "ไม่พบแผนการสอนต้นทาง"
 
-        # 2. Check for Existing Target Plan
         target_year = db.session.get(AcademicYear, target_academic_year_id) # Get target year object for message
         if not target_year:
              return False, "ไม่พบปีการศึกษาเป้าหมาย"
@@ -1500,144 +1828,72 @@ def copy_lesson_plan(source_plan_id: int, target_academic_year_id: int, current_
             subject_name = source_plan.subject.name if source_plan.subject else f"ID {source_plan.subject_id}"
             return False, f"มีแผนการสอนสำหรับวิชา {subject_name} ในปีการศึกษา {target_year.year} อยู่แล้ว"
 
-        # 3. Create New Plan Object
-        new_plan = LessonPlan(
-            subject_id=source_plan.subject_id,
-            academic_year_id=target_academic_year_id,
-            target_mid_ratio=source_plan.target_mid_ratio,
-            target_final_ratio=source_plan.target_final_ratio,
-            status='ฉบับร่าง', # Always start as draft
-            revision_notes=None, # Clear revision notes
-            manual_scheduling_notes=source_plan.manual_scheduling_notes # Keep manual notes
-        )
-        db.session.add(new_plan)
-        # Flush to get the new_plan.id needed for custom indicators
-        db.session.flush()
-
-        # --- Mappings to track old IDs to new objects ---
-        unit_map = {} # old_unit_id -> new_unit_object
-        graded_item_map = {} # old_graded_item_id -> new_graded_item_object
-        assessment_item_map = {} # old_assessment_item_id -> new_assessment_item_object
-
-        # 4. Deep Copy Learning Units and their contents
-        for source_unit in sorted(source_plan.learning_units, key=lambda u: u.sequence):
-            new_unit = LearningUnit(
-                lesson_plan=new_plan, # Associate with new plan
-                title=source_unit.title,
-                sequence=source_unit.sequence,
-                midterm_score=source_unit.midterm_score,
-                final_score=source_unit.final_score,
-                topic=source_unit.topic,
-                hours=source_unit.hours,
-                learning_objectives=source_unit.learning_objectives,
-                learning_content=source_unit.learning_content,
-                learning_activities=source_unit.learning_activities,
-                core_concepts=source_unit.core_concepts,
-                # activities=source_unit.activities, # Deprecated
-                media_sources=source_unit.media_sources
-                # DO NOT COPY reflections or PostTeachingLog
-            )
-            db.session.add(new_unit)
-            db.session.flush() # Get new_unit.id
-            unit_map[source_unit.id] = new_unit
-
-            # 4.1 Copy Standard Indicator relationships (link to existing ones)
-            # Filter out custom indicators before assigning
-            standard_indicators = [ind for ind in source_unit.indicators if ind.creator_type == 'ADMIN']
-            new_unit.indicators = standard_indicators
-
-            # 4.2 Deep Copy Graded Items
-            for source_item in source_unit.graded_items:
-                new_item = GradedItem(
-                    learning_unit=new_unit, # Associate with new unit
-                    name=source_item.name,
-                    max_score=source_item.max_score,
-                    indicator_type=source_item.indicator_type,
-                    assessment_type=source_item.assessment_type,
-                    assessment_dimension_id=source_item.assessment_dimension_id,
-                    is_group_assignment=source_item.is_group_assignment
-                )
-                db.session.add(new_item)
-                db.session.flush() # Get new_item.id
-                graded_item_map[source_item.id] = new_item
-
-            # 4.3 Deep Copy Assessment Items
-            for source_assess_item in source_unit.assessment_items:
-                new_assess_item = AssessmentItem(
-                    unit=new_unit, # Associate with new unit
-                    assessment_topic_id=source_assess_item.assessment_topic_id
-                )
-                db.session.add(new_assess_item)
-                db.session.flush() # Get new_assess_item.id
-                assessment_item_map[source_assess_item.id] = new_assess_item
-
-            # 4.4 Deep Copy SubUnits (if any)
-            for source_sub_unit in sorted(source_unit.sub_units, key=lambda su: su.hour_sequence):
-                 new_sub_unit = SubUnit(
-                      learning_unit=new_unit, # Associate with new unit
-                      title=source_sub_unit.title,
-                      hour_sequence=source_sub_unit.hour_sequence,
-                      activities=source_sub_unit.activities
-                 )
-                 db.session.add(new_sub_unit) # Add first to allow relationship assignment
-                 db.session.flush() # Get new_sub_unit ID
-
-                 # Copy relationships using the maps created
-                 sub_standard_indicators = [ind for ind in source_sub_unit.indicators if ind.creator_type == 'ADMIN']
-                 new_sub_unit.indicators = sub_standard_indicators # Link to existing standard ones
-                 new_sub_unit.graded_items = [graded_item_map[gi.id] for gi in source_sub_unit.graded_items if gi.id in graded_item_map]
-                 new_sub_unit.assessment_items = [assessment_item_map[ai.id] for ai in source_sub_unit.assessment_items if ai.id in assessment_item_map]
-                 # No need to add again, already added
-
-        # 5. Deep Copy Custom Indicators (if any) linked directly to the PLAN
-        # Also copy custom indicators linked to UNITS/SUBUNITS
-        all_source_custom_indicators = list(source_plan.custom_indicators) # Plan level
-        for su in source_plan.learning_units:
-             all_source_custom_indicators.extend([ind for ind in su.indicators if ind.creator_type == 'TEACHER']) # Unit level
-             for sub in su.sub_units:
-                  all_source_custom_indicators.extend([ind for ind in sub.indicators if ind.creator_type == 'TEACHER']) # SubUnit level
-
-        # Use a set to handle potential duplicates if an indicator is linked multiple times
-        unique_source_custom_indicators = {ind.id: ind for ind in all_source_custom_indicators}.values()
-
-        custom_indicator_map = {} # old_custom_id -> new_custom_object
-        for source_custom_ind in unique_source_custom_indicators:
-            # Check if this custom indicator was linked to a unit/subunit that was copied
-            # We need to decide where the *new* custom indicator should be linked.
-            # Simplest approach: Link all copied custom indicators ONLY to the new PLAN.
-            new_custom_ind = Indicator(
-                lesson_plan=new_plan, # Link to new plan ONLY
-                code=source_custom_ind.code,
-                description=source_custom_ind.description,
-                standard_id=source_custom_ind.standard_id, # Assume custom standard exists
-                creator_type='TEACHER',
-                creator_id=current_user_id # Assign to the user doing the copy
-            )
-            db.session.add(new_custom_ind)
-            db.session.flush()
-            custom_indicator_map[source_custom_ind.id] = new_custom_ind
-
-        # 6. Copy Constraints
-        for source_constraint in source_plan.constraints:
-            new_constraint = LessonPlanConstraint(
-                lesson_plan=new_plan, # Link to new plan
-                constraint_type=source_constraint.constraint_type,
-                value=source_constraint.value
-            )
-            db.session.add(new_constraint)
-
-        # 7. Commit all changes
+        plan_map, _ = _copy_lesson_plans([source_plan_id], target_academic_year_id, creator_id=current_user_id)
         db.session.commit()
-
-        # 8. Return success and the new plan ID
-        return True, new_plan.id
+        return True, plan_map[source_plan_id]
 
     except Exception as e:
         db.session.rollback()
         # Use Flask's logger
         current_app.logger.error(f"Error copying lesson plan {source_plan_id}: {e}", exc_info=True)
         return False, f"เกิดข้อผิดพลาดในการคัดลอก: {str(e)}"
-    
+
+
+def rollover_lesson_plans(source_academic_year_id, target_academic_year_id, subject_ids=None, job=None):
+    """
+    [NEW] Copies every lesson plan of the source year (optionally only
+    ``subject_ids``) into the target year. Subjects that already have a plan
+    in the target year are skipped, so the rollover can be re-run.
+
+    Plans are copied ROLLOVER_PLAN_CHUNK at a time, one transaction each.
+
+    Returns:
+        dict: Summary (copied, skipped_existing, units, graded_items, ..., errors).
+    """
+    source_year = db.session.get(AcademicYear, source_academic_year_id)
+    target_year = db.session.get(AcademicYear, target_academic_year_id)
+    if not source_year or not target_year:
+        return {'errors': ['Invalid source or target academic year ID.']}
+    if source_year.id == target_year.id:
+        return {'errors': ['Source and target academic year must differ.']}
+
+    query = db.session.query(LessonPlan.id, LessonPlan.subject_id).filter(LessonPlan.academic_year_id == source_year.id)
+    if subject_ids is not None:
+        query = query.filter(LessonPlan.subject_id.in_(subject_ids))
+    source_plans = query.order_by(LessonPlan.subject_id).all()
+    existing_subject_ids = {sid for (sid,) in db.session.query(LessonPlan.subject_id).filter(
+        LessonPlan.academic_year_id == target_year.id).all()}
+    to_copy = [plan_id for plan_id, subject_id in source_plans if subject_id not in existing_subject_ids]
+
+    summary = {'copied': 0, 'skipped_existing': len(source_plans) - len(to_copy), 'units': 0, 'sub_units': 0,
+               'graded_items': 0, 'assessment_items': 0, 'custom_indicators': 0, 'errors': []}
+    if job is not None:
+        job.update(done=0, total=len(to_copy), message=f'กำลังคัดลอกแผนการสอน {source_year.year} -> {target_year.year}')
+
+    for start in range(0, len(to_copy), ROLLOVER_PLAN_CHUNK):
+        chunk = to_copy[start:start + ROLLOVER_PLAN_CHUNK]
+        try:
+            plan_map, counts = _copy_lesson_plans(chunk, target_year.id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            summary['errors'].append(f"คัดลอกแผน {len(chunk)} รายการไม่สำเร็จ: {e}")
+            current_app.logger.error(f"Error rolling over lesson plans {chunk}: {e}", exc_info=True)
+        else:
+            summary['copied'] += len(plan_map)
+            for key in ('units', 'sub_units', 'graded_items', 'assessment_items', 'custom_indicators'):
+                summary[key] += counts[key]
+        if job is not None:
+            job.update(done=min(start + ROLLOVER_PLAN_CHUNK, len(to_copy)))
+
+    current_app.logger.info(f"Lesson plan rollover {source_year.year} -> {target_year.year}: {summary}")
+    return summary
+
+
+def run_lesson_plan_rollover_job(job, source_academic_year_id, target_academic_year_id, subject_ids=None):
+    """Background-job wrapper for rollover_lesson_plans."""
+    return rollover_lesson_plans(source_academic_year_id, target_academic_year_id, subject_ids, job=job)
+
 # --- [START ADDITION] New Service Function for Copying Schedule Structure ---
 def copy_schedule_structure(source_semester_id: int, target_semester_id: int):
     """
@@ -1715,6 +1971,166 @@ def copy_schedule_structure(source_semester_id: int, target_semester_id: int):
         return False, f"เกิดข้อผิดพลาดในการคัดลอกโครงสร้าง: {str(e)}"
 # --- [END ADDITION] ---
 
+SEMESTER_CLONE_SCOPES = ('slots', 'courses', 'teachers', 'timetable')
+
+
+def clone_semester_setup(source_semester_id, target_semester_id, scopes=SEMESTER_CLONE_SCOPES, dry_run=False):
+    """
+    [NEW] Copies a semester's setup into another semester with INSERT ... SELECT
+    statements, adding only what the target does not have yet:
+
+    - ``slots``: WeeklyScheduleSlots (matched by grade, day and period) and TimeSlots (by period).
+    - ``courses``: Courses with their room; the classroom is matched by name in
+      the target year and the lesson plan by subject in the target year.
+    - ``teachers``: course_teachers links, for target courses that have no teacher yet.
+    - ``timetable``: TimetableEntries, remapped to the target course and slot.
+      Each entry is checked with the target's ConflictIndex (slot, classroom,
+      teacher and room) before it is placed; entries that would clash are not
+      copied and are listed under ``summary['timetable']['skipped']``.
+
+    With ``dry_run`` the statements run and are rolled back, so the counts
+    (and the skipped entries) are the exact diff.
+
+    Returns:
+        dict: {'dry_run', 'scopes', 'errors', <scope>: {'source': n, 'added': n}, ...}
+    """
+    source = db.session.get(Semester, source_semester_id)
+    target = db.session.get(Semester, target_semester_id)
+    if not source or not target:
+        return {'errors': ['ไม่พบภาคเรียนต้นทางหรือปลายทาง']}
+    if source.id == target.id:
+        return {'errors': ['ภาคเรียนต้นทางและปลายทางต้องแตกต่างกัน']}
+    scopes = [scope for scope in SEMESTER_CLONE_SCOPES if scope in scopes]
+
+    weekly, time_slot = WeeklyScheduleSlot.__table__, TimeSlot.__table__
+    course, entry, classroom = Course.__table__, TimetableEntry.__table__, Classroom.__table__
+    source_slot, target_slot = weekly.alias('source_slot'), weekly.alias('target_slot')
+    source_course, target_course = course.alias('source_course'), course.alias('target_course')
+    source_room, target_room = classroom.alias('source_classroom'), classroom.alias('target_classroom')
+    existing_teacher = course_teachers.alias('existing_teacher')
+
+    same_slot = and_(target_slot.c.semester_id == target.id,
+                     target_slot.c.grade_level_id == source_slot.c.grade_level_id,
+                     target_slot.c.day_of_week == source_slot.c.day_of_week,
+                     target_slot.c.period_number == source_slot.c.period_number)
+    # ห้องเรียนปลายทาง = ห้องชื่อเดียวกันในปีการศึกษาของภาคเรียนปลายทาง (ภาค 2 ปีเดียวกัน = ห้องเดิม)
+    mapped_classroom = source_course.join(source_room, source_course.c.classroom_id == source_room.c.id).join(
+        target_room, and_(target_room.c.name == source_room.c.name,
+                          target_room.c.academic_year_id == target.academic_year_id))
+    same_course = and_(target_course.c.semester_id == target.id,
+                       target_course.c.subject_id == source_course.c.subject_id,
+                       target_course.c.classroom_id == target_room.c.id)
+    course_pairs = select(source_course.c.id.label('source_id'), target_course.c.id.label('target_id')).select_from(
+        mapped_classroom.join(target_course, same_course)
+    ).where(source_course.c.semester_id == source.id).subquery('course_pairs')
+
+    def count(table, *criteria):
+        return db.session.execute(select(func.count()).select_from(table).where(*criteria)).scalar()
+
+    summary = {'dry_run': dry_run, 'scopes': scopes, 'errors': []}
+    try:
+        if 'slots' in scopes:
+            columns = ['grade_level_id', 'day_of_week', 'period_number', 'start_time', 'end_time',
+                       'activity_name', 'is_teaching_period']
+            result = db.session.execute(insert(weekly).from_select(['semester_id', *columns], select(
+                literal(target.id), *[source_slot.c[c] for c in columns]
+            ).where(source_slot.c.semester_id == source.id, ~exists().where(same_slot))))
+            summary['slots'] = {'source': count(weekly, weekly.c.semester_id == source.id), 'added': result.rowcount}
+
+            source_time, target_time = time_slot.alias('source_time'), time_slot.alias('target_time')
+            columns = ['period_number', 'start_time', 'end_time', 'activity_name', 'is_teaching_period']
+            result = db.session.execute(insert(time_slot).from_select(['semester_id', *columns], select(
+                literal(target.id), *[source_time.c[c] for c in columns]
+            ).where(source_time.c.semester_id == source.id, ~exists().where(
+                target_time.c.semester_id == target.id, target_time.c.period_number == source_time.c.period_number))))
+            summary['time_slots'] = {'source': count(time_slot, time_slot.c.semester_id == source.id),
+                                     'added': result.rowcount}
+
+        if 'courses' in scopes:
+            target_plan = select(LessonPlan.__table__.c.id).where(
+                LessonPlan.__table__.c.subject_id == source_course.c.subject_id,
+                LessonPlan.__table__.c.academic_year_id == target.academic_year_id
+            ).limit(1).scalar_subquery()
+            result = db.session.execute(insert(course).from_select(
+                ['subject_id', 'classroom_id', 'semester_id', 'lesson_plan_id', 'room_id', 'grade_submission_status'],
+                select(source_course.c.subject_id, target_room.c.id, literal(target.id), target_plan,
+                       source_course.c.room_id, literal('ยังไม่ส่ง')).select_from(mapped_classroom).where(
+                    source_course.c.semester_id == source.id, ~exists().where(same_course))))
+            summary['courses'] = {'source': count(course, course.c.semester_id == source.id), 'added': result.rowcount}
+
+        if 'teachers' in scopes:
+            result = db.session.execute(insert(course_teachers).from_select(['course_id', 'user_id'], select(
+                course_pairs.c.target_id, course_teachers.c.user_id
+            ).select_from(course_teachers.join(course_pairs, course_teachers.c.course_id == course_pairs.c.source_id)).where(
+                ~exists().where(existing_teacher.c.course_id == course_pairs.c.target_id)
+            ).distinct()))
+            summary['teachers'] = {'source': count(course_teachers.join(course, course_teachers.c.course_id == course.c.id),
+                                                   course.c.semester_id == source.id), 'added': result.rowcount}
+
+        if 'timetable' in scopes:
+            candidates = db.session.execute(select(
+                entry.c.id, course_pairs.c.target_id, target_slot.c.id
+            ).select_from(entry.join(source_slot, entry.c.weekly_schedule_slot_id == source_slot.c.id).join(
+                course_pairs, entry.c.course_id == course_pairs.c.source_id).join(target_slot, same_slot)).where(
+                source_slot.c.semester_id == source.id).order_by(entry.c.id, course_pairs.c.target_id)).all()
+            # ตรวจด้วย conflict index ชุดเดียวกับหน้าจัดตาราง (รวมรายวิชา/ครูที่เพิ่งเพิ่มข้างบน เพราะอยู่ใน transaction เดียวกัน)
+            # แล้วจองช่องทีละคาบ: คาบซ้ำช่องเดียวกันจาก course_pairs จะถูกข้ามแทนที่จะชน _slot_uc
+            index = ConflictIndex.build(target.id, target.timetable_version)
+            rows, skipped = [], []
+            for source_entry_id, course_id, slot_id in candidates:
+                found = index.conflicts(course_id, slot_id)
+                occupant = index.entry_by_slot.get(slot_id)
+                if found and occupant is not None and index.entries[occupant][0] == course_id:
+                    continue # คัดลอกไว้แล้วจากรอบก่อน
+                if found:
+                    skipped.append((source_entry_id, course_id, slot_id, *found[0]))
+                    continue
+                index.place(-(len(rows) + 1), course_id, slot_id) # ยังไม่มี id จริง
+                rows.append({'course_id': course_id, 'weekly_schedule_slot_id': slot_id})
+            if rows:
+                db.session.execute(insert(entry), rows)
+            summary['timetable'] = {'source': count(entry.join(weekly, entry.c.weekly_schedule_slot_id == weekly.c.id),
+                                                    weekly.c.semester_id == source.id), 'added': len(rows),
+                                    'skipped': _describe_skipped_entries(index, skipped)}
+
+        if dry_run:
+            db.session.rollback()
+        else:
+            bump_timetable_version(db.session, [target.id]) # INSERT ... SELECT ไม่ผ่าน before_flush
+            db.session.commit()
+            current_app.logger.info(f"Cloned semester {source.id} -> {target.id}: {summary}")
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error cloning semester {source_semester_id} -> {target_semester_id}: {e}", exc_info=True)
+        summary['errors'].append(f"เกิดข้อผิดพลาดในการคัดลอก: {e}")
+    return summary
+
+CLONE_CONFLICT_LABELS = {
+    'slot': 'ช่องเวลานี้มีคาบอื่นแล้ว',
+    'activity': 'เป็นคาบกิจกรรม',
+    'classroom': 'ห้องเรียนมีคาบอื่นในเวลานี้แล้ว',
+    'teacher': 'ครูมีสอนคาบอื่นในเวลานี้แล้ว',
+    'room': 'ห้องถูกใช้งานในเวลานี้แล้ว',
+}
+
+
+def _describe_skipped_entries(index, skipped):
+    """Rows of (source_entry_id, course_id, slot_id, kind, ref_id) -> dicts for the clone summary."""
+    course_ids = {course_id for _, course_id, _, _, _ in skipped}
+    labels = {}
+    if course_ids:
+        labels = {course_id: f"{code} {classroom}" for course_id, code, classroom in db.session.query(
+            Course.id, Subject.subject_code, Classroom.name
+        ).join(Subject, Course.subject_id == Subject.id).join(Classroom, Course.classroom_id == Classroom.id).filter(
+            Course.id.in_(course_ids))}
+    described = []
+    for source_entry_id, course_id, slot_id, kind, ref_id in skipped:
+        _, day, period, _, _ = index.slots[slot_id]
+        described.append({'source_entry_id': source_entry_id, 'course_id': course_id, 'slot_id': slot_id,
+                          'course': labels.get(course_id, str(course_id)), 'day': day, 'period': period,
+                          'conflict': kind, 'conflict_id': ref_id, 'reason': CLONE_CONFLICT_LABELS.get(kind, kind)})
+    return described
+
 def log_action(action: str, user=None, model=None, record_id: int = None, old_value=None, new_value=None):
     """
     Creates and saves an audit log entry. Does not commit the session.
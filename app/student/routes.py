@@ -2,10 +2,11 @@
 
 from flask import flash, render_template, abort, redirect, url_for
 from flask_login import login_required, current_user
+from app.materialized_timetables import OWNER_CLASSROOM, cells_on_day, get_weekly_timetable
 from app.services import get_student_dashboard_data
 from app.student import bp
 # --- [NEW] Added models and datetime ---
-from app.models import Student, Semester, Classroom, WeeklyScheduleSlot, TimetableEntry, Course, Enrollment, CourseGrade # Import Enrollment model
+from app.models import Student, Semester, Classroom, WeeklyScheduleSlot, Course, Enrollment, CourseGrade # Import Enrollment model
 from sqlalchemy.orm import selectinload
 from datetime import datetime, date, time
 # --- [END NEW] ---
@@ -123,6 +124,10 @@ def dashboard():
 
     # --- [NEW] Query for schedule IF classroom and grade_level are found ---
     if classroom and grade_level_id:
+        # [REVISED] คาบเรียนของห้องทั้งสัปดาห์มาจากตารางที่คำนวณไว้แล้ว (query เดียว)
+        classroom_timetable = get_weekly_timetable(current_semester.id, OWNER_CLASSROOM, classroom.id)
+        today_cells = cells_on_day(classroom_timetable, current_day_of_week)
+        cells_by_slot = {cell['slot_id']: cell for cell in today_cells}
         
         # 1. Find Current Slot
         current_slot = WeeklyScheduleSlot.query.filter(
@@ -142,24 +147,16 @@ def dashboard():
                 'is_teaching': current_slot.is_teaching_period,
                 'activity': current_slot.activity_name
             }
-            # Find matching TimetableEntry (Must match the specific classroom's course)
-            current_entry = TimetableEntry.query.join(Course).filter(
-                TimetableEntry.weekly_schedule_slot_id == current_slot.id,
-                Course.classroom_id == classroom.id # Match the specific classroom
-            ).options(
-                selectinload(TimetableEntry.course).selectinload(Course.subject),
-                selectinload(TimetableEntry.course).selectinload(Course.room),
-                selectinload(TimetableEntry.course).selectinload(Course.teachers)
-            ).first()
+            # Find matching entry in the classroom's materialized timetable
+            current_entry = cells_by_slot.get(current_slot.id)
 
             if current_entry:
-                teacher_names = ", ".join([t.full_name for t in current_entry.course.teachers])
                 current_entry_data = {
-                    'course_id': current_entry.course_id,
-                    'subject': current_entry.course.subject.name if current_entry.course.subject else 'N/A',
-                    'subject_code': current_entry.course.subject.subject_code if current_entry.course.subject else '',
-                    'room': current_entry.course.room.name if current_entry.course.room else '-',
-                    'teachers': teacher_names
+                    'course_id': current_entry['course_id'],
+                    'subject': current_entry['subject_name'] or 'N/A',
+                    'subject_code': current_entry['subject_code'] or '',
+                    'room': current_entry['room_name'] or '-',
+                    'teachers': current_entry['teachers']
                 }
 
         # 2. Find Next Slot
@@ -191,48 +188,29 @@ def dashboard():
                 'is_teaching': next_slot.is_teaching_period,
                 'activity': next_slot.activity_name
             }
-            # Find matching TimetableEntry
-            next_entry = TimetableEntry.query.join(Course).filter(
-                TimetableEntry.weekly_schedule_slot_id == next_slot.id,
-                Course.classroom_id == classroom.id
-            ).options(
-                selectinload(TimetableEntry.course).selectinload(Course.subject),
-                selectinload(TimetableEntry.course).selectinload(Course.room)
-            ).first()
+            # Find matching entry
+            next_entry = cells_by_slot.get(next_slot.id)
 
             if next_entry:
                 next_entry_data = {
-                    'subject': next_entry.course.subject.name if next_entry.course.subject else 'N/A',
-                    'room': next_entry.course.room.name if next_entry.course.room else '-'
+                    'subject': next_entry['subject_name'] or 'N/A',
+                    'room': next_entry['room_name'] or '-'
                 }
 
         # 3. Find Today's Schedule
-        today_entries = TimetableEntry.query.join(Course).join(WeeklyScheduleSlot).filter(
-            Course.classroom_id == classroom.id,
-            Course.semester_id == current_semester.id,
-            WeeklyScheduleSlot.day_of_week == current_day_of_week
-        ).options(
-            selectinload(TimetableEntry.slot),
-            selectinload(TimetableEntry.course).selectinload(Course.subject),
-            selectinload(TimetableEntry.course).selectinload(Course.room),
-            selectinload(TimetableEntry.course).selectinload(Course.teachers)
-        ).order_by(WeeklyScheduleSlot.period_number.asc()).all()
-
-        for entry in today_entries:
-            slot = entry.slot
-            teacher_names = ", ".join([t.full_name for t in entry.course.teachers])
+        for cell in today_cells:
             today_schedule.append({
-                'period': slot.period_number,
-                'start': slot.start_time.strftime('%H:%M'),
-                'end': slot.end_time.strftime('%H:%M'),
-                'is_teaching': slot.is_teaching_period,
-                'activity': slot.activity_name,
-                'course_id': entry.course_id,
-                'subject': entry.course.subject.name if entry.course.subject else 'N/A',
-                'subject_code': entry.course.subject.subject_code if entry.course.subject else '',
-                'room': entry.course.room.name if entry.course.room else '-',
-                'teachers': teacher_names,
-                'is_current': (current_slot and slot.id == current_slot.id)
+                'period': cell['period'],
+                'start': cell['start'],
+                'end': cell['end'],
+                'is_teaching': True,
+                'activity': None,
+                'course_id': cell['course_id'],
+                'subject': cell['subject_name'] or 'N/A',
+                'subject_code': cell['subject_code'] or '',
+                'room': cell['room_name'] or '-',
+                'teachers': cell['teachers'],
+                'is_current': (current_slot and cell['slot_id'] == current_slot.id)
             })
     # --- [END NEW] ---
 
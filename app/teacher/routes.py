@@ -10,22 +10,28 @@ from sqlalchemy import and_, or_
 from wtforms import IntegerField, StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, Length, Optional
 from app.auth.decorators import initial_setup_required
-from sqlalchemy.orm import joinedload, selectinload, aliased, contains_eager
+from sqlalchemy.orm import joinedload, selectinload, contains_eager
 from app import db
 from sqlalchemy import func
 # Ensure all necessary models are imported
 from app.models import (AcademicYear, AttendanceRecord, AssessmentDimension, AssessmentItem, AssessmentTemplate, AssessmentTopic,
                         AttendanceWarning, AuditLog, Classroom, CourseGrade, Enrollment, GradedItem, Indicator, LearningStrand,
                         LessonPlanConstraint, PostTeachingLog, Room, RubricLevel, Score, Semester, Course, LearningUnit,
-                        LessonPlan, Setting, Standard, Student, StudentGroup, SubUnit, SubjectGroup, TimetableEntry, User,
+                        LessonPlan, Setting, Standard, Student, StudentGroup, SubUnit, SubjectGroup, TimetableEntry,
                         Subject, QualitativeScore, GroupScore, WeeklyScheduleSlot, Notification)
+from app.db_profile import retry_on_busy
+from app.materialized_timetables import OWNER_CLASSROOM, OWNER_TEACHER, cells_on_day, get_weekly_timetable
+from app.indicator_search import find_indicators
+from app.typeahead import (SOURCE_ACADEMIC_YEARS, SOURCE_INDICATORS, SOURCE_ROOMS, SOURCE_USERS, cached_lookup,
+                           get_index, normalize, parse_limit, search_source, typeahead_response)
 from app.teacher.forms import LearningUnitForm
 from app.teacher import bp
 from flask_wtf import FlaskForm
 # Ensure all necessary services are imported
 from app.services import (calculate_final_grades_for_course, check_and_create_attendance_warnings,
                           get_lesson_plan_export_data, get_pator05_data, resolve_active_attendance_warning,
-                          copy_lesson_plan, create_blank_lesson_plan) # Added copy_lesson_plan and create_blank_lesson_plan
+                          copy_lesson_plan, create_blank_lesson_plan, # deep copy ใช้ของ services (bulk insert)
+                          get_lesson_plan_export, get_lesson_plan_export_cover)
 import logging
 import docx
 import numpy as np
@@ -63,67 +69,14 @@ def dashboard():
 
     today_formatted = f"วัน{day_str}ที่ {today.day} {month_str} พ.ศ. {year_str}"
 
-    entries = TimetableEntry.query.join(
-        WeeklyScheduleSlot
-    ).join(
-        Course
-    ).filter(
-        WeeklyScheduleSlot.semester_id == semester.id,
-        WeeklyScheduleSlot.day_of_week == today_weekday,
-        Course.teachers.any(id=current_user.id)
-    ).options(
-        joinedload(TimetableEntry.slot),
-        joinedload(TimetableEntry.course).selectinload(Course.subject),
-        joinedload(TimetableEntry.course).selectinload(Course.classroom),
-        joinedload(TimetableEntry.course).selectinload(Course.room)
-    ).order_by(WeeklyScheduleSlot.period_number).all()
-    # Aliases for self-join
-    Slot1 = aliased(WeeklyScheduleSlot)
-    Slot2 = aliased(WeeklyScheduleSlot)
-    Entry1 = aliased(TimetableEntry)
-    Entry2 = aliased(TimetableEntry)
-
-    # Base query for today's entries
-    entries_query = db.session.query(
-        Entry1, 
-        Entry2.id # Get the ID of the next entry if it exists
-    ).join(
-        Slot1, Entry1.weekly_schedule_slot_id == Slot1.id
-    ).join(
-        Course, Entry1.course_id == Course.id
-    ).outerjoin( # Use outerjoin to find the potential next entry
-        Entry2, 
-        and_(
-            Entry1.course_id == Entry2.course_id, # Must be the same course
-            Entry2.weekly_schedule_slot_id == db.session.query(Slot2.id).filter(
-                Slot1.semester_id == Slot2.semester_id,
-                Slot1.day_of_week == Slot2.day_of_week,
-                Slot2.period_number == Slot1.period_number + 1, # Next period
-                Slot1.grade_level_id == Slot2.grade_level_id
-            ).scalar_subquery() # Find the slot ID for the next period
-        )
-    ).filter(
-        Slot1.semester_id == semester.id,
-        Slot1.day_of_week == today_weekday,
-        Course.teachers.any(id=current_user.id)
-    ).options(
-        # Eager load necessary data for Entry1
-        joinedload(Entry1.slot),
-        joinedload(Entry1.course).selectinload(Course.subject),
-        joinedload(Entry1.course).selectinload(Course.classroom),
-        joinedload(Entry1.course).selectinload(Course.room)
-    ).order_by(Slot1.period_number)
-
-    # Process results: Create a list of dictionaries
-    entries_with_next = []
-    for entry, next_id in entries_query.all():
-        entries_with_next.append({
-            'entry': entry,
-            'next_entry_id': next_id # Will be None if no consecutive entry
-        })
+    # [REVISED] อ่านจากตารางสอนที่คำนวณไว้แล้ว (มี next_entry_id ของคาบต่อเนื่องในตัว) แทน self-join
+    timetable = get_weekly_timetable(semester.id, OWNER_TEACHER, current_user.id)
+    entries_with_next = [
+        {'entry': cell, 'next_entry_id': cell['next_entry_id']}
+        for cell in cells_on_day(timetable, today_weekday)
+    ]
     return render_template('teacher/dashboard.html', 
                            title="ห้องเรียนวันนี้",
-                           entries=entries,
                            entries_with_next=entries_with_next,
                            today_formatted=today_formatted,
                            today=today)
@@ -564,39 +517,30 @@ def update_assessment_items(unit_id):
 def search_indicators():
     """
     API endpoint for TomSelect to search for indicators.
-    Results are now sorted by standard and indicator code.
+    Results come from app.indicator_search, best match first, with prefix matching.
     """
-    query_str = request.args.get('q', '', type=str)
+    query_str = request.args.get('q', '', type=str).strip()
     
     if not query_str or len(query_str) < 1:
         return jsonify([])
 
-    search_term = f"%{query_str}%"
-    
-    indicators = Indicator.query.join(Standard).filter(
-        Indicator.creator_type == 'ADMIN',
-        or_(
-            Indicator.code.ilike(search_term),
-            Indicator.description.ilike(search_term),
-            Standard.code.ilike(search_term)
-        )
-    # --- THIS IS THE FIX: Add sorting to the query ---
-    ).order_by(Standard.code, Indicator.code).limit(50).all()
-    # --- END OF FIX ---
+    # [REVISED] ใช้ search index (FTS5 / pg_trgm) แทน ILIKE '%q%' ทั้งตาราง เรียงตามความเกี่ยวข้อง
+    # ผลลัพธ์ของคำค้นเดิมถูก cache ไว้จนกว่าตัวชี้วัด/มาตรฐานจะเปลี่ยน
+    def run_search():
+        return [
+            {
+                "id": i.id,
+                "text": f"[{i.standard.code} {i.code}] {i.description}",
+                "indicator_code": i.code,
+                "indicator_desc": i.description,
+                "standard_id": i.standard.id,
+                "standard_code": i.standard.code,
+                "standard_desc": i.standard.description
+            }
+            for i in find_indicators(query_str)
+        ]
 
-    results = [
-        {
-            "id": i.id,
-            "text": f"[{i.standard.code} {i.code}] {i.description}",
-            "indicator_code": i.code,
-            "indicator_desc": i.description,
-            "standard_id": i.standard.id,
-            "standard_code": i.standard.code,
-            "standard_desc": i.standard.description
-        }
-        for i in indicators
-    ]
-    return jsonify(results)
+    return typeahead_response(cached_lookup(SOURCE_INDICATORS, normalize(query_str), run_search))
 
 @bp.route('/api/indicators/add-custom', methods=['POST'])
 @login_required
@@ -1265,21 +1209,23 @@ def save_score():
     except (ValueError, TypeError):
         return jsonify({'status': 'error', 'message': 'รูปแบบคะแนนไม่ถูกต้อง'}), 400
 
-    # Logic: Update if exists, Insert if not (Upsert)
-    score_obj = Score.query.filter_by(student_id=student_id, graded_item_id=item_id).first()
+    def write():
+        # Logic: Update if exists, Insert if not (Upsert)
+        score_obj = Score.query.filter_by(student_id=student_id, graded_item_id=item_id).first()
 
-    if score_obj:
-        score_obj.score = score_float
-    else:
-        score_obj = Score(
-            student_id=student_id,
-            graded_item_id=item_id,
-            score=score_float
-        )
-        db.session.add(score_obj)
+        if score_obj:
+            score_obj.score = score_float
+        else:
+            score_obj = Score(
+                student_id=student_id,
+                graded_item_id=item_id,
+                score=score_float
+            )
+            db.session.add(score_obj)
+        db.session.commit()
 
     try:
-        db.session.commit()
+        retry_on_busy(write) # ครูหลายคนบันทึกพร้อมกัน: ลองใหม่แทนการตอบ "database is locked"
         return jsonify({'status': 'success', 'message': 'บันทึกคะแนนเรียบร้อย'})
     except Exception as e:
         db.session.rollback()
@@ -1880,21 +1826,9 @@ def copy_plan_api(source_plan_id):
 @bp.route('/api/academic-years') # REMOVE '/teacher' prefix if moved to 'main' blueprint
 @login_required
 def get_academic_years():
-    """ API endpoint to get all academic years for selection. """
+    """ API endpoint to get all academic years for selection (served from app.typeahead). """
     try:
-        # Find the current academic year ID
-        current_semester = Semester.query.filter_by(is_current=True).first()
-        current_year_id = current_semester.academic_year_id if current_semester else None
-
-        years = AcademicYear.query.order_by(AcademicYear.year.desc()).all()
-
-        results = [{
-            'id': year.id,
-            'year': year.year,
-            'is_current': (year.id == current_year_id)
-        } for year in years]
-
-        return jsonify(results)
+        return typeahead_response(get_index(SOURCE_ACADEMIC_YEARS).items)
     except Exception as e:
         current_app.logger.error(f"Error fetching academic years: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -1907,11 +1841,16 @@ def get_academic_years():
 @login_required
 # Add role check if needed, e.g., @admin_required or @academic_required
 def get_users_simple_list():
-     """ API endpoint to get a simple list of users (ID and Full Name). """
+     """
+     API endpoint to get a simple list of users (ID and Full Name).
+     [REVISED] Served from app.typeahead; ``?q=`` filters by name/username
+     (capped by ``?limit=``), without it the full list is returned as before.
+     """
      try:
-          users = User.query.order_by(User.first_name, User.last_name).all()
-          results = [{'id': user.id, 'full_name': user.full_name} for user in users]
-          return jsonify(results)
+          query = request.args.get('q', '').strip()
+          users = search_source(SOURCE_USERS, query, parse_limit(request.args.get('limit'))) if query \
+               else get_index(SOURCE_USERS).items
+          return typeahead_response([{'id': u['id'], 'full_name': u['full_name']} for u in users])
      except Exception as e:
           current_app.logger.error(f"Error fetching simple user list: {e}")
           return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -2221,55 +2160,34 @@ def save_attendance_bulk():
 @bp.route('/api/search-rooms')
 @login_required
 def search_rooms():
-    """API for Tom-Select to search for rooms."""
-    
-    # --- DEBUGGING PRINT ---
-    print("\n--- DEBUG: search_rooms (FIXED VERSION) IS RUNNING ---") 
-    # --- END DEBUGGING ---
-
+    """
+    API for Tom-Select to search for rooms.
+    [REVISED] Rooms come from the in-memory typeahead index instead of an
+    ILIKE query per keystroke.
+    """
     query = request.args.get('q', '').strip()
     
     # ดึงข้อมูลห้องเรียนที่ถูกเลือกในปัจจุบันสำหรับแผนการสอนนี้ (เพื่อแสดงผลเริ่มต้น)
     plan_id = request.args.get('plan_id', type=int)
     current_room_id = None
-    
-    print(f"--- DEBUG: Searching for plan_id: {plan_id} ---") # DEBUG
-    
-    if plan_id:
-        course_with_room = Course.query.filter(
+    if plan_id and not query:
+        current_room_id = db.session.query(Course.room_id).filter(
             Course.lesson_plan_id == plan_id,
             Course.teachers.any(id=current_user.id),
             Course.room_id.isnot(None) # <-- เพิ่มเงื่อนไข: ต้องมี room_id
-        ).first()
-        
-        if course_with_room:
-            current_room_id = course_with_room.room_id
-            print(f"--- DEBUG: Found saved room_id: {current_room_id} ---") # DEBUG
-        else:
-            print("--- DEBUG: No course with a saved room_id was found. ---") # DEBUG
-
-    # สร้าง Query เริ่มต้น
-    room_query = Room.query
-    
-    # ถ้ามีคำค้นหา ให้กรองตามชื่อ
-    if query:
-        room_query = room_query.filter(Room.name.ilike(f'%{query}%'))
+        ).limit(1).scalar()
 
-    # จำกัดผลลัพธ์เพื่อประสิทธิภาพ
-    rooms = room_query.limit(20).all()
-    
-    # แปลงผลลัพธ์เป็น JSON ที่ Tom-Select เข้าใจ
-    results = [{'id': room.id, 'name': room.name, 'capacity': room.capacity} for room in rooms]
+    rooms_index = get_index(SOURCE_ROOMS)
+    # จำกัดผลลัพธ์เพื่อประสิทธิภาพ (ข้อมูลเป็น dict {'id', 'name', 'capacity'} ที่ Tom-Select เข้าใจ)
+    results = rooms_index.search(query, parse_limit(request.args.get('limit')))
     
     # ถ้ามีห้องที่ถูกเลือกไว้อยู่แล้ว แต่ไม่ติดมาในผลการค้นหา ให้เพิ่มเข้าไปด้วย
     if current_room_id and not any(r['id'] == current_room_id for r in results):
-        current_room = Room.query.get(current_room_id)
+        current_room = rooms_index.get('id', current_room_id)
         if current_room:
-            results.insert(0, {'id': current_room.id, 'name': current_room.name, 'capacity': current_room.capacity})
-            print(f"--- DEBUG: Manually added current_room {current_room_id} to results. ---") # DEBUG
+            results = [current_room] + results
 
-    print(f"--- DEBUG: Returning {len(results)} results. ---\n") # DEBUG
-    return jsonify(results)
+    return typeahead_response(results)
 
 @bp.route('/api/rooms/create', methods=['POST'])
 @login_required
@@ -3437,82 +3355,55 @@ def _get_google_creds(user):
         return None
 # --- [END NEW] ---
 #     
+def _can_export_lesson_plan(plan):
+    """
+    Teachers of the plan plus the reviewers in the approval chain
+    (department head of the subject group, academic office, director, admin).
+    """
+    if any(current_user in c.teachers for c in plan.courses):
+        return True
+    if current_user.has_role('Academic') or current_user.has_role('ผู้อำนวยการ') or current_user.has_role('Admin'):
+        return True
+    led_group = current_user.led_subject_group
+    return bool(led_group and plan.subject and plan.subject.subject_group_id == led_group.id)
+
 @bp.route('/plan/<int:plan_id>/export/pdf')
 @login_required
 def export_lesson_plan_pdf(plan_id):
     """
-    [REVISED v6 - Single Cover] Generates PDF with a single cover page
-    followed by one page per LearningUnit.
+    [REVISED v7 - Single Document & Cache] Renders the cover and every
+    LearningUnit as one WeasyPrint document. The result is cached per
+    (plan_id, revision, input digest) so repeated opens by reviewers skip rendering.
     """
     plan = db.session.query(LessonPlan).options(
         joinedload(LessonPlan.subject), # Need subject for cover
         joinedload(LessonPlan.academic_year), # Need year for cover
         selectinload(LessonPlan.courses).selectinload(Course.teachers) # Need teachers for cover
     ).get(plan_id)
-    if not plan or not any(current_user in c.teachers for c in plan.courses): abort(403)
-
-    # --- Fetch Cover Data ---
-    settings_keys = ['school_name', 'school_logo_path', 'school_affiliation', 'school_district', 'school_province']
-    settings_q = Setting.query.filter(Setting.key.in_(settings_keys)).all()
-    school_info_cover = {s.key: s.value for s in settings_q}
-    if school_info_cover.get('school_logo_path'):
-         school_info_cover['school_logo_url'] = url_for('static', filename=f"uploads/{school_info_cover['school_logo_path']}", _external=True)
-    else: school_info_cover['school_logo_url'] = None
-
-    teachers_cover = list(set(teacher for course in plan.courses for teacher in course.teachers)) # Get unique teachers
-    teacher_names_cover = ", ".join([t.full_name for t in teachers_cover]) or '-'
-
-    cover_data = {
-        'school_info': school_info_cover,
-        'plan_info': {
-            'subject_name': plan.subject.name,
-            'subject_code': plan.subject.subject_code,
-            'academic_year': plan.academic_year.year,
-            'teacher_names': teacher_names_cover
-        }
-    }
-    # --- End Fetch Cover Data ---
+    if not plan or not _can_export_lesson_plan(plan): abort(403)
 
-    # --- Fetch Unit Data ---
-    all_unit_render_data = get_lesson_plan_export_data(plan_id) # This now returns one dict per unit
-    if not all_unit_render_data:
-        flash('ไม่พบข้อมูลแผนการสอน หรือเกิดข้อผิดพลาด', 'danger')
-        return redirect(url_for('teacher.workspace', plan_id=plan_id))
+    def build_pdf():
+        if not all_unit_render_data:
+            return None
 
-    try:
-        all_rendered_pages = []
-        base_doc = None
+        # Cover + all units in ONE document: one layout pass, shared fonts/CSS
+        html_full = render_template('exports/lesson_plan/full_plan.html', cover=cover_data, units=all_unit_render_data)
+        return HTML(string=html_full).write_pdf()
 
-        # 1. Render Cover Page
-        html_cover = render_template('exports/lesson_plan/plan_cover.html', data=cover_data)
-        doc_cover = HTML(string=html_cover)
-        rendered_cover = doc_cover.render()
-        all_rendered_pages.extend(rendered_cover.pages)
-        if not base_doc and rendered_cover.pages: base_doc = rendered_cover
-
-        # 2. Render Unit Pages
-        for unit_data in all_unit_render_data:
-            html_string = render_template('exports/lesson_plan/learning_unit_plan.html', data=unit_data)
-            doc = HTML(string=html_string)
-            rendered_doc = doc.render()
-            all_rendered_pages.extend(rendered_doc.pages)
-            if not base_doc and rendered_doc.pages: base_doc = rendered_doc # Fallback
-
-        if not all_rendered_pages or not base_doc:
-             flash('ไม่สามารถสร้างหน้า PDF ได้ (ไม่มีเนื้อหา)', 'danger')
-             return redirect(url_for('teacher.workspace', plan_id=plan_id))
-
-        # Combine all pages
-        pdf_bytes = io.BytesIO()
-        base_doc.copy(all_rendered_pages).write_pdf(target=pdf_bytes)
-        pdf_bytes.seek(0)
+    try:
+        # ข้อมูลที่ใช้สร้างไฟล์ (ใช้เป็นส่วนหนึ่งของ cache key ด้วย)
+        cover_data = get_lesson_plan_export_cover(plan)
+        all_unit_render_data = get_lesson_plan_export_data(plan_id) # One dict per unit
+        pdf_data = get_lesson_plan_export(plan, 'pdf', build_pdf, inputs=[cover_data, all_unit_render_data])
+        if not pdf_data:
+            flash('ไม่พบข้อมูลแผนการสอน หรือเกิดข้อผิดพลาด', 'danger')
+            return redirect(url_for('teacher.workspace', plan_id=plan_id))
 
         # Create filename
         timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-        safe_subject_name = "".join(c if c.isalnum() else "_" for c in plan.subject.name)
         filename = f"FullLessonPlan_{plan.subject.subject_code}_{timestamp}.pdf"
 
-        return send_file(pdf_bytes, mimetype='application/pdf', as_attachment=True, download_name=filename)
+        return send_file(io.BytesIO(pdf_data), mimetype='application/pdf', as_attachment=True, download_name=filename)
 
     except Exception as e:
         current_app.logger.error(f"Error generating Full Lesson Plan PDF for plan {plan_id}: {e}", exc_info=True)
@@ -3524,32 +3415,27 @@ def export_lesson_plan_pdf(plan_id):
 @login_required
 def export_lesson_plan_docx(plan_id):
     """
-    [REVISED v7 - Single Cover & Merged Cells] Generates DOCX with cover page,
-    unit pages using multi-row table, merged activity cell, and sub-topics.
+    [REVISED v8 - Cached] Generates DOCX with cover page, unit pages using
+    multi-row table, merged activity cell, and sub-topics. The file is cached
+    per (plan_id, revision, input digest) like the PDF export.
     """
     plan = db.session.query(LessonPlan).options(
         joinedload(LessonPlan.subject),
         joinedload(LessonPlan.academic_year),
         selectinload(LessonPlan.courses).selectinload(Course.teachers)
     ).get(plan_id)
-    if not plan or not any(current_user in c.teachers for c in plan.courses): abort(403)
-
-    # --- Fetch Cover Data ---
-    settings_keys = ['school_name', 'school_logo_path', 'school_affiliation', 'school_district', 'school_province']
-    settings_q = Setting.query.filter(Setting.key.in_(settings_keys)).all()
-    school_info_cover = {s.key: s.value for s in settings_q}
-    # Logo handling for DOCX is complex, skipping for now, add placeholder
-    teachers_cover = list(set(teacher for course in plan.courses for teacher in course.teachers))
-    teacher_names_cover = ", ".join([t.full_name for t in teachers_cover]) or '-'
-    # --- End Fetch Cover Data ---
-
-    # --- Fetch Unit Data ---
-    all_unit_render_data = get_lesson_plan_export_data(plan_id)
-    if not all_unit_render_data:
-        flash('ไม่พบข้อมูลแผนการสอน หรือเกิดข้อผิดพลาด', 'danger')
-        return redirect(url_for('teacher.workspace', plan_id=plan_id))
+    if not plan or not _can_export_lesson_plan(plan): abort(403)
+
+    def build_docx():
+        # --- Cover Data ---
+        school_info_cover = cover_data['school_info']
+        # Logo handling for DOCX is complex, skipping for now, add placeholder
+        teacher_names_cover = cover_data['plan_info']['teacher_names']
+
+        # --- Unit Data ---
+        if not all_unit_render_data:
+            return None
 
-    try:
         document = Document()
         # --- Helper function ---
         def add_para(text, bold=False, size=10, indent_first=False, indent_left_pt=0, parent=document, align=None, style=None):
@@ -3678,15 +3564,23 @@ def export_lesson_plan_docx(plan_id):
             if i < len(all_unit_render_data) - 1:
                  document.add_page_break()
 
-
         # --- Save DOCX ---
-        docx_bytes = io.BytesIO(); document.save(docx_bytes); docx_bytes.seek(0)
+        docx_bytes = io.BytesIO(); document.save(docx_bytes)
+        return docx_bytes.getvalue()
+
+    try:
+        cover_data = get_lesson_plan_export_cover(plan)
+        all_unit_render_data = get_lesson_plan_export_data(plan_id)
+        docx_data = get_lesson_plan_export(plan, 'docx', build_docx, inputs=[cover_data, all_unit_render_data])
+        if not docx_data:
+            flash('ไม่พบข้อมูลแผนการสอน หรือเกิดข้อผิดพลาด', 'danger')
+            return redirect(url_for('teacher.workspace', plan_id=plan_id))
         # --- Create filename ---
         timestamp = datetime.now().strftime("%Y%m%d_%H%M")
         safe_subject_name = "".join(c if c.isalnum() else "_" for c in plan.subject.name)
         filename = f"FullLessonPlan_{plan.subject.subject_code}_{timestamp}.docx"
         # --- Send file ---
-        return send_file(docx_bytes, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', as_attachment=True, download_name=filename)
+        return send_file(io.BytesIO(docx_data), mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', as_attachment=True, download_name=filename)
 
     except Exception as e:
         current_app.logger.error(f"Error generating Full Lesson Plan DOCX for plan {plan_id}: {e}", exc_info=True)
@@ -3880,191 +3774,6 @@ def import_or_create_plan():
         # Use 400 Bad Request for logical errors during creation/import
         return jsonify({'status': 'error', 'message': error_message or 'ไม่สามารถสร้าง/นำเข้าแผนได้'}), 400
 
-def copy_lesson_plan(source_plan_id: int, target_academic_year_id: int, current_user_id: int):
-    """
-    Creates a copy of a lesson plan for a new academic year.
-
-    Args:
-        source_plan_id: ID of the LessonPlan to copy.
-        target_academic_year_id: ID of the AcademicYear for the new plan.
-        current_user_id: ID of the user performing the copy.
-
-    Returns:
-        Tuple (bool, Union[int, str]): (True, new_plan_id) on success,
-                                       (False, error_message) on failure.
-    """
-    try:
-        # 1. Fetch Source Plan with related data eagerly
-        source_plan = db.session.query(LessonPlan).options(
-            selectinload(LessonPlan.subject), # Load subject for error message
-            selectinload(LessonPlan.learning_units).options(
-                selectinload(LearningUnit.graded_items).selectinload(GradedItem.dimension), # Load dimension too
-                selectinload(LearningUnit.assessment_items).selectinload(AssessmentItem.topic), # Load topic
-                selectinload(LearningUnit.indicators).selectinload(Indicator.standard), # Standard indicators + standard
-                selectinload(LearningUnit.sub_units).options(
-                     selectinload(SubUnit.indicators).selectinload(Indicator.standard),
-                     selectinload(SubUnit.graded_items).selectinload(GradedItem.dimension),
-                     selectinload(SubUnit.assessment_items).selectinload(AssessmentItem.topic)
-                )
-            ),
-            selectinload(LessonPlan.custom_indicators).selectinload(Indicator.standard), # Custom indicators + standard
-            selectinload(LessonPlan.constraints)
-        ).get(source_plan_id)
-
-        if not source_plan:
-            return False, "ไม่พบแผนการสอนต้นทาง"
-
-        # 2. Check for Existing Target Plan
-        target_year = db.session.get(AcademicYear, target_academic_year_id) # Get target year object for message
-        if not target_year:
-             return False, "ไม่พบปีการศึกษาเป้าหมาย"
-
-        existing_target_plan = LessonPlan.query.filter_by(
-            subject_id=source_plan.subject_id,
-            academic_year_id=target_academic_year_id
-        ).first()
-        if existing_target_plan:
-            subject_name = source_plan.subject.name if source_plan.subject else f"ID {source_plan.subject_id}"
-            return False, f"มีแผนการสอนสำหรับวิชา {subject_name} ในปีการศึกษา {target_year.year} อยู่แล้ว"
-
-        # 3. Create New Plan Object
-        new_plan = LessonPlan(
-            subject_id=source_plan.subject_id,
-            academic_year_id=target_academic_year_id,
-            target_mid_ratio=source_plan.target_mid_ratio,
-            target_final_ratio=source_plan.target_final_ratio,
-            status='ฉบับร่าง', # Always start as draft
-            revision_notes=None, # Clear revision notes
-            manual_scheduling_notes=source_plan.manual_scheduling_notes # Keep manual notes
-        )
-        db.session.add(new_plan)
-        # Flush to get the new_plan.id needed for custom indicators
-        db.session.flush()
-
-        # --- Mappings to track old IDs to new objects ---
-        unit_map = {} # old_unit_id -> new_unit_object
-        graded_item_map = {} # old_graded_item_id -> new_graded_item_object
-        assessment_item_map = {} # old_assessment_item_id -> new_assessment_item_object
-
-        # 4. Deep Copy Learning Units and their contents
-        for source_unit in sorted(source_plan.learning_units, key=lambda u: u.sequence):
-            new_unit = LearningUnit(
-                lesson_plan=new_plan, # Associate with new plan
-                title=source_unit.title,
-                sequence=source_unit.sequence,
-                midterm_score=source_unit.midterm_score,
-                final_score=source_unit.final_score,
-                topic=source_unit.topic,
-                hours=source_unit.hours,
-                learning_objectives=source_unit.learning_objectives,
-                learning_content=source_unit.learning_content,
-                learning_activities=source_unit.learning_activities,
-                core_concepts=source_unit.core_concepts,
-                # activities=source_unit.activities, # Deprecated
-                media_sources=source_unit.media_sources
-                # DO NOT COPY reflections or PostTeachingLog
-            )
-            db.session.add(new_unit)
-            db.session.flush() # Get new_unit.id
-            unit_map[source_unit.id] = new_unit
-
-            # 4.1 Copy Standard Indicator relationships (link to existing ones)
-            # Filter out custom indicators before assigning
-            standard_indicators = [ind for ind in source_unit.indicators if ind.creator_type == 'ADMIN']
-            new_unit.indicators = standard_indicators
-
-            # 4.2 Deep Copy Graded Items
-            for source_item in source_unit.graded_items:
-                new_item = GradedItem(
-                    learning_unit=new_unit, # Associate with new unit
-                    name=source_item.name,
-                    max_score=source_item.max_score,
-                    indicator_type=source_item.indicator_type,
-                    assessment_type=source_item.assessment_type,
-                    assessment_dimension_id=source_item.assessment_dimension_id,
-                    is_group_assignment=source_item.is_group_assignment
-                )
-                db.session.add(new_item)
-                db.session.flush() # Get new_item.id
-                graded_item_map[source_item.id] = new_item
-
-            # 4.3 Deep Copy Assessment Items
-            for source_assess_item in source_unit.assessment_items:
-                new_assess_item = AssessmentItem(
-                    unit=new_unit, # Associate with new unit
-                    assessment_topic_id=source_assess_item.assessment_topic_id
-                )
-                db.session.add(new_assess_item)
-                db.session.flush() # Get new_assess_item.id
-                assessment_item_map[source_assess_item.id] = new_assess_item
-
-            # 4.4 Deep Copy SubUnits (if any)
-            for source_sub_unit in sorted(source_unit.sub_units, key=lambda su: su.hour_sequence):
-                 new_sub_unit = SubUnit(
-                      learning_unit=new_unit, # Associate with new unit
-                      title=source_sub_unit.title,
-                      hour_sequence=source_sub_unit.hour_sequence,
-                      activities=source_sub_unit.activities
-                 )
-                 db.session.add(new_sub_unit) # Add first to allow relationship assignment
-                 db.session.flush() # Get new_sub_unit ID
-
-                 # Copy relationships using the maps created
-                 sub_standard_indicators = [ind for ind in source_sub_unit.indicators if ind.creator_type == 'ADMIN']
-                 new_sub_unit.indicators = sub_standard_indicators # Link to existing standard ones
-                 new_sub_unit.graded_items = [graded_item_map[gi.id] for gi in source_sub_unit.graded_items if gi.id in graded_item_map]
-                 new_sub_unit.assessment_items = [assessment_item_map[ai.id] for ai in source_sub_unit.assessment_items if ai.id in assessment_item_map]
-                 # No need to add again, already added
-
-        # 5. Deep Copy Custom Indicators (if any) linked directly to the PLAN
-        # Also copy custom indicators linked to UNITS/SUBUNITS
-        all_source_custom_indicators = list(source_plan.custom_indicators) # Plan level
-        for su in source_plan.learning_units:
-             all_source_custom_indicators.extend([ind for ind in su.indicators if ind.creator_type == 'TEACHER']) # Unit level
-             for sub in su.sub_units:
-                  all_source_custom_indicators.extend([ind for ind in sub.indicators if ind.creator_type == 'TEACHER']) # SubUnit level
-
-        # Use a set to handle potential duplicates if an indicator is linked multiple times
-        unique_source_custom_indicators = {ind.id: ind for ind in all_source_custom_indicators}.values()
-
-        custom_indicator_map = {} # old_custom_id -> new_custom_object
-        for source_custom_ind in unique_source_custom_indicators:
-            # Check if this custom indicator was linked to a unit/subunit that was copied
-            # We need to decide where the *new* custom indicator should be linked.
-            # Simplest approach: Link all copied custom indicators ONLY to the new PLAN.
-            new_custom_ind = Indicator(
-                lesson_plan=new_plan, # Link to new plan ONLY
-                code=source_custom_ind.code,
-                description=source_custom_ind.description,
-                standard_id=source_custom_ind.standard_id, # Assume custom standard exists
-                creator_type='TEACHER',
-                creator_id=current_user_id # Assign to the user doing the copy
-            )
-            db.session.add(new_custom_ind)
-            db.session.flush()
-            custom_indicator_map[source_custom_ind.id] = new_custom_ind
-
-        # 6. Copy Constraints
-        for source_constraint in source_plan.constraints:
-            new_constraint = LessonPlanConstraint(
-                lesson_plan=new_plan, # Link to new plan
-                constraint_type=source_constraint.constraint_type,
-                value=source_constraint.value
-            )
-            db.session.add(new_constraint)
-
-        # 7. Commit all changes
-        db.session.commit()
-
-        # 8. Return success and the new plan ID
-        return True, new_plan.id
-
-    except Exception as e:
-        db.session.rollback()
-        # Use Flask's logger
-        current_app.logger.error(f"Error copying lesson plan {source_plan_id}: {e}", exc_info=True)
-        return False, f"เกิดข้อผิดพลาดในการคัดลอก: {str(e)}"
-
 @bp.route('/history')
 @login_required
 def teaching_history():
@@ -4174,18 +3883,12 @@ def mobile_entry(entry_id):
     if not semester.start_date:
         current_app.logger.warning(f"Course {course.id}: ไม่ได้ตั้งค่าวันเริ่มเทอม (Semester Start Date)")
     else:
-        all_entries_for_course = TimetableEntry.query.filter_by(
-            course_id=course.id
-        ).join(
-            WeeklyScheduleSlot, TimetableEntry.weekly_schedule_slot_id == WeeklyScheduleSlot.id
-        ).options(
-            contains_eager(TimetableEntry.slot)
-        ).all()
+        classroom_timetable = get_weekly_timetable(course.semester_id, OWNER_CLASSROOM, classroom.id)
         
         slots_by_day = defaultdict(list)
-        for entry_in_course in all_entries_for_course:
-            if entry_in_course.slot: 
-                slots_by_day[entry_in_course.slot.day_of_week].append(entry_in_course.slot.period_number)
+        for cell in classroom_timetable['cells']:
+            if cell['course_id'] == course.id:
+                slots_by_day[cell['day']].append(cell['period'])
         
         teaching_days_of_week = set(slots_by_day.keys())
         temp_hour_count = 0
@@ -4495,42 +4198,45 @@ def api_set_attendance_status():
         if current_user not in entry.course.teachers:
             return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
         
-        # --- ค้นหาหรือสร้าง Record ---
-        record = AttendanceRecord.query.filter_by(
-            student_id=student_id,
-            timetable_entry_id=entry_id,
-            attendance_date=attendance_date
-        ).first()
+        def write():
+            # --- ค้นหาหรือสร้าง Record ---
+            record = AttendanceRecord.query.filter_by(
+                student_id=student_id,
+                timetable_entry_id=entry_id,
+                attendance_date=attendance_date
+            ).first()
 
-        current_time = datetime.utcnow()
+            current_time = datetime.utcnow()
 
-        if record:
-            # Update existing record
-            if record.status != status:
-                record.status = status
-                record.recorded_at = current_time
-                record.recorder_id = current_user.id
+            if record:
+                # Update existing record
+                if record.status != status:
+                    record.status = status
+                    record.recorded_at = current_time
+                    record.recorder_id = current_user.id
+                    db.session.add(record)
+            else:
+                # Create new record
+                record = AttendanceRecord(
+                    student_id=student_id,
+                    timetable_entry_id=entry_id,
+                    status=status,
+                    recorder_id=current_user.id,
+                    attendance_date=attendance_date,
+                    recorded_at=current_time
+                )
                 db.session.add(record)
-        else:
-            # Create new record
-            record = AttendanceRecord(
-                student_id=student_id,
-                timetable_entry_id=entry_id,
-                status=status,
-                recorder_id=current_user.id,
-                attendance_date=attendance_date,
-                recorded_at=current_time
-            )
-            db.session.add(record)
 
-        # --- ตรวจสอบการแจ้งเตือน (เรียก Service) ---
-        if status in ['ABSENT', 'LATE', 'TARDY']:
-             # เราต้องส่ง object ของ record ไป (ต้อง commit ก่อนเพื่อให้มี id หรือ flush)
-             # หรือส่ง object ที่เพิ่งสร้าง/อัปเดตไป
-             db.session.flush() # Flush เพื่อให้ record มี state
-             check_and_create_attendance_warnings(record)
+            # --- ตรวจสอบการแจ้งเตือน (เรียก Service) ---
+            if status in ['ABSENT', 'LATE', 'TARDY']:
+                 # เราต้องส่ง object ของ record ไป (ต้อง commit ก่อนเพื่อให้มี id หรือ flush)
+                 # หรือส่ง object ที่เพิ่งสร้าง/อัปเดตไป
+                 db.session.flush() # Flush เพื่อให้ record มี state
+                 check_and_create_attendance_warnings(record)
 
-        db.session.commit()
+            db.session.commit()
+
+        retry_on_busy(write)
         return jsonify({'status': 'success', 'message': 'Attendance updated'})
 
     except Exception as e:
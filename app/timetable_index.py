@@ -0,0 +1,316 @@
+# FILE: app/timetable_index.py
+"""
+Per-semester conflict index for manual timetable edits.
+
+Occupancy of every teacher, classroom, room and grade-level slot row is kept
+as an int bitmask over (day, period) (same layout as app/timetable_solver.py),
+so a conflict check is a handful of AND operations instead of three JOIN
+queries per drop.
+
+Indexes are built once per semester and cached in the process. Each one is
+tagged with Semester.timetable_version; a request only reads that single
+integer to know whether the cached index is still current. Writes made
+through the index's own routes advance the cached copy in memory
+(copy-on-write) instead of forcing a rebuild.
+
+The JSON payload of the manage_timetable page is cached the same way (one
+serialized body per semester version) and served with an ETag.
+"""
+import json
+import threading
+from collections import defaultdict
+
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db
+from app.models import (Classroom, Course, LessonPlan, Semester, TimetableEntry, WeeklyScheduleSlot,
+                        course_teachers)
+from app.timetable_solver import slot_bit
+
+_cache = {}
+_payload_cache = {} # semester_id -> (version, serialized JSON bytes)
+_cache_lock = threading.Lock()
+
+
+class ConflictIndex:
+    """Immutable snapshot of a semester's timetable occupancy."""
+
+    def __init__(self, semester_id, version):
+        self.semester_id = semester_id
+        self.version = version
+        self.busy = defaultdict(int) # ('t'|'c'|'r'|'g', id) -> bitmask
+        self.slots = {} # slot_id -> (grade_level_id, day, period, is_teaching, activity_name)
+        self.slot_ids = {} # (grade_level_id, day, period) -> slot_id
+        self.courses = {} # course_id -> (teacher_ids, classroom_id, room_id, grade_level_id)
+        self.entries = {} # entry_id -> (course_id, slot_id)
+        self.entry_by_slot = {} # slot_id -> entry_id
+
+    @classmethod
+    def build(cls, semester_id, version):
+        index = cls(semester_id, version)
+        for slot_id, grade_level_id, day, period, is_teaching, activity in db.session.query(
+            WeeklyScheduleSlot.id, WeeklyScheduleSlot.grade_level_id, WeeklyScheduleSlot.day_of_week,
+            WeeklyScheduleSlot.period_number, WeeklyScheduleSlot.is_teaching_period, WeeklyScheduleSlot.activity_name
+        ).filter(WeeklyScheduleSlot.semester_id == semester_id):
+            index.slots[slot_id] = (grade_level_id, day, period, is_teaching, activity)
+            index.slot_ids[(grade_level_id, day, period)] = slot_id
+
+        teachers = defaultdict(list)
+        for course_id, user_id in db.session.query(course_teachers.c.course_id, course_teachers.c.user_id).join(
+            Course, Course.id == course_teachers.c.course_id
+        ).filter(Course.semester_id == semester_id):
+            teachers[course_id].append(user_id)
+        for course_id, classroom_id, room_id, grade_level_id in db.session.query(
+            Course.id, Course.classroom_id, Course.room_id, Classroom.grade_level_id
+        ).join(Classroom, Classroom.id == Course.classroom_id).filter(Course.semester_id == semester_id):
+            index.courses[course_id] = (tuple(sorted(teachers[course_id])), classroom_id, room_id, grade_level_id)
+
+        for entry_id, course_id, slot_id in db.session.query(
+            TimetableEntry.id, TimetableEntry.course_id, TimetableEntry.weekly_schedule_slot_id
+        ).join(WeeklyScheduleSlot).filter(WeeklyScheduleSlot.semester_id == semester_id):
+            index._occupy(entry_id, course_id, slot_id)
+        return index
+
+    def _keys(self, course_id, slot_id):
+        keys = [('g', self.slots[slot_id][0])]
+        course = self.courses.get(course_id)
+        if course:
+            keys.extend(('t', tid) for tid in course[0])
+            keys.append(('c', course[1]))
+            if course[2]:
+                keys.append(('r', course[2]))
+        return keys
+
+    def _mask(self, slot_id):
+        _, day, period, _, _ = self.slots[slot_id]
+        return slot_bit(day, period)
+
+    def _occupy(self, entry_id, course_id, slot_id):
+        if slot_id not in self.slots:
+            return
+        mask = self._mask(slot_id)
+        for key in self._keys(course_id, slot_id):
+            self.busy[key] |= mask
+        self.entries[entry_id] = (course_id, slot_id)
+        self.entry_by_slot[slot_id] = entry_id
+
+    def _release(self, entry_id):
+        course_id, slot_id = self.entries.pop(entry_id)
+        mask = self._mask(slot_id)
+        for key in self._keys(course_id, slot_id):
+            self.busy[key] &= ~mask
+        if self.entry_by_slot.get(slot_id) == entry_id:
+            del self.entry_by_slot[slot_id]
+
+    def copy(self, version=None):
+        clone = ConflictIndex(self.semester_id, self.version if version is None else version)
+        clone.busy = defaultdict(int, self.busy)
+        clone.slots = self.slots
+        clone.slot_ids = self.slot_ids
+        clone.courses = self.courses
+        clone.entries = dict(self.entries)
+        clone.entry_by_slot = dict(self.entry_by_slot)
+        return clone
+
+    # --- queries ---
+
+    def slot_for_course(self, course_id, day, period):
+        """The slot row of the course's grade level at (day, period), or None."""
+        course = self.courses.get(course_id)
+        return self.slot_ids.get((course[3], day, period)) if course else None
+
+    def conflicts(self, course_id, slot_id, ignore_entry_ids=()):
+        """
+        Returns the conflicts of placing ``course_id`` in ``slot_id`` as a list
+        of (kind, id) tuples: ('activity', slot_id), ('slot', entry_id),
+        ('classroom', classroom_id), ('teacher', user_id), ('room', room_id).
+        """
+        grade_level_id, _, _, is_teaching, _ = self.slots[slot_id]
+        if not is_teaching:
+            return [('activity', slot_id)]
+        ignored = [self.entries[eid] for eid in ignore_entry_ids if eid in self.entries]
+        mask = self._mask(slot_id)
+        course = self.courses.get(course_id)
+
+        def taken(key):
+            busy = self.busy[key]
+            for other_course_id, other_slot_id in ignored:
+                if key in self._keys(other_course_id, other_slot_id):
+                    busy &= ~self._mask(other_slot_id)
+            return busy & mask
+
+        found = []
+        occupant = self.entry_by_slot.get(slot_id)
+        if occupant is not None and occupant not in ignore_entry_ids:
+            found.append(('slot', occupant))
+        if course:
+            if taken(('c', course[1])):
+                found.append(('classroom', course[1]))
+            found.extend(('teacher', tid) for tid in course[0] if taken(('t', tid)))
+            if course[2] and taken(('r', course[2])):
+                found.append(('room', course[2]))
+        return found
+
+    def validate_moves(self, moves):
+        """
+        Checks a batch of moves together: every moved entry is lifted first, then
+        the moves are placed one by one, so swaps inside the batch validate.
+
+        Args:
+            moves (list[tuple[int, int]]): (entry_id, new_slot_id) pairs.
+
+        Returns:
+            tuple[ConflictIndex, dict]: The index with the moves applied, and
+                {entry_id: [conflicts]} for the moves that failed (empty if all pass).
+        """
+        trial = self.copy()
+        errors = {}
+        for entry_id, _ in moves:
+            if entry_id in trial.entries:
+                trial._release(entry_id)
+        for entry_id, new_slot_id in moves:
+            course_id = self.entries[entry_id][0] if entry_id in self.entries else None
+            if course_id is None:
+                errors[entry_id] = [('entry', entry_id)]
+                continue
+            if new_slot_id not in self.slots:
+                errors[entry_id] = [('missing_slot', new_slot_id)]
+                continue
+            found = trial.conflicts(course_id, new_slot_id)
+            if found:
+                errors[entry_id] = found
+                continue
+            trial._occupy(entry_id, course_id, new_slot_id)
+        return trial, errors
+
+    def place(self, entry_id, course_id, slot_id):
+        """Marks ``course_id`` as taught in ``slot_id`` on this index (for callers that check a batch of new entries)."""
+        self._occupy(entry_id, course_id, slot_id)
+
+    def with_changes(self, version, removed=(), placed=()):
+        """Copy advanced to ``version`` with entries removed and (entry_id, course_id, slot_id) placed."""
+        clone = self.copy(version)
+        for entry_id in removed:
+            if entry_id in clone.entries:
+                clone._release(entry_id)
+        for entry_id, course_id, slot_id in placed:
+            if entry_id in clone.entries:
+                clone._release(entry_id)
+            clone._occupy(entry_id, course_id, slot_id)
+        return clone
+
+
+def _current_version(semester_id):
+    return db.session.query(Semester.timetable_version).filter(Semester.id == semester_id).scalar()
+
+
+def get_conflict_index(semester_id):
+    """Returns the cached conflict index of a semester, rebuilding it if the timetable changed."""
+    version = _current_version(semester_id)
+    if version is None:
+        return None
+    with _cache_lock:
+        index = _cache.get(semester_id)
+    if index is not None and index.version == version:
+        return index
+    index = ConflictIndex.build(semester_id, version)
+    with _cache_lock:
+        _cache[semester_id] = index
+    return index
+
+
+def advance_conflict_index(index, removed=(), placed=()):
+    """
+    Call after committing a change made against ``index``. If nobody else wrote
+    to the semester meanwhile (version moved by exactly one), the cached index
+    is updated in memory; otherwise it is dropped and rebuilt on next use.
+    """
+    version = _current_version(index.semester_id)
+    with _cache_lock:
+        if version == index.version + 1 and _cache.get(index.semester_id) is index:
+            _cache[index.semester_id] = index.with_changes(version, removed=removed, placed=placed)
+        else:
+            _cache.pop(index.semester_id, None)
+
+
+def invalidate_conflict_index(semester_id):
+    with _cache_lock:
+        _cache.pop(semester_id, None)
+        _payload_cache.pop(semester_id, None)
+
+
+def _build_timetable_payload(semester_id, version):
+    courses = Course.query.filter_by(semester_id=semester_id).options(
+        joinedload(Course.subject),
+        joinedload(Course.classroom),
+        selectinload(Course.teachers),
+        joinedload(Course.room),
+        joinedload(Course.lesson_plan).selectinload(LessonPlan.constraints)
+    ).all()
+
+    courses_data, classrooms, teachers, rooms = {}, {}, {}, {}
+    for c in courses:
+        constraints, manual_notes = {}, None
+        if c.lesson_plan:
+            constraints = {const.constraint_type: const.value for const in c.lesson_plan.constraints}
+            manual_notes = c.lesson_plan.manual_scheduling_notes
+        courses_data[c.id] = {
+            'id': c.id,
+            'subject_name': f"{c.subject.subject_code} - {c.subject.name}",
+            'classroom_id': c.classroom_id,
+            'classroom_name': c.classroom.name,
+            'teacher_ids': [t.id for t in c.teachers],
+            'teachers_name': [t.full_name for t in c.teachers],
+            'room_id': c.room_id,
+            'room_name': c.room.name if c.room else 'N/A',
+            'periods_needed': int((c.subject.credit or 0) * 2),
+            'constraints': constraints,
+            'manual_notes': manual_notes,
+        }
+        classrooms[c.classroom_id] = {'id': c.classroom_id, 'name': c.classroom.name,
+                                      'grade_level_id': c.classroom.grade_level_id}
+        for t in c.teachers:
+            teachers[t.id] = (t.first_name or '', {'id': t.id, 'name': t.full_name})
+        if c.room:
+            rooms[c.room_id] = {'id': c.room_id, 'name': c.room.name}
+
+    slots = db.session.query(
+        WeeklyScheduleSlot.id, WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number,
+        WeeklyScheduleSlot.is_teaching_period, WeeklyScheduleSlot.activity_name, WeeklyScheduleSlot.grade_level_id
+    ).filter(WeeklyScheduleSlot.semester_id == semester_id).all()
+    entries = db.session.query(
+        TimetableEntry.id, TimetableEntry.course_id, WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number
+    ).join(WeeklyScheduleSlot).filter(WeeklyScheduleSlot.semester_id == semester_id).all()
+
+    payload = {
+        'semester_id': semester_id,
+        'version': version,
+        'classrooms': sorted(classrooms.values(), key=lambda c: c['name']),
+        'teachers': [t for _, t in sorted(teachers.values(), key=lambda t: t[0])],
+        'rooms': sorted(rooms.values(), key=lambda r: r['name']),
+        'courses': courses_data,
+        'entries': [{'id': eid, 'course_id': cid, 'day': day, 'period': period} for eid, cid, day, period in entries],
+        'slots': [{'id': sid, 'day': day, 'period': period, 'is_teaching': is_teaching, 'activity': activity,
+                   'grade_level_id': grade_level_id}
+                  for sid, day, period, is_teaching, activity, grade_level_id in slots],
+    }
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def get_timetable_payload(semester_id):
+    """
+    Returns (version, body) for the manage_timetable data API, or None if the
+    semester does not exist. The body is rebuilt only when the semester's
+    timetable version changes.
+    """
+    version = _current_version(semester_id)
+    if version is None:
+        return None
+    with _cache_lock:
+        cached = _payload_cache.get(semester_id)
+    if cached is not None and cached[0] == version:
+        return cached
+    cached = (version, _build_timetable_payload(semester_id, version))
+    with _cache_lock:
+        _payload_cache[semester_id] = cached
+    return cached
@@ -0,0 +1,627 @@
+# FILE: app/timetable_solver.py
+"""
+Constraint solver behind academic.auto_schedule_timetable.
+
+The search runs on a plain snapshot of the semester (dicts and tuples, no ORM
+objects), so it can run in the request, in a background job or in a worker
+process:
+
+* occupancy of every teacher, classroom, room and grade-level slot row is an
+  int bitmask over (day, period), so a conflict check is a single AND;
+* a course is split into lessons (single periods, or consecutive pairs for
+  the 'consecutive' arrangement) and the most constrained lesson (smallest
+  remaining domain) is placed first;
+* every placement forward-checks the lessons that share a resource, values
+  that would wipe out another lesson's domain are tried last, and the
+  search backtracks until it is exhausted or the node/time budget runs out;
+* the best solution seen wins: fewest unplaced periods, then the lowest
+  soft-constraint score (time preference, same-day repeats, split pairs).
+
+Given the same snapshot, seed and node limit the result is deterministic.
+solve_multistart runs several seeds in a process pool and keeps the best.
+"""
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db
+from app.models import Course, LessonPlan, TimetableEntry, User, WeeklyScheduleSlot, bump_timetable_version
+
+MAX_PERIODS_PER_DAY = 32
+MORNING_LAST_PERIOD = 5 # คาบ 1-5 = ช่วงเช้า, คาบ 6 ขึ้นไป = ช่วงบ่าย (เกณฑ์เดียวกับตัวจัดตารางเดิม)
+DEFAULT_TIME_BUDGET = 10.0 # วินาที
+DEFAULT_NODE_LIMIT = 50000
+DEFAULT_STARTS = 8 # จำนวนรอบค้นหาอิสระในโหมด multi-start
+MAX_SEARCH_PROCESSES = max(1, min(4, (os.cpu_count() or 1) - 1)) # เหลือ 1 core ไว้ให้เว็บ
+
+# คะแนนโทษของเงื่อนไขแบบ soft
+PENALTY_TIME_PREFERENCE = 1 # ต่อคาบที่อยู่นอกช่วงเช้า/บ่ายที่ขอไว้
+PENALTY_SAME_DAY = 1 # วิชาเดียวกันสอนหลายครั้งในวันเดียว
+PENALTY_BROKEN_PAIR = 2 # คาบคู่ที่ต้องแยกเป็นคาบเดี่ยว
+
+_SKIP = object()
+
+
+def slot_bit(day, period):
+    return 1 << (day * MAX_PERIODS_PER_DAY + period)
+
+
+def _preference_penalty(time_preference, period):
+    if time_preference == 'morning' and period > MORNING_LAST_PERIOD:
+        return PENALTY_TIME_PREFERENCE
+    if time_preference == 'afternoon' and period <= MORNING_LAST_PERIOD:
+        return PENALTY_TIME_PREFERENCE
+    return 0
+
+
+class _Option:
+    __slots__ = ('mask', 'slot_ids', 'day', 'periods', 'base_penalty')
+
+    def __init__(self, mask, slot_ids, day, periods, base_penalty):
+        self.mask = mask
+        self.slot_ids = slot_ids
+        self.day = day
+        self.periods = periods
+        self.base_penalty = base_penalty
+
+
+class _Lesson:
+    __slots__ = ('index', 'course', 'size', 'keys', 'options', 'domain', 'tiebreak')
+
+    def __init__(self, index, course, size, keys, options, tiebreak):
+        self.index = index
+        self.course = course
+        self.size = size
+        self.keys = keys
+        self.options = options
+        self.domain = len(options)
+        self.tiebreak = tiebreak
+
+
+class _Frame:
+    __slots__ = ('lesson', 'options', 'cursor', 'deferred', 'phase', 'choice', 'penalty', 'skipped')
+
+    def __init__(self, lesson, options):
+        self.lesson = lesson
+        self.options = options
+        self.cursor = 0
+        self.deferred = []
+        self.phase = 0
+        self.choice = None
+        self.penalty = 0
+        self.skipped = False
+
+
+class TimetableSolver:
+    """
+    Backtracking solver with bitset occupancy and forward checking.
+
+    Args:
+        snapshot (dict): Output of build_timetable_snapshot.
+        seed (int | None): Seed for tie-breaking; None picks a random seed.
+        time_budget (float): Wall-clock limit in seconds.
+        node_limit (int | None): Maximum placements tried. With a seed this
+            makes the run reproducible regardless of machine speed.
+    """
+
+    def __init__(self, snapshot, seed=0, time_budget=DEFAULT_TIME_BUDGET, node_limit=DEFAULT_NODE_LIMIT):
+        self.seed = seed if seed is not None else random.randrange(1 << 30)
+        self.rng = random.Random(self.seed)
+        self.time_budget = time_budget
+        self.node_limit = node_limit
+        self.courses = {c['id']: c for c in snapshot['courses']}
+        self.slots = {s[0]: s for s in snapshot['slots']}
+
+        # --- occupancy ที่มีอยู่แล้ว (คาบที่ถูกจัดไว้ก่อนหน้า) ---
+        self.fixed_busy = defaultdict(int)
+        self.fixed_days = defaultdict(Counter)
+        scheduled = Counter()
+        for course_id, slot_id in snapshot['entries']:
+            slot = self.slots.get(slot_id)
+            if not slot:
+                continue
+            bit = slot_bit(slot[2], slot[3])
+            self.fixed_busy[('g', slot[1])] |= bit
+            course = self.courses.get(course_id)
+            if course:
+                for key in self._course_keys(course):
+                    self.fixed_busy[key] |= bit
+                self.fixed_days[course_id][slot[2]] += 1
+            scheduled[course_id] += 1
+
+        free_slots_by_grade = defaultdict(dict)
+        for slot_id, grade_level_id, day, period, is_teaching in snapshot['slots']:
+            if is_teaching and not self.fixed_busy[('g', grade_level_id)] & slot_bit(day, period):
+                free_slots_by_grade[grade_level_id][(day, period)] = slot_id
+        self.free_slots_by_grade = free_slots_by_grade
+
+        # --- แตกแต่ละวิชาเป็นบทเรียน (คาบเดี่ยว / คาบคู่) ---
+        self.required = {}
+        self.lessons = []
+        for course_id in snapshot['target_course_ids']:
+            course = self.courses.get(course_id)
+            if not course:
+                continue
+            remaining = course['periods_needed'] - scheduled[course_id]
+            if remaining <= 0:
+                continue
+            self.required[course_id] = remaining
+            if course['arrangement'] == 'consecutive' and remaining > 1:
+                sizes = [2] * (remaining // 2) + [1] * (remaining % 2)
+            else:
+                sizes = [1] * remaining
+            for size in sizes:
+                self.lessons.append(self._make_lesson(course, size))
+
+        self.lessons_by_key = defaultdict(list)
+        for lesson in self.lessons:
+            for key in lesson.keys:
+                self.lessons_by_key[key].append(lesson.index)
+
+    @staticmethod
+    def _course_keys(course):
+        keys = [('t', tid) for tid in course['teacher_ids']]
+        keys.append(('c', course['classroom_id']))
+        if course['room_id']:
+            keys.append(('r', course['room_id']))
+        return keys
+
+    def _options_for(self, course, size):
+        grade_slots = self.free_slots_by_grade.get(course['grade_level_id'], {})
+        preference = course['time_preference']
+        options = []
+        for (day, period), slot_id in sorted(grade_slots.items()):
+            if size == 1:
+                options.append(_Option(slot_bit(day, period), (slot_id,), day, (period,),
+                                       _preference_penalty(preference, period)))
+            elif (day, period + 1) in grade_slots:
+                options.append(_Option(slot_bit(day, period) | slot_bit(day, period + 1),
+                                       (slot_id, grade_slots[(day, period + 1)]), day, (period, period + 1),
+                                       _preference_penalty(preference, period) + _preference_penalty(preference, period + 1)))
+        return options
+
+    def _make_lesson(self, course, size):
+        keys = tuple(self._course_keys(course) + [('g', course['grade_level_id'])])
+        return _Lesson(len(self.lessons), course, size, keys, self._options_for(course, size), self.rng.random())
+
+    # --- state helpers ---
+
+    def _reset_state(self):
+        self.busy = defaultdict(int, self.fixed_busy)
+        self.course_days = defaultdict(Counter, {k: Counter(v) for k, v in self.fixed_days.items()})
+        self.placement = {}
+        self.unplaced = 0
+        self.penalty = 0
+
+    def _blocked(self, lesson):
+        mask = 0
+        for key in lesson.keys:
+            mask |= self.busy[key]
+        return mask
+
+    def _domain_size(self, lesson):
+        blocked = self._blocked(lesson)
+        return sum(1 for opt in lesson.options if not opt.mask & blocked)
+
+    def _penalty_for(self, lesson, opt):
+        penalty = opt.base_penalty
+        if self.course_days[lesson.course['id']][opt.day]:
+            penalty += PENALTY_SAME_DAY
+        return penalty
+
+    def _apply(self, lesson, opt):
+        for key in lesson.keys:
+            self.busy[key] |= opt.mask
+        self.course_days[lesson.course['id']][opt.day] += 1
+        self.placement[lesson.index] = opt
+
+    def _remove(self, lesson, opt):
+        for key in lesson.keys:
+            self.busy[key] &= ~opt.mask
+        self.course_days[lesson.course['id']][opt.day] -= 1
+        del self.placement[lesson.index]
+
+    def _refresh_neighbours(self, lesson, unassigned):
+        """Recomputes the domains of unassigned lessons sharing a resource; returns periods lost to wipe-outs."""
+        seen, lost = set(), 0
+        for key in lesson.keys:
+            for idx in self.lessons_by_key[key]:
+                if idx in seen or idx not in unassigned:
+                    continue
+                seen.add(idx)
+                other = self.lessons[idx]
+                other.domain = self._domain_size(other)
+                if other.domain == 0:
+                    lost += other.size
+        return lost
+
+    # --- search ---
+
+    def _out_of_budget(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            return True
+        return time.perf_counter() - self.started > self.time_budget
+
+    def _bound_exceeded(self, extra):
+        return self.best is not None and self.unplaced + extra > self.best['unplaced']
+
+    def _select(self, unassigned):
+        lessons = self.lessons
+        return min((lessons[i] for i in unassigned),
+                   key=lambda l: (l.domain, -l.size, -len(l.keys), l.tiebreak))
+
+    def _ordered_options(self, lesson):
+        blocked = self._blocked(lesson)
+        free = [opt for opt in lesson.options if not opt.mask & blocked]
+        keyed = [(self._penalty_for(lesson, opt), self.rng.random(), i) for i, opt in enumerate(free)]
+        keyed.sort()
+        return [free[i] for _, _, i in keyed]
+
+    def _undo(self, frame, unassigned):
+        if frame.choice is _SKIP:
+            self.unplaced -= frame.lesson.size
+        elif frame.choice is not None:
+            self._remove(frame.lesson, frame.choice)
+            self.penalty -= frame.penalty
+            self._refresh_neighbours(frame.lesson, unassigned)
+        frame.choice = None
+        frame.penalty = 0
+
+    def _advance(self, frame, unassigned):
+        """Moves a frame to its next value; returns False when the frame is exhausted."""
+        self._undo(frame, unassigned)
+        lesson = frame.lesson
+        while True:
+            if frame.phase == 0 and frame.cursor >= len(frame.options):
+                frame.phase, frame.options, frame.cursor = 1, frame.deferred, 0
+            if frame.cursor >= len(frame.options):
+                break
+            opt = frame.options[frame.cursor]
+            frame.cursor += 1
+            penalty = self._penalty_for(lesson, opt)
+            self._apply(lesson, opt)
+            self.nodes += 1
+            lost = self._refresh_neighbours(lesson, unassigned)
+            if self._bound_exceeded(lost) or (lost and frame.phase == 0):
+                self._remove(lesson, opt)
+                self._refresh_neighbours(lesson, unassigned)
+                if not self._bound_exceeded(lost):
+                    frame.deferred.append(opt)
+                continue
+            frame.choice, frame.penalty = opt, penalty
+            self.penalty += penalty
+            return True
+
+        if not frame.skipped and not self._bound_exceeded(lesson.size):
+            frame.skipped = True
+            frame.choice = _SKIP
+            self.unplaced += lesson.size
+            return True
+        return False
+
+    def _backtrack(self, frames, unassigned):
+        while frames:
+            frame = frames[-1]
+            if self._advance(frame, unassigned):
+                return True
+            frames.pop()
+            unassigned.add(frame.lesson.index)
+            self.backtracks += 1
+            if self._out_of_budget():
+                return False
+        return False
+
+    def _record_best(self):
+        score = (self.unplaced, self.penalty)
+        if self.best is None or score < (self.best['unplaced'], self.best['penalty']):
+            self.best = {'unplaced': self.unplaced, 'penalty': self.penalty, 'placement': dict(self.placement)}
+
+    def _search(self):
+        self._reset_state()
+        unassigned = set(range(len(self.lessons)))
+        for lesson in self.lessons:
+            lesson.domain = self._domain_size(lesson)
+        frames = []
+        self.exhausted = False
+        while True:
+            if not unassigned:
+                self._record_best()
+                if self.unplaced == 0 and self.penalty == 0:
+                    break
+                if self._out_of_budget() or not self._backtrack(frames, unassigned):
+                    self.exhausted = not frames
+                    break
+                continue
+            if self._out_of_budget():
+                break
+            lesson = self._select(unassigned)
+            unassigned.discard(lesson.index)
+            frame = _Frame(lesson, self._ordered_options(lesson))
+            frames.append(frame)
+            if not self._advance(frame, unassigned):
+                frames.pop()
+                unassigned.add(lesson.index)
+                if not self._backtrack(frames, unassigned):
+                    self.exhausted = not frames
+                    break
+
+    def _repair_pairs(self, placement):
+        """Places unplaced consecutive pairs as two single periods (soft violation)."""
+        self._reset_state()
+        for idx, opt in placement.items():
+            self._apply(self.lessons[idx], opt)
+        broken = []
+        for lesson in self.lessons:
+            if lesson.index in placement or lesson.size != 2:
+                continue
+            singles = self._options_for(lesson.course, 1)
+            chosen = []
+            for _ in range(2):
+                blocked = self._blocked(lesson)
+                free = [opt for opt in singles if not opt.mask & blocked and opt not in chosen]
+                if not free:
+                    break
+                opt = min(free, key=lambda o: (self._penalty_for(lesson, o), o.day, o.periods))
+                chosen.append(opt)
+                for key in lesson.keys:
+                    self.busy[key] |= opt.mask
+                self.course_days[lesson.course['id']][opt.day] += 1
+            if len(chosen) == 2:
+                broken.append((lesson, chosen))
+            else:
+                for opt in chosen:
+                    for key in lesson.keys:
+                        self.busy[key] &= ~opt.mask
+                    self.course_days[lesson.course['id']][opt.day] -= 1
+        return broken
+
+    def solve(self):
+        """
+        Runs the search and returns the best solution found.
+
+        Returns:
+            dict: {'assignments': {course_id: [slot_id, ...]},
+                   'unscheduled_courses': [{'course_id', 'subject_name', 'missing', 'reason'}],
+                   'metrics': {...}}
+        """
+        self.started = time.perf_counter()
+        self.nodes = self.backtracks = 0
+        self.best = None
+        self.exhausted = True
+        if self.lessons:
+            self._search()
+        placement = self.best['placement'] if self.best else {}
+        broken = self._repair_pairs(placement) if self.lessons else []
+
+        assignments = defaultdict(list)
+        placed = Counter()
+        days = defaultdict(Counter, {k: Counter(v) for k, v in self.fixed_days.items()})
+        violations = Counter()
+        placed_units = [(self.lessons[idx], [opt]) for idx, opt in placement.items()] + broken
+        for lesson, opts in placed_units:
+            course_id = lesson.course['id']
+            for opt in opts:
+                assignments[course_id].extend(opt.slot_ids)
+                placed[course_id] += len(opt.slot_ids)
+                for period in opt.periods:
+                    if _preference_penalty(lesson.course['time_preference'], period):
+                        violations['time_preference'] += 1
+                days[course_id][opt.day] += 1
+        violations['broken_pair'] = len(broken)
+        for course_id in assignments:
+            violations['same_day'] += sum(n - 1 for n in days[course_id].values() if n > 1)
+
+        unscheduled = []
+        for course_id, required in self.required.items():
+            missing = required - placed[course_id]
+            if missing > 0:
+                course = self.courses[course_id]
+                unscheduled.append({
+                    'course_id': course_id,
+                    'subject_name': course['label'],
+                    'missing': missing,
+                    'reason': self._explain(course, missing),
+                })
+
+        soft_score = (violations['time_preference'] * PENALTY_TIME_PREFERENCE
+                      + violations['same_day'] * PENALTY_SAME_DAY
+                      + violations['broken_pair'] * PENALTY_BROKEN_PAIR)
+        required_total = sum(self.required.values())
+        placed_total = sum(placed.values())
+        return {
+            'assignments': dict(assignments),
+            'unscheduled_courses': unscheduled,
+            'metrics': {
+                'required_periods': required_total,
+                'placed_periods': placed_total,
+                'placement_rate': round(placed_total / required_total, 4) if required_total else 1.0,
+                'soft_violations': dict(violations),
+                'soft_score': soft_score,
+                'solve_time': round(time.perf_counter() - self.started, 3),
+                'nodes': self.nodes,
+                'backtracks': self.backtracks,
+                'seed': self.seed,
+                'search_complete': self.exhausted or (self.best is not None and self.best['unplaced'] == 0
+                                                      and self.best['penalty'] == 0),
+            },
+        }
+
+    def _explain(self, course, missing):
+        """Thai summary of why a course could not be fully placed (for the UI)."""
+        grade_slots = self.free_slots_by_grade.get(course['grade_level_id'], {})
+        grade_busy = self.busy[('g', course['grade_level_id'])]
+        teacher_busy = 0
+        for tid in course['teacher_ids']:
+            teacher_busy |= self.busy[('t', tid)]
+        reasons = Counter()
+        available = 0
+        for (day, period) in grade_slots:
+            bit = slot_bit(day, period)
+            if grade_busy & bit:
+                continue
+            available += 1
+            if teacher_busy & bit:
+                reasons['ครูผู้สอนไม่ว่าง'] += 1
+            elif self.busy[('c', course['classroom_id'])] & bit:
+                reasons['ห้องเรียนไม่ว่าง'] += 1
+            elif course['room_id'] and self.busy[('r', course['room_id'])] & bit:
+                reasons[f"ห้อง {course['room_name']} ไม่ว่าง"] += 1
+
+        summary = f"มีคาบว่างสำหรับระดับชั้นนี้ {available} คาบ (ยังขาด {missing} คาบ) "
+        if reasons:
+            top_reason = max(reasons, key=reasons.get)
+            summary += f"สาเหตุหลัก: {top_reason} ({reasons[top_reason]} คาบ)"
+        elif available < missing:
+            summary += "สาเหตุ: มีคาบว่างไม่พอ"
+        else:
+            summary += "สาเหตุ: ไม่สามารถหาคาบคู่ได้"
+        return summary
+
+
+def solution_score(result):
+    """Sort key for solver results: fewest unplaced periods, then lowest soft score."""
+    metrics = result['metrics']
+    return (metrics['required_periods'] - metrics['placed_periods'], metrics['soft_score'])
+
+
+def _solve_one(snapshot, seed, time_budget, node_limit):
+    # ฟังก์ชันระดับ module เพื่อให้ process ลูก (spawn) import และ pickle ได้
+    return TimetableSolver(snapshot, seed=seed, time_budget=time_budget, node_limit=node_limit).solve()
+
+
+def solve_multistart(snapshot, starts=DEFAULT_STARTS, base_seed=0, time_budget=DEFAULT_TIME_BUDGET,
+                     node_limit=DEFAULT_NODE_LIMIT, processes=None, on_progress=None):
+    """
+    Runs ``starts`` independent searches (seeds base_seed .. base_seed+starts-1)
+    across worker processes and returns the best result.
+
+    Args:
+        on_progress (callable, optional): Called as ``on_progress(done, starts, best)``
+            after each search finishes, with the best result so far.
+    """
+    processes = min(processes or MAX_SEARCH_PROCESSES, starts)
+    best, done, results = None, 0, []
+    # spawn แทน fork: ถูกเรียกจาก thread ของ background job ใน gunicorn worker การ fork process ที่มีหลาย thread
+    # อาจได้ lock (logging, connection pool, import lock) ที่ thread อื่นถืออยู่ติดไปด้วย ทำให้ process ลูกค้าง
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_solve_one, snapshot, base_seed + i, time_budget, node_limit) for i in range(starts)]
+        for future in as_completed(futures):
+            result = future.result()
+            done += 1
+            results.append(result['metrics'])
+            if best is None or (solution_score(result), result['metrics']['seed']) < (solution_score(best), best['metrics']['seed']):
+                best = result
+            if on_progress:
+                on_progress(done, starts, best)
+    best['metrics']['starts'] = [
+        {'seed': m['seed'], 'placed_periods': m['placed_periods'], 'soft_score': m['soft_score'], 'solve_time': m['solve_time']}
+        for m in sorted(results, key=lambda m: m['seed'])
+    ]
+    return best
+
+
+def find_target_course_ids(semester_id, classroom_id=None, teacher_id=None, room_id=None):
+    """Course ids the auto-scheduler should fill, using the same target filters as the UI."""
+    query = db.session.query(Course.id).filter(Course.semester_id == semester_id)
+    if classroom_id:
+        query = query.filter(Course.classroom_id == classroom_id)
+    elif teacher_id:
+        query = query.filter(Course.teachers.any(User.id == teacher_id))
+    elif room_id:
+        query = query.filter(Course.room_id == room_id)
+    return [cid for cid, in query.order_by(Course.id).all()]
+
+
+def build_timetable_snapshot(semester_id, target_course_ids):
+    """
+    Serialises everything the solver needs for one semester into plain data.
+
+    All courses of the semester are included (existing entries of non-target
+    courses still occupy their teachers, classrooms and rooms).
+    """
+    courses = Course.query.filter_by(semester_id=semester_id).options(
+        joinedload(Course.subject),
+        joinedload(Course.classroom),
+        joinedload(Course.room),
+        selectinload(Course.teachers),
+        joinedload(Course.lesson_plan).selectinload(LessonPlan.constraints)
+    ).all()
+
+    course_data = []
+    for c in courses:
+        constraints = {const.constraint_type: const.value for const in c.lesson_plan.constraints} if c.lesson_plan else {}
+        course_data.append({
+            'id': c.id,
+            'label': f"{c.subject.subject_code} ({c.classroom.name})",
+            'grade_level_id': c.classroom.grade_level_id,
+            'classroom_id': c.classroom_id,
+            'teacher_ids': tuple(sorted(t.id for t in c.teachers)),
+            'room_id': c.room_id,
+            'room_name': c.room.name if c.room else None,
+            'periods_needed': int((c.subject.credit or 0) * 2),
+            'arrangement': constraints.get('period_arrangement', 'separate'),
+            'time_preference': constraints.get('time_preference', 'any'),
+        })
+
+    slots = [tuple(row) for row in db.session.query(
+        WeeklyScheduleSlot.id, WeeklyScheduleSlot.grade_level_id, WeeklyScheduleSlot.day_of_week,
+        WeeklyScheduleSlot.period_number, WeeklyScheduleSlot.is_teaching_period
+    ).filter(WeeklyScheduleSlot.semester_id == semester_id).order_by(WeeklyScheduleSlot.id).all()]
+
+    entries = [tuple(row) for row in db.session.query(
+        TimetableEntry.course_id, TimetableEntry.weekly_schedule_slot_id
+    ).join(WeeklyScheduleSlot).filter(WeeklyScheduleSlot.semester_id == semester_id).all()]
+
+    return {
+        'semester_id': semester_id,
+        'courses': course_data,
+        'slots': slots,
+        'entries': entries,
+        'target_course_ids': list(target_course_ids),
+    }
+
+
+def save_timetable_solution(semester_id, assignments):
+    """Writes a solver result with one bulk INSERT; the caller commits."""
+    rows = [{'course_id': course_id, 'weekly_schedule_slot_id': slot_id}
+            for course_id, slot_ids in assignments.items() for slot_id in slot_ids]
+    if rows:
+        db.session.execute(insert(TimetableEntry), rows)
+        bump_timetable_version(db.session, [semester_id])
+    return len(rows)
+
+
+def run_timetable_search(job, semester_id, target_course_ids, starts=DEFAULT_STARTS, base_seed=0,
+                         time_budget=DEFAULT_TIME_BUDGET):
+    """
+    Background job body (app.jobs.start_job) for the multi-start auto-scheduler.
+
+    The snapshot is taken once; only the best solution is written back. If the
+    timetable was edited meanwhile and a slot is taken, the job fails and
+    nothing is saved.
+    """
+    job.update(done=0, total=starts, message='กำลังเตรียมข้อมูลตารางสอน...')
+    snapshot = build_timetable_snapshot(semester_id, target_course_ids)
+
+    def report(done, total, best):
+        metrics = best['metrics']
+        job.update(done=done, total=total,
+                   message=f"ค้นหาแล้ว {done}/{total} รอบ",
+                   best={'placed_periods': metrics['placed_periods'], 'required_periods': metrics['required_periods'],
+                         'soft_score': metrics['soft_score'], 'seed': metrics['seed']})
+
+    best = solve_multistart(snapshot, starts=starts, base_seed=base_seed, time_budget=time_budget, on_progress=report)
+    job.update(message='กำลังบันทึกผลลัพธ์...')
+    saved = save_timetable_solution(semester_id, best['assignments'])
+    db.session.commit()
+    return {
+        'saved_entries': saved,
+        'unscheduled_courses': best['unscheduled_courses'],
+        'metrics': best['metrics'],
+    }
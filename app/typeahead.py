@@ -0,0 +1,268 @@
+# FILE: app/typeahead.py
+"""
+In-process lookup indexes for typeahead / dropdown endpoints.
+
+Rooms, users and academic years are small lists that change rarely, yet the
+TomSelect widgets queried them on every keystroke. Each source here is
+loaded once into a PrefixIndex (sorted word keys for prefix search with
+bisect, plus a bigram map for substring search) and served from memory.
+
+A source is reloaded after a commit that wrote one of its models — ORM flushes
+and bulk ``session.execute(insert(Model), ...)`` alike — in this process.
+The same write also bumps a per-source counter in the Setting table
+(``typeahead_version:<source>``) inside its transaction; before serving from
+memory every worker compares that counter (one small indexed query) with the
+one its copy was built at, so other gunicorn workers reload right after the
+commit instead of waiting for TYPEAHEAD_TTL. Query results that are not list
+lookups (indicator search) go through cached_lookup(), which is invalidated
+the same way.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+
+from flask import jsonify
+from sqlalchemy import cast, event, Integer, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import AcademicYear, Indicator, Room, Semester, Setting, Standard, User
+
+TYPEAHEAD_TTL = 300 # วินาที — กันพลาดเท่านั้น การเขียนจาก worker อื่นเห็นผ่าน shared version
+VERSION_KEY_PREFIX = 'typeahead_version:'
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+CACHE_MAX_AGE = 30 # Cache-Control ของ response (วินาที)
+LOOKUP_CACHE_SIZE = 512
+
+SOURCE_ROOMS = 'rooms'
+SOURCE_USERS = 'users'
+SOURCE_ACADEMIC_YEARS = 'academic_years'
+SOURCE_INDICATORS = 'indicators'
+
+_SOURCE_MODELS = {
+    Room: (SOURCE_ROOMS,),
+    User: (SOURCE_USERS,),
+    AcademicYear: (SOURCE_ACADEMIC_YEARS,),
+    Semester: (SOURCE_ACADEMIC_YEARS,), # is_current
+    Indicator: (SOURCE_INDICATORS,),
+    Standard: (SOURCE_INDICATORS,),
+}
+
+
+def normalize(value):
+    return ' '.join(str(value or '').lower().split())
+
+
+class PrefixIndex:
+    """
+    Items kept in display order. search() returns items with a word starting
+    with the query first, then items containing it anywhere, both in display
+    order.
+    """
+
+    def __init__(self, items, text_of):
+        self.items = list(items)
+        self.texts = [normalize(text_of(item)) for item in self.items]
+        self.keys = []
+        self.grams = defaultdict(set)
+        for pos, value in enumerate(self.texts):
+            start = 0
+            for word in value.split(' '):
+                self.keys.append((value[start:], pos)) # คำนำหน้าของ "คำนี้จนจบข้อความ"
+                start += len(word) + 1
+            for i in range(len(value) - 1):
+                self.grams[value[i:i + 2]].add(pos)
+        self.keys.sort()
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        q = normalize(query)
+        if not q:
+            return self.items[:limit]
+
+        prefix_hits = set()
+        i = bisect_left(self.keys, (q,))
+        while i < len(self.keys) and self.keys[i][0].startswith(q):
+            prefix_hits.add(self.keys[i][1])
+            i += 1
+        ranked = sorted(prefix_hits)
+
+        if len(ranked) < limit:
+            if len(q) == 1:
+                candidates = (pos for pos, value in enumerate(self.texts) if q in value)
+            else:
+                postings = sorted((self.grams.get(q[j:j + 2], set()) for j in range(len(q) - 1)), key=len)
+                candidates = set.intersection(*postings) if postings[0] else set()
+                candidates = (pos for pos in sorted(candidates) if q in self.texts[pos])
+            ranked.extend(pos for pos in candidates if pos not in prefix_hits)
+        return [self.items[pos] for pos in ranked[:limit]]
+
+    def get(self, key, value):
+        return next((item for item in self.items if item.get(key) == value), None)
+
+
+def _load_rooms():
+    return [{'id': r.id, 'name': r.name, 'capacity': r.capacity}
+            for r in Room.query.order_by(Room.name).all()]
+
+
+def _load_users():
+    return [{'id': u.id, 'full_name': u.full_name, 'username': u.username}
+            for u in User.query.order_by(User.first_name, User.last_name).all()]
+
+
+def _load_academic_years():
+    current_semester = Semester.query.filter_by(is_current=True).first()
+    current_year_id = current_semester.academic_year_id if current_semester else None
+    return [{'id': year.id, 'year': year.year, 'is_current': year.id == current_year_id}
+            for year in AcademicYear.query.order_by(AcademicYear.year.desc()).all()]
+
+
+_SOURCES = {
+    SOURCE_ROOMS: (_load_rooms, lambda item: item['name']),
+    SOURCE_USERS: (_load_users, lambda item: f"{item['full_name']} {item['username']}"),
+    SOURCE_ACADEMIC_YEARS: (_load_academic_years, lambda item: item['year']),
+}
+
+_lock = threading.Lock()
+_generations = defaultdict(int) # source -> เลขรุ่น เพิ่มเมื่อมีการเขียน
+_indexes = {} # source -> ((generation, shared_version), built_at, PrefixIndex)
+_lookups = OrderedDict() # (source, (generation, shared_version), key) -> value
+
+
+def _version_key(source):
+    return f'{VERSION_KEY_PREFIX}{source}'
+
+
+def shared_version(source):
+    """The cross-process version counter of ``source`` (row created on first use)."""
+    key = _version_key(source)
+    value = db.session.execute(select(Setting.value).where(Setting.key == key)).scalar()
+    if value is None:
+        try:
+            # connection แยก เพื่อไม่ commit transaction ของ request
+            with db.engine.begin() as conn:
+                conn.execute(Setting.__table__.insert().values(key=key, value='0'))
+        except SQLAlchemyError:
+            pass # worker อื่นสร้างไปพร้อมกัน (หรือฐานข้อมูลไม่ว่าง: ครั้งหน้าค่อยสร้าง)
+        return '0'
+    return value
+
+
+def _bump_shared_versions(session, sources):
+    """Increments the counters of ``sources`` inside the writing transaction (once per transaction)."""
+    bumped = session.info.setdefault('typeahead_bumped', set())
+    pending = set(sources) - bumped
+    if not pending:
+        return
+    bumped.update(pending)
+    session.connection().execute(update(Setting.__table__).where(
+        Setting.__table__.c.key.in_([_version_key(source) for source in pending])
+    ).values(value=cast(cast(Setting.__table__.c.value, Integer) + 1, Setting.__table__.c.value.type)))
+
+
+def _current_version(source):
+    with _lock:
+        generation = _generations[source]
+    return generation, shared_version(source)
+
+
+def get_index(source):
+    """The PrefixIndex of ``source``, (re)loaded when invalidated here or in another worker."""
+    version = _current_version(source)
+    with _lock:
+        cached = _indexes.get(source)
+    if cached and cached[0] == version and time.monotonic() - cached[1] < TYPEAHEAD_TTL:
+        return cached[2]
+
+    loader, text_of = _SOURCES[source]
+    index = PrefixIndex(loader(), text_of)
+    with _lock:
+        if _generations[source] == version[0]: # ไม่มีการเขียนระหว่างโหลด
+            _indexes[source] = (version, time.monotonic(), index)
+    return index
+
+
+def search_source(source, query, limit=DEFAULT_LIMIT):
+    return get_index(source).search(query, limit)
+
+
+def cached_lookup(source, key, compute):
+    """
+    Memoizes ``compute()`` under ``key`` until ``source`` is invalidated
+    (LRU, LOOKUP_CACHE_SIZE entries, also bounded by TYPEAHEAD_TTL).
+    """
+    cache_key = (source, _current_version(source), key)
+    with _lock:
+        hit = _lookups.get(cache_key)
+        if hit and time.monotonic() - hit[0] < TYPEAHEAD_TTL:
+            _lookups.move_to_end(cache_key)
+            return hit[1]
+    value = compute()
+    with _lock:
+        if cache_key[1][0] == _generations[source]:
+            _lookups[cache_key] = (time.monotonic(), value)
+            while len(_lookups) > LOOKUP_CACHE_SIZE:
+                _lookups.popitem(last=False)
+    return value
+
+
+def invalidate_typeahead(*sources):
+    with _lock:
+        for source in sources:
+            _generations[source] += 1
+            _indexes.pop(source, None)
+        for cache_key in [k for k in _lookups if k[0] in sources]:
+            del _lookups[cache_key]
+
+
+def parse_limit(value):
+    """Clamps a ``limit`` query argument to 1..MAX_LIMIT."""
+    try:
+        return max(1, min(int(value), MAX_LIMIT))
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+
+
+def typeahead_response(data):
+    response = jsonify(data)
+    response.headers['Cache-Control'] = f'private, max-age={CACHE_MAX_AGE}'
+    return response
+
+
+def _mark_sources(session, model):
+    for cls in getattr(model, '__mro__', ()):
+        if cls in _SOURCE_MODELS:
+            session.info.setdefault('typeahead_dirty', set()).update(_SOURCE_MODELS[cls])
+            _bump_shared_versions(session, _SOURCE_MODELS[cls])
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed_sources(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        _mark_sources(session, type(obj))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk_sources(orm_execute_state):
+    # insert(User) / update(Room) แบบ bulk ไม่ผ่าน flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            _mark_sources(orm_execute_state.session, mapper.class_)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_sources(session):
+    session.info.pop('typeahead_bumped', None)
+    sources = session.info.pop('typeahead_dirty', None)
+    if sources:
+        invalidate_typeahead(*sources)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_dirty_sources(session):
+    session.info.pop('typeahead_bumped', None)
+    session.info.pop('typeahead_dirty', None)
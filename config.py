@@ -13,7 +13,23 @@ class Config:
     # --- [END FIX] ---
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # --- Database profile (app/db_profile.py) ---
+    # 'tuned' = WAL/pragmas + pool ตาม dialect, 'default' = ค่าเดิมของ SQLAlchemy (ใช้เทียบผล)
+    DB_PROFILE = os.environ.get('DB_PROFILE') or 'tuned'
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS') or 5000)
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB') or 65536)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 5)
+    SQLITE_MAX_OVERFLOW = int(os.environ.get('SQLITE_MAX_OVERFLOW') or 10)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 20)
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT') or 30)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+    DB_BUSY_RETRIES = int(os.environ.get('DB_BUSY_RETRIES') or 5)
+    DB_BUSY_RETRY_DELAY = float(os.environ.get('DB_BUSY_RETRY_DELAY') or 0.05)
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'app/static/uploads')
+    # คลังข้อมูลสำรองแบบ incremental (ค่าว่าง = instance/backups)
+    BACKUP_REPOSITORY = os.environ.get('BACKUP_REPOSITORY')
     RQ_REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379/0'
     RQ_QUEUES = ['default']
     GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configuration"
\ No newline at end of file
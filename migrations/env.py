@@ -45,6 +45,28 @@ target_db = current_app.extensions['migrate'].db
 # ... etc.
 
 
+# ตาราง/ดัชนีที่แอปสร้างเองตอนเริ่มทำงาน (ไม่อยู่ใน metadata) ห้าม autogenerate สร้างคำสั่ง drop
+FTS5_SHADOW_SUFFIXES = ('', '_data', '_idx', '_content', '_docsize', '_config')
+
+
+def _unmanaged_names():
+    from app.global_search import FTS_TABLE, TRIGRAM_INDEX
+    from app.indicator_search import INDEX_TABLE, TRIGRAM_INDEXES
+    tables = {table + suffix for table in (INDEX_TABLE, FTS_TABLE) for suffix in FTS5_SHADOW_SUFFIXES}
+    indexes = {name for name, _, _ in TRIGRAM_INDEXES} | {TRIGRAM_INDEX}
+    return tables, indexes
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if reflected and compare_to is None:
+        tables, indexes = _unmanaged_names()
+        if type_ == 'table' and name in tables:
+            return False
+        if type_ == 'index' and name in indexes:
+            return False
+    return True
+
+
 def get_metadata():
     if hasattr(target_db, 'metadatas'):
         return target_db.metadatas[None]
@@ -65,7 +87,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -92,6 +115,7 @@ def run_migrations_online():
 
     conf_args = current_app.extensions['migrate'].configure_args
     conf_args['render_as_batch'] = True
+    conf_args.setdefault('include_object', include_object)
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
 
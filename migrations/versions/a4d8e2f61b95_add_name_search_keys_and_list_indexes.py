@@ -0,0 +1,74 @@
+"""Add normalized name search columns and indexes for admin user/student lists
+
+Revision ID: a4d8e2f61b95
+Revises: f2c9a61d4b07
+Create Date: 2026-10-19 18:42:37.206114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8e2f61b95'
+down_revision = 'f2c9a61d4b07'
+branch_labels = None
+depends_on = None
+
+KEY_TABLES = ('user', 'student')
+INDEXES = [
+    ('ix_user_first_name_key', 'user', ['first_name_key']),
+    ('ix_user_last_name_key', 'user', ['last_name_key']),
+    ('ix_student_first_name_key', 'student', ['first_name_key']),
+    ('ix_student_last_name_key', 'student', ['last_name_key']),
+    ('ix_student_status', 'student', ['status']),
+    ('ix_enrollment_classroom_student', 'enrollment', ['classroom_id', 'student_id']),
+    ('ix_enrollment_student_id', 'enrollment', ['student_id']),
+    ('ix_user_roles_role_id', 'user_roles', ['role_id']),
+    ('ix_classroom_grade_level_id', 'classroom', ['grade_level_id']),
+]
+
+
+def _search_key(value):
+    # ต้องตรงกับ app.models.name_search_key
+    return ' '.join(str(value or '').lower().split()) or None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    for table_name in KEY_TABLES:
+        columns = [c['name'] for c in inspector.get_columns(table_name)]
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            for column in ('first_name_key', 'last_name_key'):
+                if column not in columns:
+                    batch_op.add_column(sa.Column(column, sa.String(length=64), nullable=True))
+                else:
+                    print(f"Column '{column}' already exists in '{table_name}'. Skipping add_column.")
+
+        # เติมค่าด้วย Python (lower() ของ SQLite แปลงได้เฉพาะ ASCII)
+        table = sa.table(table_name, sa.column('id', sa.Integer), sa.column('first_name', sa.String),
+                         sa.column('last_name', sa.String), sa.column('first_name_key', sa.String),
+                         sa.column('last_name_key', sa.String))
+        rows = [{'row_id': row_id, 'first_key': _search_key(first), 'last_key': _search_key(last)}
+                for row_id, first, last in conn.execute(sa.select(table.c.id, table.c.first_name, table.c.last_name))]
+        if rows:
+            conn.execute(table.update().where(table.c.id == sa.bindparam('row_id')).values(
+                first_name_key=sa.bindparam('first_key'), last_name_key=sa.bindparam('last_key')), rows)
+
+    for name, table_name, columns in INDEXES:
+        existing = {ix['name'] for ix in inspector.get_indexes(table_name)}
+        if name not in existing:
+            op.create_index(name, table_name, columns, unique=False)
+        else:
+            print(f"Index '{name}' already exists. Skipping create_index.")
+
+
+def downgrade():
+    for name, table_name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table_name)
+    for table_name in KEY_TABLES:
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.drop_column('last_name_key')
+            batch_op.drop_column('first_name_key')
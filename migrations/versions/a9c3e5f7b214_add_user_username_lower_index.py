@@ -0,0 +1,31 @@
+"""Add a lower(username) index for case-insensitive username prefix search
+
+Revision ID: a9c3e5f7b214
+Revises: f7d2b9c4e816
+Create Date: 2026-10-19 23:14:52.630481
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e5f7b214'
+down_revision = 'f7d2b9c4e816'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_user_username_lower'
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing = {ix['name'] for ix in inspector.get_indexes('user')}
+    if INDEX_NAME not in existing:
+        op.create_index(INDEX_NAME, 'user', [sa.text('lower(username)')], unique=False)
+    else:
+        print(f"Index '{INDEX_NAME}' already exists. Skipping create_index.")
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='user')
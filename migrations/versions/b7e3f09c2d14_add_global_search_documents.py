@@ -0,0 +1,71 @@
+"""Add search_document table for global search (FTS5 trigram on SQLite, pg_trgm on PostgreSQL)
+
+Revision ID: b7e3f09c2d14
+Revises: a4d8e2f61b95
+Create Date: 2026-10-19 19:26:51.830442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3f09c2d14'
+down_revision = 'a4d8e2f61b95'
+branch_labels = None
+depends_on = None
+
+# ต้องตรงกับ app/global_search.py (FTS_DDL / TRIGRAM_INDEX_DDL)
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_document_fts USING fts5("
+    "terms, content='search_document', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ai AFTER INSERT ON search_document BEGIN "
+    "INSERT INTO search_document_fts (rowid, terms) VALUES (new.id, new.terms); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ad AFTER DELETE ON search_document BEGIN "
+    "INSERT INTO search_document_fts (search_document_fts, rowid, terms) VALUES ('delete', old.id, old.terms); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_au AFTER UPDATE ON search_document BEGIN "
+    "INSERT INTO search_document_fts (search_document_fts, rowid, terms) VALUES ('delete', old.id, old.terms); "
+    "INSERT INTO search_document_fts (rowid, terms) VALUES (new.id, new.terms); END",
+]
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    if 'search_document' not in inspector.get_table_names():
+        op.create_table('search_document',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('entity_type', sa.String(length=20), nullable=False),
+            sa.Column('entity_id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=255), nullable=False),
+            sa.Column('subtitle', sa.String(length=255), nullable=True),
+            sa.Column('terms', sa.Text(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('entity_type', 'entity_id', name='_search_document_entity_uc')
+        )
+    else:
+        print("Table 'search_document' already exists. Skipping create_table.")
+
+    if conn.dialect.name == 'sqlite':
+        for statement in FTS_DDL:
+            op.execute(statement)
+    elif conn.dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute("CREATE INDEX IF NOT EXISTS ix_search_document_terms_trgm "
+                   "ON search_document USING gin (terms gin_trgm_ops)")
+
+    # ให้แอปสร้างเอกสารทั้งหมดตอนเริ่มทำงาน
+    op.execute("DELETE FROM setting WHERE key = 'global_search_index_version'")
+
+
+def downgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        for trigger in ('search_document_ai', 'search_document_ad', 'search_document_au'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS search_document_fts")
+    elif conn.dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_search_document_terms_trgm")
+    op.drop_table('search_document')
+    op.execute("DELETE FROM setting WHERE key = 'global_search_index_version'")
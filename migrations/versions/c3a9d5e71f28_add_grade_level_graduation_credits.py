@@ -0,0 +1,43 @@
+"""Add graduation_credits to grade_level
+
+Revision ID: c3a9d5e71f28
+Revises: b7e3f09c2d14
+Create Date: 2026-10-19 19:58:14.602731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9d5e71f28'
+down_revision = 'b7e3f09c2d14'
+branch_labels = None
+depends_on = None
+
+# ค่าเดิมที่เคย hard-code ไว้ใน services.check_graduation_readiness
+DEFAULT_GRADUATION_CREDITS = {'ม.3': 77, 'ม.6': 81}
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    columns = [c['name'] for c in inspector.get_columns('grade_level')]
+
+    with op.batch_alter_table('grade_level', schema=None) as batch_op:
+        if 'graduation_credits' not in columns:
+            batch_op.add_column(sa.Column('graduation_credits', sa.Float(), nullable=True))
+        else:
+            print("Column 'graduation_credits' already exists in 'grade_level'. Skipping add_column.")
+
+    grade_level = sa.table('grade_level', sa.column('short_name', sa.String),
+                           sa.column('graduation_credits', sa.Float))
+    for short_name, credits in DEFAULT_GRADUATION_CREDITS.items():
+        conn.execute(grade_level.update().where(
+            grade_level.c.short_name == short_name, grade_level.c.graduation_credits.is_(None)
+        ).values(graduation_credits=credits))
+
+
+def downgrade():
+    with op.batch_alter_table('grade_level', schema=None) as batch_op:
+        batch_op.drop_column('graduation_credits')
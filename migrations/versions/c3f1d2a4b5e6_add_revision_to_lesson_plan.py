@@ -0,0 +1,33 @@
+"""Add revision counter to lesson_plan
+
+Revision ID: c3f1d2a4b5e6
+Revises: 64c25761fd53
+Create Date: 2026-10-19 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1d2a4b5e6'
+down_revision = '64c25761fd53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    lesson_plan_columns = [c['name'] for c in inspector.get_columns('lesson_plan')]
+
+    with op.batch_alter_table('lesson_plan', schema=None) as batch_op:
+        if 'revision' not in lesson_plan_columns:
+            batch_op.add_column(sa.Column('revision', sa.Integer(), nullable=False, server_default='0'))
+        else:
+            print("Column 'revision' already exists in 'lesson_plan'. Skipping add_column.")
+
+
+def downgrade():
+    with op.batch_alter_table('lesson_plan', schema=None) as batch_op:
+        batch_op.drop_column('revision')
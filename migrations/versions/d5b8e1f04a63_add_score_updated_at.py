@@ -0,0 +1,34 @@
+"""Add updated_at to score (change detection for incremental backups)
+
+Revision ID: d5b8e1f04a63
+Revises: c3a9d5e71f28
+Create Date: 2026-10-19 20:41:09.318245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5b8e1f04a63'
+down_revision = 'c3a9d5e71f28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    columns = [c['name'] for c in inspector.get_columns('score')]
+
+    # ไม่ต้องเติมค่าเดิม: แถวที่ไม่เคยถูกแก้ไขหลังจากนี้มีค่าเป็น NULL
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        if 'updated_at' not in columns:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        else:
+            print("Column 'updated_at' already exists in 'score'. Skipping add_column.")
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,33 @@
+"""Add timetable version counter to semester
+
+Revision ID: d7a4e9b21c3f
+Revises: c3f1d2a4b5e6
+Create Date: 2026-10-19 16:05:12.402318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a4e9b21c3f'
+down_revision = 'c3f1d2a4b5e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    semester_columns = [c['name'] for c in inspector.get_columns('semester')]
+
+    with op.batch_alter_table('semester', schema=None) as batch_op:
+        if 'timetable_version' not in semester_columns:
+            batch_op.add_column(sa.Column('timetable_version', sa.Integer(), nullable=False, server_default='0'))
+        else:
+            print("Column 'timetable_version' already exists in 'semester'. Skipping add_column.")
+
+
+def downgrade():
+    with op.batch_alter_table('semester', schema=None) as batch_op:
+        batch_op.drop_column('timetable_version')
@@ -0,0 +1,98 @@
+"""Add composite indexes and uniqueness for score, enrollment, course, timetable, attendance and notification
+
+Revision ID: e4c7a2d9f318
+Revises: d5b8e1f04a63
+Create Date: 2026-10-19 21:17:45.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4c7a2d9f318'
+down_revision = 'd5b8e1f04a63'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_score_graded_item_id', 'score', ['graded_item_id']),
+    ('ix_score_assessment_item_id', 'score', ['assessment_item_id']),
+    ('ix_enrollment_classroom_roll', 'enrollment', ['classroom_id', 'roll_number']),
+    ('ix_enrollment_student_group_id', 'enrollment', ['student_group_id']),
+    ('ix_timetable_entry_course_slot', 'timetable_entry', ['course_id', 'weekly_schedule_slot_id']),
+    ('ix_course_semester_status', 'course', ['semester_id', 'grade_submission_status']),
+    ('ix_notification_user_read_created', 'notification', ['user_id', 'is_read', 'created_at']),
+    ('ix_attendance_record_entry_date', 'attendance_record', ['timetable_entry_id', 'attendance_date']),
+]
+# index ที่ห้ามซ้ำ -> index เดิมที่กลายเป็นส่วนหน้าของมัน (ลบทิ้งได้เมื่อสร้างสำเร็จ)
+UNIQUE_INDEXES = [
+    ('uq_score_student_graded_item', 'score', ['student_id', 'graded_item_id'], None),
+    ('uq_enrollment_student_classroom', 'enrollment', ['student_id', 'classroom_id'], 'ix_enrollment_student_id'),
+]
+
+
+DUPLICATE_REPORT_LIMIT = 20
+
+
+def _duplicate_groups(conn, table_name, columns):
+    """(values..., row count) of every group of rows that would break the unique index."""
+    cols = ', '.join(columns)
+    not_null = ' AND '.join(f"{c} IS NOT NULL" for c in columns)
+    return conn.execute(sa.text(
+        f"SELECT {cols}, COUNT(*) FROM {table_name} WHERE {not_null} "
+        f"GROUP BY {cols} HAVING COUNT(*) > 1 ORDER BY {cols}"
+    )).all()
+
+
+def _abort_on_duplicates(table_name, columns, groups):
+    # ไม่ลบข้อมูลเองใน migration และไม่สร้างแบบไม่ unique แทน (ชื่อเดียวกันจะทำให้รอบหน้าข้าม unique ไปตลอด)
+    lines = [f"  {dict(zip(columns, group[:-1]))}: {group[-1]} rows" for group in groups[:DUPLICATE_REPORT_LIMIT]]
+    if len(groups) > DUPLICATE_REPORT_LIMIT:
+        lines.append(f"  ... and {len(groups) - DUPLICATE_REPORT_LIMIT} more groups")
+    raise RuntimeError(
+        f"Cannot add a unique index on {table_name} ({', '.join(columns)}): {len(groups)} duplicate groups found.\n"
+        + '\n'.join(lines)
+        + "\nMerge or delete the duplicate rows, then run 'flask db upgrade' again."
+    )
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    for name, table_name, columns in INDEXES:
+        existing = {ix['name'] for ix in inspector.get_indexes(table_name)}
+        if name not in existing:
+            op.create_index(name, table_name, columns, unique=False)
+        else:
+            print(f"Index '{name}' already exists. Skipping create_index.")
+
+    for name, table_name, columns, replaces in UNIQUE_INDEXES:
+        existing = {ix['name']: ix for ix in inspector.get_indexes(table_name)}
+        if name in existing and existing[name].get('unique'):
+            print(f"Index '{name}' already exists. Skipping create_index.")
+            continue
+        groups = _duplicate_groups(conn, table_name, columns)
+        if groups:
+            _abort_on_duplicates(table_name, columns, groups)
+        if name in existing:
+            # รุ่นก่อนของ migration นี้เคยสร้างชื่อนี้แบบไม่ unique เมื่อพบแถวซ้ำ: สร้างใหม่ให้ตรงกับ model
+            print(f"Index '{name}' exists but is not unique. Recreating it as unique.")
+            op.drop_index(name, table_name=table_name)
+        op.create_index(name, table_name, columns, unique=True)
+        if replaces and replaces in existing:
+            op.drop_index(replaces, table_name=table_name)
+
+
+def downgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    for name, table_name, columns, replaces in reversed(UNIQUE_INDEXES):
+        existing = {ix['name'] for ix in inspector.get_indexes(table_name)}
+        if replaces and replaces not in existing:
+            op.create_index(replaces, table_name, [columns[0]], unique=False)
+        if name in existing:
+            op.drop_index(name, table_name=table_name)
+    for name, table_name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table_name)
@@ -0,0 +1,49 @@
+"""Add materialized_timetable and semester.timetable_materialized_version
+
+Revision ID: e81b5c7f0a92
+Revises: d7a4e9b21c3f
+Create Date: 2026-10-19 17:20:41.905533
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b5c7f0a92'
+down_revision = 'd7a4e9b21c3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    if 'materialized_timetable' not in inspector.get_table_names():
+        op.create_table('materialized_timetable',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('semester_id', sa.Integer(), nullable=False),
+            sa.Column('owner_type', sa.String(length=20), nullable=False),
+            sa.Column('owner_id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('data', sa.JSON(), nullable=False),
+            sa.ForeignKeyConstraint(['semester_id'], ['semester.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('semester_id', 'owner_type', 'owner_id', name='_materialized_timetable_owner_uc')
+        )
+    else:
+        print("Table 'materialized_timetable' already exists. Skipping create_table.")
+
+    semester_columns = [c['name'] for c in inspector.get_columns('semester')]
+    with op.batch_alter_table('semester', schema=None) as batch_op:
+        if 'timetable_materialized_version' not in semester_columns:
+            batch_op.add_column(sa.Column('timetable_materialized_version', sa.Integer(), nullable=True))
+        else:
+            print("Column 'timetable_materialized_version' already exists in 'semester'. Skipping add_column.")
+
+
+def downgrade():
+    with op.batch_alter_table('semester', schema=None) as batch_op:
+        batch_op.drop_column('timetable_materialized_version')
+    op.drop_table('materialized_timetable')
@@ -0,0 +1,55 @@
+"""Add indicator search index (FTS5 on SQLite, pg_trgm on PostgreSQL)
+
+Revision ID: f2c9a61d4b07
+Revises: e81b5c7f0a92
+Create Date: 2026-10-19 18:05:12.417309
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c9a61d4b07'
+down_revision = 'e81b5c7f0a92'
+branch_labels = None
+depends_on = None
+
+# ต้องตรงกับ app/indicator_search.py (CREATE_INDEX_SQL / TRIGRAM_INDEXES)
+THAI_MARKS = 'ั' + ''.join(chr(c) for c in range(0x0e34, 0x0e3b)) + ''.join(chr(c) for c in range(0x0e47, 0x0e4f))
+TRIGRAM_INDEXES = [
+    ('ix_indicator_code_trgm', 'indicator', 'code'),
+    ('ix_indicator_description_trgm', 'indicator', 'description'),
+    ('ix_standard_code_trgm', 'standard', 'code'),
+]
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    if conn.dialect.name == 'sqlite':
+        if 'indicator_search' not in inspector.get_table_names():
+            op.execute(
+                "CREATE VIRTUAL TABLE indicator_search USING fts5("
+                "code, standard_code, description, standard_id UNINDEXED, "
+                f"tokenize=\"unicode61 remove_diacritics 0 tokenchars '{THAI_MARKS}'\")"
+            )
+            # ลบเครื่องหมายว่าสร้างแล้ว ให้แอปเติมข้อมูล (segment ภาษาไทยใน Python) ตอนเริ่มทำงาน
+            op.execute("DELETE FROM setting WHERE key = 'indicator_search_segmenter'")
+        else:
+            print("Table 'indicator_search' already exists. Skipping create.")
+    elif conn.dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for name, table, column in TRIGRAM_INDEXES:
+            op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)")
+
+
+def downgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS indicator_search")
+        op.execute("DELETE FROM setting WHERE key = 'indicator_search_segmenter'")
+    elif conn.dialect.name == 'postgresql':
+        for name, _, _ in TRIGRAM_INDEXES:
+            op.execute(f"DROP INDEX IF EXISTS {name}")
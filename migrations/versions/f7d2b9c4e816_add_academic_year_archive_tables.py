@@ -0,0 +1,117 @@
+"""Add academic_year.archived_at and archived_* cold-storage tables
+
+Revision ID: f7d2b9c4e816
+Revises: e4c7a2d9f318
+Create Date: 2026-10-19 22:05:13.418207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7d2b9c4e816'
+down_revision = 'e4c7a2d9f318'
+branch_labels = None
+depends_on = None
+
+
+def _archive_columns():
+    return [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('source_id', sa.Integer(), nullable=False),
+        sa.Column('academic_year_id', sa.Integer(), nullable=False),
+    ]
+
+
+ARCHIVE_TABLES = {
+    'archived_score': [
+        sa.Column('student_id', sa.Integer(), nullable=False),
+        sa.Column('assessment_item_id', sa.Integer(), nullable=True),
+        sa.Column('rubric_level_id', sa.Integer(), nullable=True),
+        sa.Column('score', sa.Float(), nullable=True),
+        sa.Column('details', sa.JSON(), nullable=True),
+        sa.Column('graded_item_id', sa.Integer(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+    ],
+    'archived_attendance_record': [
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('recorded_at', sa.DateTime(), nullable=True),
+        sa.Column('attendance_date', sa.Date(), nullable=False),
+        sa.Column('student_id', sa.Integer(), nullable=False),
+        sa.Column('timetable_entry_id', sa.Integer(), nullable=False),
+        sa.Column('recorder_id', sa.Integer(), nullable=False),
+    ],
+    'archived_qualitative_score': [
+        sa.Column('score_value', sa.Integer(), nullable=False),
+        sa.Column('student_id', sa.Integer(), nullable=False),
+        sa.Column('assessment_topic_id', sa.Integer(), nullable=False),
+        sa.Column('course_id', sa.Integer(), nullable=False),
+    ],
+    'archived_audit_log': [
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('action', sa.String(length=255), nullable=False),
+        sa.Column('model_name', sa.String(length=50), nullable=True),
+        sa.Column('record_id', sa.String(length=50), nullable=True),
+        sa.Column('old_value', sa.Text(), nullable=True),
+        sa.Column('new_value', sa.Text(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+    ],
+    'archived_notification': [
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=255), nullable=False),
+        sa.Column('message', sa.Text(), nullable=False),
+        sa.Column('url', sa.String(length=255), nullable=True),
+        sa.Column('is_read', sa.Boolean(), nullable=False),
+        sa.Column('notification_type', sa.String(length=50), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+    ],
+}
+
+INDEXES = [
+    ('ix_archived_score_academic_year_id', 'archived_score', ['academic_year_id']),
+    ('ix_archived_score_graded_item_student', 'archived_score', ['graded_item_id', 'student_id']),
+    ('ix_archived_attendance_record_academic_year_id', 'archived_attendance_record', ['academic_year_id']),
+    ('ix_archived_attendance_record_entry_student', 'archived_attendance_record', ['timetable_entry_id', 'student_id']),
+    ('ix_archived_qualitative_score_academic_year_id', 'archived_qualitative_score', ['academic_year_id']),
+    ('ix_archived_qualitative_score_course_id', 'archived_qualitative_score', ['course_id']),
+    ('ix_archived_audit_log_academic_year_id', 'archived_audit_log', ['academic_year_id']),
+    ('ix_archived_notification_academic_year_id', 'archived_notification', ['academic_year_id']),
+    ('ix_archived_notification_user_id', 'archived_notification', ['user_id']),
+]
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+
+    year_columns = [c['name'] for c in inspector.get_columns('academic_year')]
+    with op.batch_alter_table('academic_year', schema=None) as batch_op:
+        if 'archived_at' not in year_columns:
+            batch_op.add_column(sa.Column('archived_at', sa.DateTime(), nullable=True))
+        else:
+            print("Column 'archived_at' already exists in 'academic_year'. Skipping add_column.")
+
+    existing_tables = set(inspector.get_table_names())
+    for table_name, columns in ARCHIVE_TABLES.items():
+        if table_name not in existing_tables:
+            op.create_table(table_name, *_archive_columns(), *columns, sa.PrimaryKeyConstraint('id'))
+        else:
+            print(f"Table '{table_name}' already exists. Skipping create_table.")
+
+    inspector = sa.inspect(conn)
+    for name, table_name, columns in INDEXES:
+        existing = {ix['name'] for ix in inspector.get_indexes(table_name)}
+        if name not in existing:
+            op.create_index(name, table_name, columns, unique=False)
+        else:
+            print(f"Index '{name}' already exists. Skipping create_index.")
+
+
+def downgrade():
+    for name, table_name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table_name)
+    for table_name in reversed(list(ARCHIVE_TABLES)):
+        op.drop_table(table_name)
+    with op.batch_alter_table('academic_year', schema=None) as batch_op:
+        batch_op.drop_column('archived_at')
@@ -89,10 +89,10 @@ def seed_db():
     grades_data = [
         {'name': 'มัธยมศึกษาปีที่ 1', 'short_name': 'ม.1'},
         {'name': 'มัธยมศึกษาปีที่ 2', 'short_name': 'ม.2'},
-        {'name': 'มัธยมศึกษาปีที่ 3', 'short_name': 'ม.3'},
+        {'name': 'มัธยมศึกษาปีที่ 3', 'short_name': 'ม.3', 'graduation_credits': 77},
         {'name': 'มัธยมศึกษาปีที่ 4', 'short_name': 'ม.4'},
         {'name': 'มัธยมศึกษาปีที่ 5', 'short_name': 'ม.5'},
-        {'name': 'มัธยมศึกษาปีที่ 6', 'short_name': 'ม.6'}
+        {'name': 'มัธยมศึกษาปีที่ 6', 'short_name': 'ม.6', 'graduation_credits': 81}
     ]
     for g_data in grades_data:
         if not GradeLevel.query.filter_by(name=g_data['name']).first():
@@ -328,4 +328,80 @@ def nuke_notifications_command():
         print(f'Success: Successfully deleted {deleted_count} notifications.')
     except Exception as e:
         db.session.rollback()
-        print(f'Fatal Error running nuke command: {e}')        
\ No newline at end of file
+        print(f'Fatal Error running nuke command: {e}')        
+
+@app.cli.command('backup-create')
+@click.option('--full', is_flag=True, help='Write a full backup instead of an incremental one.')
+def backup_create_command(full):
+    """
+    [CLI] Stores an incremental (or --full) backup in the backup repository.
+    Run with: flask backup-create
+    """
+    from flask import current_app
+    from app.backup_store import BackupRepository, repository_path
+
+    repo = BackupRepository(repository_path(current_app))
+    manifest = repo.create_backup(current_app._get_current_object(), full=full)
+    stats = manifest['stats']
+    print(f"Backup {manifest['id']} ({manifest['kind']}) stored in {repo.root}")
+    print(f"  new blobs: {stats['blobs_written']} ({stats['bytes_written']:,} bytes), "
+          f"blocks exported/reused: {stats['blocks_exported']}/{stats['blocks_reused']}, "
+          f"files hashed/reused: {stats['files_hashed']}/{stats['files_reused']}")
+
+@app.cli.command('backup-list')
+def backup_list_command():
+    """[CLI] Lists the backups in the backup repository."""
+    from flask import current_app
+    from app.backup_store import BackupRepository, repository_path
+
+    repo = BackupRepository(repository_path(current_app))
+    for manifest in repo.list_backups():
+        rows = sum(entry['rows'] for entry in manifest['tables'].values())
+        print(f"{manifest['id']}  {manifest['kind']:<11}  parent={manifest['parent'] or '-':<24}  "
+              f"rows={rows:,}  files={len(manifest['uploads'])}")
+
+@app.cli.command('backup-restore')
+@click.argument('backup_id')
+@click.argument('dest_dir')
+def backup_restore_command(backup_id, dest_dir):
+    """
+    [CLI] Rebuilds a stored backup (base + increments) into DEST_DIR as
+    database.db and uploads/. The live database is not touched.
+    Run with: flask backup-restore 20261019_204500_000000 /tmp/restored
+    """
+    from flask import current_app
+    from app.backup_store import BackupRepository, repository_path
+
+    repo = BackupRepository(repository_path(current_app))
+    try:
+        summary = repo.restore(backup_id, dest_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    print(f"Restored {sum(summary['tables'].values()):,} rows in {len(summary['tables'])} tables "
+          f"and {summary['files']} files into {dest_dir}")
+
+@app.cli.group('perf')
+def perf_group():
+    """[CLI] Performance diagnostics."""
+
+@perf_group.command('explain')
+@click.option('--strict', is_flag=True, help='Exit with status 1 when a hot query scans a whole table.')
+def perf_explain_command(strict):
+    """
+    [CLI] Runs EXPLAIN on the hottest endpoint queries to check index use.
+    Run with: flask perf explain
+    """
+    from app.query_plans import explain_hot_queries
+
+    with db.engine.connect() as connection:
+        results = explain_hot_queries(connection)
+    flagged = 0
+    for name, lines, full_scans in results:
+        print(f"{'!! ' if full_scans else 'ok '}{name}")
+        for line in lines:
+            print(f"      {line}")
+        flagged += bool(full_scans)
+    print(f"\n{len(results) - flagged}/{len(results)} queries use an index.")
+    if strict and flagged:
+        raise SystemExit(1)
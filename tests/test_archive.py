@@ -0,0 +1,101 @@
+# FILE: tests/test_archive.py
+"""Academic-year archival must never hide rows from calculate_final_grades_for_course, even part-way."""
+from datetime import date, time
+
+import pytest
+
+import app.archive as archive
+from app import create_app, db
+from app.models import (AcademicYear, ArchivedAttendanceRecord, ArchivedScore, AssessmentDimension, AttendanceRecord,
+                        Classroom, Course, Enrollment, GradedItem, GradeLevel, LearningUnit, LessonPlan, Score,
+                        Semester, Student, Subject, SubjectGroup, SubjectType, TimetableEntry, User, WeeklyScheduleSlot)
+from app.services import calculate_final_grades_for_course
+from config import Config
+
+
+class ArchiveTestConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'test'
+    WTF_CSRF_ENABLED = False
+    TESTING = True
+
+
+@pytest.fixture
+def app():
+    app = create_app(ArchiveTestConfig)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def course(app):
+    closed_year, newest_year = AcademicYear(year=2566), AcademicYear(year=2567)
+    semester = Semester(term=1, academic_year=closed_year, start_date=date(2023, 5, 16), end_date=date(2023, 10, 10))
+    db.session.add_all([closed_year, newest_year, semester,
+                        Semester(term=1, academic_year=newest_year, start_date=date(2024, 5, 16), is_current=True)])
+    grade_level = GradeLevel(name='ม.1')
+    classroom = Classroom(name='ม.1/1', grade_level=grade_level, academic_year=closed_year)
+    subject = Subject(subject_code='ค21101', name='คณิตศาสตร์', credit=1.0,
+                      subject_group=SubjectGroup(name='คณิตศาสตร์'), subject_type=SubjectType(name='พื้นฐาน'))
+    plan = LessonPlan(subject=subject, academic_year=closed_year)
+    unit = LearningUnit(lesson_plan=plan, title='หน่วยที่ 1')
+    dimension = AssessmentDimension(code='K', name='ความรู้')
+    items = [GradedItem(name=f'งาน {n}', max_score=10, learning_unit=unit, dimension=dimension)
+             for n in range(1, 4)]
+    course = Course(subject=subject, classroom=classroom, semester=semester, lesson_plan=plan)
+    teacher = User(username='teacher1', first_name='ครู', last_name='ทดสอบ')
+    slot = WeeklyScheduleSlot(semester=semester, grade_level=grade_level, day_of_week=1, period_number=1,
+                              start_time=time(8, 30), end_time=time(9, 20))
+    entry = TimetableEntry(course=course, slot=slot)
+    db.session.add_all([classroom, plan, unit, *items, course, teacher, entry])
+    db.session.flush()
+
+    for n in range(1, 5):
+        student = Student(student_id=f'6600{n}', name_prefix='ด.ช.', first_name=f'นักเรียน{n}', last_name='ทดสอบ')
+        db.session.add_all([student, Enrollment(student=student, classroom=classroom, roll_number=n)])
+        db.session.flush()
+        for item in items:
+            db.session.add(Score(student_id=student.id, graded_item_id=item.id, score=float(n + item.id)))
+        for day in range(1, n + 1):
+            db.session.add(AttendanceRecord(student_id=student.id, timetable_entry_id=entry.id, recorder_id=teacher.id,
+                                            attendance_date=date(2023, 6, day), status='ABSENT'))
+    db.session.commit()
+    return course
+
+
+def _grades(course):
+    rows, _ = calculate_final_grades_for_course(db.session.get(Course, course.id))
+    return [(row['student'].id, row['collected_score'], row['absent_count'], row['grade']) for row in rows]
+
+
+def test_failed_chunk_keeps_final_grades(course, monkeypatch):
+    before = _grades(course)
+    year_id = course.semester.academic_year_id
+    move_chunk = archive._archive_chunk
+    calls = {'n': 0}
+
+    def fail_second_chunk(model, ids, year_id):
+        calls['n'] += 1
+        if calls['n'] == 2:
+            raise RuntimeError('simulated failure')
+        move_chunk(model, ids, year_id)
+
+    monkeypatch.setattr(archive, 'ARCHIVE_CHUNK', 5)
+    monkeypatch.setattr(archive, '_archive_chunk', fail_second_chunk)
+    summary = archive.archive_academic_year(year_id)
+
+    assert summary['errors'] and not summary['archived']
+    assert db.session.get(AcademicYear, year_id).archived_at is not None
+    assert db.session.query(ArchivedScore).count() == 5 # ย้ายไปได้ก้อนแรกก้อนเดียว
+    assert Score.query.count() == 7
+    assert _grades(course) == before
+
+    monkeypatch.setattr(archive, '_archive_chunk', move_chunk)
+    summary = archive.archive_academic_year(year_id)
+
+    assert not summary['errors'] and summary['archived']
+    assert Score.query.count() == 0 and AttendanceRecord.query.count() == 0
+    assert db.session.query(ArchivedAttendanceRecord).count() == 10
+    assert _grades(course) == before
@@ -0,0 +1,318 @@
+# FILE: tools/benchmark_scheduler.py
+"""
+Benchmark / quality harness for the timetable auto-scheduler.
+
+Generates a synthetic semester (grades, classrooms, teachers, rooms, subjects
+with a configurable credit and constraint mix) in an in-memory SQLite
+database, runs the scheduler headless through the same functions the
+academic routes use (build_timetable_snapshot -> solver ->
+save_timetable_solution) and reports placement rate, soft-constraint
+violations, hard-constraint violations found in the saved timetable,
+runtime and peak memory. Each run is appended to a CSV file so results can
+be compared across commits.
+
+ตัวอย่าง:
+    python tools/benchmark_scheduler.py --grades 6 --classrooms-per-grade 1 --teachers 20 --seeds 1,2,3
+    python tools/benchmark_scheduler.py --strategy multistart --starts 4 --csv bench/timetable.csv
+
+หมายเหตุ: คาบ (WeeklyScheduleSlot) กำหนดต่อระดับชั้น และหนึ่งคาบมีได้เพียง
+TimetableEntry เดียว ห้องเรียนในระดับเดียวกันจึงใช้คาบร่วมกัน ค่า
+--classrooms-per-grade มากกว่า 1 จะทำให้ความจุไม่พอโดยตั้งใจ (ดู "capacity" ในรายงาน)
+"""
+import argparse
+import csv
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, time as dt_time
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_DIR)
+
+from sqlalchemy import func, insert  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import (AcademicYear, Classroom, Course, GradeLevel, LessonPlan, LessonPlanConstraint,  # noqa: E402
+                        Room, Semester, Subject, SubjectGroup, SubjectType, TimetableEntry, User,
+                        WeeklyScheduleSlot, course_teachers)
+from app.timetable_solver import (DEFAULT_NODE_LIMIT, DEFAULT_STARTS, TimetableSolver,  # noqa: E402
+                                  build_timetable_snapshot, save_timetable_solution, solve_multistart)
+from config import Config  # noqa: E402
+
+CSV_FIELDS = [
+    'timestamp', 'commit', 'strategy', 'seed', 'grades', 'classrooms_per_grade', 'teachers', 'rooms',
+    'subjects_per_classroom', 'days', 'periods_per_day', 'credits', 'consecutive_ratio', 'morning_ratio',
+    'afternoon_ratio', 'room_ratio', 'courses', 'capacity', 'required_periods', 'placed_periods',
+    'placement_rate', 'soft_time_preference', 'soft_same_day', 'soft_broken_pair', 'soft_score',
+    'hard_violations', 'solve_time', 'wall_time', 'peak_memory_kb', 'nodes', 'backtracks', 'search_complete',
+]
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'benchmark'
+    WTF_CSRF_ENABLED = False
+
+
+def _parse_credits(value):
+    try:
+        credits = [float(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("credits ต้องเป็นตัวเลขคั่นด้วย , เช่น 0.5,1,1.5")
+    if not credits or any(c <= 0 for c in credits):
+        raise argparse.ArgumentTypeError("credits ต้องมากกว่า 0")
+    return credits
+
+
+def _parse_seeds(value):
+    try:
+        return [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("seeds ต้องเป็นจำนวนเต็มคั่นด้วย ,")
+
+
+def _ratio(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError("ค่าสัดส่วนต้องอยู่ระหว่าง 0 ถึง 1")
+    return value
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def generate_semester(args, seed):
+    """
+    Fills the (empty) database with one synthetic semester and returns
+    (semester_id, course_count, capacity).
+    """
+    rng = random.Random(seed)
+    year = AcademicYear(year=2600)
+    db.session.add(year)
+    db.session.flush()
+    semester = Semester(term=1, academic_year_id=year.id)
+    group = SubjectGroup(name='กลุ่มสาระทดสอบ')
+    subject_type = SubjectType(name='พื้นฐาน')
+    db.session.add_all([semester, group, subject_type])
+    db.session.flush()
+
+    teacher_ids = [row.inserted_primary_key[0] for row in (
+        db.session.execute(insert(User).values(
+            username=f'bench_t{i}', first_name=f'ครู{i}', last_name='ทดสอบ',
+            must_change_username=False, must_change_password=False))
+        for i in range(1, args.teachers + 1))]
+    room_ids = [row.inserted_primary_key[0] for row in (
+        db.session.execute(insert(Room).values(name=f'ห้องพิเศษ {i}')) for i in range(1, args.rooms + 1))]
+
+    slot_rows = []
+    grade_ids = []
+    for g in range(1, args.grades + 1):
+        grade_id = db.session.execute(insert(GradeLevel).values(name=f'ระดับ {g}', short_name=f'G{g}')).inserted_primary_key[0]
+        grade_ids.append(grade_id)
+        for day in range(1, args.days + 1):
+            for period in range(1, args.periods + 1):
+                start = dt_time(8 + period % 10, 0)
+                slot_rows.append({
+                    'semester_id': semester.id, 'grade_level_id': grade_id, 'day_of_week': day,
+                    'period_number': period, 'start_time': start, 'end_time': dt_time(start.hour, 50),
+                    'is_teaching_period': True,
+                })
+    db.session.execute(insert(WeeklyScheduleSlot), slot_rows)
+
+    course_rows, teacher_links, constraint_rows = [], [], []
+    subject_no = 0
+    for grade_id in grade_ids:
+        for c in range(1, args.classrooms_per_grade + 1):
+            classroom_id = db.session.execute(insert(Classroom).values(
+                name=f'{grade_id}/{c}', grade_level_id=grade_id, academic_year_id=year.id)).inserted_primary_key[0]
+            for _ in range(args.subjects_per_classroom):
+                subject_no += 1
+                subject_id = db.session.execute(insert(Subject).values(
+                    subject_code=f'B{subject_no:05d}', name=f'วิชาทดสอบ {subject_no}', credit=rng.choice(args.credits),
+                    subject_group_id=group.id, subject_type_id=subject_type.id)).inserted_primary_key[0]
+                plan_id = db.session.execute(insert(LessonPlan).values(
+                    subject_id=subject_id, academic_year_id=year.id)).inserted_primary_key[0]
+                if rng.random() < args.consecutive_ratio:
+                    constraint_rows.append({'lesson_plan_id': plan_id, 'constraint_type': 'period_arrangement',
+                                            'value': 'consecutive'})
+                roll = rng.random()
+                if roll < args.morning_ratio:
+                    constraint_rows.append({'lesson_plan_id': plan_id, 'constraint_type': 'time_preference',
+                                            'value': 'morning'})
+                elif roll < args.morning_ratio + args.afternoon_ratio:
+                    constraint_rows.append({'lesson_plan_id': plan_id, 'constraint_type': 'time_preference',
+                                            'value': 'afternoon'})
+                course_rows.append({
+                    'subject_id': subject_id, 'classroom_id': classroom_id, 'semester_id': semester.id,
+                    'lesson_plan_id': plan_id,
+                    'room_id': rng.choice(room_ids) if room_ids and rng.random() < args.room_ratio else None,
+                })
+
+    for row in course_rows:
+        course_id = db.session.execute(insert(Course).values(**row)).inserted_primary_key[0]
+        teacher_links.append({'course_id': course_id, 'user_id': rng.choice(teacher_ids)})
+    if teacher_links:
+        db.session.execute(insert(course_teachers), teacher_links)
+    if constraint_rows:
+        db.session.execute(insert(LessonPlanConstraint), constraint_rows)
+    db.session.commit()
+
+    capacity = args.grades * args.days * args.periods
+    return semester.id, len(course_rows), capacity
+
+
+def count_hard_violations(semester_id):
+    """Double bookings of a teacher or room in the saved timetable (should always be 0)."""
+    base = db.session.query(WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number).join(
+        TimetableEntry, TimetableEntry.weekly_schedule_slot_id == WeeklyScheduleSlot.id
+    ).join(Course, TimetableEntry.course_id == Course.id).filter(WeeklyScheduleSlot.semester_id == semester_id)
+
+    teacher_clashes = base.join(course_teachers, course_teachers.c.course_id == Course.id).add_columns(
+        course_teachers.c.user_id
+    ).group_by(WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number, course_teachers.c.user_id
+    ).having(func.count(TimetableEntry.id) > 1).count()
+    room_clashes = base.filter(Course.room_id.isnot(None)).add_columns(Course.room_id).group_by(
+        WeeklyScheduleSlot.day_of_week, WeeklyScheduleSlot.period_number, Course.room_id
+    ).having(func.count(TimetableEntry.id) > 1).count()
+    return teacher_clashes + room_clashes
+
+
+def run_once(args, seed):
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        try:
+            semester_id, course_count, capacity = generate_semester(args, seed)
+            target_ids = [cid for cid, in db.session.query(Course.id).filter_by(semester_id=semester_id).order_by(Course.id)]
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            snapshot = build_timetable_snapshot(semester_id, target_ids)
+            if args.strategy == 'multistart':
+                result = solve_multistart(snapshot, starts=args.starts, base_seed=seed,
+                                          time_budget=args.time_budget, node_limit=args.node_limit)
+            else:
+                result = TimetableSolver(snapshot, seed=seed, time_budget=args.time_budget,
+                                         node_limit=args.node_limit).solve()
+            save_timetable_solution(semester_id, result['assignments'])
+            db.session.commit()
+            wall_time = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            metrics = result['metrics']
+            violations = metrics['soft_violations']
+            return {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'strategy': args.strategy,
+                'seed': seed,
+                'grades': args.grades,
+                'classrooms_per_grade': args.classrooms_per_grade,
+                'teachers': args.teachers,
+                'rooms': args.rooms,
+                'subjects_per_classroom': args.subjects_per_classroom,
+                'days': args.days,
+                'periods_per_day': args.periods,
+                'credits': ' '.join(str(c) for c in args.credits),
+                'consecutive_ratio': args.consecutive_ratio,
+                'morning_ratio': args.morning_ratio,
+                'afternoon_ratio': args.afternoon_ratio,
+                'room_ratio': args.room_ratio,
+                'courses': course_count,
+                'capacity': capacity,
+                'required_periods': metrics['required_periods'],
+                'placed_periods': metrics['placed_periods'],
+                'placement_rate': metrics['placement_rate'],
+                'soft_time_preference': violations.get('time_preference', 0),
+                'soft_same_day': violations.get('same_day', 0),
+                'soft_broken_pair': violations.get('broken_pair', 0),
+                'soft_score': metrics['soft_score'],
+                'hard_violations': count_hard_violations(semester_id),
+                'solve_time': metrics['solve_time'],
+                'wall_time': round(wall_time, 3),
+                # multistart: วัดเฉพาะ process หลัก (worker แต่ละตัวใช้หน่วยความจำของตัวเอง)
+                'peak_memory_kb': round(peak / 1024),
+                'nodes': metrics['nodes'],
+                'backtracks': metrics['backtracks'],
+                'search_complete': metrics['search_complete'],
+            }
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            db.session.remove()
+            db.drop_all()
+
+
+def write_csv(path, rows):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_report(rows):
+    print(f"{'seed':>6} {'placed':>11} {'rate':>7} {'soft':>6} {'hard':>5} {'time(s)':>8} {'peak(KB)':>9} {'nodes':>8}")
+    for r in rows:
+        print(f"{r['seed']:>6} {r['placed_periods']:>5}/{r['required_periods']:<5} {r['placement_rate']:>7.2%} "
+              f"{r['soft_score']:>6} {r['hard_violations']:>5} {r['wall_time']:>8.3f} {r['peak_memory_kb']:>9} {r['nodes']:>8}")
+    if len(rows) > 1:
+        n = len(rows)
+        print(f"{'mean':>6} {'':>11} {sum(r['placement_rate'] for r in rows) / n:>7.2%} "
+              f"{sum(r['soft_score'] for r in rows) / n:>6.1f} {sum(r['hard_violations'] for r in rows):>5} "
+              f"{sum(r['wall_time'] for r in rows) / n:>8.3f} {max(r['peak_memory_kb'] for r in rows):>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the timetable auto-scheduler on synthetic semesters.")
+    parser.add_argument('--grades', type=int, default=6)
+    parser.add_argument('--classrooms-per-grade', type=int, default=1)
+    parser.add_argument('--teachers', type=int, default=20)
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--subjects-per-classroom', type=int, default=12)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--periods', type=int, default=8, help="คาบสอนต่อวัน")
+    parser.add_argument('--credits', type=_parse_credits, default=[0.5, 1.0, 1.5], help="หน่วยกิตที่สุ่มใช้ เช่น 0.5,1,1.5")
+    parser.add_argument('--consecutive-ratio', type=_ratio, default=0.3, help="สัดส่วนวิชาที่ต้องเรียนคาบคู่")
+    parser.add_argument('--morning-ratio', type=_ratio, default=0.2)
+    parser.add_argument('--afternoon-ratio', type=_ratio, default=0.1)
+    parser.add_argument('--room-ratio', type=_ratio, default=0.2, help="สัดส่วนวิชาที่ใช้ห้องพิเศษ")
+    parser.add_argument('--strategy', choices=['solver', 'multistart'], default='solver')
+    parser.add_argument('--starts', type=int, default=DEFAULT_STARTS, help="จำนวนรอบค้นหาในโหมด multistart")
+    parser.add_argument('--time-budget', type=float, default=10.0, help="วินาทีต่อการค้นหาหนึ่งรอบ")
+    parser.add_argument('--node-limit', type=int, default=DEFAULT_NODE_LIMIT)
+    parser.add_argument('--seeds', type=_parse_seeds, default=[0], help="seed ของข้อมูลและตัวจัดตาราง เช่น 1,2,3")
+    parser.add_argument('--csv', default=os.path.join(BASE_DIR, 'instance', 'benchmark_scheduler.csv'))
+    parser.add_argument('--no-csv', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.morning_ratio + args.afternoon_ratio > 1:
+        parser.error("--morning-ratio + --afternoon-ratio ต้องไม่เกิน 1")
+    if min(args.grades, args.classrooms_per_grade, args.teachers, args.days, args.periods) < 1:
+        parser.error("จำนวนระดับชั้น/ห้อง/ครู/วัน/คาบ ต้องอย่างน้อย 1")
+
+    rows = []
+    for seed in args.seeds:
+        rows.append(run_once(args, seed))
+    print_report(rows)
+    if not args.no_csv:
+        write_csv(args.csv, rows)
+        print(f"บันทึกผลลงใน {args.csv}")
+    return 1 if any(r['hard_violations'] for r in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# FILE: tools/stress_db_writes.py
+"""
+Concurrency stress test for the SQLite database profile (app/db_profile.py).
+
+Starts several worker processes (like gunicorn workers) against a fresh
+file database, each running for a fixed time: writers upsert single scores
+the way teacher.save_score does, readers load whole gradebook columns. The
+same workload runs once per profile:
+
+    default  SQLAlchemy/pysqlite defaults (rollback journal, synchronous=FULL),
+             plain commit - the behaviour before the profile existed
+    tuned    WAL, synchronous=NORMAL, busy_timeout, cache/mmap, pool sizing,
+             writes through retry_on_busy
+
+and reports committed writes and reads per second, "database is locked"
+failures and write latency percentiles.
+
+ตัวอย่าง:
+    python tools/stress_db_writes.py
+    python tools/stress_db_writes.py --workers 8 --writer-ratio 0.5 --seconds 20
+    python tools/stress_db_writes.py --profiles tuned --keep-db
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_DIR)
+
+from sqlalchemy import insert  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.db_profile import is_busy_error, retry_on_busy  # noqa: E402
+from app.models import Score  # noqa: E402
+from config import Config  # noqa: E402
+
+PROFILES = ('default', 'tuned')
+
+
+def _config(db_path, profile):
+    return type('StressConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+        'SECRET_KEY': 'stress',
+        'WTF_CSRF_ENABLED': False,
+        'DB_PROFILE': profile,
+    })
+
+
+def seed(db_path, profile, students, items):
+    """Creates the schema and one score per (student, item); FKs are not enforced by SQLite, so ids are synthetic."""
+    app = create_app(_config(db_path, profile))
+    with app.app_context():
+        rows = [{'student_id': s, 'graded_item_id': i, 'score': 0.0}
+                for s in range(1, students + 1) for i in range(1, items + 1)]
+        db.session.execute(insert(Score), rows)
+        db.session.commit()
+        db.engine.dispose()
+
+
+def _write_score(student_id, item_id, value):
+    score_obj = Score.query.filter_by(student_id=student_id, graded_item_id=item_id).first()
+    if score_obj:
+        score_obj.score = value
+    else:
+        db.session.add(Score(student_id=student_id, graded_item_id=item_id, score=value))
+    db.session.commit()
+
+
+def worker(db_path, profile, role, seconds, students, items, seed_value, results):
+    app = create_app(_config(db_path, profile))
+    rng = random.Random(seed_value)
+    latencies, ok, locked, failed = [], 0, 0, 0
+    with app.app_context():
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                if role == 'writer':
+                    args = (rng.randint(1, students), rng.randint(1, items), round(rng.uniform(0, 10), 1))
+                    if profile == 'tuned':
+                        retry_on_busy(lambda: _write_score(*args))
+                    else:
+                        _write_score(*args)
+                else:
+                    Score.query.filter_by(graded_item_id=rng.randint(1, items)).all()
+                    db.session.rollback() # ปิด read transaction เหมือนจบ request
+            except OperationalError as e:
+                db.session.rollback()
+                if is_busy_error(e):
+                    locked += 1
+                else:
+                    failed += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            ok += 1
+        db.session.remove()
+        db.engine.dispose()
+    results.put({'role': role, 'ok': ok, 'locked': locked, 'failed': failed, 'latencies': latencies})
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def run_profile(profile, args, work_dir):
+    db_path = os.path.join(work_dir, f'stress_{profile}.db')
+    seed(db_path, profile, args.students, args.items)
+
+    writers = max(1, int(round(args.workers * args.writer_ratio)))
+    roles = ['writer'] * writers + ['reader'] * (args.workers - writers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(db_path, profile, role, args.seconds, args.students,
+                                                              args.items, args.seed + n, results))
+                 for n, role in enumerate(roles)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    summary = {'profile': profile, 'writers': writers, 'readers': len(roles) - writers}
+    for role in ('writer', 'reader'):
+        parts = [r for r in collected if r['role'] == role]
+        latencies = [value for r in parts for value in r['latencies']]
+        summary[role] = {
+            'ok': sum(r['ok'] for r in parts),
+            'per_second': sum(r['ok'] for r in parts) / args.seconds,
+            'locked': sum(r['locked'] for r in parts),
+            'failed': sum(r['failed'] for r in parts),
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p95_ms': _percentile(latencies, 95) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'mean_ms': (statistics.mean(latencies) * 1000) if latencies else 0.0,
+        }
+    return summary
+
+
+def print_report(summaries):
+    header = f"{'profile':<8} {'role':<7} {'ok/s':>9} {'locked':>7} {'failed':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header)
+    print('-' * len(header))
+    for summary in summaries:
+        for role in ('writer', 'reader'):
+            stats = summary[role]
+            print(f"{summary['profile']:<8} {role:<7} {stats['per_second']:>9.1f} {stats['locked']:>7} {stats['failed']:>7} "
+                  f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+    by_profile = {summary['profile']: summary for summary in summaries}
+    if set(PROFILES) <= set(by_profile):
+        before, after = by_profile['default']['writer'], by_profile['tuned']['writer']
+        if before['per_second']:
+            print(f"\nwrites/s: x{after['per_second'] / before['per_second']:.2f}, "
+                  f"locked errors: {before['locked']} -> {after['locked']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='จำนวน process (เหมือน gunicorn worker)')
+    parser.add_argument('--writer-ratio', type=float, default=0.5, help='สัดส่วน process ที่บันทึกคะแนน')
+    parser.add_argument('--seconds', type=float, default=10.0, help='เวลาที่รันต่อ profile')
+    parser.add_argument('--students', type=int, default=400)
+    parser.add_argument('--items', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='เช่น default,tuned')
+    parser.add_argument('--keep-db', action='store_true', help='ไม่ลบไฟล์ฐานข้อมูลทดสอบหลังจบ')
+    args = parser.parse_args()
+
+    profiles = [p.strip() for p in args.profiles.split(',') if p.strip()]
+    unknown = set(profiles) - set(PROFILES)
+    if unknown:
+        parser.error(f"unknown profile(s): {', '.join(sorted(unknown))}")
+
+    work_dir = tempfile.mkdtemp(prefix='edhub-stress-')
+    try:
+        summaries = []
+        for profile in profiles:
+            print(f"running '{profile}' ({args.workers} workers, {args.seconds:g}s) ...", flush=True)
+            summaries.append(run_profile(profile, args, work_dir))
+        print()
+        print_report(summaries)
+    finally:
+        if args.keep_db:
+            print(f"\ndatabases kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()